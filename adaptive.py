@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""Retries of EE computations that exceed the memory or time limits of EE.
+
+EE fails the reductions of dense collections or large regions with errors like
+"User memory limit exceeded." or "Computation timed out.". Such a computation
+often succeeds with smaller tiles (a higher tileScale or a smaller shardSize),
+with the collection split into time ranges or with the region split into parts.
+The errors are classified by their message and the computation is repeated with
+the next applicable adaptation of its parameters until it succeeds or all
+adaptations are used, so the user does not have to find smaller options.
+
+The parameters are a json encodable dict, so that a retry can be continued by
+another request (like the polling of an export task). The descriptions of the
+applied adaptations are kept under "adaptations" to be reported to the client.
+"""
+
+import logging
+
+import exportsize
+
+
+# The classes of the EE errors that can be avoided by adapting the computation and
+# the (lower case) parts of the error messages they are recognized by.
+ERROR_CLASSES = (
+    ("memory", ("memory limit exceeded", "out of memory", "too many concurrent aggregations")),
+    ("timeout", ("timed out", "deadline exceeded")),
+)
+
+
+def Classify(error):
+    """Returns the class of an EE error [memory,timeout] or None if an adaptation would not help.
+
+    Args:
+        error: An exception or an error message.
+    """
+    message = str(error).lower()
+    for kind, patterns in ERROR_CLASSES:
+        if any(pattern in message for pattern in patterns):
+            return kind
+    return None
+
+
+def Next(params, adaptations, error):
+    """Returns the parameters for the retry of a computation that failed with an error.
+
+    Args:
+        params: The json encodable parameters of the failed computation.
+        adaptations: A list of the steps that are tried in order, each step is a function that returns
+            (<adapted params>, <description>) or None if it does not apply to the params (like a
+            time range of one year that can not be split). A step is used at most once.
+        error: The exception or the error message of the failure.
+
+    Returns:
+        The adapted params with the description appended to "adaptations" or None if the error
+        is not caused by a limit of EE or no step is left.
+    """
+    kind = Classify(error)
+    if kind is None:
+        return None
+    for index in range(params.get("step", 0), len(adaptations)):
+        adapted = adaptations[index](dict(params))
+        if adapted is not None:
+            adapted, description = adapted
+            adapted["step"] = index + 1
+            adapted["adaptations"] = params.get("adaptations", []) + [description]
+            logging.warning("EE %s limit exceeded (%s), retrying with %s.", kind, error, description)
+            return adapted
+    logging.warning("EE %s limit exceeded (%s), no adaptation left.", kind, error)
+    return None
+
+
+def Run(compute, params, adaptations, report=None):
+    """Runs a computation and retries it with adapted parameters after EE memory or time limit errors.
+
+    Args:
+        compute: A function that runs the computation for the params and returns the result.
+        params: The initial parameters, see Next().
+        adaptations: The steps of the adaptations, see Next().
+        report: An optional function that is called with the descriptions of the applied adaptations before a retry.
+
+    Returns:
+        A tuple (<result>, <params of the successful attempt>), the params of one computation
+        can be passed on to the next one, so that they share the adaptations.
+
+    Raises:
+        The exception of the last attempt if it is not caused by a limit of EE or no adaptation is left.
+    """
+    while True:
+        try:
+            return compute(params), params
+        except Exception as e:
+            adapted = Next(params, adaptations, e)
+            if adapted is None:
+                raise
+        params = adapted
+        if report is not None:
+            report(params["adaptations"])
+
+
+def Multiply(key, factor, limit):
+    """Returns a step that multiplies a numeric parameter (like tileScale) by a factor up to (or down to) a limit."""
+    def adapt(params):
+        value = params.get(key)
+        if value is None:
+            return None
+        value = min(value * factor, limit) if factor > 1 else max(value * factor, limit)
+        if value == params[key]:
+            return None
+        params[key] = type(limit)(value)
+        return params, "%s %s" % (key, params[key])
+    return adapt
+
+
+def SplitYears(key):
+    """Returns a step that splits the time ranges [<start year>,<end year>] of a parameter in halves."""
+    def adapt(params):
+        ranges = params.get(key)
+        if ranges is None or all(start == end for start, end in ranges):
+            return None
+        split = []
+        for start, end in ranges:
+            middle = (start + end) // 2
+            split.extend([[start, middle], [middle + 1, end]] if start < end else [[start, end]])
+        params[key] = split
+        return params, "%s time ranges" % len(split)
+    return adapt
+
+
+def SplitBounds(key, count):
+    """Returns a step that splits each bounding box [<west>,<south>,<east>,<north>] of a parameter into count parts.
+
+    A part None stands for the whole region, its bounding box is the parameter "bounds".
+    """
+    def adapt(params):
+        parts = params.get(key)
+        if parts is None:
+            return None
+        params[key] = [tile for part in parts for tile in exportsize.Tiles(params["bounds"] if part is None else part, count)]
+        return params, "%s parts" % len(params[key])
+    return adapt
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+"""Bulk exports of many features or points with one set of options.
+
+A bulk export consists of parts, each part is exported by its own EE task:
+    image: the regression image clipped to the polygons of a feature or a cluster of
+           nearby features (see ReadFeatures() and ClusterFeatures())
+    series: a table with the NDVI time series of a batch of nearby points
+            (see ReadPoints() and BatchPoints())
+    coefficients: a table with the regression coefficients of a batch of points
+The EE objects the parts are computed from (the regression image or the collection)
+are created once for all parts and saved serialized as "graphs". The parts are queued
+in the global export queue as jobs with the key "bulk" and share its slots with the
+other exports.
+
+The state of a bulk export is saved as an entity in the Datastore and changed in transactions,
+the geometries of the parts and the graphs are saved as child entities as they do not change.
+"""
+
+import datetime
+import gzip
+import io
+import json
+import time
+import zlib
+
+from google.appengine.ext import ndb
+
+
+# the states of a part, only waiting and running parts are changed
+WAITING = "waiting"
+RUNNING = "running"
+COMPLETED = "completed"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+FINISHED = (COMPLETED, CANCELLED, FAILED)
+
+# The maximum size (bytes) of the compressed state, graphs or geometry of a part, below the 1 MB limit of an entity.
+MAX_ENTITY_BYTES = 900 * 1024
+
+
+class BulkExport(ndb.Model):
+
+    """The state of a bulk export (see BulkExports.Create()), the key id is the id of the bulk export."""
+
+    state = ndb.JsonProperty(compressed=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class BulkData(ndb.Model):
+
+    """The graphs (key id "graphs") or the geometry of a part (key id "geometry:<index>") of a bulk export, its parent."""
+
+    value = ndb.JsonProperty(compressed=True)
+
+
+class BulkExports(object):
+
+    """Creates, reads and changes the state of bulk exports."""
+
+    def __init__(self, lifetime):
+        """Creates the helper.
+
+        Args:
+            lifetime: Seconds the state of a bulk export is kept (the manifest is available as long).
+        """
+        self.lifetime = lifetime
+
+
+    def Create(self, bulk_id, kind, client_id, filename, parts, graphs, features=None, encoding=None):
+        """Saves a new bulk export with all parts waiting.
+
+        Args:
+            bulk_id: The id of the bulk export.
+            kind: The type of the job in the status messages [bulk,points].
+            client_id: The id of the client that started the export.
+            filename: The file name prefix of the export.
+            parts: A list of dicts with the keys "kind" [image,series,coefficients], "name" (the Drive file
+                   name prefix), "bounds", "size" (the number of features or points), "columns" (the columns
+                   of a table or None) and "geometry" (the polygons of an image or the points of a table).
+            graphs: A dict {<name>:<serialized EE object>} of the objects the parts are computed from.
+            features: A list of {"name":<feature name>,"part":<part index>} or None if the manifest
+                      has no entry per feature.
+            encoding: The scaled integer encoding of the images (a JSON encodable dict) or None.
+
+        Returns:
+            The state of the bulk export, a dict with the keys "id", "kind", "client_id", "filename", "created",
+            "cancelled", "features", "encoding" and "parts" (the parts without "geometry" and with the keys "id"
+            (the export queue job id), "state", "task", "progress", "urls", "folder" and "error").
+
+        Raises:
+            ValueError: If the state, a geometry or the graphs are too large for an entity.
+        """
+        bulk = {"id": bulk_id, "kind": kind, "client_id": client_id, "filename": filename, "created": time.time(),
+                "cancelled": False, "features": features, "encoding": encoding, "parts": []}
+        key = ndb.Key(BulkExport, bulk_id)
+        entities = [BulkData(parent=key, id="graphs", value=_CheckSize(graphs, "The graphs"))]
+        for index, part in enumerate(parts):
+            entities.append(BulkData(parent=key, id="geometry:%s" % index, value=_CheckSize(part["geometry"], "The geometry of part %s" % part["name"])))
+            bulk["parts"].append({"id": "%s-%s" % (bulk_id, index + 1), "kind": part["kind"], "name": part["name"],
+                                  "bounds": part["bounds"], "size": part["size"], "columns": part["columns"],
+                                  "state": WAITING, "task": None, "progress": None, "urls": None, "folder": None, "error": None})
+
+        # the state is saved last, a bulk export without state is never started
+        ndb.put_multi(entities)
+        BulkExport(id=bulk_id, state=_CheckSize(bulk, "The state of the bulk export")).put()
+        return bulk
+
+
+    def Get(self, bulk_id):
+        """Returns the state of a bulk export or None if it is unknown or older than the lifetime."""
+        entity = ndb.Key(BulkExport, bulk_id).get()
+        if entity is None or time.time() - entity.state["created"] > self.lifetime:
+            return None
+        return entity.state
+
+
+    def GetGraphs(self, bulk_id):
+        """Returns the dict of the serialized EE objects of a bulk export.
+
+        Raises:
+            LookupError: If the graphs are not saved (like after the deletion of an expired bulk export).
+        """
+        return self._GetData(bulk_id, "graphs")
+
+
+    def GetGeometry(self, bulk_id, index):
+        """Returns the polygons or the points of a part of a bulk export.
+
+        Raises:
+            LookupError: If the geometry is not saved.
+        """
+        return self._GetData(bulk_id, "geometry:%s" % index)
+
+
+    def Update(self, bulk_id, change):
+        """Applies the change function to the state in a transaction.
+
+        Returns:
+            The changed state or None if the bulk export is unknown.
+        """
+        def update():
+            entity = ndb.Key(BulkExport, bulk_id).get()
+            if entity is None:
+                return None
+            change(entity.state)
+            entity.put()
+            return entity.state
+        return ndb.transaction(update, retries=10)
+
+
+    def UpdateParts(self, bulk_id, changes):
+        """Changes parts of a bulk export.
+
+        Args:
+            changes: A dict {<part index>: <dict of changed values>}.
+
+        Returns:
+            The changed state or None if the bulk export is unknown.
+        """
+        def update(bulk):
+            for index, values in changes.items():
+                bulk["parts"][index].update(values)
+        return self.Update(bulk_id, update)
+
+
+    def DeleteExpired(self):
+        """Deletes the bulk exports (with their graphs and geometries) that are older than the lifetime.
+
+        Returns:
+            The number of deleted bulk exports.
+        """
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.lifetime)
+        keys = BulkExport.query(BulkExport.created < cutoff).fetch(keys_only=True)
+        for key in keys:
+            ndb.delete_multi(BulkData.query(ancestor=key).fetch(keys_only=True) + [key])
+        return len(keys)
+
+
+    def _GetData(self, bulk_id, name):
+        entity = ndb.Key(BulkData, name, parent=ndb.Key(BulkExport, bulk_id)).get()
+        if entity is None:
+            raise LookupError("The %s of the bulk export %s is not saved." % (name, bulk_id))
+        return entity.value
+
+
+def _CheckSize(value, description):
+    """Returns the value if it fits into an entity (compressed like a JsonProperty), else raises a ValueError."""
+    size = len(zlib.compress(json.dumps(value).encode("utf-8")))
+    if size > MAX_ENTITY_BYTES:
+        raise ValueError("%s is too large (%s bytes compressed, at most %s bytes)." % (description, size, MAX_ENTITY_BYTES))
+    return value
+
+
+def Counts(bulk):
+    """Returns the number of parts per state and the total number of parts as dict."""
+    counts = dict((state, 0) for state in (WAITING, RUNNING) + FINISHED)
+    for part in bulk["parts"]:
+        counts[part["state"]] += 1
+    counts["total"] = len(bulk["parts"])
+    return counts
+
+
+def State(bulk):
+    """Returns the state of a bulk export [queued,running,cancelling,completed,cancelled,failed].
+
+    A bulk export is completed if all parts are finished and at least one part is completed.
+    """
+    counts = Counts(bulk)
+    if counts[WAITING] or counts[RUNNING]:
+        if bulk["cancelled"]:
+            return "cancelling"
+        return "running" if counts[RUNNING] or counts[COMPLETED] or counts[FAILED] else "queued"
+    if counts[COMPLETED]:
+        return "completed"
+    return "cancelled" if bulk["cancelled"] else "failed"
+
+
+def Progress(bulk):
+    """Returns the progress of a bulk export [0-1], the finished parts count as done."""
+    if not bulk["parts"]:
+        return 1.0
+    done = 0.0
+    for part in bulk["parts"]:
+        if part["state"] in FINISHED:
+            done += 1
+        elif part["state"] == RUNNING:
+            done += part["progress"] or 0
+    return round(done / len(bulk["parts"]), 2)
+
+
+def Manifest(bulk):
+    """Returns the manifest of a bulk export with the state and the download links of each part
+        and (for exports of features) of each feature and the encoding of the images."""
+    parts = []
+    for part in bulk["parts"]:
+        parts.append({"name": part["name"], "kind": part["kind"], "bounds": part["bounds"], "size": part["size"],
+                      "state": part["state"], "progress": part["progress"], "urls": part["urls"] or [],
+                      "folder": part["folder"], "error": part["error"]})
+    manifest = {"id": bulk["id"], "filename": bulk["filename"], "state": State(bulk), "progress": Progress(bulk),
+                "counts": Counts(bulk), "parts": parts}
+    if bulk.get("encoding") is not None:
+        manifest["encoding"] = bulk["encoding"]
+
+    if bulk["features"] is not None:
+        manifest["features"] = []
+        for part in parts:
+            part["features"] = []
+        for feature in bulk["features"]:
+            part = parts[feature["part"]]
+            part["features"].append(feature["name"])
+            manifest["features"].append({"name": feature["name"], "part": part["name"], "state": part["state"], "progress": part["progress"],
+                                         "urls": part["urls"], "folder": part["folder"], "error": part["error"]})
+    return manifest
+
+
+def ReadFeatures(collection):
+    """Reads the polygons of the features of a GeoJSON FeatureCollection.
+
+    The name of a feature is its "name" or "id" property, its id or else its number (starting with 1).
+
+    Returns:
+        A list of (<name>, <polygons>) where polygons is a list of polygons as lists of rings.
+
+    Raises:
+        ValueError: If the collection is invalid or a feature is not a Polygon or MultiPolygon.
+    """
+    if not isinstance(collection, dict) or collection.get("type") != "FeatureCollection":
+        raise ValueError("The features are not a GeoJSON FeatureCollection.")
+
+    features = []
+    for number, feature in enumerate(collection.get("features") or [], 1):
+        geometry = feature.get("geometry") or {}
+        properties = feature.get("properties") or {}
+        name = properties.get("name", properties.get("id", feature.get("id", number)))
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            raise ValueError("Feature %s is not a Polygon or MultiPolygon." % name)
+        if not polygons or not all(polygon and polygon[0] for polygon in polygons):
+            raise ValueError("Feature %s has no coordinates." % name)
+        features.append((str(name), polygons))
+    if not features:
+        raise ValueError("The FeatureCollection has no features.")
+    return features
+
+
+def Bounds(polygons):
+    """Returns the bounding box [<west>,<south>,<east>,<north>] of the outer rings of polygons."""
+    lons = [c[0] for polygon in polygons for c in polygon[0]]
+    lats = [c[1] for polygon in polygons for c in polygon[0]]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+def ClusterFeatures(features, distance=None):
+    """Groups nearby features so that they are exported together.
+
+    The features are grouped by the cell of a grid with the cell size distance (degrees)
+    which contains the center of their bounding box.
+
+    Args:
+        features: A list of (<name>, <polygons>) created by ReadFeatures().
+        distance: The cell size in degrees or None to export each feature on its own.
+
+    Returns:
+        A list of lists of feature indices in the order of the first feature of each group.
+    """
+    if not distance:
+        return [[index] for index in range(len(features))]
+
+    clusters = []
+    cells = {}
+    for index, (_, polygons) in enumerate(features):
+        west, south, east, north = Bounds(polygons)
+        cell = (int((west + east) / 2 // distance), int((south + north) / 2 // distance))
+        if cell not in cells:
+            cells[cell] = []
+            clusters.append(cells[cell])
+        cells[cell].append(index)
+    return clusters
+
+
+def ReadPoints(text):
+    """Reads points from a GeoJSON FeatureCollection of Point features or from a CSV table.
+
+    The CSV table needs a header with the columns lon (or lng, longitude, x) and lat (or latitude, y),
+    the point id is read from the column id (or name). The id of a GeoJSON feature is its "id" or
+    "name" property or its id. Points without an id get their number (starting with 1).
+
+    Returns:
+        A list of [<id>, <longitude>, <latitude>].
+
+    Raises:
+        ValueError: If the points can not be read or a coordinate is out of range.
+    """
+    text = text.strip()
+    points = []
+    if text.startswith("{"):
+        collection = json.loads(text)
+        if collection.get("type") != "FeatureCollection":
+            raise ValueError("The points are not a GeoJSON FeatureCollection.")
+        for number, feature in enumerate(collection.get("features") or [], 1):
+            geometry = feature.get("geometry") or {}
+            properties = feature.get("properties") or {}
+            point_id = properties.get("id", properties.get("name", feature.get("id", number)))
+            if geometry.get("type") != "Point":
+                raise ValueError("Feature %s is not a Point." % point_id)
+            points.append([str(point_id), float(geometry["coordinates"][0]), float(geometry["coordinates"][1])])
+    else:
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if not lines:
+            raise ValueError("The CSV table has no header.")
+        header = [column.strip().strip('"').lower() for column in lines[0].split(",")]
+
+        def column(names):
+            for name in names:
+                if name in header:
+                    return header.index(name)
+            return None
+        lon = column(("lon", "lng", "longitude", "x"))
+        lat = column(("lat", "latitude", "y"))
+        point_id = column(("id", "name"))
+        if lon is None or lat is None:
+            raise ValueError("The CSV table needs the columns lon and lat.")
+
+        for number, line in enumerate(lines[1:], 1):
+            values = [value.strip().strip('"') for value in line.split(",")]
+            try:
+                points.append([values[point_id] if point_id is not None else str(number), float(values[lon]), float(values[lat])])
+            except (IndexError, ValueError):
+                raise ValueError("Invalid point in line %s: %s" % (number + 1, line))
+
+    for point_id, lon, lat in points:
+        if not -180 <= lon <= 180 or not -90 <= lat <= 90:
+            raise ValueError("The coordinates of point %s are out of range." % point_id)
+    if not points:
+        raise ValueError("No points found.")
+    return points
+
+
+def PointBounds(points):
+    """Returns the bounding box [<west>,<south>,<east>,<north>] of points."""
+    lons = [p[1] for p in points]
+    lats = [p[2] for p in points]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+def BatchPoints(points, size, cell):
+    """Groups nearby points into batches, so that each batch only needs the scenes of a small area.
+
+    The points are grouped by the cell of a grid with the cell size cell (degrees) and the points
+    of a cell are split into batches of at most size points, ordered by longitude.
+
+    Args:
+        points: A list of [<id>, <longitude>, <latitude>] created by ReadPoints().
+        size: The maximum number of points of a batch.
+        cell: The size of the grid cells in degrees.
+
+    Returns:
+        A list of lists of point indices.
+    """
+    cells = {}
+    for index, (_, lon, lat) in enumerate(points):
+        cells.setdefault((int(lat // cell), int(lon // cell)), []).append(index)
+
+    batches = []
+    for key in sorted(cells):
+        indices = sorted(cells[key], key=lambda index: (points[index][1], points[index][2]))
+        for start in range(0, len(indices), size):
+            batches.append(indices[start:start + size])
+    return batches
+
+
+def CompressedCsv(columns, rows):
+    """Returns a gzip compressed CSV table (bytes) with a header row.
+
+    Args:
+        columns: The names of the columns.
+        rows: A list of lists of values, None is written as empty value.
+    """
+    def value(v):
+        v = "" if v is None else (repr(v) if isinstance(v, float) else u"%s" % v)
+        if any(c in v for c in ",\"\n"):
+            v = '"%s"' % v.replace('"', '""')
+        return v
+
+    data = u"".join(u",".join(value(v) for v in row) + u"\n" for row in [columns] + list(rows))
+    output = io.BytesIO()
+    compressed = gzip.GzipFile(fileobj=output, mode="wb")
+    compressed.write(data.encode("utf-8"))
+    compressed.close()
+    return output.getvalue()
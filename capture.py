@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Sampled capture of the handled requests for benchmarks and replays.
+
+Each captured request is written as one JSON line with the route, the request
+parameters, the canonical options, the timings, the number and duration of
+the outbound calls (EE, Drive, Firebase, Memcache, Task Queue, URL Fetch) and
+the serialized size and node count of the EE graphs sent by the calls (which
+the app measures for all requests and passes with the record).
+The lines are written to a rotating file or, if no file is configured (the App
+Engine file system is read-only), to the application log with the prefix
+"capture: ". tools/replay.py reads both formats.
+"""
+
+import json
+import logging
+import logging.handlers
+import random
+import threading
+import time
+import zlib
+
+
+class RequestCapture(object):
+
+    """Records the outbound calls of a request and writes a record for the sampled requests.
+
+    The sampling is done per client (by the hash of the client id), so that the
+    captured sessions are complete.
+    """
+
+    def __init__(self, rate, filename=None, max_bytes=10 * 1024 * 1024, backups=5):
+        """Creates the capture.
+
+        Args:
+            rate: The fraction [0-1] of the clients whose requests are captured. 0 disables the capture.
+            filename: The path of the JSONL file or None to write the records to the application log.
+            max_bytes: The size of the file after which it is rotated.
+            backups: The number of rotated files that are kept.
+        """
+        self.rate = rate
+        self.local = threading.local()
+
+        self.logger = logging.getLogger("capture")
+        if filename is not None:
+            handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            self.prefix = ""
+        else:
+            self.prefix = "capture: "
+
+
+    def Enabled(self):
+        return self.rate > 0
+
+
+    def Sampled(self, client_id):
+        """Checks if the requests of the client are captured. Requests without client id are sampled randomly."""
+        if not self.Enabled():
+            return False
+        if client_id is None:
+            return random.random() < self.rate
+        return (zlib.crc32(client_id.encode("utf-8")) & 0xffffffff) % 10000 < self.rate * 10000
+
+
+    def Start(self):
+        """Starts recording the outbound calls of the current request (thread)."""
+        self.local.calls = {}
+        self.local.start = time.time()
+
+
+    def Finish(self, record):
+        """Stops the recording and writes the record with the timings and outbound calls.
+
+        Args:
+            record: A json encodable dict with information about the request.
+        """
+        start = getattr(self.local, "start", None)
+        if start is None:
+            return
+        record["time"] = start
+        record["duration"] = time.time() - start
+        record["calls"] = self.local.calls
+        self.local.start = None
+        self.logger.info(self.prefix + json.dumps(record, sort_keys=True))
+
+
+    def Cancel(self):
+        """Stops the recording without writing a record."""
+        self.local.start = None
+
+
+    def Instrument(self, obj, names, service):
+        """Replaces methods or functions of an object or module with versions that are recorded as calls of the service.
+
+        Args:
+            obj: A module or object.
+            names: The names of the methods or functions. Names that do not exist are skipped.
+            service: The name of the service in the records.
+        """
+        for name in names:
+            function = getattr(obj, name, None)
+            if function is not None:
+                setattr(obj, name, self._Track(function, service))
+
+
+    def _Track(self, function, service):
+        local = self.local
+
+        def tracked(*args, **kwargs):
+            if getattr(local, "start", None) is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                call = local.calls.setdefault(service, [0, 0.0])
+                call[0] += 1
+                call[1] += time.time() - start
+        tracked.__name__ = function.__name__
+        tracked.__doc__ = function.__doc__
+        return tracked
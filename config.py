@@ -8,3 +8,27 @@ SERVICE_ACC_JSON_KEYFILE = "service_acc.json"
 
 # The name of the firebase config template (located in the templates folder)
 FIREBASE_CONFIG = "_firebase_config.html"
+
+# The fraction [0-1] of the clients whose requests are captured for benchmarks and replays (0 disables the capture)
+CAPTURE_RATE = 0
+
+# The path of the rotating JSONL capture file or None to write the captured requests to the application log
+CAPTURE_FILE = None
+
+# Use the local numpy emulator of Earth Engine instead of EE (for offline benchmarks, see eemulator/__init__.py)
+EE_EMULATOR = False
+
+# The directory with the raster stacks of the emulator or None to use synthetic Landsat scenes
+EE_EMULATOR_DATA = None
+
+# Serve the map tiles through the caching tile proxy /tiles instead of directly from EE (see tiles.py)
+TILE_PROXY = False
+
+# The directory of the bounded disk cache of the tile proxy or None to use the Memcache API (the App Engine file system is read-only)
+TILE_CACHE_DIR = None
+
+# The EE asset folder of the stored yearly regression statistics (see regressionstats.py) or None to fit each regression on all images
+REGRESSION_STATS_FOLDER = None
+
+# Extract the point series of a chart when the marker is placed, before the chart is requested (see ChartPrefetchHandler)
+CHART_PREFETCH = False
@@ -2,6 +2,7 @@
 """Helpers for interfacing with Google Drive."""
 
 import googleapiclient.discovery
+import googleapiclient.http
 import httplib2
 
 
@@ -62,6 +63,22 @@ class DriveHelper(object):
         return folder["id"]
 
 
+    def UploadFile(self, title, data, mime_type):
+        """Uploads a file.
+
+        Args:
+            title: The file name.
+            data: The content of the file (bytes).
+            mime_type: The MIME type of the content.
+
+        Returns:
+            The Google Drive file ID.
+        """
+        media = googleapiclient.http.MediaInMemoryUpload(data, mimetype=mime_type)
+        f = self.service.files().insert(body={"title":title, "mimeType":mime_type}, media_body=media).execute()
+        return f["id"]
+
+
     def RenameFile(self, file_id, new_title):
         """Renames the file with the given file ID.
 
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""A local emulator of the part of the Earth Engine Python API the app uses.
+
+The objects are evaluated lazily like in EE, but locally with numpy on synthetic
+Landsat scenes or on-disk raster stacks (see sources.py). The pixels are computed
+on longitude/latitude grids whose size is limited per map, region and export (see
+settings.py), so the results are realistic in volume but not in resolution.
+
+Use it instead of the ee module with:
+    import eemulator as ee
+    ee.Initialize()
+    ee.Configure(data="/path/to/stacks")
+"""
+
+from eemulator import batch, data, deserializer, serializer, settings
+from eemulator.collection import Feature, FeatureCollection, ImageCollection
+from eemulator.computed import ComputedObject, Date, Dictionary, EEException, List, Number
+from eemulator.filter import Filter
+from eemulator.geometry import Geometry
+from eemulator.image import CACHE, Algorithms, Image
+from eemulator.reducer import Reducer
+
+
+def Initialize(credentials=None, opt_url=None):
+    """The emulator needs no credentials."""
+
+
+def Configure(data=None, output=None, map_pixels=None, region_pixels=None, export_pixels=None, cache_bytes=None, seed=None, exported=None):
+    """Changes the settings of the emulator (see settings.py), None keeps a setting."""
+    values = {"DATA": data, "OUTPUT": output, "MAP_PIXELS": map_pixels, "REGION_PIXELS": region_pixels,
+              "EXPORT_PIXELS": export_pixels, "CACHE_BYTES": cache_bytes, "SEED": seed, "EXPORTED": exported}
+    for name, value in values.items():
+        if value is not None:
+            setattr(settings, name, value)
+    CACHE.Clear()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Export tasks (ee.batch)."""
+
+from eemulator import data
+
+
+class Task(object):
+
+    """An export task, started with start() and then computed in a background thread."""
+
+    State = data._TaskState
+
+    def __init__(self, task_id, config):
+        self.id = task_id
+        self.config = config
+
+
+    def start(self):
+        data.startProcessing(self.id, self.config)
+
+
+    def status(self):
+        return data.getTaskStatus(self.id)[0]
+
+
+    def active(self):
+        return self.status()["state"] in (Task.State.READY, Task.State.RUNNING)
+
+
+    def cancel(self):
+        data.cancelTask(self.id)
+
+
+class _ImageExport(object):
+
+    """Export.image, called like a function (the legacy API) or with toAsset()."""
+
+    def __call__(self, image, description="myExportImageTask", config=None):
+        """Creates a task that writes the image to <driveFileNamePrefix>.npz in settings.OUTPUT.
+
+        The image is computed at config["scale"] (limited to settings.EXPORT_PIXELS per side).
+        """
+        config = dict(config or {})
+        config.update({"image": image, "description": description})
+        return Task(data.newTaskId()[0], config)
+
+
+    def toAsset(self, image, description="myExportImageTask", assetId=None, region=None, scale=None, maxPixels=None, **kwargs):
+        """Creates a task that writes the image in double precision to the asset, ee.Image(assetId) loads it.
+
+        The region is ignored, the image is computed within its bounds (clip it to the region).
+        """
+        return Task(data.newTaskId()[0], {"image": image, "description": description, "assetId": assetId, "scale": scale})
+
+
+class Export(object):
+
+    image = _ImageExport()
+
+
+    @staticmethod
+    def table(collection, description="myExportTableTask", config=None):
+        """Creates a task that writes the features to <driveFileNamePrefix>.csv in settings.OUTPUT.
+
+        The columns are config["selectors"] (a comma separated string or a list) or all properties.
+        """
+        config = dict(config or {})
+        config.update({"collection": collection, "description": description})
+        return Task(data.newTaskId()[0], config)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""Image and feature collections (ee.ImageCollection, ee.Feature, ee.FeatureCollection).
+
+A collection is evaluated to a list of Rasters (images) or FeatureValues (features).
+The filters on date and location of a collection that is loaded by its id are passed
+to sources.py, so that only the matching images are loaded.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+from eemulator import sources
+from eemulator.computed import ComputedObject, Date, Dictionary, EEException, Evaluate, List, Number
+from eemulator.filter import Filter
+from eemulator.geometry import Geometry, IntersectBounds, UnionBounds
+from eemulator.image import Image, Raster, _Image
+from eemulator.reducer import Reducer
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+
+class ImageCollection(ComputedObject):
+
+    """An image collection (ee.ImageCollection)."""
+
+    def __init__(self, args):
+        """Creates a collection from an id, a list of images or another collection."""
+        self._query = None
+        if isinstance(args, _STRING_TYPES):
+            self._query = sources.Query(str(args))
+            self._tests = ()
+            ComputedObject.__init__(self, lambda: [r for r in sources.Load(self._query) if all(test(r) for test in self._tests)])
+        elif isinstance(args, (list, tuple)):
+            images = [image if isinstance(image, Image) else Image(image) for image in args]
+            ComputedObject.__init__(self, lambda: Evaluate(images))
+        elif isinstance(args, ComputedObject):
+            ComputedObject.__init__(self, lambda: Evaluate(args))
+        else:
+            raise EEException("Invalid argument for ee.ImageCollection(): %r" % (args,))
+
+
+    def _Filtered(self, test, **narrow):
+        """Returns the images that pass the test.
+
+        The filters of a collection that is loaded by its id are combined with the
+        constraints, so that only the images that can pass them are loaded.
+        """
+        if self._query is None:
+            return _Collection(lambda: [raster for raster in Evaluate(self) if test(raster)])
+        collection = ImageCollection(self._query.id)
+        collection._query = self._query.Narrow(**narrow)
+        collection._tests = self._tests + (test,)
+        return collection
+
+
+    def filter(self, filter):
+        narrow = {"pathrows": set(filter.pathrows)} if filter.pathrows is not None else {}
+        return self._Filtered(lambda raster: filter.test(raster.properties), **narrow)
+
+
+    def filterDate(self, start, end=None):
+        date = Filter.date(start, end)
+        narrow = {"start": Evaluate(Date(start))}
+        if end is not None:
+            narrow["end"] = Evaluate(Date(end))
+        return self._Filtered(lambda raster: date.test(raster.properties), **narrow)
+
+
+    def filterBounds(self, geometry):
+        return self._Filtered(lambda raster: raster.bounds is None or geometry.Intersects(raster.bounds, raster.footprint), geometry=geometry)
+
+
+    def map(self, algorithm):
+        """Applies the algorithm to each image, it may return images or feature collections."""
+        def compute():
+            return [Evaluate(algorithm(_Image(lambda raster=raster: raster))) for raster in Evaluate(self)]
+        return _Collection(compute)
+
+
+    def select(self, selectors, names=None):
+        args = (selectors,) if names is None else (selectors, names)
+        return self.map(lambda image: image.select(*args))
+
+
+    def merge(self, collection2):
+        return _Collection(lambda: Evaluate(self) + Evaluate(collection2))
+
+
+    def sort(self, property, ascending=True):
+        def key(raster):
+            value = raster.properties.get(property)
+            return (value is None, value)
+        return _Collection(lambda: sorted(Evaluate(self), key=key, reverse=not ascending))
+
+
+    def distinct(self, properties):
+        """Keeps the first image of each value of the property."""
+        def compute():
+            seen = set()
+            result = []
+            for raster in Evaluate(self):
+                value = raster.properties.get(properties)
+                if value not in seen:
+                    seen.add(value)
+                    result.append(raster)
+            return result
+        return _Collection(compute)
+
+
+    def limit(self, max, property=None, ascending=True):
+        collection = self.sort(property, ascending) if property is not None else self
+        return _Collection(lambda: Evaluate(collection)[:max])
+
+
+    def first(self):
+        def compute():
+            rasters = Evaluate(self)
+            if not rasters:
+                raise EEException("Empty collection.")
+            return rasters[0]
+        return _Image(compute)
+
+
+    def size(self):
+        return Number(ComputedObject(lambda: len(Evaluate(self))))
+
+
+    def aggregate_array(self, property):
+        return List(ComputedObject(lambda: [r.properties[property] for r in Evaluate(self) if r.properties.get(property) is not None]))
+
+
+    def sum(self):
+        """Sums the images pixel by pixel, the bands keep their names."""
+        reduced = self.reduce(Reducer.sum())
+
+        def compute():
+            rasters = Evaluate(self)
+            return reduced._Raster().Copy(rasters[0].names if rasters else [])
+        return _Image(compute)
+
+
+    def reduce(self, reducer):
+        """Reduces the images pixel by pixel, the images are accumulated one after the other."""
+        def compute():
+            rasters = Evaluate(self)
+            if not rasters:
+                return Raster([], None)
+            names = reducer.OutputNames(rasters[0].names)
+            bounds = _Bounds(rasters)
+            scale = rasters[0].scale
+            results = collections.OrderedDict()
+            lock = threading.Lock()
+
+            def reduced(grid):
+                with lock:
+                    if grid.key in results:
+                        results[grid.key] = results.pop(grid.key)
+                    else:
+                        accumulator = reducer.Accumulator((grid.height, grid.width))
+                        for raster in _Overlapping(rasters, grid):
+                            accumulator.Add([raster.Band(i, grid) for i in range(len(raster.names))])
+                        results[grid.key] = accumulator.Result(len(names))
+                        # only keep the results of a few grids (a map, a point and a region)
+                        while len(results) > 4:
+                            results.popitem(last=False)
+                    return results[grid.key]
+            return Raster(names, lambda grid, index: reduced(grid)[index], bounds=bounds, scale=scale)
+        return _Image(compute)
+
+
+    def median(self):
+        """Returns the per pixel median of each band, the bands keep their names.
+
+        Each band is computed on its own (and cached), only the pixels of the band are kept in memory.
+        """
+        def compute():
+            rasters = Evaluate(self)
+            if not rasters:
+                return Raster([], None)
+
+            def pixels(grid, index):
+                bands = [raster.Band(index, grid) for raster in _Overlapping(rasters, grid)]
+                if not bands:
+                    return np.ma.masked_all((grid.height, grid.width))
+                return np.ma.median(np.ma.stack(bands), axis=0)
+            return Raster(rasters[0].names, pixels, bounds=_Bounds(rasters), scale=rasters[0].scale, cache=True)
+        return _Image(compute)
+
+
+    def qualityMosaic(self, qualityBand):
+        """Returns the bands of the image with the highest value of the quality band per pixel."""
+        def compute():
+            rasters = Evaluate(self)
+            if not rasters:
+                return Raster([], None)
+            quality = rasters[0].names.index(qualityBand)
+
+            def pixels(grid, index):
+                best = np.full((grid.height, grid.width), -np.inf)
+                result = np.ma.masked_all((grid.height, grid.width))
+                for raster in _Overlapping(rasters, grid):
+                    values = raster.Band(quality, grid)
+                    better = ~np.ma.getmaskarray(values) & (np.ma.getdata(values) > best)
+                    if better.any():
+                        best = np.where(better, np.ma.getdata(values), best)
+                        result[better] = raster.Band(index, grid)[better]
+                return result
+            return Raster(rasters[0].names, pixels, bounds=_Bounds(rasters), scale=rasters[0].scale, cache=True)
+        return _Image(compute)
+
+
+    def aggregate_mean(self, property):
+        """Returns the mean of the values of a property (None if no image has it)."""
+        def compute():
+            values = [r.properties[property] for r in Evaluate(self) if r.properties.get(property) is not None]
+            return float(sum(values)) / len(values) if values else None
+        return Number(ComputedObject(compute))
+
+
+def _Overlapping(rasters, grid):
+    """Returns the rasters that can have valid pixels on the grid (images outside of the grid have none)."""
+    result = []
+    for raster in rasters:
+        if raster.bounds is not None:
+            w, s, e, n = IntersectBounds(raster.bounds, grid.bounds)
+            if w >= e or s >= n:
+                continue
+        result.append(raster)
+    return result
+
+
+def _Bounds(rasters):
+    """Returns the union of the bounds of the rasters or None if one of them is unbounded."""
+    return UnionBounds([r.bounds for r in rasters]) if all(r.bounds is not None for r in rasters) else None
+
+
+def _Collection(compute):
+    """Creates a collection that is computed by a function that returns a list."""
+    collection = ImageCollection.__new__(ImageCollection)
+    collection._query = None
+    ComputedObject.__init__(collection, compute)
+    return collection
+
+
+class FeatureValue(object):
+
+    """The evaluated value of a feature."""
+
+    def __init__(self, geometry, properties):
+        self.geometry = geometry
+        self.properties = properties
+
+
+class Feature(ComputedObject):
+
+    """A feature (ee.Feature)."""
+
+    def __init__(self, geometry, properties=None):
+        ComputedObject.__init__(self, lambda: FeatureValue(geometry, Evaluate(dict(properties or {}))))
+
+
+    def get(self, property):
+        return ComputedObject(lambda: Evaluate(self).properties.get(property))
+
+
+    def set(self, *args):
+        """Sets properties like set(<name>, <value>) or set({<name>: <value>,...})."""
+        values = args[0] if len(args) == 1 else {args[0]: args[1]}
+
+        def compute():
+            feature = Evaluate(self)
+            properties = dict(feature.properties)
+            properties.update(Evaluate(dict(values)))
+            return FeatureValue(feature.geometry, properties)
+        feature = Feature.__new__(Feature)
+        ComputedObject.__init__(feature, compute)
+        return feature
+
+
+class FeatureCollection(ComputedObject):
+
+    """A feature collection (ee.FeatureCollection)."""
+
+    def __init__(self, args):
+        """Creates a collection from a geometry, a list of features or geometries or another collection."""
+        if isinstance(args, Geometry):
+            args = [args]
+        if isinstance(args, (list, tuple)):
+            ComputedObject.__init__(self, lambda: [FeatureValue(f, {}) if isinstance(f, Geometry) else Evaluate(f) for f in args])
+        elif isinstance(args, ComputedObject):
+            ComputedObject.__init__(self, lambda: Evaluate(args))
+        else:
+            raise EEException("Invalid argument for ee.FeatureCollection(): %r" % (args,))
+
+
+    def getInfo(self):
+        """Returns the collection as GeoJSON FeatureCollection."""
+        return {"type": "FeatureCollection", "features": ComputedObject.getInfo(self)}
+
+
+    def flatten(self):
+        """Flattens a collection of collections."""
+        return FeatureCollection(ComputedObject(lambda: [feature for features in Evaluate(self) for feature in features]))
+
+
+    def map(self, algorithm):
+        def compute():
+            return [Evaluate(algorithm(Feature(feature.geometry, feature.properties))) for feature in Evaluate(self)]
+        return FeatureCollection(ComputedObject(compute))
+
+
+    def filter(self, filter):
+        return FeatureCollection(ComputedObject(lambda: [f for f in Evaluate(self) if filter.test(f.properties)]))
+
+
+    def size(self):
+        return Number(ComputedObject(lambda: len(Evaluate(self))))
+
+
+    def geometry(self, maxError=None):
+        """Returns the union of the geometries of the features (the features are evaluated, like all geometries)."""
+        return Geometry([part for feature in Evaluate(self) if feature.geometry is not None for part in feature.geometry.parts])
+
+
+    def aggregate_array(self, property):
+        """Returns the values of a property, features without it are skipped."""
+        return List(ComputedObject(lambda: [f.properties[property] for f in Evaluate(self) if f.properties.get(property) is not None]))
+
+
+    def reduceColumns(self, reducer, selectors, weightSelectors=None):
+        """Reduces the values of the selected properties, features without all of them are skipped."""
+        def compute():
+            names = Evaluate(selectors)
+            rows = [[f.properties.get(name) for name in names] for f in Evaluate(self)]
+            rows = [row for row in rows if None not in row]
+            columns = [np.array([row[i] for row in rows], dtype=np.float64) for i in range(len(names))]
+            return reducer.ReduceColumns(columns)
+        return Dictionary(ComputedObject(compute))
+
+
+    def makeArray(self, properties, name="array"):
+        """Adds the values of the properties as list, features without all of them are left unchanged."""
+        def compute():
+            result = []
+            for feature in Evaluate(self):
+                values = [feature.properties.get(p) for p in properties]
+                if None not in values:
+                    feature = FeatureValue(feature.geometry, dict(feature.properties, **{name: values}))
+                result.append(feature)
+            return result
+        return FeatureCollection(ComputedObject(compute))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""Lazily computed values: the base class of all emulated EE objects, numbers, dates and dictionaries."""
+
+import calendar
+import datetime
+import math
+import numbers
+
+
+class EEException(Exception):
+
+    """The exception raised for invalid arguments or failed computations (like ee.EEException)."""
+
+
+class ComputedObject(object):
+
+    """A value that is computed when it is needed for the first time.
+
+    Like in EE nothing is computed when an object is created. The value is computed
+    when getInfo() (or an object that depends on it) needs it and is then kept.
+    """
+
+    def __init__(self, compute):
+        """Creates the object.
+
+        Args:
+            compute: A function without arguments that returns the value.
+        """
+        self._compute = compute
+
+
+    def _Value(self):
+        if not hasattr(self, "_value"):
+            self._value = self._compute()
+        return self._value
+
+
+    def getInfo(self):
+        """Computes the value and returns it as json encodable object."""
+        from eemulator import data
+        return data.computeValue(self)
+
+
+def Evaluate(value):
+    """Returns the value of a ComputedObject or the value itself.
+
+    Lists and dicts are evaluated recursively.
+    """
+    while isinstance(value, ComputedObject):
+        value = value._Value()
+    if isinstance(value, list):
+        return [Evaluate(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, Evaluate(v)) for k, v in value.items())
+    return value
+
+
+class Number(ComputedObject):
+
+    """A number (ee.Number)."""
+
+    def __init__(self, number):
+        if isinstance(number, ComputedObject):
+            ComputedObject.__init__(self, lambda: Evaluate(number))
+        elif isinstance(number, numbers.Number):
+            ComputedObject.__init__(self, lambda: number)
+        else:
+            raise EEException("Invalid argument for ee.Number(): %r" % (number,))
+
+
+    def _Binary(self, other, op):
+        return Number(ComputedObject(lambda: op(Evaluate(self), Evaluate(other))))
+
+
+    def _Unary(self, op):
+        return Number(ComputedObject(lambda: op(Evaluate(self))))
+
+
+    def add(self, other):
+        return self._Binary(other, lambda a, b: a + b)
+
+    def subtract(self, other):
+        return self._Binary(other, lambda a, b: a - b)
+
+    def multiply(self, other):
+        return self._Binary(other, lambda a, b: a * b)
+
+    def divide(self, other):
+        return self._Binary(other, lambda a, b: float(a) / b)
+
+    def pow(self, other):
+        return self._Binary(other, lambda a, b: float(a) ** b)
+
+    def mod(self, other):
+        return self._Binary(other, lambda a, b: math.fmod(a, b))
+
+    def min(self, other):
+        return self._Binary(other, min)
+
+    def max(self, other):
+        return self._Binary(other, max)
+
+    def floor(self):
+        return self._Unary(math.floor)
+
+    def ceil(self):
+        return self._Unary(math.ceil)
+
+    def round(self):
+        return self._Unary(round)
+
+    def abs(self):
+        return self._Unary(abs)
+
+    def sqrt(self):
+        return self._Unary(math.sqrt)
+
+    def sin(self):
+        return self._Unary(math.sin)
+
+    def cos(self):
+        return self._Unary(math.cos)
+
+    def int(self):
+        return self._Unary(int)
+
+    def toFloat(self):
+        return self._Unary(float)
+
+
+class Date(ComputedObject):
+
+    """A date (ee.Date), the value is the number of milliseconds since the epoch."""
+
+    def __init__(self, date):
+        if isinstance(date, ComputedObject):
+            ComputedObject.__init__(self, lambda: float(Evaluate(date)))
+        elif isinstance(date, numbers.Number):
+            ComputedObject.__init__(self, lambda: float(date))
+        elif isinstance(date, datetime.datetime):
+            ComputedObject.__init__(self, lambda: _Millis(date))
+        else:
+            ComputedObject.__init__(self, lambda: ParseDate(date))
+
+
+    def millis(self):
+        return Number(self)
+
+
+    def get(self, unit):
+        """Returns the year, month (1-12), day, hour, minute or second of the date."""
+        if unit not in ("year", "month", "day", "hour", "minute", "second"):
+            raise EEException("Unsupported unit for Date.get(): %s" % unit)
+        return Number(ComputedObject(lambda: getattr(_Datetime(Evaluate(self)), unit)))
+
+
+    def getRelative(self, unit, inUnit):
+        """Returns the 0-based day of the year or month, or the 0-based month of the year."""
+        def relative():
+            date = _Datetime(Evaluate(self))
+            if unit == "day" and inUnit == "year":
+                return date.timetuple().tm_yday - 1
+            if unit == "day" and inUnit == "month":
+                return date.day - 1
+            if unit == "month" and inUnit == "year":
+                return date.month - 1
+            raise EEException("Unsupported units for Date.getRelative(): %s in %s" % (unit, inUnit))
+        return Number(ComputedObject(relative))
+
+
+    def format(self, format=None):
+        """Formats the date with a Joda-Time pattern, only the fields yyyy (or YYYY), MM, dd, HH, mm and ss are supported."""
+        pattern = format or "yyyy-MM-dd'T'HH:mm:ss"
+        fields = (("yyyy", "%Y"), ("YYYY", "%Y"), ("MM", "%m"), ("dd", "%d"), ("HH", "%H"), ("mm", "%M"), ("ss", "%S"), ("'", ""))
+        for field, directive in fields:
+            pattern = pattern.replace(field, directive)
+        return ComputedObject(lambda: _Datetime(Evaluate(self)).strftime(pattern))
+
+
+    def advance(self, delta, unit):
+        seconds = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400}
+        if unit not in seconds:
+            raise EEException("Unsupported unit for Date.advance(): %s" % unit)
+        return Date(ComputedObject(lambda: Evaluate(self) + Evaluate(delta) * seconds[unit] * 1000))
+
+
+class Dictionary(ComputedObject):
+
+    """A dictionary (ee.Dictionary), the values are evaluated with the dictionary."""
+
+    def __init__(self, dictionary=None):
+        ComputedObject.__init__(self, lambda: Evaluate(dict(Evaluate(dictionary) or {})))
+
+
+    def get(self, key):
+        return ComputedObject(lambda: Evaluate(self)[key])
+
+
+    def keys(self):
+        return ComputedObject(lambda: sorted(Evaluate(self).keys()))
+
+
+class List(ComputedObject):
+
+    """A list (ee.List)."""
+
+    def __init__(self, items):
+        ComputedObject.__init__(self, lambda: Evaluate(list(Evaluate(items))))
+
+
+    def get(self, index):
+        return ComputedObject(lambda: Evaluate(self)[Evaluate(index)])
+
+
+    def size(self):
+        return Number(ComputedObject(lambda: len(Evaluate(self))))
+
+
+    def map(self, baseAlgorithm):
+        """Applies the algorithm to each item, like in EE it gets the items as computed objects."""
+        return List(ComputedObject(lambda: [baseAlgorithm(ComputedObject(lambda item=item: item)) for item in Evaluate(self)]))
+
+
+def ParseDate(date):
+    """Returns the milliseconds since the epoch of an ISO date string like 2010, 2010-01-01 or 2010-12-31T23:59:59."""
+    for pattern in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            return _Millis(datetime.datetime.strptime(str(date).split(".")[0], pattern))
+        except ValueError:
+            pass
+    raise EEException("Invalid date: %r" % (date,))
+
+
+def _Millis(date):
+    return calendar.timegm(date.timetuple()) * 1000.0
+
+
+def _Datetime(millis):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=millis)
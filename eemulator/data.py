@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""The requests of the client library (ee.data), computed locally.
+
+Like in EE all computations start here: getInfo() calls computeValue(), getMapId()
+computes the bands of a map, getDownloadId() writes a download and startProcessing()
+runs an export task in a background thread.
+"""
+
+import collections
+import csv
+import itertools
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from eemulator import settings
+from eemulator.computed import EEException, Evaluate
+from eemulator.geometry import Geometry, Grid
+
+# the number of computed maps that are kept for GetMap()
+MAX_MAPS = 64
+
+_MAPS = collections.OrderedDict()
+_DOWNLOADS = {}
+_TASKS = {}
+_IDS = itertools.count(1)
+_LOCK = threading.Lock()
+
+
+class _TaskState(object):
+    UNSUBMITTED = "UNSUBMITTED"
+    READY = "READY"
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+    FAILED = "FAILED"
+    CANCEL_REQUESTED = "CANCEL_REQUESTED"
+    CANCELLED = "CANCELLED"
+
+
+def setDeadline(milliseconds):
+    """The computations are local and have no deadline."""
+
+
+def computeValue(obj):
+    """Computes an object and returns it as json encodable value."""
+    return _Serialize(Evaluate(obj))
+
+
+def getMapId(params):
+    """Computes all bands of an image for a map of at most settings.MAP_PIXELS per side.
+
+    The pixels are computed at the scale of the image (see reproject()) or at the largest
+    scale the map size allows. The tiles are not served, the computed bands are kept for GetMap().
+
+    Args:
+        params: A dict with the key "image".
+
+    Returns:
+        A dict like {"mapid": <mapid>, "token": <token>}.
+    """
+    raster = Evaluate(params["image"])
+    grid = Grid.ForBounds(raster.bounds, raster.scale, settings.MAP_PIXELS)
+    bands = [raster.Band(i, grid) for i in range(len(raster.names))]
+
+    mapid = "%s-%s" % (uuid.uuid4().hex[:16], next(_IDS))
+    with _LOCK:
+        _MAPS[mapid] = (raster.names, grid, bands)
+        while len(_MAPS) > MAX_MAPS:
+            _MAPS.popitem(last=False)
+    return {"mapid": mapid, "token": uuid.uuid4().hex[:16]}
+
+
+def GetMap(mapid):
+    """Returns the band names, grid and masked arrays of a map or None if it is unknown."""
+    with _LOCK:
+        return _MAPS.get(mapid)
+
+
+def getDownloadId(params):
+    """Writes the region of an image to an .npz file in settings.OUTPUT.
+
+    Args:
+        params: A dict with the keys "image", "name", "scale" and "region" (optional).
+
+    Returns:
+        A dict like {"docid": <docid>, "token": <token>}.
+    """
+    image = params["image"]
+    region = params.get("region")
+    if region is not None:
+        image = image.clip(region if isinstance(region, Geometry) else Geometry.Polygon(Evaluate(region)))
+
+    docid = "%s-%s" % (uuid.uuid4().hex[:16], next(_IDS))
+    path = _Write(Evaluate(image), params.get("scale"), params.get("name") or docid)
+    with _LOCK:
+        _DOWNLOADS[docid] = path
+    return {"docid": docid, "token": uuid.uuid4().hex[:16]}
+
+
+def makeDownloadUrl(download):
+    """Returns a file:// URL of a download."""
+    with _LOCK:
+        return "file://" + _DOWNLOADS[download["docid"]]
+
+
+def AssetPath(id):
+    """Returns the path of the .npz file of an image asset written by an export to an asset."""
+    return os.path.join(settings.OUTPUT, "assets", *id.split("/")) + ".npz"
+
+
+def getList(params):
+    """Returns the image assets in the folder params["id"] like [{"type":"Image","id":<asset id>},...]."""
+    directory = os.path.dirname(AssetPath(params["id"] + "/x"))
+    if not os.path.isdir(directory):
+        raise EEException("Folder '%s' not found." % params["id"])
+    return [{"type": "Image", "id": "%s/%s" % (params["id"], name[:-4])} for name in sorted(os.listdir(directory)) if name.endswith(".npz")]
+
+
+def newTaskId(count=1):
+    return ["EMULATOR%08d" % next(_IDS) for _ in range(count)]
+
+
+def startProcessing(task_id, params):
+    """Starts an export task in a background thread.
+
+    Args:
+        task_id: An id created by newTaskId().
+        params: A dict with the keys "image", "description", "driveFileNamePrefix" and "scale"
+                or (for a table) "collection", "description", "driveFileNamePrefix" and "selectors".
+    """
+    with _LOCK:
+        if task_id in _TASKS:
+            raise EEException("Task %s was already started." % task_id)
+        now = time.time() * 1000
+        _TASKS[task_id] = {"id": task_id, "state": _TaskState.READY, "description": params.get("description"),
+                           "creation_timestamp_ms": now, "update_timestamp_ms": now, "task_type": "EXPORT_IMAGE"}
+
+    thread = threading.Thread(target=_RunExport, args=(task_id, params))
+    thread.daemon = True
+    thread.start()
+    return {"taskId": task_id, "started": "OK"}
+
+
+def getTaskStatus(taskId):
+    """Returns a list with the status dict of each task id."""
+    ids = [taskId] if not isinstance(taskId, (list, tuple)) else taskId
+    with _LOCK:
+        return [dict(_TASKS.get(task_id, {"id": task_id, "state": _TaskState.UNSUBMITTED})) for task_id in ids]
+
+
+def cancelTask(taskId):
+    with _LOCK:
+        task = _TASKS.get(taskId)
+        if task is None:
+            raise EEException("Task %s not found." % taskId)
+        if task["state"] in (_TaskState.READY, _TaskState.RUNNING):
+            task["state"] = _TaskState.CANCEL_REQUESTED
+            task["update_timestamp_ms"] = time.time() * 1000
+
+
+def _Update(task_id, state, **kwargs):
+    """Sets the state of a task unless it was cancelled. Returns False if the task was cancelled."""
+    with _LOCK:
+        task = _TASKS[task_id]
+        if task["state"] == _TaskState.CANCEL_REQUESTED:
+            state = _TaskState.CANCELLED
+            kwargs = {}
+        task.update(kwargs, state=state, update_timestamp_ms=time.time() * 1000)
+        return state != _TaskState.CANCELLED
+
+
+def _Progress(task_id, fraction):
+    """Sets the progress of a running task."""
+    with _LOCK:
+        task = _TASKS[task_id]
+        if task["state"] == _TaskState.RUNNING:
+            task.update(progress=fraction, update_timestamp_ms=time.time() * 1000)
+
+
+def _RunExport(task_id, params):
+    if not _Update(task_id, _TaskState.RUNNING, start_timestamp_ms=time.time() * 1000):
+        return
+    try:
+        if "collection" in params:
+            path = _WriteTable(Evaluate(params["collection"]), params.get("selectors"), params.get("driveFileNamePrefix") or params.get("description") or task_id)
+        elif params.get("assetId"):
+            _Write(Evaluate(params["image"]), params.get("scale"), None, dtype=np.float64, path=AssetPath(params["assetId"]))
+            _Update(task_id, _TaskState.COMPLETED)
+            return
+        else:
+            path = _Write(Evaluate(params["image"]), params.get("scale"), params.get("driveFileNamePrefix") or params.get("description") or task_id,
+                          cancelled=lambda: _TASKS[task_id]["state"] == _TaskState.CANCEL_REQUESTED,
+                          progress=lambda fraction: _Progress(task_id, fraction))
+        if path is None:
+            _Update(task_id, _TaskState.CANCELLED)
+        elif _Update(task_id, _TaskState.COMPLETED, output_url=["file://" + path]) and settings.EXPORTED is not None:
+            settings.EXPORTED(path)
+    except Exception as e:
+        _Update(task_id, _TaskState.FAILED, error_message=str(e))
+
+
+def _Write(raster, scale, name, cancelled=lambda: False, progress=lambda fraction: None, dtype=np.float32, path=None):
+    """Computes the bands of a raster and writes them as stack (see sources.py) to an .npz file.
+
+    The file is <name>.npz in settings.OUTPUT or the path. The progress function is called
+    with the fraction of the computed bands after each band. Integer bands (see toInt16()) keep
+    their type, if all bands have it.
+
+    Returns:
+        The path of the file or None if the computation was cancelled.
+    """
+    grid = Grid.ForBounds(raster.bounds, scale or raster.scale, settings.EXPORT_PIXELS)
+    bands = []
+    for i in range(len(raster.names)):
+        if cancelled():
+            return None
+        band = raster.Band(i, grid)
+        if band.ndim != 2:
+            raise EEException("Band '%s' is an array band, use arrayFlatten() before the export." % raster.names[i])
+        bands.append(band)
+        progress(round(float(i + 1) / len(raster.names), 2))
+    types = set(band.dtype for band in bands)
+    if len(types) == 1 and np.issubdtype(list(types)[0], np.integer):
+        bands = [band.filled(np.iinfo(band.dtype).min) for band in bands]
+    else:
+        bands = [band.astype(dtype).filled(np.nan) for band in bands]
+
+    if path is None:
+        path = os.path.join(settings.OUTPUT, name + ".npz")
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    properties = dict(("property:" + k, np.array([v])) for k, v in raster.properties.items() if isinstance(v, (int, float)))
+    np.savez_compressed(path, names=np.array(raster.names), bands=np.array([bands]).reshape((1, len(bands), grid.height, grid.width)),
+                        time_start=np.array([raster.properties.get("system:time_start", 0.0)]), bounds=np.array(grid.bounds), **properties)
+    return path
+
+
+def _WriteTable(features, selectors, name):
+    """Writes the properties of the features to a .csv file, the columns are the selectors or all properties.
+
+    Returns:
+        The path of the file.
+    """
+    if isinstance(selectors, str):
+        selectors = selectors.split(",")
+    columns = list(selectors or sorted(set(key for feature in features for key in feature.properties)))
+
+    if not os.path.isdir(settings.OUTPUT):
+        os.makedirs(settings.OUTPUT)
+    path = os.path.join(settings.OUTPUT, name + ".csv")
+    with open(path, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for feature in features:
+            writer.writerow([_Serialize(feature.properties.get(column, "")) for column in columns])
+    return path
+
+
+def _Serialize(value):
+    """Converts an evaluated value to json encodable objects."""
+    from eemulator.collection import FeatureValue
+    from eemulator.image import Raster
+
+    if isinstance(value, Raster):
+        return {"type": "Image", "bands": [{"id": name} for name in value.names], "properties": _Serialize(value.properties)}
+    if isinstance(value, FeatureValue):
+        geometry = value.geometry.toGeoJSON() if value.geometry is not None else None
+        return {"type": "Feature", "geometry": geometry, "properties": _Serialize(value.properties)}
+    if isinstance(value, Geometry):
+        return value.toGeoJSON()
+    if isinstance(value, (list, tuple)):
+        return [_Serialize(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _Serialize(v)) for k, v in value.items())
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+"""Deserialization of objects (ee.deserializer) that were serialized by serializer.py."""
+
+import json
+
+from eemulator import serializer
+from eemulator.computed import EEException
+
+
+def fromJSON(json_obj):
+    """Returns the object of a json string created by serializer.toJSON()."""
+    obj = serializer.GetObject(json.loads(json_obj).get("emulated"))
+    if obj is None:
+        raise EEException("The serialized object is unknown, it was serialized by another process or evicted.")
+    return obj
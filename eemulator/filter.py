@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Metadata filters (ee.Filter)."""
+
+from eemulator.computed import Date, EEException, Evaluate
+
+
+class Filter(object):
+
+    """A filter on the properties of the elements of a collection.
+
+    Filters on WRS_PATH and WRS_ROW also report the path/row pairs they select, so that
+    the scenes of a collection can be enumerated only for these (see sources.py).
+    """
+
+    def __init__(self, test, pathrows=None):
+        """Creates a filter.
+
+        Args:
+            test: A function that returns True for the properties dict of an element that passes.
+            pathrows: A set of (path, row) tuples that contains all elements that can pass or None.
+        """
+        self.test = test
+        self.pathrows = pathrows
+
+
+    @staticmethod
+    def _Compare(name, value, compare):
+        def test(properties):
+            if name not in properties or properties[name] is None:
+                return False
+            return compare(properties[name], Evaluate(value))
+        return Filter(test)
+
+
+    @staticmethod
+    def eq(name, value):
+        f = Filter._Compare(name, value, lambda a, b: a == b)
+        f.equals = (name, value)
+        return f
+
+    @staticmethod
+    def neq(name, value):
+        return Filter._Compare(name, value, lambda a, b: a != b)
+
+    @staticmethod
+    def gt(name, value):
+        return Filter._Compare(name, value, lambda a, b: a > b)
+
+    @staticmethod
+    def gte(name, value):
+        return Filter._Compare(name, value, lambda a, b: a >= b)
+
+    @staticmethod
+    def lt(name, value):
+        return Filter._Compare(name, value, lambda a, b: a < b)
+
+    @staticmethod
+    def lte(name, value):
+        return Filter._Compare(name, value, lambda a, b: a <= b)
+
+
+    @staticmethod
+    def inList(name, values):
+        f = Filter._Compare(name, values, lambda a, b: a in b)
+        f.within = (name, values)
+        return f
+
+
+    @staticmethod
+    def notNull(properties):
+        return Filter(lambda values: all(values.get(name) is not None for name in properties))
+
+
+    @staticmethod
+    def date(start, end=None):
+        start = Date(start)
+        end = Date(end) if end is not None else None
+
+        def test(properties):
+            time_start = properties.get("system:time_start")
+            if time_start is None:
+                return False
+            return Evaluate(start) <= time_start and (end is None or time_start < Evaluate(end))
+        return Filter(test)
+
+
+    @staticmethod
+    def And(*filters):
+        if len(filters) == 1 and isinstance(filters[0], (list, tuple)):
+            filters = filters[0]
+
+        # eq("WRS_PATH", <path>) and inList("WRS_ROW", [<row>,...]) select known path/row pairs
+        paths = [f.equals[1] for f in filters if getattr(f, "equals", (None,))[0] == "WRS_PATH"]
+        rows = [f.within[1] for f in filters if getattr(f, "within", (None,))[0] == "WRS_ROW"]
+        rows += [[f.equals[1]] for f in filters if getattr(f, "equals", (None,))[0] == "WRS_ROW"]
+        pathrows = None
+        if paths and rows:
+            pathrows = set((int(Evaluate(path)), int(row)) for path in paths for row in Evaluate(rows[0]))
+        for f in filters:
+            if f.pathrows is not None:
+                pathrows = f.pathrows if pathrows is None else pathrows & f.pathrows
+
+        return Filter(lambda properties: all(f.test(properties) for f in filters), pathrows)
+
+
+    @staticmethod
+    def Or(*filters):
+        if len(filters) == 1 and isinstance(filters[0], (list, tuple)):
+            filters = filters[0]
+        if not filters:
+            raise EEException("Filter.Or() needs at least one filter.")
+
+        pathrows = None
+        if all(f.pathrows is not None for f in filters):
+            pathrows = set()
+            for f in filters:
+                pathrows |= f.pathrows
+
+        return Filter(lambda properties: any(f.test(properties) for f in filters), pathrows)
+
+
+    def Not(self):
+        return Filter(lambda properties: not self.test(properties))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Geometries (ee.Geometry) and the grids the pixels are computed on."""
+
+import math
+
+import numpy as np
+
+from eemulator import settings
+from eemulator.computed import ComputedObject, EEException, Evaluate
+
+
+# meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+
+class Geometry(object):
+
+    """A point, a polygon or a union of them in longitude/latitude coordinates.
+
+    Geometries are not computed lazily, they are only created from coordinates.
+    """
+
+    def __init__(self, parts):
+        """Creates a geometry from a list of parts ("Point", [<lon>,<lat>]) or ("Polygon", [<ring>,...])."""
+        self.parts = parts
+
+
+    @staticmethod
+    def Point(coords, *args):
+        """Creates a point from [<longitude>,<latitude>] or (<longitude>, <latitude>)."""
+        if args:
+            coords = [coords, args[0]]
+        coords = Evaluate(coords)
+        return Geometry([("Point", [float(coords[0]), float(coords[1])])])
+
+
+    @staticmethod
+    def Polygon(coords, *args):
+        """Creates a polygon from a ring [[<lon>,<lat>],...] or a list of rings."""
+        coords = Evaluate(coords)
+        if not isinstance(coords[0][0], (list, tuple)):
+            coords = [coords]
+        rings = []
+        for ring in coords:
+            ring = [[float(c[0]), float(c[1])] for c in ring]
+            if ring[0] != ring[-1]:
+                ring.append(list(ring[0]))
+            rings.append(ring)
+        return Geometry([("Polygon", rings)])
+
+
+    @staticmethod
+    def MultiPolygon(coords, *args):
+        """Creates a union of polygons from a list of polygons (each a ring or a list of rings)."""
+        return Geometry([part for polygon in Evaluate(coords) for part in Geometry.Polygon(polygon).parts])
+
+
+    @staticmethod
+    def Rectangle(coords, *args):
+        """Creates a rectangle from [<west>, <south>, <east>, <north>]."""
+        w, s, e, n = Evaluate(coords)
+        return Geometry.Polygon([[w, s], [e, s], [e, n], [w, n]])
+
+
+    def union(self, right, maxError=None, proj=None):
+        return Geometry(self.parts + right.parts)
+
+
+    def bounds(self, maxError=None, proj=None):
+        return Geometry.Rectangle(list(self.Bounds()))
+
+
+    def coordinates(self):
+        return ComputedObject(lambda: self.parts[0][1] if len(self.parts) == 1 else [p[1] for p in self.parts])
+
+
+    def Bounds(self):
+        """Returns the bounding box (west, south, east, north)."""
+        coords = []
+        for kind, c in self.parts:
+            coords.extend([c] if kind == "Point" else c[0])
+        lons = [c[0] for c in coords]
+        lats = [c[1] for c in coords]
+        return (min(lons), min(lats), max(lons), max(lats))
+
+
+    def IsPoint(self):
+        return len(self.parts) == 1 and self.parts[0][0] == "Point"
+
+
+    def Contains(self, lon, lat, tolerance=0.0):
+        """Returns a boolean array that is True for the coordinates inside of the geometry.
+
+        Points contain the coordinates that are closer than the tolerance (degrees).
+        """
+        inside = np.zeros(np.shape(lon), dtype=bool)
+        for kind, c in self.parts:
+            if kind == "Point":
+                inside |= (np.abs(lon - c[0]) <= tolerance) & (np.abs(lat - c[1]) <= tolerance)
+            else:
+                part = PointsInRing(lon, lat, c[0])
+                for hole in c[1:]:
+                    part &= ~PointsInRing(lon, lat, hole)
+                inside |= part
+        return inside
+
+
+    def Intersects(self, bounds, ring=None):
+        """Checks if the geometry intersects a bounding box and (if given) a ring."""
+        w, s, e, n = self.Bounds()
+        if w > bounds[2] or e < bounds[0] or s > bounds[3] or n < bounds[1]:
+            return False
+        if ring is None:
+            return True
+        for kind, c in self.parts:
+            if kind == "Point":
+                if PointsInRing(np.array([c[0]]), np.array([c[1]]), ring)[0]:
+                    return True
+            elif _RingsIntersect(c[0], ring):
+                return True
+        return False
+
+
+    def getInfo(self):
+        return self.toGeoJSON()
+
+
+    def toGeoJSON(self):
+        if len(self.parts) == 1:
+            return {"type": self.parts[0][0], "coordinates": self.parts[0][1]}
+        return {"type": "GeometryCollection",
+                "geometries": [{"type": kind, "coordinates": c} for kind, c in self.parts]}
+
+
+class Grid(object):
+
+    """A regular longitude/latitude grid. The pixels of all images are computed on a grid."""
+
+    def __init__(self, bounds, width, height):
+        """Creates the grid.
+
+        Args:
+            bounds: (west, south, east, north) of the outer pixel edges.
+            width: The number of columns.
+            height: The number of rows.
+        """
+        self.bounds = tuple(float(b) for b in bounds)
+        self.width = int(width)
+        self.height = int(height)
+        self.key = (self.bounds, self.width, self.height)
+        self._coordinates = None
+
+
+    @classmethod
+    def ForPoint(cls, lon, lat, scale=30):
+        """A grid of a single pixel centered at the point."""
+        half = scale / METERS_PER_DEGREE / 2
+        return cls((lon - half, lat - half, lon + half, lat + half), 1, 1)
+
+
+    @classmethod
+    def ForBounds(cls, bounds, scale=None, max_pixels=None):
+        """A grid that covers the bounds with pixels of the scale (meters), limited to max_pixels per side."""
+        if bounds is None:
+            raise EEException("The emulator can not compute an unbounded image, use clip() or a region.")
+        w, s, e, n = bounds
+        max_pixels = max_pixels or settings.MAP_PIXELS
+        meters_x = (e - w) * METERS_PER_DEGREE * math.cos(math.radians((s + n) / 2.0))
+        meters_y = (n - s) * METERS_PER_DEGREE
+        if scale:
+            width = int(math.ceil(meters_x / scale))
+            height = int(math.ceil(meters_y / scale))
+        else:
+            width = height = max_pixels
+        # keep the aspect ratio if the grid is limited
+        factor = max(1.0, float(max(width, height)) / max_pixels)
+        return cls(bounds, max(1, int(round(width / factor))), max(1, int(round(height / factor))))
+
+
+    @property
+    def scale(self):
+        """The pixel height in meters."""
+        return (self.bounds[3] - self.bounds[1]) / self.height * METERS_PER_DEGREE
+
+
+    def Coordinates(self):
+        """Returns the longitude and latitude arrays (height, width) of the pixel centers."""
+        if self._coordinates is None:
+            w, s, e, n = self.bounds
+            lons = w + (np.arange(self.width) + 0.5) * (e - w) / self.width
+            lats = n - (np.arange(self.height) + 0.5) * (n - s) / self.height
+            self._coordinates = np.meshgrid(lons, lats)
+        return self._coordinates
+
+
+def UnionBounds(bounds):
+    """Returns the bounding box of a list of bounding boxes (None entries are unbounded and ignored)."""
+    bounds = [b for b in bounds if b is not None]
+    if not bounds:
+        return None
+    return (min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+
+def IntersectBounds(a, b):
+    """Returns the intersection of two bounding boxes (None is unbounded)."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    w, s, e, n = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    if w >= e or s >= n:
+        return (w, s, w, s)
+    return (w, s, e, n)
+
+
+def PointsInRing(lon, lat, ring):
+    """Vectorized ray casting point in polygon test."""
+    inside = np.zeros(np.shape(lon), dtype=bool)
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i]
+        xj, yj = ring[j]
+        if yi != yj:
+            crosses = ((yi > lat) != (yj > lat)) & (lon < (xj - xi) * (lat - yi) / (yj - yi) + xi)
+            inside ^= crosses
+        j = i
+    return inside
+
+
+def _RingsIntersect(ring1, ring2):
+    """Checks if two rings overlap (a vertex lies in the other ring or two edges cross)."""
+    if PointsInRing(np.array([ring1[0][0]]), np.array([ring1[0][1]]), ring2)[0]:
+        return True
+    if PointsInRing(np.array([ring2[0][0]]), np.array([ring2[0][1]]), ring1)[0]:
+        return True
+
+    def orientation(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+
+    for i in range(len(ring1)):
+        a, b = ring1[i - 1], ring1[i]
+        for j in range(len(ring2)):
+            c, d = ring2[j - 1], ring2[j]
+            if ((orientation(c, d, a) > 0) != (orientation(c, d, b) > 0)) and \
+                    ((orientation(a, b, c) > 0) != (orientation(a, b, d) > 0)):
+                return True
+    return False
@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+"""Images (ee.Image) and the rasters they are evaluated to.
+
+An Image is evaluated to a Raster, which knows the band names, properties and bounds
+of the image but computes the pixels of a band only for a given grid. The pixels of
+a band are a numpy masked array of the grid shape (height, width), or (height, width,
+rows, columns) for the array bands of the regression reducer.
+"""
+
+import collections
+import itertools
+import re
+import threading
+
+import numpy as np
+
+from eemulator import data, settings
+from eemulator.computed import ComputedObject, Date, Dictionary, EEException, Evaluate, List
+from eemulator.geometry import Grid, IntersectBounds, METERS_PER_DEGREE, UnionBounds
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+
+class _PixelCache(object):
+
+    """A thread safe least recently used cache of computed arrays, limited by their size in bytes."""
+
+    def __init__(self):
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+
+    def Get(self, key, compute):
+        with self._lock:
+            if key in self._items:
+                value = self._items.pop(key)
+                self._items[key] = value
+                return value
+
+        value = compute()
+        size = _Bytes(value)
+
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self._bytes += size
+            while self._bytes > settings.CACHE_BYTES and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self._bytes -= _Bytes(old)
+        return value
+
+
+    def Clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+def _Bytes(array):
+    """Returns the size of an array and its mask (if any)."""
+    return array.nbytes + np.ma.getmask(array).nbytes
+
+
+CACHE = _PixelCache()
+
+_SERIALS = itertools.count()
+
+
+class Raster(object):
+
+    """The evaluated value of an image."""
+
+    def __init__(self, names, pixels, properties=None, bounds=None, scale=None, footprint=None, cache=False):
+        """Creates a raster.
+
+        Args:
+            names: The band names.
+            pixels: A function (grid, index) that returns the masked array of a band on the grid.
+            properties: The image properties.
+            bounds: The bounding box (west, south, east, north) of the valid pixels or None if unbounded.
+            scale: The pixel size (meters) the image is computed at or None for the grid scale.
+            footprint: A ring [[<lon>,<lat>],...] that contains the valid pixels (used by filterBounds).
+            cache: True to keep the computed bands in the CACHE (only worth it for expensive bands).
+        """
+        self.names = list(names)
+        self._pixels = pixels
+        self.properties = properties if properties is not None else {}
+        self.bounds = bounds
+        self.scale = scale
+        self.footprint = footprint
+        self._cache = cache
+        self._serial = next(_SERIALS)
+
+
+    def Band(self, index, grid):
+        """Returns the masked array of a band on the grid."""
+        if not self._cache:
+            return self._pixels(grid, index)
+        return CACHE.Get((self._serial, index, grid.key), lambda: self._pixels(grid, index))
+
+
+    def Copy(self, names=None, pixels=None, properties=None, cache=False, **kwargs):
+        """Returns a raster with some attributes replaced (the bands are read from this raster by default)."""
+        attributes = {"bounds": self.bounds, "scale": self.scale, "footprint": self.footprint}
+        attributes.update(kwargs)
+        return Raster(self.names if names is None else names,
+                      (lambda grid, index: self.Band(index, grid)) if pixels is None else pixels,
+                      self.properties if properties is None else properties,
+                      cache=cache,
+                      **attributes)
+
+
+class Image(ComputedObject):
+
+    """An image (ee.Image)."""
+
+    def __init__(self, image=None):
+        """Creates an image from another image, a number (constant image), an asset id or nothing (an image without bands)."""
+        if image is None:
+            ComputedObject.__init__(self, lambda: Raster([], None))
+        elif isinstance(image, _STRING_TYPES):
+            def load():
+                from eemulator import sources
+                return sources.LoadAsset(str(image))
+            ComputedObject.__init__(self, load)
+        elif isinstance(image, Image):
+            ComputedObject.__init__(self, lambda: Evaluate(image))
+        elif isinstance(image, (ComputedObject, int, float)):
+            ComputedObject.__init__(self, lambda: Evaluate(Image.constant(image)))
+        else:
+            raise EEException("The emulator only creates images from numbers or other images, not %r." % (image,))
+
+
+    def _Raster(self):
+        return Evaluate(self)
+
+
+    @staticmethod
+    def constant(value):
+        def compute():
+            number = float(Evaluate(value))
+            return Raster(["constant"], lambda grid, index: np.ma.MaskedArray(np.full((grid.height, grid.width), number), mask=np.zeros((grid.height, grid.width), dtype=bool)))
+        return _Image(compute)
+
+
+    def select(self, *args):
+        """Selects bands by names, regular expressions or indices and optionally renames them."""
+        if not args:
+            selectors, names = [], None
+        elif isinstance(args[0], (list, tuple)):
+            selectors = list(args[0])
+            names = list(args[1]) if len(args) > 1 and args[1] is not None else None
+        else:
+            selectors, names = list(args), None
+
+        def compute():
+            raster = self._Raster()
+            indices = _Indices(raster.names, Evaluate(selectors))
+            if names is not None and len(names) != len(indices):
+                raise EEException("Selected %s bands but got %s new names." % (len(indices), len(names)))
+            return raster.Copy(names or [raster.names[i] for i in indices],
+                               lambda grid, index: raster.Band(indices[index], grid))
+        return _Image(compute)
+
+
+    def rename(self, *names):
+        if len(names) == 1 and isinstance(names[0], (list, tuple)):
+            names = names[0]
+
+        def compute():
+            raster = self._Raster()
+            if len(names) != len(raster.names):
+                raise EEException("The image has %s bands but got %s names." % (len(raster.names), len(names)))
+            return raster.Copy(list(names))
+        return _Image(compute)
+
+
+    def addBands(self, srcImg, names=None, overwrite=False):
+        """Adds the bands of another image, duplicate names get a suffix like "_1" unless overwritten."""
+        other = srcImg if isinstance(srcImg, Image) else Image(srcImg)
+        if names is not None:
+            other = other.select(names)
+
+        def compute():
+            first = self._Raster()
+            second = other._Raster()
+            sources = [(first, i) for i in range(len(first.names))]
+            result = list(first.names)
+            for i, name in enumerate(second.names):
+                if name in result and overwrite:
+                    sources[result.index(name)] = (second, i)
+                    continue
+                unique, suffix = name, 0
+                while unique in result:
+                    suffix += 1
+                    unique = "%s_%s" % (name, suffix)
+                result.append(unique)
+                sources.append((second, i))
+
+            bounds = UnionBounds([first.bounds, second.bounds]) if first.bounds is not None and second.bounds is not None else (first.bounds or second.bounds)
+            return first.Copy(result, lambda grid, index: sources[index][0].Band(sources[index][1], grid),
+                              bounds=bounds, scale=first.scale or second.scale)
+        return _Image(compute)
+
+
+    def normalizedDifference(self, bandNames=None):
+        selected = self.select(bandNames) if bandNames is not None else self
+
+        def compute():
+            raster = selected._Raster()
+            if len(raster.names) < 2:
+                raise EEException("normalizedDifference needs 2 bands, got %s." % len(raster.names))
+
+            def pixels(grid, index):
+                a = raster.Band(0, grid).astype(float)
+                b = raster.Band(1, grid).astype(float)
+                return _Divide(a - b, a + b)
+            return raster.Copy(["nd"], pixels, properties={})
+        return _Image(compute)
+
+
+    def metadata(self, property, name=None):
+        """Returns a constant band with the value of a numeric property."""
+        def compute():
+            raster = self._Raster()
+            if raster.properties.get(property) is None:
+                raise EEException("Image has no property '%s'." % property)
+            value = float(raster.properties[property])
+            return raster.Copy([name or property], lambda grid, index: np.ma.MaskedArray(np.full((grid.height, grid.width), value), mask=np.zeros((grid.height, grid.width), dtype=bool)))
+        return _Image(compute)
+
+
+    def _Binary(self, other, op):
+        """Applies a pixel wise operation, a single band operand is applied to all bands of the other."""
+        other = other if isinstance(other, Image) else Image(other)
+
+        def compute():
+            a = self._Raster()
+            b = other._Raster()
+            if len(a.names) != len(b.names) and len(a.names) != 1 and len(b.names) != 1:
+                raise EEException("Images must have the same number of bands or one band, got %s and %s." % (len(a.names), len(b.names)))
+            names = a.names if len(a.names) >= len(b.names) else b.names
+
+            def pixels(grid, index):
+                left = a.Band(min(index, len(a.names) - 1), grid)
+                right = b.Band(min(index, len(b.names) - 1), grid)
+                return op(left, right)
+            return a.Copy(names, pixels, bounds=IntersectBounds(a.bounds, b.bounds))
+        return _Image(compute)
+
+
+    def _Unary(self, op):
+        def compute():
+            raster = self._Raster()
+            return raster.Copy(pixels=lambda grid, index: op(raster.Band(index, grid)))
+        return _Image(compute)
+
+
+    def add(self, other):
+        return self._Binary(other, lambda a, b: a + b)
+
+    def subtract(self, other):
+        return self._Binary(other, lambda a, b: a - b)
+
+    def multiply(self, other):
+        return self._Binary(other, lambda a, b: a * b)
+
+    def divide(self, other):
+        return self._Binary(other, _Divide)
+
+    def gt(self, other):
+        return self._Binary(other, lambda a, b: (a > b).astype(np.uint8))
+
+    def gte(self, other):
+        return self._Binary(other, lambda a, b: (a >= b).astype(np.uint8))
+
+    def lt(self, other):
+        return self._Binary(other, lambda a, b: (a < b).astype(np.uint8))
+
+    def lte(self, other):
+        return self._Binary(other, lambda a, b: (a <= b).astype(np.uint8))
+
+    def eq(self, other):
+        return self._Binary(other, lambda a, b: (a == b).astype(np.uint8))
+
+    def neq(self, other):
+        return self._Binary(other, lambda a, b: (a != b).astype(np.uint8))
+
+    def bitwiseAnd(self, other):
+        return self._Binary(other, lambda a, b: np.ma.bitwise_and(a.astype(np.int64), b.astype(np.int64)))
+
+    def max(self, other):
+        return self._Binary(other, np.ma.maximum)
+
+    def floor(self):
+        return self._Unary(np.ma.floor)
+
+    def sqrt(self):
+        return self._Unary(np.ma.sqrt)
+
+    def round(self):
+        return self._Unary(np.ma.round)
+
+    def clamp(self, low, high):
+        return self._Unary(lambda a: np.ma.clip(a, low, high))
+
+    def toFloat(self):
+        return self._Unary(lambda a: a.astype(np.float32))
+
+    def toDouble(self):
+        return self._Unary(lambda a: a.astype(np.float64))
+
+    def toInt16(self):
+        return self._Unary(lambda a: np.ma.clip(a, -2**15, 2**15 - 1).astype(np.int16))
+
+    def toInt32(self):
+        return self._Unary(lambda a: np.ma.clip(a, -2**31, 2**31 - 1).astype(np.int32))
+
+
+    def unmask(self, value=0):
+        """Sets the masked pixels to the value, unlike in EE the image keeps its bounds."""
+        def compute():
+            raster = self._Raster()
+
+            def pixels(grid, index):
+                band = raster.Band(index, grid)
+                return np.ma.MaskedArray(band.filled(value), mask=np.zeros(band.shape, dtype=bool))
+            return raster.Copy(pixels=pixels)
+        return _Image(compute)
+
+
+    def updateMask(self, mask):
+        """Masks the pixels where the mask is 0 or masked."""
+        mask = mask if isinstance(mask, Image) else Image(mask)
+
+        def compute():
+            raster = self._Raster()
+            masks = mask._Raster()
+
+            def pixels(grid, index):
+                band = raster.Band(index, grid)
+                m = masks.Band(min(index, len(masks.names) - 1), grid)
+                invalid = np.ma.getmaskarray(m) | (np.ma.getdata(m) == 0)
+                invalid = invalid.reshape(invalid.shape + (1,) * (band.ndim - invalid.ndim))
+                return np.ma.MaskedArray(np.ma.getdata(band), mask=np.ma.getmaskarray(band) | invalid)
+            return raster.Copy(pixels=pixels, bounds=IntersectBounds(raster.bounds, masks.bounds))
+        return _Image(compute)
+
+
+    def clip(self, geometry):
+        """Masks the pixels outside of the geometry."""
+        def compute():
+            raster = self._Raster()
+
+            def pixels(grid, index):
+                band = raster.Band(index, grid)
+                lon, lat = grid.Coordinates()
+                outside = ~geometry.Contains(lon, lat, tolerance=grid.scale / METERS_PER_DEGREE / 2)
+                outside = outside.reshape(outside.shape + (1,) * (band.ndim - 2))
+                return np.ma.MaskedArray(np.ma.getdata(band), mask=np.ma.getmaskarray(band) | outside)
+            return raster.Copy(pixels=pixels, bounds=IntersectBounds(raster.bounds, geometry.Bounds()))
+        return _Image(compute)
+
+
+    def reproject(self, crs, crsTransform=None, scale=None):
+        """Sets the pixel size the image is computed at (the projection is ignored, all grids are lon/lat)."""
+        return _Image(lambda: self._Raster().Copy(scale=scale))
+
+
+    def visualize(self, bands=None, min=0, max=1, palette=None, **kwargs):
+        """Stretches the first band (or 3 bands) from [min, max] to [0, 255] in the bands vis-red, vis-green and vis-blue."""
+        image = self.select(bands) if bands is not None else self
+
+        def compute():
+            raster = image._Raster()
+            if len(raster.names) not in (1, 3):
+                raise EEException("visualize needs 1 or 3 bands, got %s." % len(raster.names))
+
+            def pixels(grid, index):
+                band = raster.Band(index if len(raster.names) == 3 else 0, grid).astype(float)
+                return np.ma.clip((band - min) / float(max - min) * 255, 0, 255).astype(np.uint8)
+            return raster.Copy(["vis-red", "vis-green", "vis-blue"], pixels, properties={})
+        return _Image(compute)
+
+
+    def arrayFlatten(self, coordinateLabels):
+        """Flattens the array bands to one band per array element, named like "<row label>_<column label>"."""
+        labels = Evaluate(coordinateLabels)
+
+        def compute():
+            raster = self._Raster()
+            sources = []
+            for i, name in enumerate(raster.names):
+                prefix = name + "_" if len(raster.names) > 1 else ""
+                if len(labels) == 1:
+                    sources.extend((prefix + row, i, (r,)) for r, row in enumerate(labels[0]))
+                else:
+                    sources.extend((prefix + row + "_" + column, i, (r, c)) for r, row in enumerate(labels[0]) for c, column in enumerate(labels[1]))
+
+            def pixels(grid, index):
+                _, band, element = sources[index]
+                array = raster.Band(band, grid)
+                if array.ndim != 2 + len(element):
+                    raise EEException("arrayFlatten got %s labels for an array of %s dimensions." % (len(element), array.ndim - 2))
+                return array[(Ellipsis,) + element]
+            return raster.Copy([s[0] for s in sources], pixels)
+        return _Image(compute)
+
+
+    def set(self, *args):
+        """Sets properties like set(<name>, <value>) or set({<name>: <value>,...})."""
+        values = args[0] if len(args) == 1 else {args[0]: args[1]}
+
+        def compute():
+            raster = self._Raster()
+            properties = dict(raster.properties)
+            properties.update(Evaluate(dict(values)))
+            return raster.Copy(properties=properties)
+        return _Image(compute)
+
+
+    def get(self, property):
+        return ComputedObject(lambda: self._Raster().properties.get(property))
+
+
+    def date(self):
+        return Date(ComputedObject(lambda: self._Raster().properties["system:time_start"]))
+
+
+    def bandNames(self):
+        return List(ComputedObject(lambda: self._Raster().names))
+
+
+    def reduceRegion(self, reducer, geometry=None, scale=None, **kwargs):
+        """Reduces the pixels inside of the geometry to a dictionary keyed by the band names."""
+        def compute():
+            raster = self._Raster()
+            arrays = _RegionPixels(raster, geometry, scale)
+            return dict(zip(reducer.RegionNames(raster.names), reducer.ReduceRegion(arrays)))
+        return Dictionary(ComputedObject(compute))
+
+
+    def reduceRegions(self, collection, reducer, scale=None, **kwargs):
+        """Reduces the pixels inside of each feature and adds the results as properties.
+
+        A single band result is named after the output of the reducer (like "mean"), otherwise after the bands.
+        Masked results are left out.
+        """
+        from eemulator.collection import FeatureCollection, FeatureValue
+        features = collection if isinstance(collection, FeatureCollection) else FeatureCollection(collection)
+
+        def compute():
+            raster = self._Raster()
+            names = raster.names if len(raster.names) > 1 else reducer._Outputs()
+            result = []
+            for feature in Evaluate(features):
+                values = reducer.ReduceRegion(_RegionPixels(raster, feature.geometry, scale))
+                properties = dict(feature.properties)
+                properties.update((name, value) for name, value in zip(names, values) if value is not None)
+                result.append(FeatureValue(feature.geometry, properties))
+            return result
+        return FeatureCollection(ComputedObject(compute))
+
+
+    def sample(self, region=None, scale=None, projection=None, factor=None, numPixels=None, seed=0, dropNulls=True, **kwargs):
+        """Samples random pixels inside of the region as features with a property per band (without geometries).
+
+        Like in EE the pixels are drawn from the region, so with dropNulls the masked ones reduce the sample.
+        """
+        from eemulator.collection import FeatureCollection, FeatureValue
+
+        def compute():
+            raster = self._Raster()
+            bounds = region.Bounds() if region is not None else raster.bounds
+            grid = Grid.ForBounds(bounds, scale or raster.scale or 30, settings.REGION_PIXELS)
+            inside = np.ones((grid.height, grid.width), dtype=bool)
+            if region is not None:
+                lon, lat = grid.Coordinates()
+                inside = region.Contains(lon, lat, tolerance=grid.scale / METERS_PER_DEGREE / 2)
+            pixels = np.flatnonzero(inside)
+            if numPixels is not None and numPixels < pixels.size:
+                pixels = np.sort(np.random.RandomState(seed).choice(pixels, numPixels, replace=False))
+
+            columns = [raster.Band(i, grid).reshape(-1)[pixels] for i in range(len(raster.names))]
+            valid = np.ones(pixels.size, dtype=bool)
+            for column in columns:
+                valid &= ~np.ma.getmaskarray(column)
+            features = []
+            for row in range(pixels.size):
+                if dropNulls and not valid[row]:
+                    continue
+                values = [None if np.ma.is_masked(column[row]) else float(column[row]) for column in columns]
+                features.append(FeatureValue(None, dict(zip(raster.names, values))))
+            return features
+        return FeatureCollection(ComputedObject(compute))
+
+
+    def getMapId(self, vis_params=None):
+        request = dict(vis_params or {})
+        request["image"] = self
+        return data.getMapId(request)
+
+
+    def getDownloadURL(self, params=None):
+        request = dict(params or {})
+        request["image"] = self
+        return data.makeDownloadUrl(data.getDownloadId(request))
+
+
+def _Image(compute):
+    """Creates an image that is computed by a function that returns a Raster."""
+    image = Image.__new__(Image)
+    ComputedObject.__init__(image, compute)
+    return image
+
+
+def _Divide(a, b):
+    """Divides masked arrays and masks the division by zero (faster than np.ma.divide)."""
+    divisor = np.ma.getdata(b)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.ma.getdata(a).astype(np.float64) / divisor
+    return np.ma.MaskedArray(result, mask=np.ma.getmaskarray(a) | np.ma.getmaskarray(b) | (divisor == 0))
+
+
+def _Indices(names, selectors):
+    """Returns the indices of the bands matched by names, regular expressions or indices."""
+    indices = []
+    for selector in selectors:
+        if isinstance(selector, int):
+            if selector >= len(names):
+                raise EEException("Band index %s out of range, the image has %s bands." % (selector, len(names)))
+            indices.append(selector)
+        elif selector in names:
+            indices.append(names.index(selector))
+        else:
+            matched = [i for i, name in enumerate(names) if re.match("(?:%s)$" % selector, name)]
+            if not matched:
+                raise EEException("Pattern '%s' did not match any bands of %s." % (selector, names))
+            indices.extend(matched)
+    return indices
+
+
+def _RegionPixels(raster, geometry, scale):
+    """Returns the masked arrays of all bands inside of a geometry (or the bounds of the raster)."""
+    scale = scale or raster.scale or 30
+    if geometry is not None and geometry.IsPoint():
+        lon, lat = geometry.parts[0][1]
+        return [raster.Band(i, Grid.ForPoint(lon, lat, scale)) for i in range(len(raster.names))]
+
+    bounds = geometry.Bounds() if geometry is not None else raster.bounds
+    grid = Grid.ForBounds(bounds, scale, settings.REGION_PIXELS)
+    arrays = [raster.Band(i, grid) for i in range(len(raster.names))]
+    if geometry is not None:
+        lon, lat = grid.Coordinates()
+        outside = ~geometry.Contains(lon, lat, tolerance=grid.scale / METERS_PER_DEGREE / 2)
+        arrays = [np.ma.MaskedArray(np.ma.getdata(a), mask=np.ma.getmaskarray(a) | outside) for a in arrays]
+    return arrays
+
+
+class Landsat(object):
+
+    """The Landsat algorithms (ee.Algorithms.Landsat)."""
+
+    @staticmethod
+    def simpleCloudScore(image):
+        """Adds a band "cloud" (0-100) like the EE algorithm: the minimum of the rescaled brightness,
+        visible and infrared reflectance, temperature and snow index."""
+        def compute():
+            raster = image._Raster()
+            if "B10" in raster.names:
+                bands = ("B2", "B3", "B4", "B5", "B6", "B7", "B10")
+            elif "B6_VCID_1" in raster.names:
+                bands = ("B1", "B2", "B3", "B4", "B5", "B7", "B6_VCID_1")
+            elif "B6" in raster.names:
+                bands = ("B1", "B2", "B3", "B4", "B5", "B7", "B6")
+            else:
+                raise EEException("simpleCloudScore needs a Landsat TOA image, got the bands %s." % raster.names)
+            indices = [raster.names.index(b) for b in bands]
+
+            def rescale(value, low, high):
+                return np.clip((value - low) / (high - low), 0, 1)
+
+            def pixels(grid, index):
+                if index < len(raster.names):
+                    return raster.Band(index, grid)
+                bands = [raster.Band(i, grid) for i in indices]
+                mask = np.logical_or.reduce([np.ma.getmaskarray(band) for band in bands])
+                blue, green, red, nir, swir1, swir2, temp = [np.ma.getdata(band).astype(np.float32) for band in bands]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    ndsi = np.nan_to_num((green - swir1) / (green + swir1))
+                score = rescale(blue, 0.1, 0.3)
+                score = np.minimum(score, rescale(red + green + blue, 0.2, 0.8))
+                score = np.minimum(score, rescale(nir + swir1 + swir2, 0.3, 0.8))
+                score = np.minimum(score, rescale(temp, 300.0, 290.0))
+                score = np.minimum(score, rescale(ndsi, 0.8, 0.6))
+                return np.ma.MaskedArray(score * 100, mask=mask)
+            return raster.Copy(raster.names + ["cloud"], pixels, cache=True)
+        return _Image(compute)
+
+
+class Algorithms(object):
+
+    """The EE algorithms used by the app (ee.Algorithms)."""
+
+    Landsat = Landsat
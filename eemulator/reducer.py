@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""Reducers (ee.Reducer) for image collections (per pixel), regions (over pixels) and table columns.
+
+The per pixel reducers accumulate one image after the other, so that a collection is
+reduced with the memory of a few images.
+"""
+
+import numpy as np
+
+from eemulator.computed import EEException
+
+
+class Reducer(object):
+
+    """A reducer. Use the static methods to create one."""
+
+    def __init__(self, name, arguments=()):
+        self.name = name
+        self.arguments = arguments
+        self.outputs = None
+
+
+    @staticmethod
+    def mean():
+        return Reducer("mean")
+
+    @staticmethod
+    def sum():
+        return Reducer("sum")
+
+    @staticmethod
+    def count():
+        return Reducer("count")
+
+    @staticmethod
+    def min():
+        return Reducer("min")
+
+    @staticmethod
+    def max():
+        return Reducer("max")
+
+    @staticmethod
+    def first():
+        return Reducer("first")
+
+    @staticmethod
+    def linearRegression(numX, numY=1):
+        return Reducer("linearRegression", (numX, numY))
+
+    @staticmethod
+    def percentile(percentiles, outputNames=None):
+        reducer = Reducer("percentile", (list(percentiles),))
+        reducer.outputs = list(outputNames) if outputNames is not None else ["p%s" % p for p in percentiles]
+        return reducer
+
+    @staticmethod
+    def histogram(maxBuckets=None, minBucketWidth=None, maxRaw=None):
+        return Reducer("histogram", (maxBuckets or 255,))
+
+
+    def forEach(self, outputNames):
+        """Repeats the reducer for each output name, it gets an input per name (like a column of a table)."""
+        return Reducer("forEach", (self, list(outputNames)))
+
+
+    def combine(self, reducer2, outputPrefix=None, sharedInputs=False):
+        """Combines two reducers, without shared inputs the inputs of this reducer come first."""
+        return Reducer("combine", (self, reducer2, outputPrefix or "", sharedInputs))
+
+
+    def setOutputs(self, outputs):
+        """Returns the reducer with renamed outputs."""
+        reducer = Reducer(self.name, self.arguments)
+        reducer.outputs = list(outputs)
+        return reducer
+
+
+    def RegionNames(self, names):
+        """Returns the keys of the dictionary of a region reduction of bands with the names.
+
+        The results of a reducer with one output are named after the bands, otherwise like <band>_<output>.
+        """
+        outputs = self._Outputs()
+        if len(outputs) == 1:
+            return list(names)
+        return ["%s_%s" % (name, output) for name in names for output in outputs]
+
+
+    def OutputNames(self, names):
+        """Returns the band names of a collection reduced with this reducer.
+
+        A reducer with one input is repeated for each band and its outputs are prefixed with
+        the band name, the outputs of a reducer with multiple inputs keep their names.
+        """
+        if self._Inputs() > 1:
+            if len(names) != self._Inputs():
+                raise EEException("The reducer needs %s bands, got %s." % (self._Inputs(), len(names)))
+            return self._Outputs()
+        if self.name == "combine":
+            first, second, prefix, _ = self.arguments
+            return first.OutputNames(names) + [prefix + name for name in second.OutputNames(names)]
+        return ["%s_%s" % (name, self.name) for name in names]
+
+
+    def Accumulator(self, shape):
+        """Returns an accumulator for the per pixel reduction on a grid with the shape (height, width)."""
+        if self.name == "linearRegression":
+            return _Regression(shape, *self.arguments)
+        if self.name in ("mean", "sum", "count", "min", "max"):
+            return _Statistics(shape, self.name)
+        if self.name == "combine":
+            first, second, _, shared = self.arguments
+            return _Combined(first, second, shape, None if shared or self._Inputs() == 1 else first._Inputs())
+        raise EEException("Unsupported reducer: %s" % self.name)
+
+
+    def _Inputs(self):
+        """Returns the number of inputs."""
+        if self.name == "linearRegression":
+            return sum(self.arguments)
+        if self.name == "combine":
+            first, second, _, shared = self.arguments
+            return max(first._Inputs(), second._Inputs()) if shared else first._Inputs() + second._Inputs()
+        if self.name == "forEach":
+            reducer, names = self.arguments
+            return reducer._Inputs() * len(names)
+        return 1
+
+
+    def _Outputs(self):
+        """Returns the names of the outputs."""
+        if self.outputs is not None:
+            return self.outputs
+        if self.name == "linearRegression":
+            return ["coefficients", "residuals"]
+        if self.name == "combine":
+            first, second, prefix, _ = self.arguments
+            return first._Outputs() + [prefix + name for name in second._Outputs()]
+        if self.name == "forEach":
+            # the output names are used as they are for a reducer with one output, else as prefix
+            reducer, names = self.arguments
+            outputs = reducer._Outputs()
+            if len(outputs) == 1:
+                return list(names)
+            return ["%s_%s" % (name, output) for name in names for output in outputs]
+        return [self.name]
+
+
+    def ReduceRegion(self, arrays):
+        """Reduces each masked array over its pixels.
+
+        Returns:
+            A list of the results, the outputs of each array one after the other (None if all pixels are masked).
+        """
+        results = []
+        for array in arrays:
+            results.extend(self._ReduceValues(array.compressed()))
+        return results
+
+
+    def ReduceColumns(self, columns):
+        """Reduces the columns of a table, a column per input of the reducer.
+
+        Returns:
+            A dict of the outputs like a region reduction (the values are None if a column is empty).
+        """
+        if len(columns) != self._Inputs():
+            raise EEException("The reducer needs %s columns, got %s." % (self._Inputs(), len(columns)))
+        if self.name == "forEach":
+            reducer, _ = self.arguments
+            if reducer._Inputs() != 1:
+                raise EEException("Unsupported column reducer: forEach of %s" % reducer.name)
+            results = []
+            for column in columns:
+                results.extend(reducer._ReduceValues(column))
+        elif self._Inputs() == 1:
+            results = self._ReduceValues(columns[0])
+        else:
+            raise EEException("Unsupported column reducer: %s" % self.name)
+        return dict(zip(self._Outputs(), results))
+
+
+    def _ReduceValues(self, values):
+        """Returns the list of the outputs of the reduction of the valid pixel values of a band."""
+        if self.name == "combine":
+            first, second, _, _ = self.arguments
+            return first._ReduceValues(values) + second._ReduceValues(values)
+        if self.name == "count":
+            return [int(values.size)]
+        if values.size == 0:
+            return [None] * len(self._Outputs())
+        if self.name in ("mean", "sum", "min", "max"):
+            return [float(getattr(np, self.name)(values))]
+        if self.name == "first":
+            return [float(values[0])]
+        if self.name == "percentile":
+            return [float(v) for v in np.percentile(values, self.arguments[0])]
+        if self.name == "histogram":
+            # equal buckets from the minimum to the maximum (EE rounds the bucket width)
+            low, high = float(values.min()), float(values.max())
+            counts, edges = np.histogram(values, bins=self.arguments[0], range=(low, high if high > low else low + 1))
+            width = float(edges[1] - edges[0])
+            return [{"bucketMin": low, "bucketWidth": width, "histogram": [int(c) for c in counts],
+                     "bucketMeans": [low + (i + 0.5) * width for i in range(len(counts))]}]
+        raise EEException("Unsupported region reducer: %s" % self.name)
+
+
+class _Statistics(object):
+
+    """Accumulates simple per pixel statistics of each band."""
+
+    def __init__(self, shape, name):
+        self.shape = shape
+        self.name = name
+        self.values = None
+        self.counts = None
+
+
+    def Add(self, arrays):
+        if self.values is None:
+            fill = {"min": np.inf, "max": -np.inf}.get(self.name, 0.0)
+            self.values = [np.full(self.shape, fill) for _ in arrays]
+            self.counts = [np.zeros(self.shape, dtype=np.int64) for _ in arrays]
+        for array, values, counts in zip(arrays, self.values, self.counts):
+            valid = ~np.ma.getmaskarray(array)
+            data = np.ma.getdata(array)
+            if self.name in ("mean", "sum"):
+                values += np.where(valid, data, 0)
+            elif self.name == "min":
+                np.minimum(values, np.where(valid, data, np.inf), out=values)
+            elif self.name == "max":
+                np.maximum(values, np.where(valid, data, -np.inf), out=values)
+            counts += valid
+
+
+    def Result(self, bands):
+        """Returns the reduced arrays of the bands (count is never masked)."""
+        if self.values is None:
+            return [np.ma.masked_all(self.shape) for _ in range(bands)]
+        results = []
+        for values, counts in zip(self.values, self.counts):
+            if self.name == "count":
+                results.append(np.ma.MaskedArray(counts, mask=np.zeros(self.shape, dtype=bool)))
+            elif self.name == "mean":
+                results.append(np.ma.MaskedArray(values / np.maximum(counts, 1), mask=counts == 0))
+            else:
+                results.append(np.ma.MaskedArray(values, mask=counts == 0))
+        return results
+
+
+class _Combined(object):
+
+    """Accumulates two reducers, the results of the first come first."""
+
+    def __init__(self, first, second, shape, split):
+        """Creates the accumulators, the first split arrays are the inputs of the first reducer (None for shared inputs)."""
+        self.first = first.Accumulator(shape)
+        self.second = second.Accumulator(shape)
+        self.outputs = (first, second)
+        self.split = split
+
+
+    def Add(self, arrays):
+        if self.split is None:
+            self.first.Add(arrays)
+            self.second.Add(arrays)
+        else:
+            self.first.Add(arrays[:self.split])
+            self.second.Add(arrays[self.split:])
+
+
+    def Result(self, bands):
+        first, second = self.outputs
+        if self.split is None:
+            count = bands // 2 if first._Inputs() == 1 else len(first._Outputs())
+        else:
+            count = len(first._Outputs())
+        return self.first.Result(count) + self.second.Result(bands - count)
+
+
+class _Regression(object):
+
+    """Accumulates the sufficient statistics of a per pixel least squares regression.
+
+    The result are the bands "coefficients" (numX x numY array per pixel) and "residuals"
+    (the root mean square of the residuals, array of numY per pixel) like in EE.
+    """
+
+    def __init__(self, shape, numX, numY):
+        self.shape = shape
+        self.numX = numX
+        self.numY = numY
+        self.xx = np.zeros(shape + (numX, numX))
+        self.xy = np.zeros(shape + (numX, numY))
+        self.yy = np.zeros(shape + (numY,))
+        self.n = np.zeros(shape)
+
+
+    def Add(self, arrays):
+        valid = np.ones(self.shape, dtype=bool)
+        for array in arrays:
+            valid &= ~np.ma.getmaskarray(array)
+        data = [np.where(valid, np.ma.getdata(array), 0.0) for array in arrays]
+        x = np.stack(data[:self.numX], axis=-1)
+        y = np.stack(data[self.numX:], axis=-1)
+        self.xx += x[..., :, None] * x[..., None, :]
+        self.xy += x[..., :, None] * y[..., None, :]
+        self.yy += y * y
+        self.n += valid
+
+
+    def Result(self, bands):
+        # the system is solved with unit diagonal, since the predictors differ by orders of magnitude
+        # (like the seconds and the cosine of the Zhu & Woodcock model)
+        diagonal = np.sqrt(np.diagonal(self.xx, axis1=-2, axis2=-1))
+        solvable = (self.n >= self.numX) & np.all(diagonal > 0, axis=-1)
+        scale = np.where(solvable[..., None], diagonal, 1.0)
+        xx = self.xx / (scale[..., :, None] * scale[..., None, :])
+        xy = self.xy / scale[..., :, None]
+
+        # pixels with fewer observations than predictors or a singular system are masked
+        solvable &= np.abs(np.linalg.det(xx)) > 1e-10
+        identity = np.eye(self.numX)
+        xx = np.where(solvable[..., None, None], xx, identity)
+        coefficients = np.linalg.solve(xx, np.where(solvable[..., None, None], xy, 0.0)) / scale[..., :, None]
+
+        # residual sum of squares: y'y - 2 b'X'y + b'X'Xb
+        fitted = np.einsum("...im,...ij,...jm->...m", coefficients, self.xx, coefficients)
+        cross = np.einsum("...im,...im->...m", coefficients, self.xy)
+        rss = np.maximum(self.yy - 2 * cross + fitted, 0.0)
+        residuals = np.sqrt(rss / np.maximum(self.n, 1)[..., None])
+
+        mask = ~solvable
+        return [np.ma.MaskedArray(coefficients, mask=np.broadcast_to(mask[..., None, None], coefficients.shape).copy()),
+                np.ma.MaskedArray(residuals, mask=np.broadcast_to(mask[..., None], residuals.shape).copy())]
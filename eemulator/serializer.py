@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""Serialization of objects (ee.serializer).
+
+The emulated objects are Python closures that can not be encoded, so toJSON() keeps
+the object in the process and encodes a reference to it. The references can only be
+deserialized (see deserializer.py) by the same process, like in the single process of
+the load test and the benchmark.
+"""
+
+import collections
+import itertools
+import json
+import threading
+import uuid
+
+# the number of serialized objects that are kept for fromJSON()
+MAX_OBJECTS = 256
+
+_OBJECTS = collections.OrderedDict()
+_IDS = itertools.count(1)
+_LOCK = threading.Lock()
+
+
+def toJSON(obj, opt_pretty=False):
+    """Returns a json string with a reference to the object."""
+    reference = "%s-%s" % (uuid.uuid4().hex[:16], next(_IDS))
+    with _LOCK:
+        _OBJECTS[reference] = obj
+        while len(_OBJECTS) > MAX_OBJECTS:
+            _OBJECTS.popitem(last=False)
+    return json.dumps({"emulated": reference}, indent=2 if opt_pretty else None)
+
+
+def GetObject(reference):
+    """Returns the object of a reference or None if it is unknown."""
+    with _LOCK:
+        return _OBJECTS.get(reference)
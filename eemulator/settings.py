@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""The settings of the emulator, changed with eemulator.Configure()."""
+
+import os
+import tempfile
+
+
+# The directory with the on-disk raster stacks (<collection id with "/" replaced by "_">.npz)
+# or None to use synthetic scenes only.
+DATA = None
+
+# The directory the downloads and exports are written to.
+OUTPUT = os.path.join(tempfile.gettempdir(), "eemulator")
+
+# The maximum number of pixels per side of the grid a map is computed on.
+MAP_PIXELS = 256
+
+# The maximum number of pixels per side of the grid of a region reduction.
+REGION_PIXELS = 512
+
+# The maximum number of pixels per side of a download or export.
+EXPORT_PIXELS = 1024
+
+# The maximum size of the pixel cache (bytes).
+CACHE_BYTES = 256 * 1024 * 1024
+
+# The seed of the synthetic scenes.
+SEED = 0
+
+# A function that is called with the path of each completed export or None.
+EXPORTED = None
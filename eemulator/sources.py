@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""The image collections the emulator can load: on-disk raster stacks or synthetic Landsat scenes.
+
+An on-disk stack is a numpy .npz file in settings.DATA named after the collection id
+with "/" replaced by "_" (like LANDSAT_LC8_L1T_TOA.npz) that contains the arrays:
+
+    names:      (B,) the band names
+    bands:      (N, B, H, W) the pixel values of N images, NaN is masked
+    time_start: (N,) the acquisition times in milliseconds since the epoch
+    bounds:     (4,) west, south, east, north of the stack
+    property:<name>: (N,) optional image properties like property:CLOUD_COVER,
+                     property:WRS_PATH and property:WRS_ROW
+
+Without a stack the scenes of the Landsat collections are synthesized: each WRS-2 path
+is acquired every 16 days and the pixels follow a seasonal NDVI model with clouds. The
+synthetic scenes are only enumerated for the path/row pairs of a spatial filter.
+
+An image asset (ee.Image(<asset id>)) is a stack of one image written by an export
+to the asset (see data.py) to <settings.OUTPUT>/assets/<asset id>.npz.
+"""
+
+import calendar
+import datetime
+import math
+import os
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import wrs
+from eemulator import data, settings
+from eemulator.computed import EEException, ParseDate
+from eemulator.geometry import PointsInRing
+from eemulator.image import CACHE, Raster
+
+
+DAY = 24 * 60 * 60 * 1000.0
+
+_TM = ["B1", "B2", "B3", "B4", "B5", "B6", "B7"]
+_ETM = ["B1", "B2", "B3", "B4", "B5", "B6_VCID_1", "B6_VCID_2", "B7", "B8"]
+_OLI = ["B1", "B2", "B3", "B4", "B5", "B6", "B7", "B8", "B9", "B10", "B11"]
+
+# collection id: (spacecraft, bands, first acquisition, last acquisition or None, days after the first orbit cycle)
+CATALOG = {
+    "LANDSAT/LT5_L1T_TOA": ("LANDSAT_5", _TM, "1984-03-16", "2012-05-05", 0),
+    "LANDSAT/LE7_L1T_TOA": ("LANDSAT_7", _ETM, "1999-05-28", None, 8),
+    "LANDSAT/LC8_L1T_TOA": ("LANDSAT_8", _OLI, "2013-04-11", None, 0),
+    "LANDSAT/LT05/C01/T1_TOA": ("LANDSAT_5", _TM + ["BQA"], "1984-03-16", "2012-05-05", 0),
+    "LANDSAT/LE07/C01/T1_TOA": ("LANDSAT_7", _ETM + ["BQA"], "1999-05-28", None, 8),
+    "LANDSAT/LC08/C01/T1_TOA": ("LANDSAT_8", _OLI + ["BQA"], "2013-04-11", None, 0),
+}
+
+# the first day of the 16 day orbit cycle of path 1
+_CYCLE_START = ParseDate("1984-01-03")
+
+# the scan line corrector of Landsat 7 failed on this day
+_SLC_OFF = ParseDate("2003-05-31")
+
+# the quality bits of a cloud pixel (cloud and high cloud confidence)
+_CLOUD_BITS = (1 << 4) | (1 << 5) | (1 << 6)
+
+_WRS_INDEX = None
+_FIELD_SAMPLE = None
+_STACKS = {}
+_LOCK = threading.Lock()
+
+
+class Query(object):
+
+    """The constraints of a collection that are known before its images are loaded.
+
+    The filters of a collection are still applied to the loaded images, a query only
+    limits which images are loaded.
+    """
+
+    def __init__(self, id, start=None, end=None, pathrows=None, geometries=()):
+        self.id = id
+        self.start = start
+        self.end = end
+        self.pathrows = pathrows
+        self.geometries = tuple(geometries)
+
+
+    def Narrow(self, start=None, end=None, pathrows=None, geometry=None):
+        """Returns a query with additional constraints."""
+        if start is not None and self.start is not None:
+            start = max(start, self.start)
+        if end is not None and self.end is not None:
+            end = min(end, self.end)
+        if pathrows is not None and self.pathrows is not None:
+            pathrows = pathrows & self.pathrows
+        return Query(self.id,
+                     self.start if start is None else start,
+                     self.end if end is None else end,
+                     self.pathrows if pathrows is None else pathrows,
+                     self.geometries + ((geometry,) if geometry is not None else ()))
+
+
+def Load(query):
+    """Returns the rasters of the images of a collection that match the query."""
+    stack = _Stack(query.id)
+    if stack is not None:
+        return _StackRasters(query, stack)
+    if query.id not in CATALOG:
+        raise EEException("ImageCollection asset '%s' not found (no synthetic scenes and no stack in %s)." % (query.id, settings.DATA))
+    return _SyntheticRasters(query)
+
+
+def LoadAsset(id):
+    """Returns the raster of an image asset (loaded once, assets do not change)."""
+    path = data.AssetPath(id)
+    with _LOCK:
+        if path not in _STACKS or _STACKS[path] is None:
+            if not os.path.exists(path):
+                raise EEException("Image asset '%s' not found." % id)
+            arrays = np.load(path)
+            _STACKS[path] = dict((name, arrays[name]) for name in arrays.files)
+        stack = _STACKS[path]
+    return _StackRasters(Query(id), stack)[0]
+
+
+def _Stack(id):
+    """Returns the on-disk stack of a collection (loaded once) or None."""
+    if settings.DATA is None:
+        return None
+    path = os.path.join(settings.DATA, id.replace("/", "_") + ".npz")
+    with _LOCK:
+        if path not in _STACKS:
+            if not os.path.exists(path):
+                _STACKS[path] = None
+            else:
+                arrays = np.load(path)
+                _STACKS[path] = dict((name, arrays[name]) for name in arrays.files)
+        return _STACKS[path]
+
+
+def _StackRasters(query, stack):
+    names = [str(name) for name in stack["names"]]
+    bounds = tuple(float(b) for b in stack["bounds"])
+    w, s, e, n = bounds
+    footprint = [[w, s], [e, s], [e, n], [w, n], [w, s]]
+    properties = dict((key.split(":", 1)[1], stack[key]) for key in stack if key.startswith("property:"))
+
+    rasters = []
+    for i, time_start in enumerate(stack["time_start"]):
+        time_start = float(time_start)
+        if (query.start is not None and time_start < query.start) or (query.end is not None and time_start >= query.end):
+            continue
+        image_properties = dict((name, values[i].item()) for name, values in properties.items())
+        image_properties.update({"system:time_start": time_start, "system:index": "%s_%s" % (query.id.replace("/", "_"), i)})
+
+        def pixels(grid, index, i=i):
+            lon, lat = grid.Coordinates()
+            data = stack["bands"][i, index]
+            height, width = data.shape
+            col = np.floor((lon - w) / (e - w) * width).astype(int)
+            row = np.floor((n - lat) / (n - s) * height).astype(int)
+            outside = (col < 0) | (col >= width) | (row < 0) | (row >= height)
+            values = data[np.clip(row, 0, height - 1), np.clip(col, 0, width - 1)].astype(float)
+            return np.ma.MaskedArray(values, mask=outside | np.isnan(values))
+        rasters.append(Raster(names, pixels, image_properties, bounds=bounds, footprint=footprint))
+    return rasters
+
+
+def _SyntheticRasters(query):
+    global _WRS_INDEX
+    spacecraft, names, first, last, offset = CATALOG[query.id]
+
+    if _WRS_INDEX is None:
+        _WRS_INDEX = wrs.WrsIndex()
+    pathrows = query.pathrows
+    for geometry in query.geometries:
+        covered = set()
+        for kind, coordinates in geometry.parts:
+            if kind == "Point":
+                covered.update(_WRS_INDEX.PathRowsForPoint(coordinates))
+            else:
+                covered.update(_WRS_INDEX.PathRowsForPolygon(coordinates[0]))
+        pathrows = covered if pathrows is None else pathrows & covered
+    if pathrows is None:
+        raise EEException("The emulator only synthesizes the scenes of '%s' for a filterBounds() or WRS_PATH/WRS_ROW filter." % query.id)
+
+    start = max(ParseDate(first), query.start if query.start is not None else 0)
+    end = min(ParseDate(last) + DAY if last else time.time() * 1000, query.end if query.end is not None else float("inf"))
+
+    rasters = []
+    for path, row in sorted(pathrows):
+        footprint = _WRS_INDEX.Footprint(path, row)
+        lons = [c[0] for c in footprint]
+        lats = [c[1] for c in footprint]
+        bounds = (min(lons), min(lats), max(lons), max(lats))
+
+        # the paths are acquired in the order 1, 8, 15,... of a 16 day cycle
+        day = _CYCLE_START + (((path - 1) * 7 + offset) % 16) * DAY
+        day += math.ceil((start - day) / (16 * DAY)) * 16 * DAY
+        while day < end:
+            # about 10:00 local solar time
+            time_start = day + ((10 - bounds[0] / 15.0) % 24) * 3600 * 1000
+            if start <= time_start < end:
+                rasters.append(_Scene(query.id, spacecraft, names, path, row, time_start, footprint, bounds))
+            day += 16 * DAY
+    return rasters
+
+
+def _Scene(id, spacecraft, names, path, row, time_start, footprint, bounds):
+    date = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=time_start)
+    index = "%s%s_%03d%03d_%s" % ("LC0" if spacecraft == "LANDSAT_8" else "LE0" if spacecraft == "LANDSAT_7" else "LT0",
+                                  spacecraft[-1], path, row, date.strftime("%Y%m%d"))
+    rng = random.Random(zlib.crc32((index + str(settings.SEED)).encode("utf-8")))
+
+    # 35% nearly clear scenes, 35% partly cloudy and 30% cloudy
+    u = rng.random()
+    if u < 0.35:
+        cloud_cover = rng.uniform(0, 5)
+    elif u < 0.7:
+        cloud_cover = rng.uniform(5, 40)
+    else:
+        cloud_cover = rng.uniform(40, 100)
+    phases = [rng.uniform(0, 2 * math.pi) for _ in range(3)]
+
+    properties = {"system:time_start": time_start, "system:index": index, "CLOUD_COVER": round(cloud_cover, 2),
+                  "WRS_PATH": path, "WRS_ROW": row, "SPACECRAFT_ID": spacecraft}
+
+    # the seasonal cycle peaks in the summer of each hemisphere
+    doy = date.timetuple().tm_yday
+    season = (math.cos(2 * math.pi * (doy - 196) / 365.25), math.cos(2 * math.pi * (doy - 15) / 365.25))
+    years = (time_start - calendar.timegm((2000, 1, 1, 0, 0, 0)) * 1000.0) / (365.25 * DAY)
+    sensor = _OLI_SENSOR if spacecraft == "LANDSAT_8" else _TM_SENSOR
+    slc_off = spacecraft == "LANDSAT_7" and time_start >= _SLC_OFF
+
+    # only the fields of a grid, the footprint and the clouds are cached, the bands are cheap to derive from them
+    def pixels(grid, band):
+        fields = CACHE.Get(("fields", settings.SEED, grid.key), lambda: _Fields(grid))
+        mask = CACHE.Get(("footprint", path, row, slc_off, grid.key), lambda: _FootprintMask(grid, footprint, bounds, slc_off))
+        cloud = CACHE.Get((id, index, grid.key), lambda: _CloudMask(grid, cloud_cover, phases))
+        values = _Reflectance(sensor[names[band]], fields, season, years, cloud)
+        return np.ma.MaskedArray(values.astype(np.float32), mask=mask.copy())
+
+    return Raster(names, pixels, properties, bounds=bounds, footprint=footprint)
+
+
+# the modeled values of the bands
+_OLI_SENSOR = {"B1": "blue", "B2": "blue", "B3": "green", "B4": "red", "B5": "nir", "B6": "swir1", "B7": "swir2",
+               "B8": "pan", "B9": "cirrus", "B10": "thermal", "B11": "thermal", "BQA": "qa"}
+_TM_SENSOR = {"B1": "blue", "B2": "green", "B3": "red", "B4": "nir", "B5": "swir1", "B6": "thermal", "B6_VCID_1": "thermal",
+              "B6_VCID_2": "thermal", "B7": "swir2", "B8": "pan", "BQA": "qa"}
+
+
+def _Fields(grid):
+    """Returns the fields of a grid that do not change over time: the NDVI without the seasonal
+    cycle, its amplitude in the northern and southern hemisphere, the direction of the NDVI trend,
+    the brightness and water."""
+    lon, lat = grid.Coordinates()
+    density = np.clip(0.55 + 0.35 * np.sin(lon * 5.3 + lat * 4.1) * np.cos(lat * 3.7 - lon * 1.3), 0, 1)
+    water = np.sin(lon * 3.1) + np.cos(lat * 2.7) + 0.5 * np.sin((lon + lat) * 7.3) < -1.6
+    brightness = np.where(water, 0.08, 0.32 + 0.06 * np.sin(lat * 9.1 + lon * 6.7))
+    north = lat >= 0
+    fields = [0.12 + 0.38 * density, 0.28 * density * north, 0.28 * density * ~north, 0.004 * np.sin(lon * 2.3),
+              brightness, water, 293 - 6 * density, 9.0 * north, 9.0 * ~north]
+    return np.stack(fields).astype(np.float32)
+
+
+def _FootprintMask(grid, footprint, bounds, slc_off):
+    """Returns True for the pixels outside of the footprint (its longitudes may exceed 180) or in the SLC-off gaps."""
+    lon, lat = grid.Coordinates()
+    mask = ~(PointsInRing(lon, lat, footprint) | PointsInRing(lon + 360, lat, footprint))
+    if slc_off:
+        # the gaps widen from the center to the edges of the scene
+        center = (bounds[0] + bounds[2]) / 2.0
+        width = np.abs(lon - center) / ((bounds[2] - bounds[0]) / 2.0)
+        mask |= np.mod((lat + 0.15 * lon) * 25.0, 1.0) < 0.25 * width
+    return mask
+
+
+def _CloudMask(grid, cloud_cover, phases):
+    """Returns True for the pixels of cloud blobs that cover about the cloud cover of the scene."""
+    lon, lat = [c.astype(np.float32) for c in grid.Coordinates()]
+    field = np.sin(lon * 41 + phases[0]) * np.cos(lat * 37 + phases[1]) + np.sin((lon - lat) * 23 + phases[2])
+    return field > _FieldQuantile(1 - cloud_cover / 100.0)
+
+
+def _Reflectance(name, fields, season, years, cloud):
+    """Returns the modeled value of a band: the red and NIR reflectance follow the seasonal NDVI,
+    the other bands are derived from them. Clouds are bright and cold."""
+    base, north, south, trend, brightness, water, temperature, north_temperature, south_temperature = fields
+    if name == "qa":
+        return np.where(cloud, _CLOUD_BITS, 0)
+    if name == "cirrus":
+        return np.where(cloud, 0.02, 0.004)
+    if name == "thermal":
+        return np.where(cloud, 265.0, temperature + north_temperature * season[0] + south_temperature * season[1])
+
+    ndvi = np.clip(base + north * season[0] + south * season[1] + trend * years, -0.1, 0.95)
+    ndvi = np.where(water > 0, -0.25, ndvi)
+    if name in ("nir", "swir1", "swir2"):
+        nir = brightness * (1 + ndvi) / 2
+        values = nir if name == "nir" else 0.5 * nir + 0.05 if name == "swir1" else 0.35 * nir + 0.03
+        return np.where(cloud, 0.4, values)
+    red = brightness * (1 - ndvi) / 2
+    values = {"blue": 0.6 * red + 0.03, "green": 0.8 * red + 0.04, "red": red, "pan": 0.8 * red + 0.0233}[name]
+    return np.where(cloud, 0.45, values)
+
+
+def _FieldQuantile(q):
+    """Returns the quantile of the cloud field values, so that clouds cover the same share of any grid."""
+    global _FIELD_SAMPLE
+    if _FIELD_SAMPLE is None:
+        angles = np.random.RandomState(0).uniform(0, 2 * math.pi, (3, 100000))
+        _FIELD_SAMPLE = np.sort(np.sin(angles[0]) * np.cos(angles[1]) + np.sin(angles[2]))
+    if q >= 1:
+        return np.inf
+    return _FIELD_SAMPLE[int(q * len(_FIELD_SAMPLE))]
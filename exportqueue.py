@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""A global queue for EE export tasks stored in the Datastore."""
+
+import time
+
+from google.appengine.ext import ndb
+
+
+class ExportJob(ndb.Model):
+
+    """A waiting or running job of the export queue, the key id is the job id and the parent the queue."""
+
+    client_id = ndb.StringProperty(indexed=False)
+    queued = ndb.FloatProperty(indexed=False)
+    # the time of the last heartbeat of a running job, None while the job is waiting
+    heartbeat = ndb.FloatProperty(indexed=False)
+    job = ndb.JsonProperty()
+
+
+class ExportQueue(object):
+
+    """A FIFO queue of export jobs with a global limit of concurrently running EE tasks.
+
+    A job is a dict with at least the keys "id" and "client_id". Waiting jobs are started
+    in the order they were queued, but a client with fewer running jobs goes first, so that
+    a client with many exports can not block the other clients.
+    The jobs are saved as entities of one entity group and changed in transactions, so they
+    survive like the exported files (see storage.py) and the limit holds for concurrent requests.
+    """
+
+    def __init__(self, name, max_running, slot_timeout):
+        """Creates the queue helper.
+
+        Args:
+            name: The key name of the queue, the parent of the jobs.
+            max_running: The maximum number of jobs with a running EE task.
+            slot_timeout: Seconds after which a running job without heartbeat frees its slot.
+        """
+        self.root = ndb.Key("ExportQueue", name)
+        self.max_running = max_running
+        self.slot_timeout = slot_timeout
+
+
+    def Enqueue(self, job):
+        """Adds a job to the end of the queue.
+
+        Args:
+            job: A json encodable dict with the keys "id" and "client_id".
+        """
+        job["queued"] = time.time()
+        ExportJob(parent=self.root, id=job["id"], client_id=job["client_id"], queued=job["queued"], job=job).put()
+
+
+    def Dispatch(self):
+        """Moves waiting jobs to the running jobs while there are free slots.
+
+        Running jobs whose last heartbeat is older than the slot timeout are dropped before.
+
+        Returns:
+            A list of the jobs that can start their EE task now.
+        """
+        def dispatch():
+            now = time.time()
+            jobs = self._Jobs()
+            stale = [j for j in jobs if j.heartbeat is not None and now - j.heartbeat > self.slot_timeout]
+            running = [j for j in jobs if j.heartbeat is not None and j not in stale]
+            waiting = [j for j in jobs if j.heartbeat is None]
+
+            started = []
+            while waiting and len(running) < self.max_running:
+                job = min(waiting, key=lambda j: (self._RunningCount(running, j.client_id), j.queued))
+                waiting.remove(job)
+                job.heartbeat = now
+                running.append(job)
+                started.append(job)
+
+            if stale:
+                ndb.delete_multi([j.key for j in stale])
+            if started:
+                ndb.put_multi(started)
+            return [j.job for j in started]
+
+        return ndb.transaction(dispatch, retries=10)
+
+
+    def Heartbeat(self, job_id):
+        """Marks a running job as alive.
+
+        The heartbeat is only written if the last one is older than a twentieth of the slot timeout,
+        so that the polling runners do not contend for the entity group of the queue.
+        """
+        def beat():
+            job = self._Key(job_id).get()
+            if job is not None and job.heartbeat is not None and time.time() - job.heartbeat > self.slot_timeout / 20.0:
+                job.heartbeat = time.time()
+                job.put()
+        ndb.transaction(beat, retries=10)
+
+
+    def Release(self, job_id):
+        """Frees the slot of a finished job."""
+        ndb.transaction(lambda: self._Key(job_id).delete(), retries=10)
+
+
+    def Cancel(self, job_id, client_id):
+        """Removes a waiting job of the client from the queue.
+
+        Returns:
+            The removed job or None if the client has no waiting job with this id.
+        """
+        def cancel():
+            job = self._Key(job_id).get()
+            if job is None or job.heartbeat is not None or job.client_id != client_id:
+                return None
+            job.key.delete()
+            return job.job
+
+        return ndb.transaction(cancel, retries=10)
+
+
+    def Contains(self, job_id):
+        """Checks if a job is waiting or running (a job whose slot timed out is dropped)."""
+        return self._Key(job_id).get() is not None
+
+
+    def Running(self):
+        """Returns the ids of the jobs that have a slot."""
+        return set(j.key.id() for j in self._Jobs() if j.heartbeat is not None)
+
+
+    def Waiting(self):
+        """Returns the waiting jobs in the order they will be started (assuming no new jobs)."""
+        jobs = self._Jobs()
+        running = [j for j in jobs if j.heartbeat is not None]
+        waiting = [j for j in jobs if j.heartbeat is None]
+
+        order = []
+        while waiting:
+            job = min(waiting, key=lambda j: (self._RunningCount(running, j.client_id), j.queued))
+            waiting.remove(job)
+            running.append(job)
+            order.append(job.job)
+        return order
+
+
+    def _RunningCount(self, running, client_id):
+        return len([job for job in running if job.client_id == client_id])
+
+
+    def _Jobs(self):
+        """Returns all jobs of the queue (an ancestor query, which is strongly consistent)."""
+        return ExportJob.query(ancestor=self.root).fetch()
+
+
+    def _Key(self, job_id):
+        return ndb.Key(ExportJob, job_id, parent=self.root)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Local estimates of the output size of the downloads and exports of the regression images.
+
+EE rejects oversized downloads only after it has started to compute them and a large export
+can run for an hour before it fails. The estimates are computed from the bounding box of the
+region, the scale and the bands without any EE call, so that a request can be rejected or
+routed (direct download, download in tiles or batch export) before it is started.
+
+The regression images are reduced from collections and have no native projection, so EE
+computes them in EPSG:4326 with the scale converted to degrees at the equator. The output
+covers the bounding box of the region, the pixels outside of the polygon are masked but
+still stored. The sizes are the sizes of the uncompressed bands.
+"""
+
+import math
+
+
+# The meters per degree at the equator, used by EE to convert the scale of EPSG:4326 outputs.
+METERS_PER_DEGREE = 111319.49
+
+# The bytes per pixel of a band of the EE data types.
+TYPE_BYTES = {"int8": 1, "uint8": 1, "int16": 2, "uint16": 2, "int32": 4, "uint32": 4, "float": 4, "double": 8}
+
+
+def Estimate(bounds, scale, bands, data_type):
+    """Estimates the size of the output of an image for a region.
+
+    Args:
+        bounds: The bounding box [<west>,<south>,<east>,<north>] of the region (degrees).
+        scale: The pixel size (meters).
+        bands: The number of bands.
+        data_type: The EE data type of the bands (a key of TYPE_BYTES).
+
+    Returns:
+        A dict {"width":<pixels>,"height":<pixels>,"pixels":<width * height>,"bands":<bands>,
+        "type":<data type>,"bytes":<pixels * bands * bytes per pixel>}.
+    """
+    west, south, east, north = bounds
+    degrees = float(scale) / METERS_PER_DEGREE
+    width = max(int(math.ceil((east - west) / degrees)), 1)
+    height = max(int(math.ceil((north - south) / degrees)), 1)
+    pixels = width * height
+    return {"width": width, "height": height, "pixels": pixels, "bands": bands, "type": data_type,
+            "bytes": pixels * bands * TYPE_BYTES[data_type]}
+
+
+def Tiles(bounds, count):
+    """Splits a bounding box into at least count tiles of about the same size and shape.
+
+    Returns:
+        A list of the bounding boxes [<west>,<south>,<east>,<north>] of the tiles, row by row from the south west.
+    """
+    west, south, east, north = bounds
+    if count <= 1:
+        return [list(bounds)]
+    aspect = (east - west) / max(north - south, 1e-9)
+    columns = max(int(round(math.sqrt(count * aspect))), 1)
+    rows = int(math.ceil(float(count) / columns))
+    width = (east - west) / columns
+    height = (north - south) / rows
+    return [[west + column * width, south + row * height, west + (column + 1) * width, south + (row + 1) * height]
+            for row in range(rows) for column in range(columns)]
+
+
+def FormatBytes(size):
+    """Returns a size in bytes as human readable string like '1.5 GB'."""
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024:
+            return ("%d %s" if unit == "bytes" else "%.1f %s") % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Validation, repair and simplification of the client drawn polygons.
+
+The regions of the clients are traced by hand or pasted from parcel data and
+can have thousands of vertices, which slow down the path/row lookup, the log
+and every EE call that gets the polygon (clip, reductions, downloads and
+exports). A ring is repaired (closed, counterclockwise, without repeated
+vertices) and simplified with the Douglas-Peucker algorithm to a tolerance of
+about a pixel, so the simplified polygon differs from the drawn one by less
+than the pixels the regression is computed at.
+
+The vertices of a simplified ring are a subset of the drawn ones. A drawn ring
+that intersects itself (like a bow-tie) is rejected, EE would accept it but
+the area it encloses is ambiguous. A ring that would intersect itself after
+the simplification is simplified with a smaller tolerance.
+"""
+
+import math
+import numbers
+
+import exportsize
+
+
+# The number of times the tolerance is halved if a simplified ring intersects itself.
+MAX_HALVINGS = 6
+
+
+def Prepare(ring, tolerance):
+    """Validates, repairs and simplifies a ring.
+
+    Args:
+        ring: The ring [[<longitude>,<latitude>],...], closed or not.
+        tolerance: The maximum distance (meters) of a removed vertex from the simplified ring.
+
+    Returns:
+        A tuple (<closed simplified ring>, <number of distinct vertices of the drawn ring>).
+
+    Raises:
+        ValueError: If the ring has invalid coordinates, less than three distinct vertices or intersects itself.
+    """
+    if not isinstance(ring, list):
+        raise ValueError("The region is not a list of coordinates.")
+    vertices = []
+    for c in ring:
+        if (not isinstance(c, (list, tuple)) or len(c) < 2 or not all(isinstance(v, numbers.Real) for v in c[:2])
+                or not -180 <= c[0] <= 180 or not -90 <= c[1] <= 90):
+            raise ValueError("Invalid coordinates in the region: %s" % (c,))
+        vertex = [float(c[0]), float(c[1])]
+        # repeated vertices (and the closing one) are dropped
+        if not vertices or vertex != vertices[-1]:
+            vertices.append(vertex)
+    while len(vertices) > 1 and vertices[0] == vertices[-1]:
+        vertices.pop()
+    if len(vertices) < 3:
+        raise ValueError("The region needs at least three distinct vertices.")
+
+    points = _Project(vertices)
+    area = _Area(points)
+    if area == 0:
+        raise ValueError("The region has no area.")
+    if area < 0:
+        vertices.reverse()
+        points.reverse()
+
+    if _SelfIntersects(points):
+        raise ValueError("The region intersects itself, draw it without crossing edges.")
+
+    # the drawn ring is kept if no simplification is free of intersections
+    indices = list(range(len(vertices)))
+    for _ in range(MAX_HALVINGS + 1):
+        simplified = _Simplify(points, tolerance)
+        if len(simplified) >= 3 and not _SelfIntersects([points[i] for i in simplified]):
+            indices = simplified
+            break
+        tolerance /= 2.0
+
+    result = [vertices[i] for i in indices]
+    return result + [list(result[0])], len(vertices)
+
+
+def _Project(vertices):
+    """Returns the vertices in meters on a plane tangent at their mean latitude, with continuous longitudes."""
+    scale = math.cos(math.radians(sum(v[1] for v in vertices) / len(vertices))) * exportsize.METERS_PER_DEGREE
+    points = []
+    lon = vertices[0][0]
+    for v in vertices:
+        # make the longitudes continuous if the ring crosses the antimeridian
+        lon += (v[0] - lon + 180) % 360 - 180
+        points.append((lon * scale, v[1] * exportsize.METERS_PER_DEGREE))
+    return points
+
+
+def _Area(points):
+    """Returns the signed area of a ring (positive if it is counterclockwise)."""
+    return sum(points[i - 1][0] * points[i][1] - points[i][0] * points[i - 1][1] for i in range(len(points))) / 2.0
+
+
+def _Simplify(points, tolerance):
+    """Returns the indices of the vertices of a ring that are kept by the Douglas-Peucker algorithm.
+
+    The ring is split at its first vertex and the vertex farthest from it, both halves are simplified on their own.
+    """
+    first = points[0]
+    far = max(range(len(points)), key=lambda i: (points[i][0] - first[0]) ** 2 + (points[i][1] - first[1]) ** 2)
+    keep = set([0, far])
+    stack = [(0, far), (far, len(points))]
+    while stack:
+        start, end = stack.pop()
+        a, b = points[start], points[end % len(points)]
+        distance, index = 0.0, None
+        for i in range(start + 1, end):
+            d = _SegmentDistance(points[i], a, b)
+            if d > distance:
+                distance, index = d, i
+        if index is not None and distance > tolerance:
+            keep.add(index)
+            stack.extend([(start, index), (index, end)])
+    return sorted(keep)
+
+
+def _SegmentDistance(p, a, b):
+    """Returns the distance of the point p from the segment from a to b."""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def _SelfIntersects(points):
+    """Checks if two edges of a ring that are not adjacent intersect or touch.
+
+    The edges are sorted by their west end, so that only the edges that overlap in longitude are compared.
+    """
+    n = len(points)
+    edges = sorted((min(points[i][0], points[(i + 1) % n][0]), max(points[i][0], points[(i + 1) % n][0]), i) for i in range(n))
+    for k, (_, east, i) in enumerate(edges):
+        for west2, _, j in edges[k + 1:]:
+            if west2 > east:
+                break
+            if abs(i - j) in (1, n - 1):
+                continue
+            if _SegmentsIntersect(points[i], points[(i + 1) % n], points[j], points[(j + 1) % n]):
+                return True
+    return False
+
+
+def _SegmentsIntersect(a, b, c, d):
+    """Checks if the segments a-b and c-d intersect or touch."""
+    def orientation(p, q, r):
+        value = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (value > 0) - (value < 0)
+
+    def onSegment(p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+
+    o1, o2, o3, o4 = orientation(a, b, c), orientation(a, b, d), orientation(c, d, a), orientation(c, d, b)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and onSegment(a, b, c)) or (o2 == 0 and onSegment(a, b, d))
+            or (o3 == 0 and onSegment(c, d, a)) or (o4 == 0 and onSegment(c, d, b)))
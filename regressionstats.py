@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""The yearly per pixel sufficient statistics of the regressions, stored as EE assets.
+
+The least squares fit of a regression only needs the sums X'X, X'y, y'y and n of the
+observations, and these sums are additive over the images. They are stored per model
+family, satellite, cloud mask, WRS-2 path/row and year ("chunk"), so the regression of
+any range of years is solved from the sum of the stored chunks, and only the years
+without stored chunks (like the current year) are computed from the images.
+
+The sums are stored for a well conditioned basis of each model family, the powers of
+the day of year divided by 365 and the harmonics of the time since EPOCH_YEAR with the
+years since EPOCH_YEAR. Conversion() maps the coefficients of this basis to the
+coefficients of the variables of the app.
+"""
+
+import calendar
+import math
+
+from google.appengine.api import memcache
+
+
+# The model family of the stored sums and the number of predictors of each regression,
+# the polynomials use the leading predictors of the "poly" basis [1, x, x^2, x^3].
+FAMILIES = {"poly1": ("poly", 2), "poly2": ("poly", 3), "poly3": ("poly", 4), "zhuWood": ("harmonic", 4)}
+
+# The number of predictors of the basis of each family.
+PREDICTORS = 4
+
+# The origin of the time of the harmonic basis.
+EPOCH_YEAR = 2000
+
+# The length of a year of the harmonic models (seconds).
+YEAR_SECONDS = 365 * 24 * 60 * 60
+
+# The days the day of year is divided by in the polynomial basis.
+YEAR_DAYS = 365.0
+
+
+def XXBand(i, j):
+    """Returns the name of the band with the sum of x_i * x_j (i and j in any order)."""
+    return "xx_%s_%s" % (min(i, j), max(i, j))
+
+
+def XYBand(i):
+    """Returns the name of the band with the sum of x_i * y."""
+    return "xy_%s" % i
+
+
+def Bands():
+    """Returns the names of the bands of the stored sums (the upper triangle of X'X, X'y, y'y and n)."""
+    return ([XXBand(i, j) for i in range(PREDICTORS) for j in range(i, PREDICTORS)] +
+            [XYBand(i) for i in range(PREDICTORS)] + ["yy", "n"])
+
+
+def MaskKey(cloudmask, cloudscore, max_cover, clear_cover):
+    """Returns the part of the chunk name that identifies the cloud masking of the options.
+
+    The thresholds of the scene cloud cover prefilter decide which scenes are summed into a chunk, so they
+    are part of the key and the chunks are not reused if they change.
+
+    Args:
+        cloudmask: The cloud masking method of the options [score,qa].
+        cloudscore: The max cloud score of the options.
+        max_cover: The cloud cover above which the scenes are dropped (if the pixels are masked).
+        clear_cover: The cloud cover up to which the scenes skip the cloud score.
+    """
+    if cloudmask == "qa":
+        return "qa-max%s" % max_cover
+    if 0 < cloudscore < 100:
+        return "score%s-max%s-clear%s" % (cloudscore, max_cover, clear_cover)
+    return "none"
+
+
+def ChunkName(family, sensor, mask, path, row, year):
+    """Returns the asset name of a chunk like "poly_land8_score20-max80-clear2_193_023_2015"."""
+    return "%s_%s_%s_%03d_%03d_%s" % (family, sensor, mask, path, row, year)
+
+
+def Conversion(regression, start):
+    """Returns the matrix that maps the coefficients of the stored basis to the coefficients of the app.
+
+    The variables of the app are linear combinations of the basis, X_app = X_basis * M, so the
+    coefficients are b_app = M^-1 * b_basis and the residuals are the same.
+
+    Args:
+        regression: The regression of the options (a key of FAMILIES).
+        start: The first year of the options, the origin of the time of the Zhu & Woodcock model.
+
+    Returns:
+        A list of rows of the k x k matrix M^-1 (k is the number of predictors of the regression).
+    """
+    family, predictors = FAMILIES[regression]
+    if family == "poly":
+        # doy^k = (365 * x)^k
+        return [[(1.0 / YEAR_DAYS ** i if i == j else 0.0) for j in range(predictors)] for i in range(predictors)]
+
+    # the app uses the time since the start year t - c, cos(w(t - c)) = cos(wc) cos(wt) + sin(wc) sin(wt)
+    offset = calendar.timegm((start, 1, 1, 0, 0, 0)) - calendar.timegm((EPOCH_YEAR, 1, 1, 0, 0, 0))
+    angle = 2 * math.pi * offset / YEAR_SECONDS
+    matrix = [[1.0, 0.0, 0.0, -float(offset)],
+              [0.0, math.cos(angle), -math.sin(angle), 0.0],
+              [0.0, math.sin(angle), math.cos(angle), 0.0],
+              [0.0, 0.0, 0.0, float(YEAR_SECONDS)]]
+    return _Invert(matrix)
+
+
+def _Invert(matrix):
+    """Returns the inverse of a small regular matrix (Gauss-Jordan elimination with pivoting)."""
+    size = len(matrix)
+    rows = [list(row) + [1.0 if i == j else 0.0 for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(rows[r][column]))
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        divisor = rows[column][column]
+        rows[column] = [value / divisor for value in rows[column]]
+        for r in range(size):
+            if r != column and rows[r][column] != 0:
+                factor = rows[r][column]
+                rows[r] = [value - factor * pivot_value for value, pivot_value in zip(rows[r], rows[column])]
+    return [row[size:] for row in rows]
+
+
+class StatsStore(object):
+
+    """The index of the stored chunks in an EE asset folder.
+
+    The list of the assets is cached in the Memcache, and a chunk whose export was started
+    is marked as pending, so that it is only exported once.
+    """
+
+    def __init__(self, folder, list_assets, list_lifetime, pending_lifetime):
+        """Creates the store.
+
+        Args:
+            folder: The EE asset folder of the chunks.
+            list_assets: A function that returns the asset ids in a folder.
+            list_lifetime: Seconds the list of the assets is cached.
+            pending_lifetime: Seconds after which a pending chunk can be exported again.
+        """
+        self.folder = folder
+        self.list_assets = list_assets
+        self.list_lifetime = list_lifetime
+        self.pending_lifetime = pending_lifetime
+
+
+    def AssetId(self, name):
+        return "%s/%s" % (self.folder, name)
+
+
+    def Stored(self):
+        """Returns the set of the names of the stored chunks."""
+        names = memcache.get("stats-assets:" + self.folder)
+        if names is None:
+            names = set(asset_id.rsplit("/", 1)[-1] for asset_id in self.list_assets(self.folder))
+            memcache.set("stats-assets:" + self.folder, names, time=self.list_lifetime)
+        return names
+
+
+    def Pending(self, names):
+        """Returns the set of the names whose export was started."""
+        return set(memcache.get_multi(names, key_prefix="stats-pending:"))
+
+
+    def Reserve(self, name):
+        """Marks a chunk as pending. Returns False if it is already pending."""
+        return memcache.add("stats-pending:" + name, True, time=self.pending_lifetime)
+
+
+    def Release(self, name):
+        """Removes the pending mark of a chunk whose export could not be started."""
+        memcache.delete("stats-pending:" + name)
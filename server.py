@@ -12,7 +12,8 @@ The map handler generates a unique client ID for the Channel API connection,
 injects it into the index.html template, and returns the page contents.
 
 When the user changes the options in the UI and clicks the compute button, the /mapid handler will generated
-map IDs for each image band.
+map IDs for each image band. In preview mode these are computed from a subsample of the collection first and
+the /mapidrunner sends the full resolution map IDs over Firebase when they are ready.
 
 When the user requests a chart the /chart handler generates and returns a small chart over the Channel API.
 Also a full screen version is temporary available (ids are saved with the Memcache API) where the chart can
@@ -22,12 +23,15 @@ When the user exports a file, the /export handler then kicks off an export
 runner (running asynchronously) to create the EE task and poll for the task's
 completion. When the EE task completes, the file is stored for 5 hours in the service
 account's Drive folder and an download link is sent to the user's browser using the Channel API.
+The download links point to the /file handler, which records the download and redirects to Drive.
 
 To clear the service account's Drive folder a cron job runs every hour and deletes all files older than 5 hours.
+If an export would fill the Drive above DRIVE_HIGH_WATER, older exports are deleted before (see storage.py).
 
 Another export method is the /download handler that generates a download url directly from the EE.
 With this method the computing is done on the fly, because of that the download is not very stable and
-the file size is limited by 1024 MB.
+the file size is limited by 1024 MB. The size is estimated locally before (exportsize.py), larger downloads
+are split into tiles or exported via Google Drive and exports larger than EXPORT_MAX_PIXELS are rejected.
 """
 
 import math
@@ -35,11 +39,16 @@ import traceback
 import json
 import logging
 import os
+import gzip
+import io
+import zlib
 import random
 import socket
 import string
+import threading
 import time
 import calendar
+import hashlib
 import urlparse
 import re
 from datetime import datetime
@@ -50,7 +59,6 @@ os.environ.setdefault("PATH", '')
 import httplib2
 import firebase_admin
 from firebase_admin import auth as firebase_auth
-import ee
 import jinja2
 
 from oauth2client.service_account import ServiceAccountCredentials
@@ -62,8 +70,25 @@ from google.appengine.api import urlfetch
 from google.appengine.api import memcache
 from google.appengine.api import users
 
+import adaptive
+import bulkexport
+import capture
 import config
 import drive
+import exportqueue
+import exportsize
+import polygons
+import regressionstats
+import storage
+import supersession
+import tiles
+import wrs
+
+# the local numpy emulator replaces Earth Engine for offline benchmarks (see eemulator/__init__.py)
+if config.EE_EMULATOR:
+    import eemulator as ee
+else:
+    import ee
 
 
 ###############################################################################
@@ -87,6 +112,8 @@ CREDENTIALS = ServiceAccountCredentials.from_json_keyfile_name(config.SERVICE_AC
 
 # Initialize the EE API.
 ee.Initialize(CREDENTIALS)
+if config.EE_EMULATOR:
+    ee.Configure(data=config.EE_EMULATOR_DATA)
 # Set some timeouts
 ee.data.setDeadline(URL_FETCH_TIMEOUT*1000)  # in milliseconds (default no limit)
 socket.setdefaulttimeout(URL_FETCH_TIMEOUT)
@@ -102,15 +129,195 @@ JINJA2_ENVIRONMENT = jinja2.Environment(
 # An authenticated Drive helper object for the app service account.
 DRIVE_HELPER = drive.DriveHelper(CREDENTIALS)
 
+# The share of the Drive quota that an export may fill before the exports that were not downloaded
+# for the longest time are deleted (see storage.py).
+DRIVE_HIGH_WATER = 0.8
+
+# The share of the Drive quota the deletion frees the Drive down to.
+DRIVE_LOW_WATER = 0.6
+
+# The minimum seconds an exported file is kept, even if the Drive is full.
+DRIVE_MIN_RETENTION = 15*60
+
+# The seconds an exported file is kept if the Drive is not full (deleted by the cron job).
+DRIVE_MAX_RETENTION = 5*60*60
+
+# The records of the exported files in the Drive and their eviction if the Drive is too full.
+STORAGE = storage.DriveStorage(DRIVE_HELPER, DRIVE_HIGH_WATER, DRIVE_LOW_WATER, DRIVE_MIN_RETENTION)
+
+# The local index of the Landsat WRS-2 scene footprints.
+WRS_INDEX = wrs.WrsIndex()
+
+# The sampled capture of the handled requests (disabled if config.CAPTURE_RATE is 0).
+CAPTURE = capture.RequestCapture(config.CAPTURE_RATE, config.CAPTURE_FILE)
+
+# The sizes of the EE graphs sent by the request of the current thread (see _MeasureGraphs()).
+GRAPH_SIZES = threading.local()
+
+# The generations of the map and chart requests of the clients, a newer request stops the older ones (see supersession.py).
+GENERATIONS = supersession.Generations()
+
 # The resolution of the exported images (meters per pixel).
 EXPORT_RESOLUTION = 30
 
+# The tolerance (meters) the regions of the clients are simplified with (see polygons.py), the
+# simplified polygon differs from the drawn one by less than a pixel of the exports
+REGION_SIMPLIFY_TOLERANCE = EXPORT_RESOLUTION
+
 # The maximum number of pixels in an exported image.
 EXPORT_MAX_PIXELS = 10e10
 
+# The data type of the bands of the exported regression images with the float encoding (see exportsize.py).
+EXPORT_DATA_TYPE = "double"
+
+# The encodings of the exported and downloaded regression images, float stores the bands as EXPORT_DATA_TYPE
+# and int16 and int32 store them as scaled integers (see _ExportEncoding()).
+EXPORT_ENCODINGS = ("float", "int16", "int32")
+
+# The default precision of the scaled integer encodings, the decimal digits of the contribution of a band to the NDVI,
+# and the largest precision at which a contribution of 1 still fits into the type (larger values are stored as nodata).
+EXPORT_PRECISION = {"int16": 3, "int32": 6}
+EXPORT_MAX_PRECISION = {"int16": 4, "int32": 9}
+
+# The band prefixes that can have their own precision.
+PRECISION_BANDS = ("a0", "a1", "a2", "a3", "rmse")
+
+# The range of the integer types, the smallest value marks the masked pixels.
+INTEGER_RANGES = {"int16": (-2**15, 2**15 - 1), "int32": (-2**31, 2**31 - 1)}
+
+# Exports with a larger estimated size (bytes) are started with a warning to the client.
+EXPORT_WARN_BYTES = 10*1024*1024*1024
+
+# The default size of the shards an export is computed in (pixels per side)
+EXPORT_SHARD_SIZE = 256
+
+# The adaptations of an export after EE memory or time limit errors (see adaptive.py), tried in order:
+# smaller shards, then the region split into parts that are exported one after the other
+EXPORT_ADAPTATIONS = [adaptive.Multiply("shardSize", 0.25, 64), adaptive.SplitBounds("parts", 4), adaptive.SplitBounds("parts", 4)]
+
+# The adaptations of a chart after EE memory or time limit errors, tried in order: a higher tileScale
+# of the reductions at the point and the time series split into time ranges that are reduced one by one
+CHART_ADAPTATIONS = [adaptive.Multiply("tileScale", 4, 16), adaptive.SplitYears("years"), adaptive.Multiply("tileScale", 4, 16), adaptive.SplitYears("years")]
+
+# The seconds the point series prefetched for a chart (see ChartPrefetchHandler) are kept in the Memcache,
+# the seconds a prefetch is considered running and the seconds a chart waits for the running prefetch of its point
+CHART_PREFETCH_CACHE_SECONDS = 10*60
+CHART_PREFETCH_RUNNING_SECONDS = 60
+CHART_PREFETCH_WAIT_SECONDS = 30
+
+# The number of random pixels at EXPORT_RESOLUTION the sampled statistics of /stats are computed from,
+# and the maximum number of pixels (estimated from the bounding box) of a region with exact statistics at EXPORT_RESOLUTION
+REGION_STATS_SAMPLE_PIXELS = 10000
+REGION_STATS_EXACT_PIXELS = 10e6
+REGION_STATS_MODES = ("sampled", "exact")
+
+# The seed of the pixel sample, the same region and options always give the same (cacheable) statistics
+REGION_STATS_SEED = 0
+
+# The percentiles and the maximum number of histogram buckets of the statistics of a band
+REGION_STATS_PERCENTILES = [5, 25, 50, 75, 95]
+REGION_STATS_BUCKETS = 20
+
+# The seconds the statistics of a region are kept in the Memcache and by the browser
+REGION_STATS_CACHE_SECONDS = 24*60*60
+
+# The adaptations of the statistics of a region after EE memory or time limit errors (see adaptive.py)
+REGION_STATS_ADAPTATIONS = [adaptive.Multiply("tileScale", 4, 16), adaptive.Multiply("tileScale", 4, 16)]
+
+# The maximum size of a direct download from EE (bytes) and the maximum number of tiles a larger download
+# is split into, even larger downloads are exported via Google Drive instead.
+DOWNLOAD_MAX_BYTES = 1024*1024*1024
+DOWNLOAD_MAX_TILES = 4
+
+# The number of coefficients of each regression, the regression images have a band per coefficient and the band "rmse".
+REGRESSION_COEFFICIENTS = {"poly1": 2, "poly2": 3, "poly3": 4, "zhuWood": 4}
+
+# Responses with at least this size (bytes) are compressed if the client accepts gzip or deflate.
+COMPRESS_MIN_BYTES = 1024
+
+# Seconds the clients may reuse the full map IDs of the same options and a full screen chart (see DataHandler.CacheFor()).
+MAPID_CACHE_SECONDS = 60*60
+CHART_CACHE_SECONDS = 24*60*60
+
 # The frequency to poll for export EE task completion (seconds).
 TASK_POLL_FREQUENCY = 10
 
+# The maximum number of images in the collection of a map preview.
+PREVIEW_MAX_IMAGES = 48
+
+# The scale of a map preview (meters per pixel) if the map is zoomed in further.
+PREVIEW_SCALE = 120
+
+# The composite periods and methods of the temporal compositing before the regression (see _CompositeCollection()).
+COMPOSITE_PERIODS = ("none", "16day", "month")
+COMPOSITE_METHODS = ("median", "maxndvi")
+
+# The length of the 16 day composite periods (days), the periods start on January 1st of each year.
+COMPOSITE_DAYS = 16
+
+# The maximum number of EE export tasks that run at the same time (for all clients).
+EXPORT_MAX_RUNNING = 2
+
+# The seconds after which a running export without heartbeat frees its slot in the export queue.
+EXPORT_SLOT_TIMEOUT = 20*60
+
+# The global queue of the exports of all clients (in the Datastore).
+EXPORT_QUEUE = exportqueue.ExportQueue("export-queue", EXPORT_MAX_RUNNING, EXPORT_SLOT_TIMEOUT)
+
+# The maximum number of features of a bulk export.
+BULK_MAX_FEATURES = 500
+
+# Seconds the state and the manifest of a bulk export are kept.
+BULK_LIFETIME = 24*60*60
+
+# The state of the bulk exports in the Datastore (their parts share the slots of the export queue).
+BULK_EXPORTS = bulkexport.BulkExports(BULK_LIFETIME)
+
+# The maximum number of points of a point export.
+POINT_MAX = 200000
+
+# Point exports with up to this number of points are extracted directly, larger ones with EE table exports.
+POINT_DIRECT_MAX = 100
+
+# The maximum number of points of a batch of a table export and of a direct extraction.
+POINT_BATCH_SIZE = 2000
+POINT_DIRECT_BATCH_SIZE = 25
+
+# The size of the grid cells (degrees) the points of a batch are taken from.
+POINT_BATCH_CELL = 1.0
+
+# The columns of the CSV tables with the NDVI time series of points.
+POINT_SERIES_COLUMNS = ["point_id","date","sensor","ndvi"]
+
+# Seconds the list of the stored regression statistics is cached and after which a chunk whose export did not finish is exported again.
+STATS_LIST_LIFETIME = 10*60
+STATS_PENDING_LIFETIME = 12*60*60
+
+# The maximum number of chunk exports started by one /statsrunner task.
+STATS_MAX_EXPORTS = 50
+
+# The yearly regression statistics stored in EE assets (only used if config.REGRESSION_STATS_FOLDER is set).
+STATS_STORE = regressionstats.StatsStore(config.REGRESSION_STATS_FOLDER, lambda folder: [asset["id"] for asset in ee.data.getList({"id": folder})],
+                                         STATS_LIST_LIFETIME, STATS_PENDING_LIFETIME)
+
+# The bytes of the tile cache in the memory of an instance and of the disk cache (if config.TILE_CACHE_DIR is set).
+TILE_MEMORY_BYTES = 32*1024*1024
+TILE_DISK_BYTES = 1024*1024*1024
+
+# The caching proxy of the EE map tiles (only used if config.TILE_PROXY is set).
+TILE_PROXY = tiles.TileProxy("https://earthengine.googleapis.com/map", TILE_MEMORY_BYTES, config.TILE_CACHE_DIR, TILE_DISK_BYTES)
+
+# Scenes with a higher CLOUD_COVER (percent) are dropped before the cloud masking.
+SCENE_MAX_CLOUD_COVER = 80
+
+# Scenes with a lower or equal CLOUD_COVER (percent) are used without calculating the simpleCloudScore.
+SCENE_CLEAR_CLOUD_COVER = 2
+
+# The bits of the Landsat Collection 1 BQA band that mask a pixel with the qa cloud mask:
+# cloud (4) and the high bit of the cloud shadow (7-8), snow/ice (9-10) and cirrus (11-12) confidence,
+# so that pixels with a medium or high confidence are masked out.
+QA_MASK_BITS = (1 << 4) | (1 << 8) | (1 << 10) | (1 << 12)
+
 
 ###############################################################################
 #                             Web request handlers.                           #
@@ -139,17 +346,68 @@ class DataHandler(webapp2.RequestHandler):
         raise NotImplementedError()
 
     def Handle(self, handle_function):
-        """Responds with the result of the handle_function or errors, if any."""
+        """Responds with the result of the handle_function or errors, if any, and the vertices of the region."""
         try:
             response = handle_function()
+        except supersession.Superseded as e:
+            # the client has already abandoned the request
+            response = {"cancelled": str(e)}
         except Exception as e:
             if DEBUG:
                 response = {"error": str(e) + " - " + traceback.format_exc()}
             else:
                 response = {"error": str(e)}
+
+        # the client shows how much the region was simplified (see _ReadOptions()), also for requests without other results
+        vertices = self.request.registry.get("region_vertices")
+        if vertices is not None and response is None and self.response.status_int == 200 and not self.response.body:
+            response = {}
+        if vertices is not None and isinstance(response, dict) and "error" not in response and "cancelled" not in response:
+            response["region"] = {"vertices": vertices}
         if response:
-            self.response.headers["Content-Type"] = "application/json"
-            self.response.out.write(json.dumps(response))
+            # the capture can not read errors from compressed responses
+            self.request.registry["error"] = "error" in response
+            self.Write(json.dumps(response), "application/json")
+
+    def Write(self, body, content_type):
+        """Writes the response, compressed with gzip or deflate if the client accepts it and
+        the body has at least COMPRESS_MIN_BYTES. The ETag of a compressed response gets the
+        encoding as suffix, as it is a different representation.
+        """
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        self.response.headers["Content-Type"] = content_type
+        self.response.headers["Vary"] = "Accept-Encoding"
+        encoding = _AcceptedEncoding(self.request.headers.get("Accept-Encoding", "")) if len(body) >= COMPRESS_MIN_BYTES else None
+        if encoding is not None:
+            body = _Compress(body, encoding)
+            self.response.headers["Content-Encoding"] = encoding
+            etag = self.response.headers.get("ETag")
+            if etag is not None:
+                self.response.headers["ETag"] = '%s-%s"' % (etag[:-1], encoding)
+        self.response.out.write(body)
+
+    def CacheFor(self, etag, seconds):
+        """Marks the response as deterministic, the client may reuse it for some seconds and revalidate it with the ETag."""
+        self.response.headers["ETag"] = '"%s"' % etag
+        self.response.headers["Cache-Control"] = "private, max-age=%d" % seconds
+
+    def NotModified(self, etag, seconds):
+        """Answers the request with 304 if the client sent the ETag (of any encoding) in If-None-Match.
+
+        Args:
+            etag: The ETag of the response (without quotes).
+            seconds: The time the client may keep using its copy (renewed by the 304).
+
+        Returns:
+            True if the request is answered and the handler has to return None.
+        """
+        tags = [tag.strip() for tag in self.request.headers.get("If-None-Match", "").split(",")]
+        if not any(tag == '"%s"' % etag or (tag.startswith('"%s-' % etag) and tag.endswith('"')) for tag in tags):
+            return False
+        self.response.set_status(304)
+        self.CacheFor(etag, seconds)
+        return True
 
 
 class MapHandler(DataHandler):
@@ -159,15 +417,17 @@ class MapHandler(DataHandler):
     def DoGet(self):
         """Returns the main web page with Firebase details included."""
         client_id = _GetUniqueString()
+        self.request.registry["client_id"] = client_id
 
         template = JINJA2_ENVIRONMENT.get_template("templates/index.html")
-        self.response.out.write(template.render({
+        self.Write(template.render({
                 # channel token expire in 24 hours
                 "clientId": client_id,
                 "firebaseToken": create_custom_token(client_id),
                 "firebaseConfig": "templates/%s" % config.FIREBASE_CONFIG,
+                "chartPrefetch": config.CHART_PREFETCH,
                 "display_splash": "none"
-        }))
+        }), "text/html; charset=utf-8")
 
 
 class MapIdHandler(DataHandler):
@@ -184,32 +444,170 @@ class MapIdHandler(DataHandler):
             end: the end year to filter the satellite images (including)
             cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
                         Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
             point: an array of two double values representing coordinates like [<longitude>,<latitude>]
             region: an array of arrays representing a region [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
             client_id: the unique id that is used for the channel api
+            preview: if "true" the map IDs of a fast preview are returned and the full map IDs
+                     are sent over the channel api by a MapIdRunnerHandler when they are ready (optional)
+            zoom: the current zoom level of the map, used to compute the preview at a coarser scale (optional)
+            layer_request: an id of the request that is sent back with the full map IDs (optional)
 
         Returns:
             A dictionary with a key called 'bands' containing an array of dictionaries
-                like {"name":<band name>,"mapid":<mapid>,"token":<token>}.
+                like {"name":<band name>,"mapid":<mapid>,"token":<token>} and a key called 'preview'.
+                If config.TILE_PROXY is set the dictionaries contain the key "url" of the tile proxy
+                and the mapid is a layer key (see _GetLayers()).
+                The full map IDs have an ETag of the canonical options, if the client sends it in
+                If-None-Match the request is answered with 304 without EE (with config.TILE_PROXY only
+                while the layer keys are registered at the tile proxy).
+                A request that is superseded by a newer map request of the client (see supersession.py)
+                stops between its EE calls and is answered with {"cancelled":<reason>}.
         """
 
-        # reads the request options
+        # reads the request options, the request supersedes the running map requests of the client
         options = _ReadOptions(self.request)
+        preview = self.request.get("preview") == "true"
+        generation = GENERATIONS.Next(options["client_id"], "map")
+        check = GENERATIONS.Checker(options["client_id"], "map", generation)
+
+        # the client still has the full map IDs of the options, the layer keys of the tile proxy
+        # are only valid as long as their map IDs are registered
+        etag = _ETag("mapid", _LayerKey(options))
+        registered = not config.TILE_PROXY or TILE_PROXY.HasLayers([_LayerKey(options) + "-" + band for band in _ImageBands(options)])
+        if registered and self.NotModified(etag, MAPID_CACHE_SECONDS):
+            return
 
-        # creates an image based on the options
-        image = _GetImage(options)
+        # creates an image based on the options (from a subsample of the collection for the preview)
+        info = {}
+        image = _GetImage(options, preview=preview, info=info)
 
         # _GetImage returns None if the collection is empty
         if image is None:
             return {"error": "No images in collection. Change your options."}
+        check()
+
+        # compute the preview at a coarser scale if the map shows smaller pixels
+        zoom = self.request.get("zoom")
+        coarse = preview and zoom != "" and _MapPixelSize(int(zoom)) < PREVIEW_SCALE
+        if coarse:
+            image = image.reproject("EPSG:3857", None, PREVIEW_SCALE)
+
+        # the preview is only needed if it differs from the full map
+        preview = info.get("sampled", False) or coarse
+        if preview:
+            # Kick off a runner that sends the full map IDs over the channel api.
+            # only execute once even if task fails
+            taskqueue.add(url="/mapidrunner", params={"options":json.dumps(options),"layer_request":self.request.get("layer_request"),"generation":json.dumps(generation)},
+                          retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+        else:
+            self.CacheFor(etag, MAPID_CACHE_SECONDS)
+
+        return {"bands":_GetLayers(image, _LayerKey(options, info.get("sampled", False), coarse), _ImageBands(options), check),"preview":preview}
 
-        bands = image.bandNames().getInfo()
-        layers = []
-        for band in bands:
-            # create a map overlay for each band
-            mapid = image.select(band).visualize().getMapId()
-            layers.append({"name":band, "mapid": mapid["mapid"], "token": mapid["token"]})
-        return {"bands":layers}
+
+class MapIdRunnerHandler(webapp2.RequestHandler):
+
+    """A servlet for handling async full resolution map ID requests after a preview."""
+
+    def post(self):
+        """Generates the map IDs from the whole collection and sends them to the client
+            as data of the "layer" message. The client replaces the preview layers with them
+            and can revalidate them with the ETag of the full map IDs like a /mapid response.
+
+        HTTP Parameters:
+            options: the json encoded options of the preview request
+            layer_request: the id of the preview request
+            generation: the json encoded generation of the preview request (see supersession.py)
+        """
+        options = json.loads(self.request.get("options"))
+        self.request.registry["options"] = options
+        layer_request = self.request.get("layer_request")
+        check = GENERATIONS.Checker(options["client_id"], "map", json.loads(self.request.get("generation", default_value="null")))
+
+        try:
+            check()
+            image = _GetImage(options)
+
+            # _GetImage returns None if the collection is empty
+            if image is None:
+                _SendMessage(options["client_id"],"layer","danger","Map failed to load.","No images in collection. Change your options.")
+                return
+
+            check()
+            layers = _GetLayers(image, _LayerKey(options), _ImageBands(options), check)
+        except supersession.Superseded as e:
+            # the client ignores the full map IDs of outdated previews
+            logging.info("Full map of %s stopped: %s" % (layer_request, e))
+            return
+        except Exception as e:
+            if DEBUG:
+                _SendMessage(options["client_id"],"layer","danger","Map failed to load.", str(e) + " - " + traceback.format_exc())
+            else:
+                _SendMessage(options["client_id"],"layer","danger","Map failed to load.", str(e))
+            return
+
+        _SendMessage(options["client_id"],"layer","success","Full resolution map loaded.",
+                     data={"layer_request":layer_request,"bands":layers,"etag":'"%s"' % _ETag("mapid", _LayerKey(options)),"max_age":MAPID_CACHE_SECONDS})
+
+
+class TileHandler(webapp2.RequestHandler):
+
+    """A servlet that serves the map tiles of the regression layers through the caching tile proxy."""
+
+    def get(self, layer, z, x, y):
+        """Returns a map tile from the cache or from EE (see tiles.py).
+
+        URL Path:
+            /tiles/<layer>/<z>/<x>/<y> with the layer key of a band returned by /mapid
+                and the zoom level and coordinates of the tile
+        """
+        if not config.TILE_PROXY:
+            self.response.set_status(404)
+            return
+
+        try:
+            content_type, data = TILE_PROXY.GetTile(layer, int(z), int(x), int(y))
+        except tiles.TileError as e:
+            logging.warning(str(e))
+            self.response.set_status(e.status)
+            return
+
+        self.response.headers["Content-Type"] = content_type
+        self.response.headers["Cache-Control"] = "public, max-age=3600"
+        self.response.out.write(data)
+
+
+class PathRowHandler(DataHandler):
+
+    """A servlet that reports the Landsat scenes that overlap the selected point or region"""
+
+    def DoPost(self):
+        """Returns the WRS-2 path/row pairs of the point and region from the local index (no EE call).
+
+        HTTP Parameters:
+            point: an array of two double values representing coordinates like [<longitude>,<latitude>]
+            region: an array of arrays representing a region [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
+
+        Returns:
+            A dictionary with a key called 'pathrows' containing an array of [<path>,<row>] arrays
+                and a key called 'text' containing a human readable version of it.
+        """
+        point = json.loads(self.request.get("point", default_value="null"))
+        region = json.loads(self.request.get("region", default_value="null"))
+        if region is not None:
+            try:
+                region, vertices = polygons.Prepare(region, REGION_SIMPLIFY_TOLERANCE)
+            except ValueError as e:
+                raise Exception("Invalid region: %s" % e)
+            self.request.registry["region_vertices"] = [vertices, len(region) - 1]
+
+        pathrows = WRS_INDEX.PathRows(point, region)
+        return {"pathrows": pathrows, "text": _FormatPathRows(pathrows)}
 
 
 class ChartHandler(DataHandler):
@@ -223,10 +621,15 @@ class ChartHandler(DataHandler):
             id: the unique chart id (key value for the Memcache API).
 
         Returns:
-            A html page with the full screen chart
+            A html page with the full screen chart, the page of a chart id never changes
+            so a request with its ETag is answered with 304 without the Memcache.
         """
         chart_id = self.request.get("id")
 
+        etag = _ETag("chart", chart_id)
+        if self.NotModified(etag, CHART_CACHE_SECONDS):
+            return
+
         # load chart options from Memcache API
         chart_options = memcache.get(chart_id)
 
@@ -241,20 +644,25 @@ class ChartHandler(DataHandler):
             # style chart view corresponding to the regression type
             if chart_options["regression"] == "zhuWood":
                 chart_options["chart_style"] = "height: 40%;"
-                chart_options["chartArea"] = "{width: \"80%\"}"
+                chart_options["style"]["chartArea"] = {"width":"80%"}
             else:
                 chart_options["chart_style"] = "height: 60%; max-width: 1000px;"
-                chart_options["chartArea"] = "{width: \"70%\"}"
+                chart_options["style"]["chartArea"] = {"width":"70%"}
+            chart_options["chart"] = json.dumps(chart_options["style"])
 
             # output html page
+            html = full_chart % chart_options
             self.response.set_status(200)
-            self.response.headers["Content-Type"] = "text/html"
-            self.response.out.write(full_chart % chart_options)
+            self.CacheFor(etag, CHART_CACHE_SECONDS)
+            self.Write(html, "text/html")
             return
 
     def DoPost(self):
         """Starts an ChartRunnerHandler to asynchronously generate a chart.
 
+        The chart supersedes the running chart of the client at the same pixel (see supersession.py and _ChartKind()),
+        which is stopped and reported as cancelled. The charts of other points are computed to the end.
+
         HTTP Parameters:
             regression: the regression type [poly1,poly2,poly3,zhuWood]
             source: the source satellite [all,land5,land7,land8]
@@ -262,20 +670,26 @@ class ChartHandler(DataHandler):
             end: the end year to filter the satellite images (including)
             cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
                         Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
             point: an array of two double values representing coordinates like [<longitude>,<latitude>]
             client_id: the unique id that is used for the channel api
         """
         # read request options
         options = _ReadOptions(self.request)
+        generation = GENERATIONS.Next(options["client_id"], _ChartKind(options))
 
         # Kick off an export runner to start and monitor the EE export task.
         # Note: The work "task" is used by both Earth Engine and App Engine to refer
         # to two different things. "TaskQueue" is an async App Engine service.
         # only execute once even if task fails
-        taskqueue.add(url="/chartrunner", params={"options":json.dumps(options)}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+        taskqueue.add(url="/chartrunner", params={"options":json.dumps(options),"generation":json.dumps(generation)}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
 
         # notify client browser that the chart creation has started
-        _SendMessage(options["client_id"],"chart-" + options["filename"],"info","Chart creation at [%s/%s] in progress." % (options["point"][1],options["point"][0]))
+        _SendStatus(options["client_id"],"chart",options["filename"],"running",point=options["point"])
 
 
 class ChartRunnerHandler(webapp2.RequestHandler):
@@ -293,30 +707,189 @@ class ChartRunnerHandler(webapp2.RequestHandler):
             end: the end year to filter the satellite images (including)
             cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
                         Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
             point: an array of two double values representing coordinates like [<longitude>,<latitude>]
             client_id: the unique id that is used for the channel api
+            generation: the json encoded generation of the chart request (see supersession.py)
         """
 
         # load the options
         options = json.loads(self.request.get("options"))
+        self.request.registry["options"] = options
+        check = GENERATIONS.Checker(options["client_id"], _ChartKind(options), json.loads(self.request.get("generation", default_value="null")))
 
-        # create the chart
+        # the client is notified about the retries after EE memory or time limit errors
+        adaptations = []
+
+        def report(applied):
+            adaptations[:] = applied
+            _SendStatus(options["client_id"],"chart",options["filename"],"running",point=options["point"],adaptations=applied)
+
+        # create the chart, from the series of the point if it was prefetched
         try:
-            chart = _GetChart(options)
+            check()
+            chart = _GetChart(options, report, _PrefetchedSeries(options), check)
+        except supersession.Superseded as e:
+            _SendStatus(options["client_id"],"chart",options["filename"],"cancelled",point=options["point"],error=str(e))
+            return
         except Exception as e:
             if DEBUG:
-                _SendMessage(options["client_id"],"chart-" + options["filename"],"danger","Chart creation failed.", str(e) + " - " + traceback.format_exc())
+                _SendStatus(options["client_id"],"chart",options["filename"],"failed",error=str(e) + " - " + traceback.format_exc(),adaptations=adaptations or None)
             else:
-                _SendMessage(options["client_id"],"chart-" + options["filename"],"danger","Chart creation failed.", str(e))
+                _SendStatus(options["client_id"],"chart",options["filename"],"failed",error=str(e),adaptations=adaptations or None)
             return
 
         # _GetChart returns None if the collection is empty
         if chart is None:
-            _SendMessage(options["client_id"],"chart-" + options["filename"],"danger","Chart creation failed.","No images in collection. Change your options.")
+            _SendStatus(options["client_id"],"chart",options["filename"],"failed",error="No images in collection. Change your options.")
             return
 
         # send the small chart to client
-        _SendMessage(options["client_id"],"chart-" + options["filename"],"success","Chart for '" + options["filename"] + "':",chart)
+        _SendStatus(options["client_id"],"chart",options["filename"],"completed",urls=[chart["url"]],chart=chart["chart"],adaptations=chart["adaptations"])
+
+
+class ChartPrefetchHandler(DataHandler):
+
+    """A servlet that starts the extraction of the point series of a chart before the chart is requested."""
+
+    def DoPost(self):
+        """Starts a ChartPrefetchRunnerHandler that extracts the series at the point into the Memcache.
+
+        The client calls it (debounced) when the marker is placed or moved. The series is kept for
+        CHART_PREFETCH_CACHE_SECONDS by the pixel of the point and the options (see _ChartSeriesKey()),
+        a ChartRunnerHandler of the same pixel and options takes it instead of extracting it again.
+        Nothing is started unless config.CHART_PREFETCH is set.
+
+        HTTP Parameters:
+            regression: the regression type [poly1,poly2,poly3,zhuWood]
+            source: the source satellite [all,land5,land7,land8]
+            start: the start year to filter the satellite images (including)
+            end: the end year to filter the satellite images (including)
+            cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
+                        Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            point: an array of two double values representing coordinates like [<longitude>,<latitude>]
+            client_id: the unique id that is used for the channel api
+
+        Returns:
+            A dict {"prefetch":<state>} with the state [disabled,cached,running,started].
+        """
+        if not config.CHART_PREFETCH:
+            return {"prefetch":"disabled"}
+
+        options = _ReadOptions(self.request)
+        if options["point"] is None:
+            raise Exception("No point selected")
+
+        key = _ChartSeriesKey(options)
+        if memcache.get(key) is not None:
+            return {"prefetch":"cached"}
+
+        # only one prefetch of a series runs at a time, the marker is often moved within a pixel
+        if not memcache.add(key + ":running", True, time=CHART_PREFETCH_RUNNING_SECONDS):
+            return {"prefetch":"running"}
+
+        # only execute once even if task fails, without a task the charts must not wait for the marker
+        try:
+            taskqueue.add(url="/chartprefetchrunner", params={"options":json.dumps(options)}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+        except Exception:
+            memcache.delete(key + ":running")
+            raise
+        return {"prefetch":"started"}
+
+
+class ChartPrefetchRunnerHandler(webapp2.RequestHandler):
+
+    """A servlet for handling async chart prefetch requests."""
+
+    def post(self):
+        """Extracts the series at the point of a chart into the Memcache (see ChartPrefetchHandler).
+
+        HTTP Parameters:
+            options: the json encoded options of the prefetch request
+        """
+        options = json.loads(self.request.get("options"))
+        self.request.registry["options"] = options
+        key = _ChartSeriesKey(options)
+
+        # a failed prefetch is not reported, the chart extracts the series itself
+        try:
+            series = _GetChartSeries(options)
+            if series is not None:
+                memcache.set(key, series, time=CHART_PREFETCH_CACHE_SECONDS)
+        except Exception as e:
+            logging.warning("Prefetch of the chart series failed: %s", e)
+        finally:
+            memcache.delete(key + ":running")
+
+
+class RegionStatsHandler(DataHandler):
+
+    """A servlet that computes summary statistics of the regression image over a region."""
+
+    def DoPost(self):
+        """Returns the statistics of each band of the regression image inside of the region.
+
+        The sampled mode reduces a random sample of REGION_STATS_SAMPLE_PIXELS pixels at EXPORT_RESOLUTION and
+        estimates the valid pixels of the region at a coarser scale (with bestEffort), so it answers in seconds where an export of the region takes tens of minutes. The exact mode reduces
+        all pixels at EXPORT_RESOLUTION, it is limited to regions with about REGION_STATS_EXACT_PIXELS pixels.
+        The statistics are cached in the Memcache by the canonical options, the region and the mode.
+
+        HTTP Parameters:
+            regression: the regression type [poly1,poly2,poly3,zhuWood]
+            source: the source satellite [all,land5,land7,land8]
+            start: the start year to filter the satellite images (including)
+            end: the end year to filter the satellite images (including)
+            cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
+                        Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            region: an array of arrays representing a region [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
+            mode: the mode of the statistics [sampled,exact] (optional, default sampled)
+            client_id: the unique id that is used for the channel api.
+
+        Returns:
+            A dictionary created by _GetRegionStats(). The response has an ETag of the canonical options,
+            the region and the mode, if the client sends it in If-None-Match the request is answered with 304.
+        """
+        options = _ReadOptions(self.request)
+        mode = self.request.get("mode", default_value="sampled")
+        if mode not in REGION_STATS_MODES:
+            raise Exception("Invalid statistics mode: %s" % mode)
+        if options["region"] is None:
+            raise Exception("No region selected")
+
+        # the statistics only depend on the region, not on the point or on the encoding of the exports
+        options["point"] = None
+        key = "regionstats:%s:%s" % (_OptionsKey(dict((k, v) for k, v in options.items() if k not in ("encoding", "precision", "count"))), mode)
+
+        # the client still has the statistics
+        etag = _ETag("stats", key)
+        if self.NotModified(etag, REGION_STATS_CACHE_SECONDS):
+            return
+
+        stats = memcache.get(key)
+        if stats is None:
+            stats = _GetRegionStats(options, mode)
+
+            # _GetRegionStats returns None if the collection is empty
+            if stats is None:
+                return {"error": "No images in collection. Change your options."}
+            memcache.set(key, stats, REGION_STATS_CACHE_SECONDS)
+
+        self.CacheFor(etag, REGION_STATS_CACHE_SECONDS)
+        return stats
 
 
 class DownloadHandler(DataHandler):
@@ -326,6 +899,10 @@ class DownloadHandler(DataHandler):
     def DoPost(self):
         """Creates a download url (directly from EE) for the region specified in the options.
 
+        The size of the download is estimated before (see exportsize.py). Downloads larger than
+        DOWNLOAD_MAX_BYTES are split into tiles with a download url each and downloads that would
+        need more than DOWNLOAD_MAX_TILES tiles are exported via Google Drive like with /export.
+
         HTTP Parameters:
             regression: the regression type [poly1,poly2,poly3,zhuWood]
             source: the source satellite [all,land5,land7,land8]
@@ -333,32 +910,66 @@ class DownloadHandler(DataHandler):
             end: the end year to filter the satellite images (including)
             cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
                         Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            encoding: the encoding of the bands [float,int16,int32] (optional, default float)
+                      int16 and int32 store the bands as scaled integers with a scale per band
+            precision: the decimal digits of the contribution of the bands to the NDVI with an integer encoding,
+                       a number or a JSON object {<a0,a1,a2,a3 or rmse>:<digits>} (optional, default EXPORT_PRECISION)
+            count: "true" to add the band "count" with the number of NDVI values per pixel (optional, default false)
             region: an array of arrays representing a region [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
             client_id: the unique id that is used for the channel api.
 
         Returns:
-            A dictionary with the key "url" containing the download url
+            A dictionary with the key "url" containing the download url (the first one of a tiled download)
         """
         # read the request options
         options = _ReadOptions(self.request)
+        if options["region"] is None:
+            raise Exception("No region selected")
+
+        # the size is estimated locally before anything is computed by EE
+        bounds = bulkexport.Bounds([[options["region"]]])
+        size = _EstimateSize(options, bounds)
+        if size["bytes"] > DOWNLOAD_MAX_BYTES * DOWNLOAD_MAX_TILES:
+            _SendMessage(options["client_id"],"download-" + options["filename"],"info","The download is too large, it is exported via Google Drive instead.",
+                         "Estimated size: %s (%s x %s pixels, %s bands)." % (exportsize.FormatBytes(size["bytes"]),size["width"],size["height"],size["bands"]))
+            return _QueueExport(options, size)
+        tiles = exportsize.Tiles(bounds, int(math.ceil(float(size["bytes"]) / DOWNLOAD_MAX_BYTES)))
 
         # notify client that the url creation has started
-        _SendMessage(options["client_id"],"download-" + options["filename"],"info","Download creation of '" + options["filename"] + "' in progress.")
+        _SendStatus(options["client_id"],"download",options["filename"],"running")
 
         # get the image and then the download url from EE
-        image = _GetImage(options)
+        image = _GetImage(options, count=options["count"])
 
         # _GetImage returns None if the collection is empty
         if image is None:
             return {"error": "No images in collection. Change your options."}
 
-        downloadUrl = image.getDownloadURL({"name":options["filename"],"scale":EXPORT_RESOLUTION,"region":options["region"]})
+        # the bands are stored as scaled integers
+        encoding = _ExportEncoding(options)
+        if encoding is not None:
+            image = _EncodeImage(image.clip(ee.Geometry.Polygon(options["region"])), encoding)
+
+        if len(tiles) == 1:
+            downloadUrls = [image.getDownloadURL({"name":options["filename"],"scale":EXPORT_RESOLUTION,"region":options["region"]})]
+        else:
+            # the tiles are rectangles, the pixels outside of the region are masked
+            if encoding is None:
+                image = image.clip(ee.Geometry.Polygon(options["region"]))
+            downloadUrls = [image.getDownloadURL({"name":"%s_%03d" % (options["filename"],number + 1),"scale":EXPORT_RESOLUTION,
+                                                  "region":[[west,south],[east,south],[east,north],[west,north],[west,south]]})
+                            for number, (west, south, east, north) in enumerate(tiles)]
 
-        # send the url to the client
-        _SendMessage(options["client_id"],"download-" + options["filename"],"success","Download link for '" + options["filename"] + "':","<a target='_blank' href='" + downloadUrl + "'>" + downloadUrl + "</a>")
+        # send the urls to the client
+        _SendStatus(options["client_id"],"download",options["filename"],"completed",urls=downloadUrls,encoding=encoding)
 
         # returns the download url (response is not used on the client side)
-        return {"url":downloadUrl}
+        return {"url":downloadUrls[0]}
 
 
 class ExportHandler(DataHandler):
@@ -375,26 +986,25 @@ class ExportHandler(DataHandler):
             end: the end year to filter the satellite images (including)
             cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
                         Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            encoding: the encoding of the bands [float,int16,int32] (optional, default float)
+                      int16 and int32 store the bands as scaled integers with a scale per band
+            precision: the decimal digits of the contribution of the bands to the NDVI with an integer encoding,
+                       a number or a JSON object {<a0,a1,a2,a3 or rmse>:<digits>} (optional, default EXPORT_PRECISION)
+            count: "true" to add the band "count" with the number of NDVI values per pixel (optional, default false)
             region: an array of arrays representing a region [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
             client_id: the unique id that is used for the channel api.
         """
         # read the options
         options = _ReadOptions(self.request)
+        if options["region"] is None:
+            raise Exception("No region selected")
 
-        running_export = memcache.get(options["client_id"])
-
-        # check if the user has an export running
-        if running_export is not None and running_export["task"] is not None:
-            return {"error":"Currently another export is running for you. Please wait or cancel it."}
-
-        # Kick off an export runner to start and monitor the EE export task.
-        # Note: The work "task" is used by both Earth Engine and App Engine to refer
-        # to two different things. "TaskQueue" is an async App Engine service.
-        # only execute once even if task fails
-        taskqueue.add(url="/exportrunner", params={"options":json.dumps(options)}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
-
-        # notify client that the export has started
-        _SendMessage(options["client_id"],"export-" + options["filename"],"info","Export of '" + options["filename"] + "' in progress.")
+        return _QueueExport(options, _EstimateSize(options, bulkexport.Bounds([[options["region"]]])))
 
 
 ###############################################################################
@@ -407,9 +1017,11 @@ class ExportRunnerHandler(webapp2.RequestHandler):
     def post(self):
         """Exports an image for the given options and provides a 5 hours valid download url.
 
-        This is called by our trusted export handler and runs as a separate
-        process. If the deadline of 10 Minutes is exceeded the EE task ID and polling counter
-        will be handed over to a new /exportrunner.
+        This is called by _DispatchExports() when the export got a slot in the export queue and runs
+        as a separate process. If the deadline of 10 Minutes is exceeded the EE task ID and polling counter
+        will be handed over to a new /exportrunner. When the export is finished its slot is released
+        and the next queued export is started. A task that fails with an EE memory or time limit error
+        is restarted with the next of the EXPORT_ADAPTATIONS (smaller shards or the region split into parts).
 
         HTTP Parameters:
             regression: the regression type [poly1,poly2,poly3,zhuWood]
@@ -418,8 +1030,19 @@ class ExportRunnerHandler(webapp2.RequestHandler):
             end: the end year to filter the satellite images (including)
             cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
                         Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            encoding: the encoding of the bands [float,int16,int32] (optional, default float)
+                      int16 and int32 store the bands as scaled integers with a scale per band
+            precision: the decimal digits of the contribution of the bands to the NDVI with an integer encoding,
+                       a number or a JSON object {<a0,a1,a2,a3 or rmse>:<digits>} (optional, default EXPORT_PRECISION)
+            count: "true" to add the band "count" with the number of NDVI values per pixel (optional, default false)
             region: an array of arrays representing a region [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
             client_id: the unique id that is used for the channel api.
+            job_id: the id of the export in the export queue
         """
 
         # start time in epoch seconds + 9 minutes
@@ -427,6 +1050,11 @@ class ExportRunnerHandler(webapp2.RequestHandler):
 
         # load the options
         options = json.loads(self.request.get("options"))
+        self.request.registry["options"] = options
+        job_id = self.request.get("job_id", default_value=None)
+
+        # the export keeps its queue slot while the polling is handed over to a new /exportrunner
+        handed_over = False
 
         try:
             # reads EE task id and polling counter from an previous /exportrunner
@@ -436,41 +1064,37 @@ class ExportRunnerHandler(webapp2.RequestHandler):
             except ValueError:
                 task_count = None
 
+            # the last status sent to the client as [<state>,<progress>], the client is only notified about changes
+            sent = json.loads(self.request.get("task_sent", default_value="null"))
+
+
+            # the parameters of the EE task that are adapted after EE memory or time limit errors and the parts
+            # of the region that are not exported yet (see _StartExportTask()), handed over like the task id
+            params = json.loads(self.request.get("task_params", default_value="null"))
+            if params is None:
+                params = {"shardSize":EXPORT_SHARD_SIZE,"parts":[None],"bounds":bulkexport.Bounds([[options["region"]]]),"number":0}
+            image = None
 
             # task_id and task_count are None if this is a new /exportrunner request
             if task_id is None or task_count is None:
 
-                image = _GetImage(options)
+                image = _GetImage(options, count=options.get("count", False))
 
                 # _GetImage returns None if the collection is empty
                 if image is None:
-                    _SendMessage(options["client_id"],"export-" + options["filename"],"danger","Export of '" + options["filename"] + "' failed.","No images in collection. Change your options.")
+                    _SendStatus(options["client_id"],"export",options["filename"],"failed",error="No images in collection. Change your options.")
                     return
 
-                # Determine the geometry based on the polygon's coordinates.
-                geometry = ee.Geometry.Polygon(options["region"])
-
-                # cut out the geometry (the client drawn polygon)
-                image = image.clip(geometry)
+                # older exports are deleted if the export would fill the Drive above DRIVE_HIGH_WATER
+                _MakeDriveRoom(_EstimateSize(options, params["bounds"])["bytes"])
 
-                # Create and start the task.
-                task = ee.batch.Export.image(
-                        image=image,
-                        description=options["filename"],
-                        config={
-                                "driveFileNamePrefix": options["filename"],
-                                "maxPixels": EXPORT_MAX_PIXELS,
-                                "scale": EXPORT_RESOLUTION,
-                        })
-                task.start()
-                logging.info("Started EE task (id: %s).", task.id)
+                task_id = _StartExportTask(options, image, params)
 
                 # Temporary save wich client has started wich export task and with which file name.
                 # Useed for verification during task cancellation or file deletion.
                 # Also used to ensure that a client has only one running export at the same time
-                memcache.set(options["client_id"],{"task":task.id,"filename":None})
+                memcache.set(options["client_id"],{"task":task_id,"filename":None,"job":job_id})
 
-                task_id = task.id
                 task_count = 1
 
 
@@ -483,137 +1107,648 @@ class ExportRunnerHandler(webapp2.RequestHandler):
             # Wait for the task to complete.
             counter = task_count
 
-            task_status = ee.data.getTaskStatus(task_id)[0]
-            state = task_status["state"]
-
-            while state in (ee.batch.Task.State.READY, ee.batch.Task.State.RUNNING):  # excluded CANCEL_REQUESTED because EE needs to long to cancel a task
-                if time.time() >= end_time:
-                    logging.info("Handing over task (id: %s).", task_id)
-                    # after 9 minutes hand over the task polling to a new /exportrunner because the deadline for tasks is 10 minutes
-                    taskqueue.add(url="/exportrunner", params={"options":json.dumps(options),"task_id":task_id,"task_count":counter})
-                    return
-                logging.info("Polling for task (id: %s).", task_id)
+            while True:
+                task_status = ee.data.getTaskStatus(task_id)[0]
+                state = task_status["state"]
 
-                # sends a cancellation but still alive notification to the client
-                if state == ee.batch.Task.State.CANCEL_REQUESTED:
-                    _SendMessage(options["client_id"],"export-" + options["filename"],"warning","Cancellation of '" + options["filename"] + "' in progress.","Working since " + str(counter*TASK_POLL_FREQUENCY) + " seconds...")
+                while state in (ee.batch.Task.State.READY, ee.batch.Task.State.RUNNING):  # excluded CANCEL_REQUESTED because EE needs to long to cancel a task
+                    if time.time() >= end_time:
+                        logging.info("Handing over task (id: %s).", task_id)
+                        # after 9 minutes hand over the task polling to a new /exportrunner because the deadline for tasks is 10 minutes
+                        taskqueue.add(url="/exportrunner", params={"options":json.dumps(options),"task_id":task_id,"task_count":counter,"task_sent":json.dumps(sent),
+                                                                   "task_params":json.dumps(params),"job_id":job_id})
+                        handed_over = True
+                        return
+                    logging.info("Polling for task (id: %s).", task_id)
+
+                    # keeps the slot in the export queue
+                    if job_id is not None:
+                        EXPORT_QUEUE.Heartbeat(job_id)
+
+                    # notifies the client only if the state or the progress of the task changed,
+                    # the client counts the elapsed seconds on its own
+                    status = ["cancelling" if state == ee.batch.Task.State.CANCEL_REQUESTED else "running", task_status.get("progress")]
+                    if status != sent:
+                        _SendStatus(options["client_id"],"export",options["filename"],status[0],id=task_id,progress=status[1],elapsed=counter*TASK_POLL_FREQUENCY,
+                                    adaptations=params.get("adaptations"))
+                        sent = status
+
+                    time.sleep(TASK_POLL_FREQUENCY)
+
+                    counter = counter + 1
+
+                    task_status = ee.data.getTaskStatus(task_id)[0]
+                    state = task_status["state"]
+
+                # the next part of a split export or a retry with adapted parameters after an EE memory or time limit error
+                adapted = adaptive.Next(params, EXPORT_ADAPTATIONS, getTaskError(task_status)) if state == ee.batch.Task.State.FAILED else None
+                if state == ee.batch.Task.State.COMPLETED and len(params["parts"]) > 1:
+                    params["parts"].pop(0)
+                elif adapted is not None:
+                    params = adapted
                 else:
-                    # sends a alive notification to the client
-                    _SendMessage(options["client_id"],"export-" + options["filename"],"info","Export of '" + options["filename"] + "' in progress.","Working since " + str(counter*TASK_POLL_FREQUENCY) + " seconds...<br><br><a href='javascript:;' onclick=\"$('[data-alert-name=\\'export-%s\\']').removeClass('alert-info').addClass('alert-warning');$.get('/clean?task=%s&client_id=%s');\">Cancel this export</a>" % (options["filename"],task_id,options["client_id"]))
+                    break
 
-                time.sleep(TASK_POLL_FREQUENCY)
-
-                counter = counter + 1
+                if image is None:
+                    image = _GetImage(options, count=options.get("count", False))
+                task_id = _StartExportTask(options, image, params)
+                memcache.set(options["client_id"],{"task":task_id,"filename":None,"job":job_id})
 
-                task_status = ee.data.getTaskStatus(task_id)[0]
-                state = task_status["state"]
+                # the client gets the id of the new task
+                sent = None
 
             # Checks if the task succeeded and if so sends the download url to the client
             if state == ee.batch.Task.State.COMPLETED:
                 logging.info("Task succeeded (id: %s).", task_id)
                 try:
+                    urls, folder = _GetExportUrls(options["filename"], options["client_id"])
 
-                    files = DRIVE_HELPER.GetExportedFiles(options["filename"])
-
-                    # Checks if some files were found (sometimes this seems to happen to fast and no files are found although they are there)
-                    if len(files) < 1:
-                        raise Exception("Cloud not find file: " + options["filename"])
-
-                    urls = []
-                    for f in files:
-                        urls.append({"url":DRIVE_HELPER.GetDownloadUrl(f["id"]),"title": f["title"],"id":f["id"]})
-
-                    # If the export area is large EE will create mutliple files, then this code will return a url to a google drive folder and a download url for each file
-                    if len(urls) == 1:
-                        line2 = "<a target='_blank' href='" + urls[0]["url"] + "'>Download via Google Drive (valid for 5 hours)</a>"
-                        del_message = "Delete this file"
-                    else:
-                        folder_id = DRIVE_HELPER.CreatePublicFolder(options["filename"])
-                        i = 1
-                        line2 = "<a target='_blank' href='https://drive.google.com/folderview?id=" + folder_id + "'>Open in Google Drive (valid for 5 hours)</a>"
-                        for url in urls:
-                            DRIVE_HELPER.RenameFile(url["id"],options["filename"] + "_part_%s.tif" % i)
-                            DRIVE_HELPER.MoveFileToFolder(url["id"],folder_id)
-                            line2 = line2 + "<br><a target='_blank' href='https://docs.google.com/uc?id=%s&export=download'>Download part %s</a>" % (url["id"],i)
-                            i = i + 1
-                        del_message = "Delete these files"
-
-                    # add deletion link
-                    line2 = line2 + "<br><br><a href='javascript:;' onclick=\"$('[data-alert-name=\\'export-%s\\']').removeClass('alert-success').addClass('alert-warning');$.get('/clean?filename=%s&client_id=%s');\">%s</a>" % (options["filename"],options["filename"],options["client_id"],del_message)
+                    # the scales of the bands are saved next to the files (and deleted with them)
+                    encoding = _ExportEncoding(options)
+                    if encoding is not None:
+                        data = json.dumps(encoding, indent=2)
+                        file_id = DRIVE_HELPER.UploadFile(options["filename"] + "_encoding.json", data, "application/json")
+                        encoding["url"] = _RegisterFiles(options["client_id"], options["filename"], [{"id":file_id,"fileSize":len(data)}])[0]
 
                     # Update the memcache entry with the filename and clear the task id
                     memcache.set(options["client_id"],{"task":None,"filename":options["filename"]})
 
                     # Notify the user's browser that the export is complete.
-                    _SendMessage(options["client_id"],"export-" + options["filename"],"success","Export of '" + options["filename"] + "' complete.", line2)
+                    _SendStatus(options["client_id"],"export",options["filename"],"completed",urls=urls,folder=folder,encoding=encoding,
+                                adaptations=params.get("adaptations"))
                 except Exception as e:
                     if DEBUG:
-                        line2 = str(e) + " - " + traceback.format_exc()
+                        error = str(e) + " - " + traceback.format_exc()
                     else:
-                        line2 = str(e)
+                        error = str(e)
 
                     memcache.set(options["client_id"],None)
-                    _SendMessage(options["client_id"],"export-" + options["filename"],"danger","Export of '" + options["filename"] + "' failed.", line2)
+                    _SendStatus(options["client_id"],"export",options["filename"],"failed",error=error)
 
             # Note: Notify client already if state is CANCEL_REQUESTED because EE needs to long to cancel the task
             elif state == ee.batch.Task.State.CANCELLED or state == ee.batch.Task.State.CANCEL_REQUESTED:
                 memcache.set(options["client_id"],None)
-                _SendMessage(options["client_id"],"export-" + options["filename"],"warning","Export of '" + options["filename"] + "' cancelled.")
+                _SendStatus(options["client_id"],"export",options["filename"],"cancelled")
             else:
                 memcache.set(options["client_id"],None)
-                _SendMessage(options["client_id"],"export-" + options["filename"],"danger","Export of '" + options["filename"] + "' failed.","Task %s (id: %s).<br>%s" % (state,task_id,getTaskError(task_status)))
+                _SendStatus(options["client_id"],"export",options["filename"],"failed",id=task_id,error="Task %s (id: %s). %s" % (state,task_id,getTaskError(task_status)),
+                            adaptations=params.get("adaptations"))
         except Exception as e:
             if DEBUG:
-                _SendMessage(options["client_id"],"export-" + options["filename"],"danger","Export of '" + options["filename"] + "' failed.", str(e) + " - " + traceback.format_exc())
+                _SendStatus(options["client_id"],"export",options["filename"],"failed",error=str(e) + " - " + traceback.format_exc())
             else:
-                _SendMessage(options["client_id"],"export-" + options["filename"],"danger","Export of '" + options["filename"] + "' failed.", str(e))
+                _SendStatus(options["client_id"],"export",options["filename"],"failed",error=str(e))
             return
+        finally:
+            if not handed_over and job_id is not None:
+                # the export is not running anymore (if it failed before the clients entry was updated)
+                running_export = memcache.get(options["client_id"])
+                if running_export is not None and running_export.get("job") == job_id:
+                    memcache.set(options["client_id"],None)
 
+                # free the slot and start the next export
+                EXPORT_QUEUE.Release(job_id)
+                _DispatchExports()
 
-class ChannelCloseHandler(webapp2.RequestHandler):
 
-    """Handler that cancels an open export task if the client closes the channel (usually on page closing)"""
+class BulkExportHandler(DataHandler):
 
-    def post(self):
-        """Reads the task id from memcache and calls the /clean?task handler"""
-        client_id = self.request.get("from")
+    """A servlet to handle requests for the export of an image for many features."""
 
-        running_export = memcache.get(client_id)
+    def DoPost(self):
+        """Kicks off the export of the regression image clipped to each feature of a GeoJSON FeatureCollection.
 
-        if running_export is not None and running_export["task"] is not None:
-            urlfetch.fetch("/clean?task=%s&client_id=%s" % (running_export["task"],client_id))
+        The image is computed once for the bounding box of all features. The features are exported
+        as separate parts (each feature or each cluster of nearby features) which are queued in the
+        export queue, a /bulkexportrunner starts and monitors the EE tasks of the parts.
+
+        HTTP Parameters:
+            regression: the regression type [poly1,poly2,poly3,zhuWood]
+            source: the source satellite [all,land5,land7,land8]
+            start: the start year to filter the satellite images (including)
+            end: the end year to filter the satellite images (including)
+            cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
+                        Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            encoding: the encoding of the bands [float,int16,int32] (optional, default float)
+                      int16 and int32 store the bands as scaled integers with a scale per band
+            precision: the decimal digits of the contribution of the bands to the NDVI with an integer encoding,
+                       a number or a JSON object {<a0,a1,a2,a3 or rmse>:<digits>} (optional, default EXPORT_PRECISION)
+            count: "true" to add the band "count" with the number of NDVI values per pixel (optional, default false)
+            features: a GeoJSON FeatureCollection with Polygon or MultiPolygon features
+            cluster: the grid cell size in degrees of the clusters of features that are exported together
+                     (optional, by default each feature is exported on its own)
+            filename: the prefix of the file names, the files of a part are called <filename>_<part number>
+            client_id: the unique id that is used for the channel api.
 
+        Returns:
+            A dict {"id":<bulk export id>,"parts":<number of parts>,"manifest":<manifest url>}.
+            A feature with an invalid or self-intersecting outer ring is reported by its name as {"error":<message>}.
+        """
+        # read the features, the image is computed for their bounding box
+        features = bulkexport.ReadFeatures(json.loads(self.request.get("features")))
+        if len(features) > BULK_MAX_FEATURES:
+            return {"error":"Too many features, at most %s features can be exported at once." % BULK_MAX_FEATURES}
+
+        # the outer rings are validated, repaired and simplified like a drawn region (see polygons.py), the holes are kept
+        vertices = [0, 0]
+        for index, (name, shapes) in enumerate(features):
+            prepared = []
+            for shape in shapes:
+                try:
+                    ring, drawn = polygons.Prepare(shape[0], REGION_SIMPLIFY_TOLERANCE)
+                except ValueError as e:
+                    return {"error":"Invalid feature %s: %s" % (name, e)}
+                prepared.append([ring] + shape[1:])
+                vertices[0] += drawn
+                vertices[1] += len(ring) - 1
+            features[index] = (name, prepared)
+        self.request.registry["region_vertices"] = vertices
+        logging.info("Features simplified from %s to %s vertices." % tuple(vertices))
+        cluster = self.request.get("cluster", default_value=None)
+        clusters = bulkexport.ClusterFeatures(features, float(cluster) if cluster else None)
 
-class CleanHandler(DataHandler):
+        options = _ReadOptions(self.request)
+        west, south, east, north = bulkexport.Bounds([shape for _, shapes in features for shape in shapes])
+        options["point"] = [(west + east) / 2.0, (south + north) / 2.0]
+        options["region"] = [[west,south],[east,south],[east,north],[west,north],[west,south]]
+
+        # a part per cluster, the files of a part are called <filename>_<3 digit part number>
+        # (the fixed width keeps the Drive title search of a part from matching other parts)
+        parts = []
+        names = [None] * len(features)
+        for number, cluster in enumerate(clusters):
+            shapes = [shape for index in cluster for shape in features[index][1]]
+            parts.append({"kind":"image","name":"%s_%03d" % (options["filename"],number + 1),"bounds":bulkexport.Bounds(shapes),
+                          "size":len(cluster),"columns":None,"geometry":shapes})
+            for index in cluster:
+                names[index] = {"name":features[index][0],"part":number}
+
+        # the parts are checked locally before anything is computed by EE
+        for part in parts:
+            size = _EstimateSize(options, part["bounds"])
+            if size["pixels"] > EXPORT_MAX_PIXELS:
+                return {"error":"Part %s is too large (%s x %s pixels, at most %d pixels), use a smaller cluster size or smaller features." %
+                                (part["name"],size["width"],size["height"],EXPORT_MAX_PIXELS)}
+
+        image = _GetImage(options, count=options["count"])
 
-    """A servlet for the cron job that runs every hour.
-        It deletes all files older than 5 hours from the service Google Drive account.
-    """
+        # _GetImage returns None if the collection is empty
+        if image is None:
+            return {"error":"No images in collection. Change your options."}
 
-    def cancelTask(self,client_id,task_id=None):
-        """Cancels the running EE task form the client if there is one
+        bulk = BULK_EXPORTS.Create(_GetUniqueString(),"bulk",options["client_id"],options["filename"],parts,{"image":ee.serializer.toJSON(image)},
+                                   features=names,encoding=_ExportEncoding(options))
+        return _StartBulkExport(bulk)
 
-        Args:
-            client_id: the Channel API client id
-            task_id: The task id that should be cancelled. If None the task id that is saved in memcache ist used
 
+    def DoGet(self):
+        """Returns the manifest of a bulk export (see bulkexport.Manifest()).
+
+        HTTP Parameters:
+            id: the id of the bulk export
+            client_id: the client_id with which the bulk export was started to verify the ownership
         """
-        running_export = memcache.get(client_id)
+        bulk = BULK_EXPORTS.Get(self.request.get("id"))
+        if bulk is None or bulk["client_id"] != self.request.get("client_id"):
+            return {"error":"Unknown bulk export."}
+        return bulkexport.Manifest(bulk)
 
-        if running_export is not None:
-            if task_id is not None and running_export["task"] == task_id:
-                ee.data.cancelTask(task_id)
-                logging.info("Cancelled task (id: %s).", task_id)
-            elif task_id is None and running_export["task"] is not None:
-                ee.data.cancelTask(running_export["task"])
-                memcache.set(client_id,running_export)
 
+class BulkExportRunnerHandler(webapp2.RequestHandler):
 
-    def DoPost(self):
-        """Handels the Channel disconnected request. Deletes the running task for the client.
+    """A servlet that starts and monitors the EE tasks of the parts of a bulk export."""
+
+    def post(self):
+        """Starts the EE task of each part that got a slot in the export queue and polls the running tasks.
+
+        The task of a part is created from the serialized graphs of the bulk export (see _CreateBulkTask()). When a task is
+        finished the download urls are saved in the state of the part and its slot is released. The client
+        is notified if the number of parts per state or the progress changed. After 9 minutes the polling
+        is handed over to a new /bulkexportrunner.
 
         HTTP Parameters:
-            from: the client_id that disconnected
+            bulk_id: the id of the bulk export
+            task_count: the polling counter of the previous /bulkexportrunner (optional)
+            task_sent: the last status sent to the client by the previous /bulkexportrunner (optional)
+        """
+
+        # start time in epoch seconds + 9 minutes
+        end_time = time.time() + 9*60
+
+        bulk_id = self.request.get("bulk_id")
+        bulk = BULK_EXPORTS.Get(bulk_id)
+        if bulk is None:
+            logging.warning("Unknown bulk export (id: %s).", bulk_id)
+            return
+        client_id = bulk["client_id"]
+        filename = bulk["filename"]
+        kind = bulk["kind"]
+
+        counter = int(self.request.get("task_count", default_value="1"))
+        sent = json.loads(self.request.get("task_sent", default_value="null"))
+
+        # the graphs are only read when a part is started
+        graphs = None
+
+        try:
+            while True:
+                running = EXPORT_QUEUE.Running()
+                changes = {}
+                released = False
+
+                for index, part in enumerate(bulk["parts"]):
+                    if part["id"] in running:
+                        # keeps the slot in the export queue
+                        EXPORT_QUEUE.Heartbeat(part["id"])
+
+                    if part["state"] == bulkexport.WAITING and part["id"] in running:
+                        if bulk["cancelled"]:
+                            changes[index] = {"state":bulkexport.CANCELLED}
+                            EXPORT_QUEUE.Release(part["id"])
+                            released = True
+                            continue
+
+                        # older exports are deleted if the Drive is already filled above DRIVE_HIGH_WATER
+                        _MakeDriveRoom(0)
+
+                        if graphs is None:
+                            graphs = dict((name, ee.deserializer.fromJSON(graph)) for name, graph in BULK_EXPORTS.GetGraphs(bulk_id).items())
+
+                        task = _CreateBulkTask(part, graphs, BULK_EXPORTS.GetGeometry(bulk_id, index), bulk.get("encoding"))
+                        task.start()
+                        logging.info("Started EE task (id: %s) of bulk export %s.", task.id, bulk_id)
+                        changes[index] = {"state":bulkexport.RUNNING,"task":task.id,"progress":0}
+
+                    elif part["state"] == bulkexport.RUNNING:
+                        task_status = ee.data.getTaskStatus(part["task"])[0]
+                        state = task_status["state"]
+
+                        if state in (ee.batch.Task.State.READY, ee.batch.Task.State.RUNNING):
+                            changes[index] = {"progress":task_status.get("progress") or 0}
+                            continue
+
+                        if state == ee.batch.Task.State.COMPLETED:
+                            try:
+                                urls, folder = _GetExportUrls(part["name"], client_id)
+                                changes[index] = {"state":bulkexport.COMPLETED,"progress":1,"urls":urls,"folder":folder}
+                            except Exception as e:
+                                changes[index] = {"state":bulkexport.FAILED,"error":str(e)}
+                        elif state in (ee.batch.Task.State.CANCELLED, ee.batch.Task.State.CANCEL_REQUESTED):
+                            changes[index] = {"state":bulkexport.CANCELLED}
+                        else:
+                            changes[index] = {"state":bulkexport.FAILED,"error":"Task %s (id: %s). %s" % (state,part["task"],task_status.get("error_message","No error message"))}
+                        EXPORT_QUEUE.Release(part["id"])
+                        released = True
+
+                if changes:
+                    bulk = BULK_EXPORTS.UpdateParts(bulk_id, changes)
+
+                # notifies the client only if the parts per state or the progress changed
+                status = [bulkexport.State(bulk), bulkexport.Counts(bulk), bulkexport.Progress(bulk)]
+                if status != sent:
+                    finished = status[0] in ("completed", "cancelled", "failed")
+                    _SendStatus(client_id,kind,filename,status[0],id=bulk_id,parts=status[1],progress=status[2],slots=EXPORT_MAX_RUNNING,
+                                elapsed=None if finished else counter*TASK_POLL_FREQUENCY,urls=[_BulkManifestUrl(bulk)] if finished else None)
+                    sent = status
+
+                # the parts that got a released slot are started in the next loop
+                if released:
+                    _DispatchExports()
+
+                if not any(part["state"] in (bulkexport.WAITING, bulkexport.RUNNING) for part in bulk["parts"]):
+                    logging.info("Bulk export finished (id: %s).", bulk_id)
+                    return
+
+                if time.time() >= end_time:
+                    logging.info("Handing over bulk export (id: %s).", bulk_id)
+                    # after 9 minutes hand over the polling to a new /bulkexportrunner because the deadline for tasks is 10 minutes
+                    taskqueue.add(url="/bulkexportrunner", params={"bulk_id":bulk_id,"task_count":counter,"task_sent":json.dumps(sent)})
+                    return
+
+                time.sleep(TASK_POLL_FREQUENCY)
+                counter = counter + 1
+                bulk = BULK_EXPORTS.Get(bulk_id)
+                if bulk is None:
+                    # the running tasks are cancelled and the slots released by _StopBulkExport()
+                    raise LookupError("The bulk export %s expired while it was running." % bulk_id)
+        except Exception as e:
+            if DEBUG:
+                error = str(e) + " - " + traceback.format_exc()
+            else:
+                error = str(e)
+            _StopBulkExport(bulk_id, error)
+            _SendStatus(client_id,kind,filename,"failed",id=bulk_id,error=error)
+
+
+class PointExportHandler(DataHandler):
+
+    """A servlet to handle requests for the NDVI time series of many points."""
+
+    def DoPost(self):
+        """Kicks off the extraction of the NDVI time series (and optionally the regression coefficients) of points.
+
+        The points are grouped into batches of nearby points (see bulkexport.BatchPoints()). Up to
+        POINT_DIRECT_MAX points are extracted by a /pointexportrunner and written to gzip compressed CSV
+        files. Larger jobs are exported as bulk export with an EE table export per batch, the collection
+        and the regression image are created once for the bounding box of all points.
+
+        HTTP Parameters:
+            regression: the regression type [poly1,poly2,poly3,zhuWood]
+            source: the source satellite [all,land5,land7,land8]
+            start: the start year to filter the satellite images (including)
+            end: the end year to filter the satellite images (including)
+            cloudscore: the max cloudscore for the ee.Algorithms.Landsat.simpleCloudScore [1-100]
+                        Higher means that the pixel is more likley to be a cloud
+            cloudmask: the cloud masking method [score,qa] (optional, default score)
+                       qa uses the cloud, shadow, snow and cirrus bits of the BQA band instead of the cloudscore
+            composite: the period of the temporal composites the regression is calculated from [none,16day,month]
+                       (optional, default none uses the individual scenes)
+            compositemethod: the compositing method [median,maxndvi] (optional, default median)
+            points: a CSV table with the columns id, lon and lat or a GeoJSON FeatureCollection of Point features
+            coefficients: if "true" the regression coefficients of each point are extracted too (optional)
+            filename: the prefix of the file names
+            client_id: the unique id that is used for the channel api.
+
+        Returns:
+            A dict {"points":<number of points>} or for a bulk export {"id":<bulk export id>,"parts":<number of parts>,"manifest":<manifest url>}.
+        """
+        points = bulkexport.ReadPoints(self.request.get("points"))
+        if len(points) > POINT_MAX:
+            return {"error":"Too many points, at most %s points can be exported at once." % POINT_MAX}
+        coefficients = self.request.get("coefficients") == "true"
+
+        # the collection (and the image) are created for the bounding box of all points
+        options = _ReadOptions(self.request)
+        west, south, east, north = bulkexport.PointBounds(points)
+        options["point"] = [(west + east) / 2.0, (south + north) / 2.0]
+        options["region"] = [[west,south],[east,south],[east,north],[west,north],[west,south]]
+
+        if len(points) <= POINT_DIRECT_MAX:
+            # only execute once even if task fails
+            taskqueue.add(url="/pointexportrunner", params={"options":json.dumps(options),"points":json.dumps(points),"coefficients":json.dumps(coefficients)},
+                          retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+            _SendStatus(options["client_id"],"points",options["filename"],"running")
+            return {"points":len(points)}
+
+        collection = _GetCollection(options)
+
+        # _GetCollection returns None if the collection is empty
+        if collection is None:
+            return {"error":"No images in collection. Change your options."}
+        graphs = {"collection":ee.serializer.toJSON(collection)}
+
+        if coefficients:
+            image = _GetImage(options)
+            graphs["image"] = ee.serializer.toJSON(image)
+            bands = image.bandNames().getInfo()
+
+        # a series part and a coefficients part per batch, the fixed width of the
+        # numbers keeps the Drive title search of a part from matching other parts
+        parts = []
+        for number, batch in enumerate(bulkexport.BatchPoints(points, POINT_BATCH_SIZE, POINT_BATCH_CELL)):
+            batch_points = [points[index] for index in batch]
+            part = {"bounds":bulkexport.PointBounds(batch_points),"size":len(batch_points),"geometry":batch_points}
+            parts.append(dict(part, kind="series", name="%s_series_%03d" % (options["filename"],number + 1), columns=POINT_SERIES_COLUMNS))
+            if coefficients:
+                parts.append(dict(part, kind="coefficients", name="%s_coefficients_%03d" % (options["filename"],number + 1), columns=["point_id"] + bands))
+
+        bulk = BULK_EXPORTS.Create(_GetUniqueString(),"points",options["client_id"],options["filename"],parts,graphs)
+        return _StartBulkExport(bulk)
+
+
+class PointExportRunnerHandler(webapp2.RequestHandler):
+
+    """A servlet for handling async point extraction requests."""
+
+    def post(self):
+        """Extracts the NDVI time series (and optionally the regression coefficients) of a few points
+            batch by batch and uploads them as gzip compressed CSV files to the service Google Drive.
+
+        HTTP Parameters:
+            options: the json encoded options created by _ReadOptions()
+            points: the json encoded list of [<id>,<longitude>,<latitude>]
+            coefficients: "true" if the regression coefficients are extracted too
+        """
+
+        # load the options
+        options = json.loads(self.request.get("options"))
+        self.request.registry["options"] = options
+        points = json.loads(self.request.get("points"))
+        coefficients = json.loads(self.request.get("coefficients"))
+
+        try:
+            collection = _GetCollection(options)
+
+            # _GetCollection returns None if the collection is empty
+            if collection is None:
+                _SendStatus(options["client_id"],"points",options["filename"],"failed",error="No images in collection. Change your options.")
+                return
+
+            if coefficients:
+                image = _GetImage(options)
+                bands = image.bandNames().getInfo()
+
+            series = []
+            coefficient_rows = []
+            for batch in bulkexport.BatchPoints(points, POINT_DIRECT_BATCH_SIZE, POINT_BATCH_CELL):
+                features = _PointFeatures([points[index] for index in batch])
+
+                # the columns are requested as lists with a single call
+                table = _GetPointSeries(collection, features)
+                columns = ee.Dictionary(dict((column, table.aggregate_array(column)) for column in POINT_SERIES_COLUMNS)).getInfo()
+                series.extend(zip(*[columns[column] for column in POINT_SERIES_COLUMNS]))
+
+                if coefficients:
+                    for feature in image.reduceRegions(features, ee.Reducer.first(), EXPORT_RESOLUTION).getInfo()["features"]:
+                        coefficient_rows.append([feature["properties"].get(column) for column in ["point_id"] + bands])
+
+            files = [(options["filename"] + "_series.csv.gz", bulkexport.CompressedCsv(POINT_SERIES_COLUMNS, sorted(series)))]
+            if coefficients:
+                files.append((options["filename"] + "_coefficients.csv.gz", bulkexport.CompressedCsv(["point_id"] + bands, coefficient_rows)))
+
+            uploaded = []
+            for title, data in files:
+                uploaded.append({"id":DRIVE_HELPER.UploadFile(title, data, "application/gzip"),"fileSize":len(data)})
+            urls = _RegisterFiles(options["client_id"], options["filename"], uploaded)
+
+            _SendStatus(options["client_id"],"points",options["filename"],"completed",urls=urls)
+        except Exception as e:
+            if DEBUG:
+                _SendStatus(options["client_id"],"points",options["filename"],"failed",error=str(e) + " - " + traceback.format_exc())
+            else:
+                _SendStatus(options["client_id"],"points",options["filename"],"failed",error=str(e))
+
+
+class StatsRunnerHandler(webapp2.RequestHandler):
+
+    """A servlet that exports the missing chunks of the stored regression statistics in the background."""
+
+    def post(self):
+        """Exports chunks of the yearly regression statistics to the assets of STATS_STORE (see regressionstats.py).
+
+        HTTP Parameters:
+            graph: the memcache key of the serialized ee.ImageCollection created by _GetCollection()
+            family: the model family of the chunks
+            chunks: the json encoded list of [<chunk name>,<sensor>,<path>,<row>,<year>]
+        """
+        graph = memcache.get(self.request.get("graph"))
+        if graph is None:
+            logging.warning("The collection of the regression statistics expired.")
+            return
+        collection = ee.ImageCollection(ee.deserializer.fromJSON(graph))
+        family = self.request.get("family")
+        spacecrafts = {"land5": "LANDSAT_5", "land7": "LANDSAT_7", "land8": "LANDSAT_8"}
+
+        # a chunk without images is stored with zero sums, so that its year is complete
+        zeros = ee.Image.constant(0).toDouble().rename(regressionstats.Bands()[0])
+        for band in regressionstats.Bands()[1:]:
+            zeros = zeros.addBands(ee.Image.constant(0).toDouble().rename(band))
+
+        for name, sensor, path, row, year in json.loads(self.request.get("chunks")):
+            # another request may have started the export of the chunk already
+            if not STATS_STORE.Reserve(name):
+                continue
+
+            footprint = WRS_INDEX.Footprint(path, row)
+            chunk = collection.filter(ee.Filter.And(
+                    ee.Filter.date("%s-01-01" % year, "%s-12-31T23:59:59" % year),
+                    ee.Filter.eq("WRS_PATH", path),
+                    ee.Filter.eq("WRS_ROW", row),
+                    ee.Filter.eq("SPACECRAFT_ID", spacecrafts[sensor])))
+            image = _GetImageStats(chunk, family).merge(ee.ImageCollection([zeros])).sum().clip(ee.Geometry.Polygon(footprint))
+            try:
+                ee.batch.Export.image.toAsset(
+                        image=image,
+                        description=name,
+                        assetId=STATS_STORE.AssetId(name),
+                        region=footprint,
+                        scale=EXPORT_RESOLUTION,
+                        maxPixels=EXPORT_MAX_PIXELS).start()
+            except Exception as e:
+                logging.warning("The export of the regression statistics %s failed: %s" % (name, e))
+                STATS_STORE.Release(name)
+
+
+class DispatchHandler(webapp2.RequestHandler):
+
+    """A servlet for the cron job that dispatches the export queue every minute."""
+
+    def get(self):
+        """Drops the slots of the exports without heartbeat and starts the waiting exports that got a free slot.
+
+        The queue is otherwise only dispatched when an export is queued, finished or cancelled,
+        so the slots of runners that stopped without releasing them would never be reused.
+        """
+        _DispatchExports()
+
+
+class ChannelCloseHandler(webapp2.RequestHandler):
+
+    """Handler that cancels an open export task if the client closes the channel (usually on page closing)"""
+
+    def post(self):
+        """Reads the task id from memcache and calls the /clean?task handler"""
+        client_id = self.request.get("from")
+
+        running_export = memcache.get(client_id)
+
+        if running_export is not None and running_export["task"] is not None:
+            urlfetch.fetch("/clean?task=%s&client_id=%s" % (running_export["task"],client_id))
+
+
+class FileHandler(webapp2.RequestHandler):
+
+    """A servlet that records the download of an exported file and redirects to its Google Drive download url."""
+
+    def get(self):
+        """Redirects to the download url of an exported file (see storage.py).
+
+        HTTP Parameters:
+            id: the Google Drive id of the file
+        """
+        record = STORAGE.Downloaded(self.request.get("id"))
+
+        if record is None:
+            self.response.set_status(404)
+            self.response.headers["Content-Type"] = "text/html; charset=utf-8"
+            self.response.out.write("<html><body>The file was deleted. Exported files are kept for up to %s hours, "
+                                    "older exports are deleted earlier if the storage is full.</body></html>" % (DRIVE_MAX_RETENTION / 3600))
+            return
+
+        self.redirect(str(record.url))
+
+
+class CleanHandler(DataHandler):
+
+    """A servlet for the cron job that runs every hour.
+        It deletes all files older than 5 hours from the service Google Drive account.
+    """
+
+    def cancelTask(self,client_id,task_id=None):
+        """Cancels the running EE task form the client if there is one
+
+        Args:
+            client_id: the Channel API client id
+            task_id: The task id that should be cancelled. If None the task id that is saved in memcache ist used
+
+        """
+        running_export = memcache.get(client_id)
+
+        if running_export is not None:
+            # an export that waits in the queue has no EE task yet
+            if task_id is None and running_export["task"] is None and running_export.get("job") is not None:
+                self.cancelJob(client_id,running_export["job"])
+            elif task_id is not None and running_export["task"] == task_id:
+                ee.data.cancelTask(task_id)
+                logging.info("Cancelled task (id: %s).", task_id)
+            elif task_id is None and running_export["task"] is not None:
+                ee.data.cancelTask(running_export["task"])
+                memcache.set(client_id,running_export)
+
+
+    def cancelJob(self,client_id,job_id):
+        """Removes a queued export of the client from the export queue
+
+        Args:
+            client_id: the Channel API client id
+            job_id: The id of the export in the export queue
+        """
+        job = EXPORT_QUEUE.Cancel(job_id,client_id)
+
+        if job is not None:
+            logging.info("Cancelled queued export (id: %s).", job_id)
+            memcache.set(client_id,None)
+            filename = job["options"]["filename"]
+            _SendStatus(client_id,"export",filename,"cancelled")
+
+            # the positions of the other waiting exports have changed
+            _DispatchExports()
+
+
+    def cancelBulk(self,client_id,bulk_id):
+        """Cancels the waiting and running parts of a bulk export of the client
+
+        Args:
+            client_id: the Channel API client id
+            bulk_id: The id of the bulk export
+        """
+        bulk = BULK_EXPORTS.Get(bulk_id)
+
+        if bulk is not None and bulk["client_id"] == client_id:
+            logging.info("Cancelling bulk export (id: %s).", bulk_id)
+            _StopBulkExport(bulk_id)
+
+
+    def DoPost(self):
+        """Handels the Channel disconnected request. Deletes the running task for the client.
+
+        HTTP Parameters:
+            from: the client_id that disconnected
         """
         # TODO migrate this to firebase to delete data from no longer connected clients
         self.cancelTask(self.request.get("from"))
@@ -625,6 +1760,8 @@ class CleanHandler(DataHandler):
 
         HTTP Parameters:
             task: A EE task Id that should be cancelled
+            job: The id of a queued export that should be removed from the export queue
+            bulk: The id of a bulk export that should be cancelled
             filename: Filename of an export to delete these files from the service Google Drive
             client_id: The client_id with which the task or export files are created to verify the ownership
             m: Switches the handlers mode. (only for admins)
@@ -634,6 +1771,8 @@ class CleanHandler(DataHandler):
         user = users.get_current_user()
 
         task = self.request.get("task", default_value=None)
+        job = self.request.get("job", default_value=None)
+        bulk = self.request.get("bulk", default_value=None)
         filename = self.request.get("filename", default_value=None)
         client_id = self.request.get("client_id", default_value=None)
 
@@ -645,16 +1784,27 @@ class CleanHandler(DataHandler):
             self.cancelTask(client_id,task)
 
 
+        # Removes a queued export
+        elif job is not None and client_id is not None:
+            self.cancelJob(client_id,job)
+
+
+        # Cancels a bulk export
+        elif bulk is not None and client_id is not None:
+            self.cancelBulk(client_id,bulk)
+
+
         # Deletes all files from an specific export
         elif filename is not None and client_id is not None:
-            last_export = memcache.get(client_id)
+            records = STORAGE.Owned(client_id, filename)
 
-            if last_export is not None and last_export["filename"] == filename:
-                for f in DRIVE_HELPER.GetExportedFiles(filename):
-                    DRIVE_HELPER.DeleteFile(f["id"])
-                    logging.info("Deleted File: %s - %s" % (f["title"],f["id"]))
+            if records:
+                for record in records:
+                    DRIVE_HELPER.DeleteFile(record.key.id())
+                    logging.info("Deleted File: %s - %s" % (filename,record.key.id()))
+                STORAGE.Forget([record.key.id() for record in records])
 
-                _SendMessage(client_id,"export-" + filename,"success","File deletion for '" + filename + "' complete.")
+                _SendStatus(client_id,"export",filename,"deleted")
 
 
         # If m is set user must be admin to access the view and delete all function
@@ -670,11 +1820,11 @@ class CleanHandler(DataHandler):
                     else:
                         files.append({"type":"folder","title": f["title"],"id":f["id"],"createdDate":f["createdDate"]})
 
-                about = DRIVE_HELPER.service.about().get().execute()
-                free = int(about["quotaBytesTotal"]) - int(about["quotaBytesUsed"])
+                used, total = STORAGE.Usage()
 
                 out["files"] = files
-                out["freeSpaceMB"] = free/1024/1024
+                out["freeSpaceMB"] = (total - used)/1024/1024
+                out["usedShare"] = float(used) / total
                 return out
 
             # deletes all files
@@ -683,6 +1833,7 @@ class CleanHandler(DataHandler):
                 for f in files:
                     DRIVE_HELPER.DeleteFile(f["id"])
                     logging.info("Deleted File: %s - %s" % (f["title"],f["id"]))
+                STORAGE.Forget([f["id"] for f in files])
             else:
                 return {"error": "Invalid value for parameter 'm'."}
 
@@ -692,13 +1843,22 @@ class CleanHandler(DataHandler):
         elif (urlparse.urlsplit(self.request.url).path.startswith("/cron/clean") and user is None) or users.is_current_user_admin():
 
             files = DRIVE_HELPER.GetExportedFiles(None)
+            deleted = []
             for f in files:
                 file_date = datetime.strptime(f["createdDate"].split(".")[0],"%Y-%m-%dT%H:%M:%S")
                 diff_seconds = (datetime.utcnow() - file_date).total_seconds()
 
-                if diff_seconds > 5*60*60:
+                if diff_seconds > DRIVE_MAX_RETENTION:
                     DRIVE_HELPER.DeleteFile(f["id"])
+                    deleted.append(f["id"])
                     logging.info("Deleted File: %s - %s" % (f["title"],f["id"]))
+            STORAGE.Forget(deleted)
+
+            # the manifests of the bulk exports are only available for BULK_LIFETIME
+            BULK_EXPORTS.DeleteExpired()
+
+            # the Drive is freed between the exports too, so that the next exports do not have to wait for it
+            _MakeDriveRoom(0)
         else:
             self.response.set_status(403)
             self.response.headers["Content-Type"] = "text/html; charset=utf-8"
@@ -722,27 +1882,68 @@ def _ReadOptions(request):
     options["start"] = int(request.get("start"))
     options["end"] = int(request.get("end"))
     options["cloudscore"] = int(request.get("cloudscore"))
-    options["point"] = json.loads(request.get("point"))
-    options["region"] = json.loads(request.get("region"))
+    options["cloudmask"] = request.get("cloudmask", default_value="score")
+    options["composite"] = request.get("composite", default_value="none")
+    options["compositemethod"] = request.get("compositemethod", default_value="median")
+    options["encoding"] = request.get("encoding", default_value="float")
+    options["precision"] = json.loads(request.get("precision", default_value="null"))
+    options["count"] = request.get("count", default_value="false") == "true"
+    options["point"] = json.loads(request.get("point", default_value="null"))
+    options["region"] = json.loads(request.get("region", default_value="null"))
     options["filename"] = request.get("filename")
     options["client_id"] = request.get("client_id")
 
+    # the drawn polygon is repaired and simplified once, all EE calls and the path/row lookup get the simplified one
+    if options["region"] is not None:
+        try:
+            options["region"], vertices = polygons.Prepare(options["region"], REGION_SIMPLIFY_TOLERANCE)
+        except ValueError as e:
+            raise Exception("Invalid region: %s" % e)
+        request.registry["region_vertices"] = [vertices, len(options["region"]) - 1]
+        logging.info("Region simplified from %s to %s vertices." % (vertices, len(options["region"]) - 1))
+
     logging.info("Received options: " + json.dumps(options))
+    request.registry["options"] = options
+
+    if options["cloudmask"] not in ("score", "qa"):
+        raise Exception("Invalid cloud mask: %s" % options["cloudmask"])
+    if options["composite"] not in COMPOSITE_PERIODS:
+        raise Exception("Invalid composite period: %s" % options["composite"])
+    if options["compositemethod"] not in COMPOSITE_METHODS:
+        raise Exception("Invalid composite method: %s" % options["compositemethod"])
+    if options["encoding"] not in EXPORT_ENCODINGS:
+        raise Exception("Invalid encoding: %s" % options["encoding"])
+    precision = options["precision"]
+    digits = precision.values() if isinstance(precision, dict) else [precision] if precision is not None else []
+    # json decodes true and false as bools, which are ints in python
+    max_digits = EXPORT_MAX_PRECISION.get(options["encoding"], max(EXPORT_MAX_PRECISION.values()))
+    if not all(isinstance(d, int) and not isinstance(d, bool) and 0 <= d for d in digits):
+        raise Exception("Invalid precision: %s" % json.dumps(precision))
+    if isinstance(precision, dict) and not all(band in PRECISION_BANDS for band in precision):
+        raise Exception("Invalid precision: %s, the bands are %s." % (json.dumps(precision), ", ".join(PRECISION_BANDS)))
+    if any(d > max_digits for d in digits):
+        raise Exception("The precision %s is too high for %s, at most %s digits fit into the type." % (json.dumps(precision), options["encoding"], max_digits))
 
     # TODO logic checking
 
     return options
 
 
-def _GetCollection(options,point=True,region=True):
+def _GetCollection(options,point=True,region=True,info=None):
     """Creates a ee.ImageCollection with the given options. Also the ee.Algorithms.Landsat.simpleCloudScore is used
         on each image with the cloudscore from the options and the bands are reduced and renamed to RED and NIR.
+        Before that the scenes are prefiltered by their CLOUD_COVER metadata: cloudy scenes are dropped and
+        clear scenes skip the simpleCloudScore. If the cloudmask option is "qa" the pixels are masked with
+        the quality bits of the BQA band of the Collection 1 images instead.
     Args:
         options: a dict created by _ReadOptions()
         point: boolean if the point coordinates should be used to locate the ImageCollection
         region: boolean if the region coordinates should be used to locate the ImageCollection
+        info: an optional dict that is filled with the number of images ("size"), the WRS-2
+              path/row pairs ("pathrows") of the collection and "uncovered" (True if the scenes
+              were filtered by their bounds, because the index has no path/row of the location)
     Returns:
-        A ee.ImageCollection where each image has 2 bands RED and NIR and is cloudscore masked or None if collection is empty.
+        A ee.ImageCollection where each image has 2 bands RED and NIR and is cloud masked or None if collection is empty.
     """
 
     # rename the used option values
@@ -750,6 +1951,7 @@ def _GetCollection(options,point=True,region=True):
     start = options["start"]
     end = options["end"]
     cloudscore = options["cloudscore"]
+    cloudmask = options["cloudmask"]
     if point:
         point = options["point"]
     else:
@@ -760,8 +1962,11 @@ def _GetCollection(options,point=True,region=True):
         region = None
     client_id = options["client_id"]
 
-    # the names for the different top of atmosphere satellite images
-    sourceSwitch = {"land5": "LANDSAT/LT5_L1T_TOA", "land7": "LANDSAT/LE7_L1T_TOA", "land8": "LANDSAT/LC8_L1T_TOA"}
+    # the names for the different top of atmosphere satellite images (only the Collection 1 images have a BQA band for all satellites)
+    if cloudmask == "qa":
+        sourceSwitch = {"land5": "LANDSAT/LT05/C01/T1_TOA", "land7": "LANDSAT/LE07/C01/T1_TOA", "land8": "LANDSAT/LC08/C01/T1_TOA"}
+    else:
+        sourceSwitch = {"land5": "LANDSAT/LT5_L1T_TOA", "land7": "LANDSAT/LE7_L1T_TOA", "land8": "LANDSAT/LC8_L1T_TOA"}
     bandPattern = {"land5": ["B3","B4"], "land7": ["B3","B4"], "land8": ["B4","B5"]}  # to rename bands for ndvi calculation
 
     # This function masks the input with a threshold on the simple cloud score.
@@ -769,100 +1974,346 @@ def _GetCollection(options,point=True,region=True):
         cloud = ee.Algorithms.Landsat.simpleCloudScore(img).select("cloud")
         return img.updateMask(cloud.lt(cloudscore))
 
-    # Reduce a collection to a specific region or point (or both)
-    def filterRegions(collection,point,region):
-        if region is None and point is not None:
-            return collection.filterBounds(ee.Geometry.Point(point))
-        elif region is not None and point is None:
-            return collection.filterBounds(ee.Geometry.Polygon(region))
-        elif region is not None and point is not None:
-            c1 = collection.filterBounds(ee.Geometry.Point(point))
-            c2 = collection.filterBounds(ee.Geometry.Polygon(region))
-
-            c3 = ee.ImageCollection(c1.merge(c2))  # merge the collections
-
-            return ee.ImageCollection(c3.distinct(ee.SelectorSet("LANDSAT_SCENE_ID")))  # sort out double selected
-        else:
-            raise Exception("No location selected")
-
+    # This function masks the input with a bit test on the quality assessment band.
+    def qaMask(img):
+        return img.updateMask(img.select("BQA").bitwiseAnd(QA_MASK_BITS).eq(0))
 
-    collection_line2 = None  # line2 of the information about the collection returned over the channel api
-
-    # If source is all a collection for each satellite is created
-    if source == "all":
-        # select only the images that were took between start and end
-        land5 = ee.ImageCollection(sourceSwitch["land5"]).filterDate(str(start) + "-01-01", str(end) + "-12-31T23:59:59")
-        land7 = ee.ImageCollection(sourceSwitch["land7"]).filterDate(str(start) + "-01-01", str(end) + "-12-31T23:59:59")
-        land8 = ee.ImageCollection(sourceSwitch["land8"]).filterDate(str(start) + "-01-01", str(end) + "-12-31T23:59:59")
+    if point is None and region is None:
+        raise Exception("No location selected")
 
-        # only select the images that intersect with the coordinates of point or region
-        land5 = filterRegions(land5,point,region)
-        land7 = filterRegions(land7,point,region)
-        land8 = filterRegions(land8,point,region)
-
-        # get the number of images in each collection
-        land5_size = land5.size().getInfo()
-        land7_size = land7.size().getInfo()
-        land8_size = land8.size().getInfo()
-        collection_line2 = "Landsat 5: %s<br>Landsat 7: %s<br>Landsat 8: %s" % (land5_size,land7_size,land8_size)
-
-        # use the simpleCloudScore algorithm on each collection
-        if cloudscore > 0 and cloudscore < 100:
-            land5 = land5.map(cloudMask)
-            land7 = land7.map(cloudMask)
-            land8 = land8.map(cloudMask)
+    # the WRS-2 path/row pairs that overlap the point and/or region (computed locally)
+    point_pathrows = WRS_INDEX.PathRowsForPoint(point) if point is not None else []
+    region_pathrows = WRS_INDEX.PathRowsForPolygon(region) if region is not None else []
+    pathrows = sorted(set(point_pathrows + region_pathrows))
 
-        # select only the RED and the NIR band
-        land5 = land5.select(bandPattern["land5"],["RED","NIR"])
-        land7 = land7.select(bandPattern["land7"],["RED","NIR"])
-        land8 = land8.select(bandPattern["land8"],["RED","NIR"])
+    # the index has no footprints close to the poles, then EE has to intersect the geometries
+    uncovered = (point is not None and not point_pathrows) or (region is not None and not region_pathrows)
 
-        # merge the 3 collections
-        collection = ee.ImageCollection(land5.merge(land7))
-        collection = ee.ImageCollection(collection.merge(land8))
+    # Reduce a collection to the scenes that overlap the point or region (or both),
+    # the filter or geometry is created once and shared by the collections of the sensors
+    if not uncovered:
+        pathRowFilter = _PathRowFilter(pathrows)
+        filterRegions = lambda collection: collection.filter(pathRowFilter)
     else:
+        # the scenes are filtered by the bounding box of the region, the images are clipped to the polygon later
+        if region is None:
+            bounds = ee.Geometry.Point(point)
+        elif point is None:
+            bounds = ee.Geometry.Rectangle(bulkexport.Bounds([[region]]))
+        else:
+            bounds = ee.Geometry.Rectangle(bulkexport.Bounds([[region]])).union(ee.Geometry.Point(point), 1)
+        filterRegions = lambda collection: collection.filterBounds(bounds)
+
+    # the scene cloud cover prefilter is only used if the pixels are cloud masked
+    masking = cloudmask == "qa" or (cloudscore > 0 and cloudscore < 100)
+
+    # scenes with an unknown cloud cover (missing or negative) are neither clear nor dropped
+    clearFilter = ee.Filter.And(ee.Filter.gte("CLOUD_COVER", 0), ee.Filter.lte("CLOUD_COVER", SCENE_CLEAR_CLOUD_COVER))
+    cloudyFilter = ee.Filter.gt("CLOUD_COVER", SCENE_MAX_CLOUD_COVER)
+
+    # the sizes of the different collections, requested from EE with a single call
+    sizes = {}
+
+    # Drops the cloudy scenes, skips the simpleCloudScore for the clear ones and masks the rest
+    # (the bit test of the qa mask is cheap enough to be used on all remaining scenes)
+    def cloudFilter(collection, name):
+        sizes[name] = collection.size()
+        if not masking:
+            return collection
+
+        if cloudmask == "qa":
+            collection = collection.filter(cloudyFilter.Not())
+            sizes[name + "_masked"] = collection.size()
+            return collection.map(qaMask)
+
+        clear = collection.filter(clearFilter)
+        scored = collection.filter(ee.Filter.Or(clearFilter, cloudyFilter).Not())
+        sizes[name + "_clear"] = clear.size()
+        sizes[name + "_scored"] = scored.size()
+
+        return ee.ImageCollection(clear.merge(scored.map(cloudMask)))
+
+    # If source is all a collection for each satellite is created and they are merged
+    sensors = ["land5","land7","land8"] if source == "all" else [source]
+    collection = None
+    for sensor in sensors:
         # select only the images that were took between start and end
-        collection = ee.ImageCollection(sourceSwitch[source]).filterDate(str(start) + "-01-01", str(end) + "-12-31T23:59:59")
+        images = ee.ImageCollection(sourceSwitch[sensor]).filterDate(str(start) + "-01-01", str(end) + "-12-31T23:59:59")
 
         # only select the images that intersect with the coordinates of point or region
-        collection = filterRegions(collection,point,region)
+        images = filterRegions(images)
 
-        # use the simpleCloudScore algorithm
-        if cloudscore > 0 and cloudscore < 100:
-            collection = collection.map(cloudMask)
+        # use the scene cloud cover prefilter and the simpleCloudScore algorithm
+        images = cloudFilter(images,sensor)
 
         # select only the RED and the NIR band
-        collection = collection.select(bandPattern[source],["RED","NIR"])
+        images = images.select(bandPattern[sensor],["RED","NIR"])
 
+        collection = images if collection is None else ee.ImageCollection(collection.merge(images))
+
+    sizes["collection"] = collection.size()
+    sizes = ee.Dictionary(sizes).getInfo()
 
     # Check if the collection conatins images if not return none
-    collection_size = collection.size().getInfo()
+    collection_size = sizes["collection"]
+    if info is not None:
+        info["size"] = collection_size
+        info["pathrows"] = pathrows
+        info["uncovered"] = uncovered
     if collection_size == 0:
         return None
 
+    # line2 of the information about the collection returned over the channel api
+    lines = []
+    if source == "all":
+        lines.append("Landsat 5: %s<br>Landsat 7: %s<br>Landsat 8: %s" % (sizes["land5"],sizes["land7"],sizes["land8"]))
+    if cloudmask == "qa":
+        masked = sum(sizes[s + "_masked"] for s in sensors)
+        dropped = sum(sizes[s] for s in sensors) - masked
+        lines.append("QA mask: %s scenes, %s cloudy scenes dropped (> %s%% cloud cover)" % (masked,dropped,SCENE_MAX_CLOUD_COVER))
+    elif masking:
+        clear = sum(sizes[s + "_clear"] for s in sensors)
+        scored = sum(sizes[s + "_scored"] for s in sensors)
+        dropped = sum(sizes[s] for s in sensors) - clear - scored
+        lines.append("Cloud score: computed for %s scenes, skipped for %s clear scenes (<= %s%% cloud cover), %s cloudy scenes dropped (> %s%% cloud cover)" % (scored,clear,SCENE_CLEAR_CLOUD_COVER,dropped,SCENE_MAX_CLOUD_COVER))
+    lines.append("WRS-2 path/row: %s" % _FormatPathRows(pathrows))
+
     # send number of images over Channel API to client
-    _SendMessage(client_id,"collection-info","info","Your collection contains %s images." % collection_size, collection_line2)
+    _SendMessage(client_id,"collection-info","info","Your collection contains %s images." % collection_size, "<br>".join(lines))
 
     return collection
 
 
-def _GetChart(options):
-    """Generates html code for a small chart and prepares the creation of a full sceen view by saving
-        the chart options under a unique id in the Memcache.
+def _CanonicalOptions(options):
+    """Returns the options that determine the result of a request in a canonical form
+        (without client id and filename, coordinates rounded to 6 decimals).
     Args:
-        options: a option dic created by _ReadOptions()
+        options: a dict created by _ReadOptions()
+    Returns:
+        A dict with the canonical options.
+    """
+    def roundCoordinates(value):
+        if isinstance(value, list):
+            return [roundCoordinates(v) for v in value]
+        return round(value, 6)
+
+    canonical = dict((k, v) for k, v in options.items() if k not in ("client_id", "filename"))
+    for k in ("point", "region"):
+        if canonical.get(k) is not None:
+            canonical[k] = roundCoordinates(canonical[k])
+    return canonical
+
+
+def _OptionsKey(options):
+    """Returns a hash of the canonical options that is equal for requests with the same result."""
+    return hashlib.sha1(json.dumps(_CanonicalOptions(options), sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def _EstimateSize(options, bounds):
+    """Estimates the size of the regression image of the options for a region (see exportsize.Estimate()).
+    Args:
+        options: a dict created by _ReadOptions()
+        bounds: the bounding box [<west>,<south>,<east>,<north>] of the region
+    Returns:
+        A dict with the estimated width, height, pixels, bands, type and bytes.
+    """
+    # a band per coefficient, the band "rmse" and the optional band "count"
+    bands = len(_ImageBands(options, options.get("count", False)))
+    data_type = EXPORT_DATA_TYPE if options["encoding"] == "float" else options["encoding"]
+    return exportsize.Estimate(bounds, EXPORT_RESOLUTION, bands, data_type)
+
+
+def _ImageBands(options, count=False):
+    """Returns the band names of the regression image of the options created by _GetImage()
+        (a band per coefficient like "a0_doy" or "a0_sec", "rmse" and with count "count")."""
+    suffix = "sec" if options["regression"] == "zhuWood" else "doy"
+    bands = ["a%s_%s" % (i, suffix) for i in range(REGRESSION_COEFFICIENTS[options["regression"]])] + ["rmse"]
+    return bands + ["count"] if count else bands
+
+
+def _ExportEncoding(options):
+    """Returns the scaled integer encoding of the regression image of the options.
+
+    A band is stored as round(<value> / <scale>). The scale of a coefficient is 10^-<precision> divided by
+    the largest absolute value of its predictor (the day of the year to the power of the degree, the seconds
+    since the start for the inter-annual term of Zhu & Woodcock or 1), so that the precision is the number of
+    decimal digits of its contribution to the NDVI. The scale of the rmse is 10^-<precision>. The optional
+    band "count" is stored unscaled. Values outside of the range of the type are stored as nodata
+    (like masked pixels), so a stored value is never a silently saturated one.
+    Args:
+        options: a dict created by _ReadOptions(), the option "precision" is the number of digits of all
+                 bands or a dict {<band prefix a0,a1,a2,a3 or rmse>:<digits>} (the default is EXPORT_PRECISION)
     Returns:
-        Html code with the small chart view or None if collection is empty.
+        None for the float encoding or a dict {"type":<int16 or int32>,"nodata":<the value of masked pixels>,
+        "outOfRange":"nodata","bands":[{"name":<band name>,"scale":<scale>,"offset":0,"precision":<digits>},...]},
+        a value is <stored value> * scale + offset.
     """
+    data_type = options["encoding"]
+    if data_type == "float":
+        return None
     regression = options["regression"]
-    point = options["point"]
+    precision = options["precision"]
+
+    # the largest absolute values of the predictors of the coefficients
+    if regression == "zhuWood":
+        predictors = [1, 1, 1, (options["end"] - options["start"] + 1) * 366 * 24 * 60 * 60]
+    else:
+        predictors = [365.0 ** degree for degree in range(REGRESSION_COEFFICIENTS[regression])]
+
+    bands = []
+    for name, predictor in zip(_ImageBands(options), predictors + [1]):
+        prefix = name.split("_")[0]
+        if isinstance(precision, dict):
+            digits = precision.get(prefix, EXPORT_PRECISION[data_type])
+        else:
+            digits = precision if precision is not None else EXPORT_PRECISION[data_type]
+        bands.append({"name":name,"scale":10.0 ** -digits / predictor,"offset":0,"precision":digits})
+    if options.get("count", False):
+        bands.append({"name":"count","scale":1,"offset":0,"precision":0})
+    return {"type":data_type,"nodata":INTEGER_RANGES[data_type][0],"outOfRange":"nodata","bands":bands}
+
+
+def _EncodeImage(image, encoding):
+    """Stores the bands of a regression image as scaled integers (see _ExportEncoding()).
+
+    The masked pixels and the values that do not fit into the type (the nodata value is reserved)
+    are set to the nodata value, so the image has to be clipped before and the export or download
+    needs a region.
+    Args:
+        image: an ee.Image created by _GetImage()
+        encoding: a dict created by _ExportEncoding() or None to keep the image unchanged
+    Returns:
+        An ee.Image.
+    """
+    if encoding is None:
+        return image
+    low, high = INTEGER_RANGES[encoding["type"]]
+    encoded = None
+    for band in encoding["bands"]:
+        scaled = image.select(band["name"]).divide(band["scale"]).round()
+        scaled = scaled.updateMask(scaled.gt(low).And(scaled.lte(high)))
+        encoded = scaled if encoded is None else encoded.addBands(scaled)
+    encoded = encoded.toInt16() if encoding["type"] == "int16" else encoded.toInt32()
+    return encoded.unmask(encoding["nodata"])
+
+
+def _QueueExport(options, size):
+    """Adds the export of the regression image of the options to the export queue.
+    Args:
+        options: a dict created by _ReadOptions()
+        size: the estimated size of the export created by _EstimateSize()
+    Returns:
+        None or a dict {"error":<message>} if the export is too large or the client already has an export.
+    """
+    # EE would only fail after computing for a while
+    if size["pixels"] > EXPORT_MAX_PIXELS:
+        return {"error":"The region is too large (%s x %s pixels, at most %d pixels). Draw a smaller region." % (size["width"],size["height"],EXPORT_MAX_PIXELS)}
+
+    running_export = memcache.get(options["client_id"])
+
+    # check if the user has an export running or queued, an export that the queue dropped
+    # (its runner stopped without releasing the slot) does not block the client
+    if running_export is not None and (running_export["task"] is not None or running_export.get("job") is not None):
+        if running_export.get("job") is None or EXPORT_QUEUE.Contains(running_export["job"]):
+            return {"error":"Currently another export is running for you. Please wait or cancel it."}
+
+    if size["bytes"] > EXPORT_WARN_BYTES:
+        _SendMessage(options["client_id"],"size-" + options["filename"],"warning","The export of %s is large, it can take hours." % options["filename"],
+                     "Estimated size: %s (%s x %s pixels, %s bands), EE splits it into multiple files." % (exportsize.FormatBytes(size["bytes"]),size["width"],size["height"],size["bands"]))
+
+    # Add the export to the global queue. The EE task is only started when one of the
+    # EXPORT_MAX_RUNNING slots is free, so that bursts do not exceed the EE task allowance.
+    job = {"id":_GetUniqueString(),"client_id":options["client_id"],"options":options}
+    EXPORT_QUEUE.Enqueue(job)
+    memcache.set(options["client_id"],{"task":None,"filename":None,"job":job["id"]})
+
+    # start the export if there is a free slot and notify the waiting clients
+    _DispatchExports()
+
+
+def _ETag(*parts):
+    """Returns a strong entity tag of a deterministic response, it changes with each deployed version of the app."""
+    return hashlib.sha1(json.dumps([os.environ.get("CURRENT_VERSION_ID", "")] + list(parts)).encode("utf-8")).hexdigest()
+
+
+def _AcceptedEncoding(accept_encoding):
+    """Returns "gzip" or "deflate" if the Accept-Encoding header accepts it (gzip is preferred) or None."""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        fields = [field.strip() for field in item.split(";")]
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith("q="):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(fields[0].lower())
+    for encoding in ("gzip", "deflate"):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def _Compress(body, encoding):
+    """Compresses a response body with gzip or deflate (zlib format, like HTTP defines it)."""
+    if encoding == "deflate":
+        return zlib.compress(body)
+    buf = io.BytesIO()
+    # without a timestamp the compressed body of the same response is the same
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+def _PathRowFilter(pathrows):
+    """Returns an ee.Filter that selects the scenes of the given WRS-2 path/row pairs by their metadata.
+    Args:
+        pathrows: a list of (path, row) tuples
+    Returns:
+        A ee.Filter on the WRS_PATH and WRS_ROW properties.
+    """
+    rows = {}
+    for path, row in pathrows:
+        rows.setdefault(path, []).append(row)
+
+    filters = [ee.Filter.And(ee.Filter.eq("WRS_PATH", path), ee.Filter.inList("WRS_ROW", rows[path])) for path in sorted(rows)]
+    return ee.Filter.Or(*filters)
+
+
+def _FormatPathRows(pathrows):
+    """Returns the path/row pairs as human readable string like '195/024, 196/024'."""
+    if not pathrows:
+        return "none"
+    return ", ".join("%03d/%03d" % pathrow for pathrow in pathrows)
+
+
+def _GetChartSeries(options, report=None, check=None):
+    """Extracts the NDVI series of a chart at the point of the options (and the regression coefficients of zhuWood).
+
+    The series is extracted at the center of the EXPORT_RESOLUTION pixel of the point (see _SnapPoint()), so that
+    the series prefetched for a point can be used by the charts of all points in the same pixel. The reductions at
+    the point are retried with the CHART_ADAPTATIONS if they exceed a memory or time limit of EE.
+
+    Args:
+        options: a option dic created by _ReadOptions()
+        report: an optional function that is called with the descriptions of the applied adaptations before a retry
+        check: an optional function that is called between the EE calls, it raises supersession.Superseded to stop
+    Returns:
+        A dict {"values":[[<epoch seconds>,<ndvi>],...],"coeff":<coefficients or None>,"adaptations":<descriptions>}
+        or None if the collection is empty.
+    """
+    check = check or (lambda: None)
+    point = _SnapPoint(options["point"])
     start = options["start"]
     end = options["end"]
 
-    collection = _GetCollection(options,region=False)  # only use point to filter region
+    info = {}
+    scenes = _GetCollection(dict(options, point=point),region=False,info=info)  # only use point to filter region
 
     # _GetCollection() returns None if collection is empty
-    if collection is None:
+    if scenes is None:
         return None
 
     # Generates an image with a band "nd" that contains the NDVI
@@ -870,33 +2321,120 @@ def _GetChart(options):
     def calcValues(img):
         return (img.select()
                 .addBands(img.metadata("system:time_start").divide(1000).floor())  # convert to seconds
-                .addBands(img.normalizedDifference(["NIR","RED"])))  # NDVI
+                .addBands(_Ndvi(img)))
+
+    # Creates a list of arrays like [[<image1 epoch seconds>,<image1 ndvi>],[<image2 epoch seconds>,<image2 ndvi>],...],
+    # the time ranges of the params are reduced one by one
+    def getValues(params):
+        values = []
+        for first, last in params["years"]:
+            check()
+            # the chart shows the values the regression is calculated from
+            collection = scenes
+            if len(params["years"]) > 1:
+                collection = collection.filterDate(str(first) + "-01-01", str(last) + "-12-31T23:59:59")
+            if options["composite"] != "none":
+                collection = _CompositeCollection(collection, dict(options, start=first, end=last))
+
+            # Extracts the pixel values at a specific point and adds them as array clalled "vlaues" to the image properties,
+            # useing that the mean reducer only got one value because the poi_geometry is just a point
+            def getPointValues(img):
+                return (img.reduceRegions(ee.Geometry.Point(point), ee.Reducer.mean(), EXPORT_RESOLUTION, tileScale=params["tileScale"])
+                        .makeArray(["system:time_start","nd"],"values"))
+
+            # aggregate_array also filters the masked pixels out
+            values.extend(ee.FeatureCollection(collection.map(calcValues).map(getPointValues)).flatten().aggregate_array("values").getInfo())
+        return values
+
+    values, params = adaptive.Run(getValues, {"tileScale": 1, "years": [[start, end]]}, CHART_ADAPTATIONS, report)
+
+    coeff = None
+    if options["regression"] == "zhuWood":
+        check()
+        # get the regression coefficients at the point of interest (makes chart creation a lot slower),
+        # the scenes at the point are the ones of the chart
+        image = _GetImage(options, info=info, collection=scenes)
+        # the adaptations of the values are kept (the regression is not split into time ranges)
+        coeff, params = adaptive.Run(lambda params: image.reduceRegion(ee.Reducer.mean(), ee.Geometry.Point(point), EXPORT_RESOLUTION,
+                                                                       tileScale=params["tileScale"]).getInfo(),
+                                     params, CHART_ADAPTATIONS, report)
+
+    return {"values":values,"coeff":coeff,"adaptations":params.get("adaptations")}
+
+
+def _SnapPoint(point):
+    """Returns the center of the EXPORT_RESOLUTION pixel (in EPSG:4326 like the exports) that contains the point."""
+    size = float(EXPORT_RESOLUTION) / exportsize.METERS_PER_DEGREE
+    return [round((math.floor(c / size) + 0.5) * size, 7) for c in point]
+
+
+def _ChartKind(options):
+    """Returns the kind of the generations of a chart (see supersession.py), a chart only supersedes the charts of the same pixel."""
+    return "chart at %s,%s" % tuple(_SnapPoint(options["point"]))
+
+
+def _ChartSeriesKey(options):
+    """Returns the Memcache key of the point series of a chart, equal for the points in the same pixel (see _SnapPoint())."""
+    # the series does not depend on the region and the encoding, of the regressions only zhuWood adds coefficients
+    series_options = dict(options, point=_SnapPoint(options["point"]), region=None, encoding=None, precision=None, count=None,
+                          regression=options["regression"] if options["regression"] == "zhuWood" else None)
+    return "chartseries:%s" % _OptionsKey(series_options)
+
+
+def _PrefetchedSeries(options):
+    """Returns the point series of a chart prefetched by a ChartPrefetchRunnerHandler or None.
+
+    A running prefetch of the series is awaited for up to CHART_PREFETCH_WAIT_SECONDS.
+    """
+    if not config.CHART_PREFETCH:
+        return None
+    key = _ChartSeriesKey(options)
+    deadline = time.time() + CHART_PREFETCH_WAIT_SECONDS
+    while True:
+        # the runner stores the series before it deletes the running marker
+        running = memcache.get(key + ":running")
+        series = memcache.get(key)
+        if series is not None or running is None or time.time() > deadline:
+            return series
+        time.sleep(0.5)
+
+
+def _GetChart(options, report=None, series=None, check=None):
+    """Generates the data of a small chart and prepares the creation of a full sceen view by saving
+        the chart options under a unique id in the Memcache.
 
-    collection = collection.map(calcValues)
+    Args:
+        options: a option dic created by _ReadOptions()
+        report: an optional function that is called with the descriptions of the applied adaptations before a retry
+        series: the series at the point created by _GetChartSeries() or None to extract it
+        check: an optional function that is called between the EE calls (see _GetChartSeries())
+    Returns:
+        A dict {"url":<url of the full screen view>,"chart":<small chart>,"adaptations":<descriptions>} or None if
+        collection is empty. The small chart is a dict {"table":<DataTable json>,"options":<chart options>}, it is None
+        if the table is too large to be sent to the client.
+    """
+    regression = options["regression"]
+    point = options["point"]
+    start = options["start"]
+    end = options["end"]
 
-    # Extracts the pixel values at a specific point and adds them as array clalled "vlaues" to the image properties
-    def getValues(img):
-        # useing that the mean reducer only got one value because the poi_geometry is just a point
-        return img.reduceRegions(ee.Geometry.Point(point), ee.Reducer.mean(),EXPORT_RESOLUTION).makeArray(["system:time_start","nd"],"values")
+    if series is None:
+        series = _GetChartSeries(options, report, check)
 
-    # Creates a list of arrays like [[<image1 epoch seconds>,<image1 ndvi>],[<image2 epoch seconds>,<image2 ndvi>],...]
-    # aggregate_array also filters the masked pixels out
-    raw_data = ee.FeatureCollection(collection.map(getValues)).flatten().aggregate_array("values").getInfo()
+    # _GetChartSeries() returns None if collection is empty
+    if series is None:
+        return None
+    raw_data = series["values"]
+    coeff = series["coeff"]
 
 
     # style information for the different chart types
     if regression == "zhuWood":
-
-        # get the regression coefficients at the point of interest (makes chart creation a lot slower)
-        image = _GetImage(options)
-        coeff = image.reduceRegion(ee.Reducer.mean(),ee.Geometry.Point(point),EXPORT_RESOLUTION).getInfo()
-
         coeff_map = {"a0":coeff["a0_sec"],"a1":coeff["a1_sec"],"a2":coeff["a2_sec"],"a3":coeff["a3_sec"],"rmse":coeff["rmse"]}
         # describe xAxis and yAxis
         description = [("Date","date"),("NDVI", "number"),("Regression: a0=%(a0)s, a1=%(a1)s, a2=%(a2)s, a3=%(a3)s, rmse=%(rmse)s" % coeff_map,"number")]
 
-        hAxis = """{title:"Date"},"""
-        chartArea = "{width: \"75%\"}"
+        style = {"hAxis":{"title":"Date"},"chartArea":{"width":"75%"}}
         per = "Date"
 
         # start and end epoch seconds of the collection
@@ -924,10 +2462,9 @@ def _GetChart(options):
             # convert time_struct to datetime and add it with the regression value to the data
             data.append([datetime(*time.gmtime(x)[:6]),None,reg_ndvi])
 
-        trendline = """legend:{position:"bottom"},series:{1:{lineWidth: 1}},"""
+        style.update({"legend":{"position":"bottom"},"series":{"1":{"lineWidth":1}}})
     else:
-        hAxis = """{title:"DOY",minValue:0,maxValue:365},"""
-        chartArea = "{width: \"50%\"}"
+        style = {"hAxis":{"title":"DOY","minValue":0,"maxValue":365},"chartArea":{"width":"50%"}}
         per = "DOY"
 
         # is for all points to display the regression (0_ prefix so it is always the first)
@@ -952,7 +2489,7 @@ def _GetChart(options):
 
         degree = {"poly1":1,"poly2":2,"poly3":3}
         # hide dataset that holds all points and only display the regression for it
-        trendline = """series:{0:{visibleInLegend: false}},trendlines:{0:{type:"polynomial",degree:%s,showR2: true, visibleInLegend: true}},""" % degree[regression]
+        style.update({"series":{"0":{"visibleInLegend":False}},"trendlines":{"0":{"type":"polynomial","degree":degree[regression],"showR2":True,"visibleInLegend":True}}})
 
 
 
@@ -964,146 +2501,767 @@ def _GetChart(options):
     # Creating a JavaScript code string that represents the chart
     jscode = data_table.ToJSCode("data")
 
+    # the options of the google.visualization.ScatterChart
+    style.update({"title":"NDVI at [%s,%s] per %s (%s-%s)" % (point[1],point[0],per,start,end),"pointSize":3,"vAxis":{"title":"NDVI"}})
+
     # Create temporary chart id
     chart_id = _GetUniqueString()
 
     # Set request options as chart options, and add some extra values
     chart_options = options.copy()
-    chart_options.update({"jscode":jscode,"lat":point[1],"lon":point[0],"trendline":trendline,"hAxis":hAxis,"chart_id":chart_id,"chartArea":chartArea,"per":per})
+    chart_options.update({"jscode":jscode,"style":style,"chart_id":chart_id})
 
     # Save the chart options temporary in Memcache
     memcache.set(chart_id,chart_options)
 
-    if len(jscode) < 31000:  # max 32767 chars per channel api message
-        # Load small chart template
-        f = open("templates/small_chart.html", "r")
-        small_chart = f.read()
-        f.close()
+    # large tables are only shown in the full screen view, they would make the Firebase message too large
+    table = data_table.ToJSon()
+    if len(table) < 31000:
+        chart = {"table":json.loads(table),"options":style}
+    else:
+        chart = None
+
+    return {"url":"/chart?id=" + chart_id,"chart":chart,"adaptations":series["adaptations"]}
 
-        # Fill in chart options an return template
-        return small_chart % chart_options
+
+def _GetRegionStats(options, mode):
+    """Computes the statistics of each band of the regression image inside of the region of the options.
+
+    The mean, the REGION_STATS_PERCENTILES, a histogram and the number of valid pixels are computed in one
+    reduction, which is retried with a higher tileScale if it exceeds a memory or time limit of EE.
+    The sampled mode reduces the columns of a sample of REGION_STATS_SAMPLE_PIXELS random pixels of the
+    region at EXPORT_RESOLUTION (the masked pixels are dropped), the fixed REGION_STATS_SEED makes the
+    sample and the statistics deterministic. The valid pixels of the region are counted in the same request
+    at a coarser scale, chosen so that the bounding box of the region has about REGION_STATS_SAMPLE_PIXELS
+    pixels (bestEffort lets EE raise it further if needed), and scaled to pixels of EXPORT_RESOLUTION.
+
+    Args:
+        options: a dict created by _ReadOptions() with a region
+        mode: the mode of the statistics [sampled,exact]
+
+    Returns:
+        A dict {"mode":<mode>,"scale":<pixel size in meters>,"countScale":<pixel size of the count in meters>,
+        "bands":{<band>:<statistics>},"adaptations":<descriptions>} or None if the collection is empty.
+        The statistics of a band are a dict {"count":<valid pixels of the region (estimated in the sampled mode)>,
+        "samples":<valid pixels of the sample (only in the sampled mode)>,"mean":<mean>,"percentiles":{"p5":<value>,...},
+        "histogram":{"bucketMin":<value>,"bucketWidth":<value>,"histogram":[<count>,...]}},
+        the values are None if the band has no valid pixels in the region.
+    """
+    size = exportsize.Estimate(bulkexport.Bounds([[options["region"]]]), EXPORT_RESOLUTION, 1, "float")
+    if mode == "exact":
+        if size["pixels"] > REGION_STATS_EXACT_PIXELS:
+            raise Exception("The region is too large for exact statistics (%s pixels, at most %d), use the sampled mode."
+                            % (size["pixels"], REGION_STATS_EXACT_PIXELS))
+        count_scale = EXPORT_RESOLUTION
     else:
-        return """No small chart available.<br><a href="/chart?id=%(chart_id)s" target="_blank">Full screen url (only temporary valid)</a>""" % chart_options
+        count_scale = max(EXPORT_RESOLUTION, int(math.ceil(EXPORT_RESOLUTION * math.sqrt(float(size["pixels"]) / REGION_STATS_SAMPLE_PIXELS))))
 
+    image = _GetImage(options)
 
-def _GetImage(options):
+    # _GetImage returns None if the collection is empty
+    if image is None:
+        return None
+
+    reducer = (ee.Reducer.mean()
+               .combine(ee.Reducer.percentile(REGION_STATS_PERCENTILES), sharedInputs=True)
+               .combine(ee.Reducer.histogram(REGION_STATS_BUCKETS), sharedInputs=True)
+               .combine(ee.Reducer.count(), sharedInputs=True))
+
+    bands = _ImageBands(options)
+    region = ee.Geometry.Polygon(options["region"])
+
+    def reduce(params):
+        if mode == "exact":
+            return image.reduceRegion(reducer, region, EXPORT_RESOLUTION, maxPixels=REGION_STATS_EXACT_PIXELS, tileScale=params["tileScale"]).getInfo()
+        # the reducer is repeated for each band (column) of the sample
+        sample = image.sample(region=region, scale=EXPORT_RESOLUTION, numPixels=REGION_STATS_SAMPLE_PIXELS, seed=REGION_STATS_SEED,
+                              tileScale=params["tileScale"])
+        counts = image.reduceRegion(ee.Reducer.count(), region, count_scale, maxPixels=REGION_STATS_SAMPLE_PIXELS, bestEffort=True,
+                                    tileScale=params["tileScale"])
+        return ee.Dictionary({"sample": sample.reduceColumns(reducer.forEach(bands), bands), "counts": counts}).getInfo()
+
+    result, params = adaptive.Run(reduce, {"tileScale": 1}, REGION_STATS_ADAPTATIONS)
+    values = result if mode == "exact" else result["sample"]
+
+    # the results of a combined reducer are named <band>_<output>
+    statistics = {}
+    for band in bands:
+        histogram = values.get(band + "_histogram")
+        statistics[band] = {
+            "count": values.get(band + "_count"),
+            "mean": values.get(band + "_mean"),
+            "percentiles": dict(("p%s" % p, values.get("%s_p%s" % (band, p))) for p in REGION_STATS_PERCENTILES),
+            "histogram": dict((k, histogram[k]) for k in ("bucketMin", "bucketWidth", "histogram")) if histogram else None,
+        }
+        if mode == "sampled":
+            # a pixel of the count covers (count_scale / EXPORT_RESOLUTION)^2 pixels of the statistics
+            count = result["counts"].get(band)
+            statistics[band]["samples"] = statistics[band]["count"]
+            statistics[band]["count"] = int(round(count * (float(count_scale) / EXPORT_RESOLUTION) ** 2)) if count is not None else None
+    return {"mode": mode, "scale": EXPORT_RESOLUTION, "countScale": count_scale, "bands": statistics, "adaptations": params.get("adaptations")}
+
+
+def _GetImage(options, preview=False, info=None, count=False, collection=None):
     """Returns the ndvi regression image for the given options.
 
     Args:
         options: a dict created by _ReadOptions() containing the request options
+        preview: if True the regression is only calculated from a temporally stratified subsample
+                 of at most PREVIEW_MAX_IMAGES images (see _SampleCollection())
+                 (with the composite option the composites are made from the subsample)
+        info: an optional dict that is filled with information about the collection (see _GetCollection())
+              and the key "sampled" if the collection was subsampled for the preview
+        count: if True the band "count" with the number of ndvi values per pixel is added
+        collection: the ee.ImageCollection created by _GetCollection() with the info to use instead of
+                    creating one for the options (optional)
 
     Returns:
         An ee.Image with the coefficients of the regression and a band called "rmse" containing the
         Root Mean Square Error for the ndvi value calculated by the regression or None if collection is empty.
+        Pixels with less than 2 * number of predictors ndvi values are masked.
     """
 
     # renaming the used options
     regression = options["regression"]
     start = options["start"]
 
-    collection = _GetCollection(options)
+    if info is None:
+        info = {}
+
+    if collection is None:
+        collection = _GetCollection(options, info=info)
 
     # _GetCollection() returns None if collection is empty
     if collection is None:
         return None
 
-    # Function to calculate the values needed for a regression with a polynomial of degree 1
-    def makePoly1Variables(img):
-        date = img.date()
-        doy = date.getRelative("day", "year")
+    if preview and info["size"] > PREVIEW_MAX_IMAGES:
+        collection = _SampleCollection(collection, options)
+        info["sampled"] = True
 
-        x1 = doy
-        x0 = 1
+    # the regression gets one composite per period instead of the individual scenes
+    if options["composite"] != "none":
+        collection = _CompositeCollection(collection, options)
 
-        return (img.select()
-                .addBands(ee.Image.constant(x0))                    # 0. a0 constant term
-                .addBands(ee.Image.constant(x1))                    # 1. a1*x
-                .addBands(img.normalizedDifference(["NIR","RED"]))  # 2. response variable (NDVI)
-                .toFloat())
+    # the values of the predictors of an image, the constants are computed in Python
+    # (a polynomial of the day of the year or the model after Zhu & Woodcock)
+    if regression == "zhuWood":
+        seconds_start = calendar.timegm((start, 1, 1, 0, 0, 0))
 
-    # Function to calculate the values needed for a regression with a polynomial of degree 2
-    def makePoly2Variables(img):
-        date = img.date()
-        doy = date.getRelative("day", "year")
+        def predictors(img):
+            seconds_offset = img.date().millis().divide(1000).floor().subtract(seconds_start)
+            angle = seconds_offset.multiply(2*math.pi/(365*24*60*60))
+            return [1, angle.cos(), angle.sin(), seconds_offset]  # constant term, cos and sin intra-annual, inter-annual
+    else:
+        def predictors(img):
+            doy = img.date().getRelative("day", "year")
+            return [1, doy, doy.pow(2), doy.pow(3)][:REGRESSION_COEFFICIENTS[regression]]  # a0 + a1*x + a2*x^2 + a3*x^3
+
+    # Function to calculate the values needed for the regression: a band per predictor,
+    # the response variable (NDVI) and a copy of the NDVI for the count of the values
+    def makeVariables(img):
+        ndvi = _Ndvi(img)
+        variables = img.select()
+        for value in predictors(img):
+            variables = variables.addBands(ee.Image.constant(value))
+        return variables.addBands(ndvi).addBands(ndvi.rename("observations")).toFloat()
+
+    predictorsCount = REGRESSION_COEFFICIENTS
+    flattenPattern = {"poly1": ["a0", "a1"], "poly2": ["a0", "a1", "a2"], "poly3": ["a0", "a1", "a2", "a3"], "zhuWood": ["a0", "a1", "a2", "a3"]}
+    renamePattern = {"poly1": "doy", "poly2": "doy", "poly3": "doy", "zhuWood": "sec"}
 
-        x2 = doy.pow(2)
-        x1 = doy
-        x0 = 1
+    if config.REGRESSION_STATS_FOLDER and not info.get("sampled") and not info["uncovered"] and options["composite"] == "none":
+        # the regression is solved from the sums of the stored yearly statistics and of the images of the other years
+        stats = _GetStoredStats(options, collection, info["pathrows"])
+        coefficientsImage, rmse = _SolveStats(stats, regression, start)
+        coefficientsImage = coefficientsImage.rename(["%s_%s" % (name, renamePattern[regression]) for name in flattenPattern[regression]])
+        countValues = stats.select(["n"], ["count"])
+    else:
+        # calculate the needed values for the regression
+        collection_prepared = collection.map(makeVariables)
 
-        return (img.select()
-                .addBands(ee.Image.constant(x0))                    # 0. a0 constant term
-                .addBands(ee.Image.constant(x1))                    # 1. a1*x
-                .addBands(ee.Image.constant(x2))                    # 2. a2*x^2
-                .addBands(img.normalizedDifference(["NIR","RED"]))  # 4. response variable (NDVI)
-                .toFloat())
-
-    # Function to calculate the values needed for a regression with a polynomial of degree 3
-    def makePoly3Variables(img):
+        # the regression and the count of the ndvi values per pixel are computed in one pass over the collection,
+        # the inputs are not shared so the count reducer gets the last band (a copy of the ndvi) as input
+        reducer = ee.Reducer.linearRegression(predictorsCount[regression], 1).combine(ee.Reducer.count(), None, False)
+        reduced = collection_prepared.reduce(reducer).select([0, 1, 2], ["coefficients", "residuals", "count"])
+        countValues = reduced.select("count")
+
+        # flattens regression coefficients to one image with multiple bands
+        coefficientsImage = reduced.select(["coefficients"]).arrayFlatten([flattenPattern[regression],[renamePattern[regression]]])
+
+        # flattens the root mean square of the predicted ndvi values
+        rmse = reduced.select("residuals").arrayFlatten([["rmse"]])
+
+    # masks pixels with less than 2 * number of predictors, to deliver better results
+    valid = countValues.gt(predictorsCount[regression]*2-1)
+
+    # combines coefficients and rmse (and the count) and returns them a one ee.Image
+    image = coefficientsImage.addBands(rmse)
+    if count:
+        image = image.addBands(countValues)
+    return image.updateMask(valid)
+
+
+def _SampleCollection(collection, options):
+    """Returns a bounded, temporally stratified subsample of a collection for fast previews.
+
+    The time range is divided into at most PREVIEW_MAX_IMAGES strata of whole months and from
+    each stratum the image with the lowest cloud cover is used.
+
+    Args:
+        collection: a ee.ImageCollection created by _GetCollection()
+        options: a dict created by _ReadOptions()
+
+    Returns:
+        A ee.ImageCollection with at most PREVIEW_MAX_IMAGES images.
+    """
+    start = options["start"]
+    months = (options["end"] - start + 1) * 12
+    period = int(math.ceil(float(months) / PREVIEW_MAX_IMAGES))  # months per stratum
+
+    def setStratum(img):
         date = img.date()
-        doy = date.getRelative("day", "year")
+        month = date.get("year").subtract(start).multiply(12).add(date.get("month")).subtract(1)
+        return img.set("stratum", month.divide(period).floor())
 
-        x3 = doy.pow(3)
-        x2 = doy.pow(2)
-        x1 = doy
-        x0 = 1
+    return ee.ImageCollection(collection.map(setStratum).sort("CLOUD_COVER").distinct("stratum"))
 
-        return (img.select()
-                .addBands(ee.Image.constant(x0))                    # 0. a0 constant term
-                .addBands(ee.Image.constant(x1))                    # 1. a1*x
-                .addBands(ee.Image.constant(x2))                    # 2. a2*x^2
-                .addBands(ee.Image.constant(x3))                    # 3. a3*x^3
-                .addBands(img.normalizedDifference(["NIR","RED"]))  # 4. response variable (NDVI)
-                .toFloat())
 
-    # Function to calculate the values needed for a regression with the model after Zhu & Woodcock
-    def makeZhuWoodVariables(img):
+def _Ndvi(img):
+    """Returns the NDVI of an image with the bands RED and NIR as band "nd".
 
-        seconds = img.date().millis().divide(1000).floor()
-        seconds_start = ee.Date("%s-01-01" % start).millis().divide(1000).floor()
-        seconds_offset = seconds.subtract(seconds_start)
+    All graphs compute the NDVI with this function, so that the expression is equal in
+    the graphs of the map and of the chart and is only encoded once in a request.
+    """
+    return img.normalizedDifference(["NIR","RED"])
 
-        sin_intra = ee.Number(2).multiply(math.pi).divide(365*24*60*60).multiply(seconds_offset).sin()
-        cos_intra = ee.Number(2).multiply(math.pi).divide(365*24*60*60).multiply(seconds_offset).cos()
-        inter = seconds_offset
 
-        return (img.select()
-                .addBands(ee.Image.constant(1))                     # 0. constant term
-                .addBands(ee.Image.constant(cos_intra))             # 1. cos intra-annual
-                .addBands(ee.Image.constant(sin_intra))             # 2. sin intra-annual
-                .addBands(ee.Image.constant(inter))                 # 3. inter-annual
-                .addBands(img.normalizedDifference(["NIR","RED"]))  # 5. response variable (NDVI)
-                .toFloat())
+def _CompositeCollection(collection, options):
+    """Returns the temporal composites of a collection, the regression gets one image per period.
 
-    makeVariables = {"poly1": makePoly1Variables,"poly2": makePoly2Variables, "poly3": makePoly3Variables, "zhuWood": makeZhuWoodVariables}
+    The images of each period (16 days from January 1st or a month) are reduced to the median of the
+    RED and NIR bands or to the bands of the pixels with the highest NDVI (with an additional NDVI band).
+    The system:time_start of a composite is the mean acquisition time of its images, so that it drives
+    the predictors of the regression. Periods without images are dropped.
 
-    # calculate the needed values for the regression
-    collection_prepared = collection.map(makeVariables[regression])
+    Args:
+        collection: a ee.ImageCollection created by _GetCollection()
+        options: a dict created by _ReadOptions() with a composite period other than "none"
 
-    predictorsCount = {"poly1": 2,"poly2": 3, "poly3": 4, "zhuWood": 4}
+    Returns:
+        A ee.ImageCollection with at most one image per period.
+    """
+    # the periods as [<start>,<end>] in epoch milliseconds, the end is excluded
+    periods = []
+    for year in range(options["start"], options["end"] + 1):
+        if options["composite"] == "month":
+            bounds = [calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0)) for month in range(13)]
+        else:
+            first = calendar.timegm((year, 1, 1, 0, 0, 0))
+            bounds = [first + day*24*60*60 for day in range(0, 365, COMPOSITE_DAYS)] + [calendar.timegm((year + 1, 1, 1, 0, 0, 0))]
+        periods.extend([bounds[i]*1000, bounds[i + 1]*1000] for i in range(len(bounds) - 1))
 
-    # counts the ndvi values per pixel
-    countValues = collection_prepared.select("nd").reduce(ee.Reducer.count())
+    maxNdvi = options["compositemethod"] == "maxndvi"
 
-    # masks pixels with less than 2 * number of predictors, to deliver better results
-    def countMask(img):
-        return img.updateMask(countValues.gt(predictorsCount[regression]*2-1))
+    def addNdvi(img):
+        return img.addBands(_Ndvi(img))
 
-    # use the countMask
-    collection_prepared = collection_prepared.map(countMask)
+    def makeComposite(period):
+        period = ee.List(period)
+        images = collection.filterDate(period.get(0), period.get(1))
+        if maxNdvi:
+            composite = images.map(addNdvi).qualityMosaic("nd")
+        else:
+            composite = images.median()
+        return composite.set({"system:time_start": images.aggregate_mean("system:time_start"), "images": images.size()})
 
-    # doing the regression
-    coefficients = collection_prepared.reduce(ee.Reducer.linearRegression(predictorsCount[regression], 1))
+    composites = ee.ImageCollection(ee.List(periods).map(makeComposite))
+    return composites.filter(ee.Filter.gt("images", 0))
 
-    # flattens regression coefficients to one image with multiple bands
-    flattenPattern = {"poly1": ["a0", "a1"], "poly2": ["a0", "a1", "a2"], "poly3": ["a0", "a1", "a2", "a3"], "zhuWood": ["a0", "a1", "a2", "a3"]}
-    renamePattern = {"poly1": "doy", "poly2": "doy", "poly3": "doy", "zhuWood": "sec"}
-    coefficientsImage = coefficients.select(["coefficients"]).arrayFlatten([flattenPattern[regression],[renamePattern[regression]]])
 
-    # flattens the root mean square of the predicted ndvi values
-    rmse = coefficients.select("residuals").arrayFlatten([["rmse"]])
+def _GetStoredStats(options, collection, pathrows):
+    """Returns the per pixel sums of the normal equation terms of the regression of the options.
+
+    The years whose chunks are all stored are read from the assets of STATS_STORE and the
+    other years are computed from the images (see regressionstats.py). The missing chunks
+    of the past years are exported to the assets in the background by /statsrunner.
+
+    Args:
+        options: a dict created by _ReadOptions()
+        collection: the ee.ImageCollection of the options created by _GetCollection()
+        pathrows: the WRS-2 path/row pairs of the collection
+
+    Returns:
+        An ee.Image with the bands regressionstats.Bands().
+    """
+    family = regressionstats.FAMILIES[options["regression"]][0]
+    sensors = ["land5","land7","land8"] if options["source"] == "all" else [options["source"]]
+    mask = regressionstats.MaskKey(options["cloudmask"], options["cloudscore"], SCENE_MAX_CLOUD_COVER, SCENE_CLEAR_CLOUD_COVER)
+    stored = STATS_STORE.Stored()
+
+    # only the past years are stored, the scenes of the current year are still added
+    current = datetime.utcnow().year
+    assets = []
+    fresh = []
+    missing = []
+    for year in range(options["start"], options["end"] + 1):
+        chunks = [[regressionstats.ChunkName(family, sensor, mask, path, row, year), sensor, path, row, year]
+                  for sensor in sensors for path, row in pathrows]
+        if year < current and all(chunk[0] in stored for chunk in chunks):
+            assets.extend(ee.Image(STATS_STORE.AssetId(chunk[0])) for chunk in chunks)
+        else:
+            fresh.append(year)
+            if year < current:
+                missing.extend(chunk for chunk in chunks if chunk[0] not in stored)
+
+    pending = STATS_STORE.Pending([chunk[0] for chunk in missing])
+    missing = [chunk for chunk in missing if chunk[0] not in pending]
+    if missing:
+        _StoreStats(collection, family, missing[:STATS_MAX_EXPORTS])
+
+    if not fresh:
+        return ee.ImageCollection(assets).sum()
+
+    # one date filter per run of consecutive years
+    runs = []
+    for year in fresh:
+        if runs and runs[-1][1] == year - 1:
+            runs[-1][1] = year
+        else:
+            runs.append([year, year])
+    dates = ee.Filter.Or(*[ee.Filter.date("%s-01-01" % first, "%s-12-31T23:59:59" % last) for first, last in runs])
+
+    stats = _GetImageStats(collection.filter(dates), family)
+    if assets:
+        stats = stats.merge(ee.ImageCollection(assets))
+    return stats.sum()
+
+
+def _GetImageStats(collection, family):
+    """Returns the normal equation terms of each image for the basis of a model family (see regressionstats.py).
+
+    Args:
+        collection: an ee.ImageCollection created by _GetCollection() (or a subset of it)
+        family: "poly" or "harmonic"
+
+    Returns:
+        An ee.ImageCollection with images with the bands regressionstats.Bands(),
+        masked where the ndvi is masked.
+    """
+    predictors = regressionstats.PREDICTORS
+    epoch = calendar.timegm((regressionstats.EPOCH_YEAR, 1, 1, 0, 0, 0))
+
+    def makeStats(img):
+        if family == "poly":
+            x = img.date().getRelative("day", "year").divide(regressionstats.YEAR_DAYS)
+            basis = [ee.Number(1), x, x.pow(2), x.pow(3)]
+        else:
+            seconds = img.date().millis().divide(1000).floor().subtract(epoch)
+            angle = seconds.multiply(2 * math.pi / regressionstats.YEAR_SECONDS)
+            basis = [ee.Number(1), angle.cos(), angle.sin(), seconds.divide(regressionstats.YEAR_SECONDS)]
+
+        ndvi = _Ndvi(img).toDouble()
+        ones = ndvi.multiply(0).add(1)
+
+        stats = img.select()
+        for i in range(predictors):
+            for j in range(i, predictors):
+                stats = stats.addBands(ones.multiply(basis[i].multiply(basis[j])).rename(regressionstats.XXBand(i, j)))
+        for i in range(predictors):
+            stats = stats.addBands(ndvi.multiply(basis[i]).rename(regressionstats.XYBand(i)))
+        return stats.addBands(ndvi.multiply(ndvi).rename("yy")).addBands(ones.rename("n"))
+
+    return collection.map(makeStats)
 
-    # combines coefficients and rmse and returns them a one ee.Image
-    return coefficientsImage.addBands(rmse)
+
+def _SolveStats(stats, regression, start):
+    """Solves the normal equations of a regression per pixel with a Cholesky decomposition.
+
+    The systems have at most 4 unknowns, so they are solved with band math. The basis of
+    the sums is well conditioned, the coefficients are converted to the variables of the
+    app with regressionstats.Conversion().
+
+    Args:
+        stats: an ee.Image with the sums created by _GetStoredStats()
+        regression: the regression of the options
+        start: the first year of the options
+
+    Returns:
+        A tuple (<ee.Image with a band per coefficient>, <ee.Image with the band "rmse">),
+        masked where the system is singular.
+    """
+    predictors = regressionstats.FAMILIES[regression][1]
+    xx = [[stats.select(regressionstats.XXBand(i, j)) for j in range(predictors)] for i in range(predictors)]
+    xy = [stats.select(regressionstats.XYBand(i)) for i in range(predictors)]
+
+    # X'X = L * L'
+    lower = [[None] * predictors for _ in range(predictors)]
+    solvable = None
+    for j in range(predictors):
+        pivot = xx[j][j]
+        for k in range(j):
+            pivot = pivot.subtract(lower[j][k].multiply(lower[j][k]))
+        solvable = pivot.gt(0) if solvable is None else solvable.multiply(pivot.gt(0))
+        lower[j][j] = pivot.max(0).sqrt()
+        for i in range(j + 1, predictors):
+            value = xx[i][j]
+            for k in range(j):
+                value = value.subtract(lower[i][k].multiply(lower[j][k]))
+            lower[i][j] = value.divide(lower[j][j])
+
+    # L * z = X'y and L' * b = z
+    z = []
+    for i in range(predictors):
+        value = xy[i]
+        for k in range(i):
+            value = value.subtract(lower[i][k].multiply(z[k]))
+        z.append(value.divide(lower[i][i]))
+    basis = [None] * predictors
+    for i in reversed(range(predictors)):
+        value = z[i]
+        for k in range(i + 1, predictors):
+            value = value.subtract(lower[k][i].multiply(basis[k]))
+        basis[i] = value.divide(lower[i][i])
+
+    # the residual sum of squares of the least squares solution is y'y - b'X'y
+    rss = stats.select("yy")
+    for i in range(predictors):
+        rss = rss.subtract(basis[i].multiply(xy[i]))
+    rmse = rss.max(0).divide(stats.select("n")).sqrt().rename("rmse")
+
+    coefficients = None
+    for row in regressionstats.Conversion(regression, start):
+        value = None
+        for factor, coefficient in zip(row, basis):
+            if factor != 0:
+                term = coefficient.multiply(factor)
+                value = term if value is None else value.add(term)
+        coefficients = value if coefficients is None else coefficients.addBands(value)
+
+    return coefficients.updateMask(solvable), rmse.updateMask(solvable)
+
+
+def _StoreStats(collection, family, chunks):
+    """Starts /statsrunner to export chunks of the yearly regression statistics of the collection.
+
+    Args:
+        collection: the ee.ImageCollection created by _GetCollection()
+        family: the model family of the chunks
+        chunks: a list of [<chunk name>,<sensor>,<path>,<row>,<year>]
+    """
+    key = "stats-graph:" + _GetUniqueString()
+    try:
+        memcache.set(key, ee.serializer.toJSON(collection), time=STATS_LIST_LIFETIME)
+    except ValueError:
+        logging.warning("The collection is too large to store its regression statistics.")
+        return
+    taskqueue.add(url="/statsrunner", params={"graph":key,"family":family,"chunks":json.dumps(chunks)}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+
+
+def _GetLayers(image, layer=None, bands=None, check=None):
+    """Creates a map overlay for each band of the image.
+
+    If config.TILE_PROXY is set the map IDs are registered at the tile proxy under the
+    layer key and the band name, and the overlays load their tiles from /tiles.
+
+    Args:
+        image: an ee.Image created by _GetImage()
+        layer: the layer key of the image created by _LayerKey() (optional)
+        bands: the band names of the image created by _ImageBands() (optional, else they are requested from EE)
+        check: an optional function that is called before each map ID request, it raises supersession.Superseded to stop
+
+    Returns:
+        An array of dictionaries like {"name":<band name>,"mapid":<mapid>,"token":<token>}
+        or {"name":<band name>,"mapid":<layer key of the band>,"token":"","url":"/tiles"}.
+    """
+    check = check or (lambda: None)
+    if bands is None:
+        bands = image.bandNames().getInfo()
+    layers = []
+    for band in bands:
+        check()
+        # create a map overlay for each band
+        mapid = image.select(band).visualize().getMapId()
+        if config.TILE_PROXY and layer is not None:
+            TILE_PROXY.AddLayer(layer + "-" + band, mapid["mapid"], mapid["token"])
+            layers.append({"name":band, "mapid": layer + "-" + band, "token": "", "url": "/tiles"})
+        else:
+            layers.append({"name":band, "mapid": mapid["mapid"], "token": mapid["token"]})
+    return layers
+
+
+def _LayerKey(options, sampled=False, coarse=False):
+    """Returns the key of the map layers of the options for the tile proxy.
+
+    The key is equal for all requests with the same canonical options and the same kind
+    of map (the full map, a preview from a subsample or a preview at PREVIEW_SCALE).
+    """
+    variant = ("sampled" if sampled else "full") + ("-%s" % PREVIEW_SCALE if coarse else "")
+    # the encoding and the count band of the exports do not change the map
+    options = dict((k, v) for k, v in options.items() if k not in ("encoding", "precision", "count"))
+    return "%s-%s" % (_OptionsKey(options), variant)
+
+
+def _MapPixelSize(zoom):
+    """Returns the size of a map pixel at the equator in meters for a Google Maps zoom level."""
+    return 2 * math.pi * 6378137 / 256 / 2**zoom
+
+
+def _DispatchExports():
+    """Starts an export runner for each queued export that got a free slot
+        and notifies the waiting clients about their position in the export queue."""
+    for job in EXPORT_QUEUE.Dispatch():
+        # the parts of bulk exports are started by their /bulkexportrunner
+        if "bulk" in job:
+            continue
+        options = job["options"]
+
+        # Kick off an export runner to start and monitor the EE export task.
+        # Note: The work "task" is used by both Earth Engine and App Engine to refer
+        # to two different things. "TaskQueue" is an async App Engine service.
+        # only execute once even if task fails
+        taskqueue.add(url="/exportrunner", params={"options":json.dumps(options),"job_id":job["id"]}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+
+        # notify client that the export has started
+        _SendStatus(options["client_id"],"export",options["filename"],"running")
+
+    for position, job in enumerate(EXPORT_QUEUE.Waiting()):
+        if "bulk" in job:
+            continue
+        options = job["options"]
+        _SendStatus(options["client_id"],"export",options["filename"],"queued",id=job["id"],position=position + 1,slots=EXPORT_MAX_RUNNING)
+
+
+def _StartExportTask(options, image, params):
+    """Starts the EE task of the next part of an export.
+
+    Args:
+        options: a option dic created by _ReadOptions()
+        image: the regression image created by _GetImage()
+        params: the parameters of the export that are adapted after EE memory or time limit errors (see EXPORT_ADAPTATIONS),
+            "parts" are the bounding boxes of the parts that are not exported yet (None is the whole region, the first part is started),
+            "bounds" the bounding box of the region, "shardSize" the size of the shards and "number" the count of the started parts
+
+    Returns:
+        The id of the started EE task.
+    """
+    part = params["parts"][0]
+    if part is None:
+        name = options["filename"]
+        region = options["region"]
+    else:
+        # the parts of a split region are found by the file name prefix like the files of a large export
+        params["number"] += 1
+        name = "%s_%03d" % (options["filename"],params["number"])
+        west, south, east, north = part
+        region = [[west,south],[east,south],[east,north],[west,north],[west,south]]
+
+    # cut out the geometry (the client drawn polygon) and store the bands as scaled integers
+    image = _EncodeImage(image.clip(ee.Geometry.Polygon(options["region"])), _ExportEncoding(options))
+
+    # Create and start the task, the files are tiled and compressed with overviews (Cloud Optimized GeoTIFF).
+    task = ee.batch.Export.image(
+            image=image,
+            description=name,
+            config={
+                    "driveFileNamePrefix": name,
+                    "maxPixels": EXPORT_MAX_PIXELS,
+                    "scale": EXPORT_RESOLUTION,
+                    "region": region,
+                    "shardSize": params["shardSize"],
+                    "fileFormat": "GeoTIFF",
+                    "tiffCloudOptimized": True,
+            })
+    task.start()
+    logging.info("Started EE task (id: %s).", task.id)
+    return task.id
+
+
+def _GetExportUrls(filename, client_id):
+    """Returns the download urls of the files of a completed export task and the url
+        of their Google Drive folder (None if there is only one file).
+        The files are recorded as the export of the client (see _RegisterFiles()).
+    Args:
+        filename: the driveFileNamePrefix of the export
+        client_id: the id of the client that owns the export
+    """
+    files = DRIVE_HELPER.GetExportedFiles(filename)
+
+    # Checks if some files were found (sometimes this seems to happen to fast and no files are found although they are there)
+    if len(files) < 1:
+        raise Exception("Cloud not find file: " + filename)
+
+    # If the export area is large EE will create mutliple files, then this code will return a url to a google drive folder and a download url for each file
+    if len(files) == 1:
+        return _RegisterFiles(client_id, filename, files), None
+
+    folder_id = DRIVE_HELPER.CreatePublicFolder(filename)
+    for i, f in enumerate(files):
+        DRIVE_HELPER.RenameFile(f["id"],filename + "_part_%s.tif" % (i + 1))
+        DRIVE_HELPER.MoveFileToFolder(f["id"],folder_id)
+    folder = "https://drive.google.com/folderview?id=" + folder_id
+
+    # the folder is deleted with the files, its link is not tracked
+    STORAGE.Register(client_id, filename, [{"id":folder_id,"size":0,"url":folder}])
+    return _RegisterFiles(client_id, filename, files, public=False), folder
+
+
+def _RegisterFiles(client_id, filename, files, public=True):
+    """Records the exported files of a client (see storage.py) and returns their download urls,
+        which point to the /file handler that records the downloads.
+    Args:
+        client_id: the id of the client that owns the export
+        filename: the name of the export, the files of an export are deleted together
+        files: a list of Drive file objects with the keys "id" and "fileSize"
+        public: False if the files are already accessible by everyone with the link (like in a public folder)
+    """
+    records = []
+    for f in files:
+        if public:
+            url = DRIVE_HELPER.GetDownloadUrl(f["id"])
+        else:
+            url = "https://docs.google.com/uc?id=%s&export=download" % f["id"]
+        records.append({"id":f["id"],"size":int(f.get("fileSize") or 0),"url":url})
+    STORAGE.Register(client_id, filename, records)
+    return ["/file?id=" + record["id"] for record in records]
+
+
+def _MakeDriveRoom(size):
+    """Deletes older exports if an export of the estimated size (bytes) would fill the Drive
+        above DRIVE_HIGH_WATER (see storage.py). A failed check is only logged, the export is started anyway.
+    """
+    try:
+        STORAGE.MakeRoom(size)
+    except Exception as e:
+        logging.warning("Making room in the Drive failed: %s", e)
+
+
+def _BulkManifestUrl(bulk):
+    """Returns the url of the manifest of a bulk export."""
+    return "/bulkexport?id=%s&client_id=%s" % (bulk["id"], bulk["client_id"])
+
+
+def _StartBulkExport(bulk):
+    """Queues the parts of a new bulk export and starts its /bulkexportrunner.
+
+    Args:
+        bulk: the state of the bulk export created by BULK_EXPORTS.Create()
+
+    Returns:
+        A dict {"id":<bulk export id>,"parts":<number of parts>,"manifest":<manifest url>}.
+    """
+    # the parts wait in the global queue like single exports
+    for part in bulk["parts"]:
+        EXPORT_QUEUE.Enqueue({"id":part["id"],"client_id":bulk["client_id"],"bulk":bulk["id"]})
+
+    # only execute once even if task fails
+    taskqueue.add(url="/bulkexportrunner", params={"bulk_id":bulk["id"]}, retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0,task_age_limit=1))
+    _SendStatus(bulk["client_id"],bulk["kind"],bulk["filename"],"queued",id=bulk["id"],parts=bulkexport.Counts(bulk),slots=EXPORT_MAX_RUNNING)
+
+    _DispatchExports()
+
+    return {"id":bulk["id"],"parts":len(bulk["parts"]),"manifest":_BulkManifestUrl(bulk)}
+
+
+def _CreateBulkTask(part, graphs, geometry, encoding=None):
+    """Creates the EE export task of a part of a bulk export.
+
+    Args:
+        part: the part of the bulk export (see bulkexport.BulkExports.Create())
+        graphs: the deserialized EE objects of the bulk export
+        geometry: the polygons of an image part or the points of a table part
+        encoding: the scaled integer encoding of an image part created by _ExportEncoding() or None
+
+    Returns:
+        An ee.batch.Task that is not started.
+    """
+    if part["kind"] == "image":
+        # cut out the polygons of the features of the part, the files are Cloud Optimized GeoTIFFs
+        west, south, east, north = part["bounds"]
+        return ee.batch.Export.image(
+                image=_EncodeImage(graphs["image"].clip(ee.Geometry.MultiPolygon(geometry)), encoding),
+                description=part["name"],
+                config={
+                        "driveFileNamePrefix": part["name"],
+                        "maxPixels": EXPORT_MAX_PIXELS,
+                        "scale": EXPORT_RESOLUTION,
+                        "region": [[west,south],[east,south],[east,north],[west,north],[west,south]],
+                        "fileFormat": "GeoTIFF",
+                        "tiffCloudOptimized": True,
+                })
+
+    points = _PointFeatures(geometry)
+    if part["kind"] == "series":
+        table = _GetPointSeries(graphs["collection"], points)
+    else:
+        table = graphs["image"].reduceRegions(points, ee.Reducer.first(), EXPORT_RESOLUTION)
+    return ee.batch.Export.table(table, part["name"], {
+            "driveFileNamePrefix": part["name"],
+            "fileFormat": "CSV",
+            "selectors": ",".join(part["columns"]),
+    })
+
+
+def _PointFeatures(points):
+    """Returns an ee.FeatureCollection with a feature with the property "point_id" per [<id>,<longitude>,<latitude>]."""
+    return ee.FeatureCollection([ee.Feature(ee.Geometry.Point([lon, lat]), {"point_id": point_id}) for point_id, lon, lat in points])
+
+
+def _GetPointSeries(collection, points):
+    """Extracts the NDVI time series of points.
+
+    Args:
+        collection: an ee.ImageCollection created by _GetCollection()
+        points: an ee.FeatureCollection created by _PointFeatures()
+
+    Returns:
+        An ee.FeatureCollection with a feature per point and image with a NDVI value at the point,
+        the features have the properties of POINT_SERIES_COLUMNS.
+    """
+    # only the scenes that contain one of the points
+    collection = collection.filterBounds(points.geometry())
+
+    def extract(img):
+        ndvi = _Ndvi(img)
+        values = ndvi.reduceRegions(points, ee.Reducer.first().setOutputs(["ndvi"]), EXPORT_RESOLUTION)
+        return values.map(lambda feature: feature.set({"date": img.date().format("YYYY-MM-dd"), "sensor": img.get("SPACECRAFT_ID")}))
+
+    # the masked pixels have no ndvi value
+    return ee.FeatureCollection(collection.map(extract)).flatten().filter(ee.Filter.notNull(["ndvi"]))
+
+
+def _StopBulkExport(bulk_id, error=None):
+    """Removes the waiting parts of a bulk export from the export queue and cancels its running EE tasks.
+
+    Args:
+        bulk_id: the id of the bulk export
+        error: None if the bulk export is cancelled by the client, then the /bulkexportrunner
+               finishes the running parts. Else the error of the failed /bulkexportrunner,
+               then all unfinished parts fail and free their slots.
+    """
+    bulk = BULK_EXPORTS.Update(bulk_id, lambda bulk: bulk.update(cancelled=True))
+    if bulk is None:
+        return
+
+    changes = {}
+    for index, part in enumerate(bulk["parts"]):
+        if part["state"] == bulkexport.WAITING and EXPORT_QUEUE.Cancel(part["id"],bulk["client_id"]) is not None:
+            changes[index] = {"state":bulkexport.CANCELLED}
+        elif part["state"] == bulkexport.RUNNING:
+            try:
+                ee.data.cancelTask(part["task"])
+                logging.info("Cancelled task (id: %s).", part["task"])
+            except Exception as e:
+                logging.warning("Could not cancel task (id: %s): %s", part["task"], e)
+
+        if error is not None and part["state"] in (bulkexport.WAITING, bulkexport.RUNNING):
+            changes[index] = {"state":bulkexport.FAILED,"error":error}
+            EXPORT_QUEUE.Release(part["id"])
+
+    BULK_EXPORTS.UpdateParts(bulk_id, changes)
+
+    # the positions of the other waiting exports have changed
+    _DispatchExports()
 
 
 def _GetUniqueString():
@@ -1113,7 +3271,7 @@ def _GetUniqueString():
     return date_str + random_str
 
 
-def _SendMessage(client_id, id, style, line1, line2=None):
+def _SendMessage(client_id, id, style, line1, line2=None, data=None):
     """Sends messages to the client over the Channel API
 
     Args:
@@ -1122,8 +3280,11 @@ def _SendMessage(client_id, id, style, line1, line2=None):
         style: type of the alert for Bootstrap CSS styling
         line1: The first line of the alert text
         line2: optinal second line of the alert text
+        data: optional json encodable data for the client, always sent so that
+              a null value clears the data of a previous message
     """
-    params = {"id": id, "style": style, "line1": line1}
+    # the job status is cleared, else the client would render the status of a previous job message
+    params = {"id": id, "style": style, "line1": line1, "data": data, "job": None}
 
     if line2 is not None:
         params["line2"] = line2
@@ -1132,6 +3293,146 @@ def _SendMessage(client_id, id, style, line1, line2=None):
     send_firebase_message(client_id, json.dumps(params))
 
 
+def _SendStatus(client_id, kind, name, state, **status):
+    """Sends the status of a chart, download or export job to the client which renders
+        it as alert (see handleJobMessage() in client.js).
+
+    Args:
+        client_id: the clients channel api id
+        kind: the type of the job [chart,download,export,bulk,points]
+        name: the filename of the job, the alert id is <kind>-<name>
+        state: the state of the job [queued,running,cancelling,completed,cancelled,deleted,failed]
+        status: optional values of the state, only the values that are not None are sent:
+            id: the EE task id (running exports), the export queue id (queued exports) or the bulk export id (bulk and point exports) used to cancel the job
+            point: the [<longitude>,<latitude>] of a chart
+            position: the position of a queued export in the export queue
+            slots: the number of exports that are computed at the same time
+            parts: the number of parts of a bulk or point export per state [waiting,running,completed,cancelled,failed] and in "total"
+            progress: the progress of a running EE task or bulk export [0-1]
+            elapsed: the seconds since the export was started, the client counts on from there
+            urls: the result urls (download links of the files, url of the full screen chart or of the manifest of a bulk export)
+            folder: the url of the Google Drive folder of an export with multiple files
+            chart: a dict {"table":<DataTable json>,"options":<chart options>} with the small chart
+            encoding: the scaled integer encoding of a download or export created by _ExportEncoding() (with the "url" of the sidecar file of an export)
+            adaptations: the descriptions of the adaptations a chart or export was retried with after EE memory or time limit errors
+            error: the error message of a failed job
+    """
+    job = dict((key, value) for key, value in status.items() if value is not None)
+    job.update({"type": kind, "name": name, "state": state})
+    params = {"id": kind + "-" + name, "job": job}
+
+    logging.info("Sent to client: " + json.dumps(params))
+    send_firebase_message(client_id, json.dumps(params))
+
+
+def _Dispatcher(router, request, response):
+    """Dispatches a request, logs the sizes of the EE graphs it sent and writes a capture record
+    if the client is sampled (see capture.py).
+
+    The options read by the handlers are taken from the request registry.
+    """
+    GRAPH_SIZES.sizes = {}
+    CAPTURE.Start()
+    try:
+        return router.default_dispatcher(request, response)
+    finally:
+        graphs = GRAPH_SIZES.sizes
+        GRAPH_SIZES.sizes = None
+        if graphs:
+            logging.info("EE graphs of %s: %s calls, %s bytes, %s nodes (%s)", request.path, sum(g[0] for g in graphs.values()),
+                         sum(g[1] for g in graphs.values()), sum(g[2] for g in graphs.values()), json.dumps(graphs, sort_keys=True))
+
+        options = request.registry.get("options")
+        client_id = request.registry.get("client_id") or (options or {}).get("client_id") or request.get("client_id") or None
+        if CAPTURE.Sampled(client_id):
+            CAPTURE.Finish({
+                    "route": request.path,
+                    "method": request.method,
+                    "status": response.status_int,
+                    "error": request.registry.get("error", False),
+                    "client_id": client_id,
+                    "params": dict(request.params),
+                    "options": _CanonicalOptions(options) if options is not None else None,
+                    "key": _OptionsKey(options) if options is not None else None,
+                    "region_vertices": request.registry.get("region_vertices"),
+                    "graphs": graphs,
+            })
+        else:
+            CAPTURE.Cancel()
+
+
+def _GraphSize(*args, **kwargs):
+    """Returns the (<bytes>, <nodes>) of the serialized EE graphs in the arguments of an ee.data call.
+
+    A graph is an EE object or (if the EE API serializes it before the call) a json string, also
+    as value of a dict of parameters. The nodes are the function invocations of the graph, the
+    legacy serializer encodes equal subexpressions once in the scope of the graph.
+    """
+    def invocations(value):
+        if isinstance(value, dict):
+            return (value.get("type") == "Invocation" or "functionInvocationValue" in value) + sum(invocations(v) for v in value.values())
+        if isinstance(value, list):
+            return sum(invocations(v) for v in value)
+        return 0
+
+    values = list(args) + list(kwargs.values())
+    values += [v for value in values if isinstance(value, dict) for v in value.values()]
+    size = nodes = 0
+    for value in values:
+        if isinstance(value, (str, unicode)):
+            graph = value
+        elif value is None or isinstance(value, (dict, list, tuple, int, long, float, bool)):
+            continue
+        else:
+            graph = ee.serializer.toJSON(value)
+        try:
+            decoded = json.loads(graph)
+        except ValueError:
+            continue
+        if isinstance(decoded, dict):
+            size += len(graph)
+            nodes += invocations(decoded)
+    return size, nodes
+
+
+def _MeasureGraphs():
+    """Sums the sizes of the EE graphs sent by each request as {"ee.<call>": [<calls>, <bytes>, <nodes>]}.
+
+    The graphs are serialized once more for the measurement, which is small compared to the EE call.
+    """
+    def measured(function, name):
+        def call(*args, **kwargs):
+            sizes = getattr(GRAPH_SIZES, "sizes", None)
+            if sizes is not None:
+                size, nodes = _GraphSize(*args, **kwargs)
+                graph = sizes.setdefault("ee." + name, [0, 0, 0])
+                graph[0] += 1
+                graph[1] += size
+                graph[2] += nodes
+            return function(*args, **kwargs)
+        call.__name__ = function.__name__
+        call.__doc__ = function.__doc__
+        return call
+
+    for name in ("getValue", "computeValue", "getMapId", "getDownloadId", "startProcessing"):
+        function = getattr(ee.data, name, None)
+        if function is not None:
+            setattr(ee.data, name, measured(function, name))
+
+
+def _InstrumentCapture():
+    """Records the outbound calls of the captured requests."""
+    for name in ("getValue", "computeValue", "getMapId", "getDownloadId", "startProcessing", "newTaskId", "getTaskStatus", "cancelTask"):
+        CAPTURE.Instrument(ee.data, [name], "ee." + name)
+    CAPTURE.Instrument(DRIVE_HELPER, ["GetExportedFiles", "DeleteFile", "CreatePublicFolder", "RenameFile", "MoveFileToFolder", "GetDownloadUrl"], "drive")
+    CAPTURE.Instrument(STORAGE, ["Register", "Owned", "Downloaded", "Forget"], "datastore")
+    CAPTURE.Instrument(FIREBASE_HTTP, ["request"], "firebase")
+    CAPTURE.Instrument(memcache, ["get", "set", "add", "delete"], "memcache")
+    CAPTURE.Instrument(EXPORT_QUEUE, ["Enqueue", "Dispatch", "Heartbeat", "Release", "Cancel", "Contains", "Running", "Waiting"], "datastore")
+    CAPTURE.Instrument(taskqueue, ["add"], "taskqueue")
+    CAPTURE.Instrument(urlfetch, ["fetch"], "urlfetch")
+
+
 ###############################################################################
 #                         Firebase helper function.                           #
 ###############################################################################
@@ -1209,12 +3510,31 @@ firebase_init()  # this initializes firebase_admin which is only used for token
 # http://webapp-improved.appspot.com/tutorials/quickstart.html
 app = webapp2.WSGIApplication([
         ("/download", DownloadHandler),
+        ("/stats", RegionStatsHandler),
         ("/chart", ChartHandler),
         ("/chartrunner", ChartRunnerHandler),
+        ("/chartprefetch", ChartPrefetchHandler),
+        ("/chartprefetchrunner", ChartPrefetchRunnerHandler),
         ("/export", ExportHandler),
         ("/exportrunner", ExportRunnerHandler),
+        ("/bulkexport", BulkExportHandler),
+        ("/bulkexportrunner", BulkExportRunnerHandler),
+        ("/pointexport", PointExportHandler),
+        ("/pointexportrunner", PointExportRunnerHandler),
+        ("/statsrunner", StatsRunnerHandler),
         ("/cron/clean", CleanHandler),
+        ("/cron/dispatch", DispatchHandler),
         ("/clean", CleanHandler),
+        ("/file", FileHandler),
         ("/mapid", MapIdHandler),
+        ("/mapidrunner", MapIdRunnerHandler),
+        ("/pathrow", PathRowHandler),
+        (r"/tiles/([^/]+)/(\d+)/(\d+)/(\d+)", TileHandler),
         ("/", MapHandler),
 ])
+
+# log the sizes of the EE graphs of each request and capture a sample of the requests for replays (see tools/replay.py)
+_MeasureGraphs()
+app.router.set_dispatcher(_Dispatcher)
+if CAPTURE.Enabled():
+    _InstrumentCapture()
@@ -10,9 +10,10 @@ ntst = {};  // Our namespace (NDVI Time Series Tool)
  * Starts the application. The main entry point for the app.
  * @param {string} clientId The ID of this client for Firebase communication.
  * @param {string} firebaseToken The Token of this client for Firebase communication.
+ * @param {boolean} chartPrefetch Whether the chart series is prefetched when the marker is placed.
  */
-ntst.boot = function(clientId, firebaseToken) {
-  var app = new ntst.App(clientId, firebaseToken);
+ntst.boot = function(clientId, firebaseToken, chartPrefetch) {
+  var app = new ntst.App(clientId, firebaseToken, chartPrefetch);
 };
 
 
@@ -25,9 +26,10 @@ ntst.boot = function(clientId, firebaseToken) {
  * This constructor renders the UI and sets up event handling.
  * @param {string} clientId The ID of this client for Firebase communication.
  * @param {string} firebaseToken The Token of this client for Firebase communication.
+ * @param {boolean} chartPrefetch Whether the chart series is prefetched when the marker is placed.
  * @constructor
  */
-ntst.App = function(clientId, firebaseToken) {
+ntst.App = function(clientId, firebaseToken, chartPrefetch) {
   // The Google Map.
   this.map = ntst.App.createMap($(".map").get(0));
 
@@ -48,6 +50,24 @@ ntst.App = function(clientId, firebaseToken) {
   // to switch between them.
   this.layerBands = {};
 
+  // The ids of the current map ID requests, keyed by layer name.
+  // Used to ignore full resolution map IDs of outdated previews.
+  this.layerRequestIds = {};
+
+  // The full map IDs of options like {etag, expires, bands}, keyed by the options of the map.
+  // The server answers a request with the ETag of cached map IDs with 304.
+  this.mapIdCache = {};
+
+  // The keys of the current map ID requests in the map ID cache, keyed by layer name.
+  this.layerCacheKeys = {};
+
+  // The timers that count the elapsed seconds of running exports, keyed by alert name.
+  this.jobTimers = {};
+
+  // Whether the chart series is prefetched when the marker is placed and the timer that debounces it.
+  this.chartPrefetch = chartPrefetch;
+  this.chartPrefetchTimer = null;
+
   // The ID & firebaseToken of this client for firebase communication with App Engine.
   this.clientId = clientId;
   this.firebaseToken = firebaseToken;
@@ -73,6 +93,66 @@ ntst.App.DEFAULT_ZOOM = 5;
 /** @type {Object} The default center of the map. */
 ntst.App.DEFAULT_CENTER = {lng: 10.32, lat: 53.95};
 
+/** @type {boolean} Whether a fast map preview is shown before the full map. */
+ntst.App.PREVIEW = true;
+
+/** @type {number} The milliseconds the marker has to stay in place before its chart series is prefetched. */
+ntst.App.CHART_PREFETCH_DELAY = 1000;
+
+/**
+ * @type {Object} The first line of the job alerts by job type and state.
+ * %s is replaced by the name of the job and %p by the point of a chart.
+ */
+ntst.App.JOB_TITLES = {
+  chart: {
+    running: "Chart creation at %p in progress.",
+    completed: "Chart for '%s':",
+    cancelled: "Chart creation at %p cancelled.",
+    failed: "Chart creation failed."
+  },
+  download: {
+    running: "Download creation of '%s' in progress.",
+    completed: "Download link for '%s':",
+    failed: "Download creation of '%s' failed."
+  },
+  export: {
+    queued: "Export of '%s' is queued.",
+    running: "Export of '%s' in progress.",
+    cancelling: "Cancellation of '%s' in progress.",
+    completed: "Export of '%s' complete.",
+    cancelled: "Export of '%s' cancelled.",
+    deleted: "File deletion for '%s' complete.",
+    failed: "Export of '%s' failed."
+  },
+  bulk: {
+    queued: "Bulk export of '%s' is queued.",
+    running: "Bulk export of '%s' in progress.",
+    cancelling: "Cancellation of the bulk export '%s' in progress.",
+    completed: "Bulk export of '%s' complete.",
+    cancelled: "Bulk export of '%s' cancelled.",
+    failed: "Bulk export of '%s' failed."
+  },
+  points: {
+    queued: "Point export of '%s' is queued.",
+    running: "Point export of '%s' in progress.",
+    cancelling: "Cancellation of the point export '%s' in progress.",
+    completed: "Point export of '%s' complete.",
+    cancelled: "Point export of '%s' cancelled.",
+    failed: "Point export of '%s' failed."
+  }
+};
+
+/** @type {Object} The Bootstrap alert class of the job alerts by job state. */
+ntst.App.JOB_STYLES = {
+  queued: "info",
+  running: "info",
+  cancelling: "warning",
+  completed: "success",
+  cancelled: "warning",
+  deleted: "success",
+  failed: "danger"
+};
+
 
 ///////////////////////////////////////////////////////////////////////////////
 //                               Option Helpers                              //
@@ -123,8 +203,8 @@ ntst.App.prototype.initOptions = function() {
     $("#about").css("display","inline");
   });
 
-  // init the regression & data picker
-  $(".regression-picker, .source-picker").selectpicker({
+  // init the regression, data & cloud mask picker
+  $(".regression-picker, .source-picker, .cloudmask-picker, .composite-picker, .compositemethod-picker, .encoding-picker").selectpicker({
     width: "auto"
   });
 
@@ -180,6 +260,24 @@ ntst.App.prototype.initOptions = function() {
     }
   });
 
+  // the cloud score is only used by the cloud score mask
+  $(".cloudmask-picker").change(function(){
+    var qa = $(".cloudmask-picker option:selected").val() == "qa";
+    $(".cloudscore-picker").attr("disabled", qa);
+  });
+
+  // the compositing method is only used with a composite period
+  $(".composite-picker").change(function(){
+    var none = $(".composite-picker option:selected").val() == "none";
+    $(".compositemethod-picker").prop("disabled", none).selectpicker("refresh");
+  });
+
+  // the precision is only used by the scaled integer encodings, at most EXPORT_MAX_PRECISION digits fit into the type
+  $(".encoding-picker").change(function(){
+    var encoding = $(".encoding-picker option:selected").val();
+    $(".precision-picker").attr("disabled", encoding == "float").attr("max", encoding == "int16" ? 4 : 9);
+  });
+
   //update marker on edit
   $(".lat-picker, .lon-picker").keyup((function(){
     if($(".lat-picker").val() != "" && $(".lon-picker").val()){
@@ -188,7 +286,7 @@ ntst.App.prototype.initOptions = function() {
   }).bind(this));
 
   //update default filename if options change
-  $(".regression-picker, .source-picker, .start-picker, .end-picker, .cloudscore-picker").change((function(){
+  $(".regression-picker, .source-picker, .start-picker, .end-picker, .cloudscore-picker, .cloudmask-picker, .composite-picker, .compositemethod-picker").change((function(){
     var filename = this.getOptions().filename;
     filename = filename.replace(/[0-9]{14}/g, "<timestamp>"); //replace timestamp with timestamp placeholder
     $(".filename :text").attr("placeholder",filename);
@@ -222,6 +320,12 @@ ntst.App.prototype.initOptions = function() {
     //this.getDownloadUrl(); // alternative export method
   }).bind(this));
 
+  // set statistics button action
+  $(".stats").click((function(){
+    this.removeAlert("collection-info");
+    this.getRegionStats();
+  }).bind(this));
+
   // initializes the instructions toggle
   $("#toggleInstructions").click(function(){
     if($("#toggleInstructions").html() == "more"){
@@ -251,6 +355,16 @@ ntst.App.prototype.getOptions = function() {
   options.start = parseInt($(".start-picker").val());
   options.end = parseInt($(".end-picker").val());
   options.cloudscore = parseInt($(".cloudscore-picker").val());
+  options.cloudmask = $(".cloudmask-picker option:selected").val();
+  options.composite = $(".composite-picker option:selected").val();
+  options.compositemethod = $(".compositemethod-picker option:selected").val();
+  options.encoding = $(".encoding-picker option:selected").val();
+  if (options.encoding != "float" && $(".precision-picker").val() !== "") {
+    options.precision = parseInt($(".precision-picker").val());
+  }
+  if ($(".count-picker").is(":checked")) {
+    options.count = "true";
+  }
   options.point = JSON.stringify(this.getMarkerCoordinates());
   options.region = JSON.stringify(this.getPolygonCoordinates());
   options.client_id = this.clientId;
@@ -260,7 +374,8 @@ ntst.App.prototype.getOptions = function() {
     options.filename = userProvidedFilename;
   }else{
     options.filename = "NTST_" + options.regression + "_" + options.source + "_" +
-                        options.start + "_" + options.end + "_" + options.cloudscore + "_" + (new Date()).toISOString().replace(/[^0-9]/g, "").substring(0,14);
+                        options.start + "_" + options.end + "_" + (options.cloudmask == "qa" ? "qa" : options.cloudscore) + "_" +
+                        (options.composite != "none" ? options.composite + "_" + options.compositemethod + "_" : "") + (new Date()).toISOString().replace(/[^0-9]/g, "").substring(0,14);
   }
   return options;
 };
@@ -403,6 +518,8 @@ ntst.App.prototype.setMarker = function(lat,lon) {
   $(".point").toggleClass("drawing", false);
 
   this.setMarkerModeEnabled(false);("");
+  this.updatePathRows();
+  this.prefetchChart();
 };
 
 /**
@@ -424,6 +541,7 @@ ntst.App.prototype.clearMarker = function() {
   }
   $(".lat-picker").val("");
   $(".lon-picker").val("");
+  this.updatePathRows();
 };
 
 
@@ -505,12 +623,13 @@ ntst.App.prototype.clearPolygon = function() {
 
   // updates the gui
   $(".region").removeClass("selected");
-  $(".export").attr("disabled", true);
-  $("#export-tooltip").tooltip("enable");
+  $(".export, .stats").attr("disabled", true);
+  $("#export-tooltip, #stats-tooltip").tooltip("enable");
   if($(".chart").attr("disabled")){
     $(".compute").attr("disabled",true);
     $("#compute-tooltip").tooltip("enable");
   }
+  this.updatePathRows();
 };
 
 /**
@@ -521,9 +640,57 @@ ntst.App.prototype.clearPolygon = function() {
 ntst.App.prototype.handleNewPolygon = function(opt_overlay) {
   this.currentPolygon = opt_overlay;
   $(".region").addClass("selected");
-  $(".export, .compute").attr("disabled", false);
-  $("#export-tooltip, #compute-tooltip").tooltip("disable");
+  $(".export, .stats, .compute").attr("disabled", false);
+  $("#export-tooltip, #stats-tooltip, #compute-tooltip").tooltip("disable");
   this.setDrawingModeEnabled(false);
+  this.updatePathRows();
+};
+
+
+/**
+* Starts the extraction of the chart series at the current marker on the server, once the marker
+* stayed in place for CHART_PREFETCH_DELAY, so that the chart is ready when it is requested.
+*/
+ntst.App.prototype.prefetchChart = function() {
+  if (!this.chartPrefetch) {
+    return;
+  }
+  clearTimeout(this.chartPrefetchTimer);
+  this.chartPrefetchTimer = setTimeout((function() {
+    if (this.currentMarker) {
+      // the series does not depend on the region
+      var options = this.getOptions();
+      options.region = "null";
+      $.post("/chartprefetch", options);
+    }
+  }).bind(this), ntst.App.CHART_PREFETCH_DELAY);
+};
+
+
+///////////////////////////////////////////////////////////////////////////////
+//                           Scene overlap.                                  //
+///////////////////////////////////////////////////////////////////////////////
+
+/**
+* Shows the Landsat scenes (WRS-2 path/row) that overlap the current marker and polygon.
+* The server answers from a local index, so this does not wait for Earth Engine.
+*/
+ntst.App.prototype.updatePathRows = function() {
+  var point = this.getMarkerCoordinates();
+  var region = this.getPolygonCoordinates();
+
+  if (this.pathRowRequest) {
+    this.pathRowRequest.abort();
+  }
+  if (!point && !region) {
+    this.removeAlert("pathrow");
+    return;
+  }
+
+  var params = {point: JSON.stringify(point), region: JSON.stringify(region)};
+  this.pathRowRequest = ntst.App.handleRequest($.post("/pathrow", params), (function(data) {
+    this.setAlert("pathrow", "info", "Landsat scenes (WRS-2 path/row):", data.text);
+  }).bind(this), function(error) {});
 };
 
 
@@ -546,12 +713,18 @@ ntst.App.prototype.initAlerts = function() {
     channel = firebase.database().ref("channels/" + this.clientId);
 
     // add a listener to the path that fires any time the value of the data changes
-    channel.on("value", function(data) {
+    channel.on("value", (function(data) {
       var data = data.val();
       if (data) {
-        ntst.App.prototype.setAlert(data.id,data.style,data.line1,data.line2);
+        if (data.job) {
+          this.handleJobMessage(data);
+        } else if (data.id == "layer" && data.data) {
+          this.handleLayerMessage(data);
+        } else {
+          this.setAlert(data.id,data.style,data.line1,data.line2);
+        }
       }
-    });
+    }).bind(this));
 };
 
 /**
@@ -582,6 +755,199 @@ ntst.App.prototype.setAlert = function(name, cls, line1, opt_line2) {
        .addClass("visible");
 };
 
+/**
+ * Renders the status of a chart, download or export job as alert.
+ * While an export runs the server only sends changes of its state or progress,
+ * the elapsed seconds are counted on here.
+ * @param {Object} message The Firebase message with the alert name as id and the job status
+ *     {type, name, state, id, point, position, slots, progress, elapsed, urls, folder, chart, encoding, adaptations, error}.
+ */
+ntst.App.prototype.handleJobMessage = function(message) {
+  var name = message.id;
+  var job = message.job;
+  var urls = job.urls || [];
+  var point = job.point ? "[" + job.point[1] + "/" + job.point[0] + "]" : "";
+  var line1 = ntst.App.JOB_TITLES[job.type][job.state].replace("%s", job.name).replace("%p", point);
+  var line2 = $("<span/>");
+  var chart;
+
+  this.stopJobTimer(name);
+
+  if (job.type == "bulk" || (job.type == "points" && job.id)) {
+    line2.append(this.describeBulkJob(name, job));
+    if (job.state == "running" && job.elapsed !== undefined) {
+      this.startJobTimer(name, job.elapsed);
+    }
+  } else if (job.state == "queued") {
+    line2.append("Position " + job.position + " in the queue, " + job.slots + " exports are computed at the same time.")
+         .append("<br><br>", this.createCleanLink(name, "Cancel this export", {job: job.id}));
+  } else if ((job.state == "running" || job.state == "cancelling") && job.elapsed !== undefined) {
+    line2.append("Working since ", $("<span/>", {class: "elapsed"}).text(job.elapsed), " seconds");
+    if (job.progress !== undefined) {
+      line2.append(" (" + Math.round(job.progress * 100) + "% done)");
+    }
+    line2.append("...");
+    if (job.state == "running") {
+      line2.append("<br><br>", this.createCleanLink(name, "Cancel this export", {task: job.id}));
+    }
+    this.startJobTimer(name, job.elapsed);
+  } else if (job.state == "failed" || (job.state == "cancelled" && job.error)) {
+    // a chart is cancelled when the next chart of the same pixel is requested
+    line2.text(job.error);
+  } else if (job.state == "completed" && job.type == "chart") {
+    if (job.chart) {
+      chart = $("<div/>", {style: "margin-bottom: 0.5em;"});
+      line2.append(chart);
+    } else {
+      line2.append("No small chart available.<br>");
+    }
+    line2.append($("<a/>", {href: urls[0], target: "_blank"}).text("Full screen url (only temporary valid)"));
+  } else if (job.state == "completed" && job.type == "points") {
+    // the time series and the coefficients of a few points are extracted to compressed CSV files
+    for (var j = 0; j < urls.length; j++) {
+      line2.append(j ? "<br>" : "", $("<a/>", {href: urls[j], target: "_blank"}).text(j ? "Download the coefficients (valid for up to 5 hours)" : "Download the time series (valid for up to 5 hours)"));
+    }
+  } else if (job.state == "completed" && job.type == "download") {
+    // a large download is split into tiles with a link each
+    for (var k = 0; k < urls.length; k++) {
+      line2.append(k ? "<br>" : "", $("<a/>", {href: urls[k], target: "_blank"}).text(urls.length > 1 ? "Download tile " + (k + 1) : urls[k]));
+    }
+    if (job.encoding) {
+      line2.append("<br><br>", this.describeEncoding(job.encoding));
+    }
+  } else if (job.state == "completed" && job.type == "export") {
+    // an export of a large area has multiple files which are put into a Google Drive folder
+    if (job.folder) {
+      line2.append($("<a/>", {href: job.folder, target: "_blank"}).text("Open in Google Drive (valid for up to 5 hours)"));
+      for (var i = 0; i < urls.length; i++) {
+        line2.append("<br>", $("<a/>", {href: urls[i], target: "_blank"}).text("Download part " + (i + 1)));
+      }
+    } else {
+      line2.append($("<a/>", {href: urls[0], target: "_blank"}).text("Download via Google Drive (valid for up to 5 hours)"));
+    }
+    if (job.encoding) {
+      line2.append("<br><br>", this.describeEncoding(job.encoding));
+    }
+    line2.append("<br><br>", this.createCleanLink(name, urls.length > 1 ? "Delete these files" : "Delete this file", {filename: job.name}));
+  }
+
+  // a chart or export that exceeded a memory or time limit of EE was retried with smaller tiles or split
+  if (job.adaptations) {
+    line2.append(line2.contents().length ? "<br><br>" : "", $("<span/>").text("Retried after EE memory or time limits with " +
+                                                                             job.adaptations.join(", ") + "."));
+  }
+
+  this.setAlert(name, ntst.App.JOB_STYLES[job.state], line1, line2);
+
+  // the chart is drawn once its element is shown
+  if (chart) {
+    new google.visualization.ScatterChart(chart.get(0)).draw(new google.visualization.DataTable(job.chart.table), job.chart.options);
+  }
+};
+
+/**
+ * Describes the scaled integer encoding of a download or export for its alert.
+ * @param {Object} encoding The encoding sent by the server (type, nodata, bands and the url of the sidecar file of an export).
+ * @return {Object} The jQuery DOM wrapper of the description.
+ */
+ntst.App.prototype.describeEncoding = function(encoding) {
+  var description = $("<span/>").append("The bands are " + encoding.type + " values, value = stored value * scale (" +
+                                         encoding.nodata + " marks masked pixels and values out of the range of the type):");
+  for (var i = 0; i < encoding.bands.length; i++) {
+    description.append("<br>", $("<span/>").text(encoding.bands[i].name + ": " + encoding.bands[i].scale));
+  }
+  if (encoding.url) {
+    description.append("<br>", $("<a/>", {href: encoding.url, target: "_blank"}).text("Download the scales"));
+  }
+  return description;
+};
+
+/**
+ * Describes the parts of a bulk or point export for its alert.
+ * @param {string} name The name of the alert of the export.
+ * @param {Object} job The status of the export sent by the server.
+ * @return {Object} The jQuery DOM wrapper of the description.
+ */
+ntst.App.prototype.describeBulkJob = function(name, job) {
+  var description = $("<span/>");
+  var parts = job.parts;
+
+  if (job.state == "failed" && !parts) {
+    return description.text(job.error);
+  }
+  if (job.state == "queued") {
+    description.append("Waiting for a free slot, " + job.slots + " exports are computed at the same time.<br>");
+  } else if (job.state == "running" && job.elapsed !== undefined) {
+    description.append("Working since ", $("<span/>", {class: "elapsed"}).text(job.elapsed), " seconds");
+    if (job.progress !== undefined) {
+      description.append(" (" + Math.round(job.progress * 100) + "% done)");
+    }
+    description.append("...<br>");
+  }
+  description.append(parts.completed + " of " + parts.total + " parts complete");
+  if (parts.running) {
+    description.append(", " + parts.running + " running");
+  }
+  if (parts.failed) {
+    description.append(", " + parts.failed + " failed");
+  }
+  if (parts.cancelled) {
+    description.append(", " + parts.cancelled + " cancelled");
+  }
+  description.append(".");
+
+  if (job.urls) {
+    description.append("<br><br>", $("<a/>", {href: job.urls[0], target: "_blank"}).text("Manifest with the download links (valid for 24 hours)"));
+  }
+  if (job.state == "queued" || job.state == "running") {
+    description.append("<br><br>", this.createCleanLink(name, "Cancel this export", {bulk: job.id}));
+  }
+  return description;
+};
+
+/**
+ * Creates a link that cancels a job or deletes its files with a /clean request.
+ * @param {string} name The name of the alert of the job.
+ * @param {string} text The text of the link.
+ * @param {Object} params The parameters of the request, like {task: <EE task id>}.
+ * @return {Object} The jQuery DOM wrapper of the link.
+ */
+ntst.App.prototype.createCleanLink = function(name, text, params) {
+  params.client_id = this.clientId;
+  return $("<a/>", {href: "javascript:;"}).text(text).click((function() {
+    this.findAlert(name).removeClass("alert-info alert-success").addClass("alert-warning");
+    $.get("/clean", params);
+  }).bind(this));
+};
+
+/**
+ * Counts the elapsed seconds of a running export in its alert.
+ * @param {string} name The name of the alert of the export.
+ * @param {number} elapsed The elapsed seconds sent by the server.
+ */
+ntst.App.prototype.startJobTimer = function(name, elapsed) {
+  var started = (new Date()).getTime() - elapsed * 1000;
+  this.jobTimers[name] = setInterval((function() {
+    var counter = $(".alert[data-alert-name='" + name + "'] .elapsed");
+    if (!counter.length) {
+      this.stopJobTimer(name);  // the alert was replaced or removed
+    } else {
+      counter.text(Math.round(((new Date()).getTime() - started) / 1000));
+    }
+  }).bind(this), 1000);
+};
+
+/**
+ * Stops counting the elapsed seconds of an export.
+ * @param {string} name The name of the alert of the export.
+ */
+ntst.App.prototype.stopJobTimer = function(name) {
+  if (this.jobTimers[name]) {
+    clearInterval(this.jobTimers[name]);
+    delete this.jobTimers[name];
+  }
+};
+
 /**
  * Removes the alert with the given name.
  * @param {string} name The name of the alert to remove.
@@ -638,6 +1004,8 @@ ntst.App.prototype.refreshImage = function() {
 /**
  * Sets the layer with the given name to the map. The
  * layer is created if it doesn't already exist.
+ * If previews are enabled the server returns the map IDs of a fast preview
+ * and sends the full resolution map IDs over Firebase when they are ready.
  * @param {string} name The name of the layer to set.
  * @param {string} options options for the map send to the URL /mapid. Should return mapid and token
  * @param {string} optionsString String of all option values connected
@@ -651,81 +1019,130 @@ ntst.App.prototype.setLayer = function(name, options, optionsString) {
     this.setAlert(name, "danger", "Map failed to load.", error);
   }).bind(this);
 
-  var onDone = (function(data) {
+  // the server answers with 304 if the cached full map IDs of the options are still valid
+  var cacheKey = JSON.stringify([options.regression, options.source, options.start, options.end, options.cloudscore,
+                                 options.cloudmask, options.composite, options.compositemethod, options.point, options.region]);
+  var cached = this.mapIdCache[cacheKey];
+  if (cached && cached.expires < (new Date()).getTime()) {
+    delete this.mapIdCache[cacheKey];
+    cached = undefined;
+  }
 
-    //remeber first band, to make it visible later
-    var firstBand = "";
-    this.layerBands = {};
-    for (var i = 0; i < data["bands"].length; i++) {
-      var band = data["bands"][i];
-      if(i==0){
-        firstBand = band.name; //remeber first band, to make it visible later
-      }
+  var onDone = (function(data, jqXHR) {
+    if (jqXHR.status == 304) {
+      data = {bands: cached.bands, preview: false};
+    } else {
+      this.cacheMapIds(cacheKey, jqXHR.getResponseHeader("ETag"), jqXHR.getResponseHeader("Cache-Control"), data["bands"]);
+    }
+    this.showBands(name, data["bands"]);
+    if (data["preview"]) {
+      this.setAlert("layer", "info", "Showing a preview.", "The map is calculated from a subsample of the images. The full resolution map follows when it is ready.");
+    } else {
+      this.removeAlert("layer");
+    }
+  }).bind(this);
 
-      this.layerBands[band.name] = new ee.MapLayerOverlay(ntst.App.EE_URL + "/map", band.mapid, band.token, {name: name});
+  // the id of this request, the full resolution map IDs are only used if it is still the current one
+  this.layerRequestIds[name] = name + ":" + (new Date()).getTime();
+  options.layer_request = this.layerRequestIds[name];
+  options.preview = ntst.App.PREVIEW;
+  options.zoom = this.map.getZoom();
 
-      //add overlay invisible to map
-      this.layerBands[band.name].setOpacity(0);
-      this.map.overlayMapTypes.push(this.layerBands[band.name]);
+  this.layerCacheKeys[name] = cacheKey;
 
-      //add the band name to the MapLayerOverlay to access it in the callback
-      this.layerBands[band.name].band_name = band.name;
-      // Hide and show the 'layer loading' alert as needed.
-      this.layerBands[band.name].addTileCallback((function(event) {
-        showLoadingFn(event.target.band_name + ": " + event.count + " tiles remaining.");
-        if (event.count === 0) {
-          this.removeAlert(name);
-        }
-      }).bind(this));
+  showLoadingFn();
+  this.layerPaths[name] = optionsString;
+  this.layerRequests[name] = ntst.App.handleRequest($.ajax({type: "POST", url: "/mapid", data: options, headers: cached ? {"If-None-Match": cached.etag} : {}}), onDone, onError);
+};
 
-      // create the band switcher
-      var div = document.createElement("div");
-      $(div).attr("class","checkbox checkbox");
-
-      var input = document.createElement("input");
-      $(input).attr("type","radio");
-      $(input).attr("id",band.name);
-      $(input).attr("name","bands");
-
-      // if band is checked make it visible and hide all other
-      $(input).change(band.name,(function(event){
-        if(event.target.checked){
-          for(var key in this.layerBands){
-            if(key == event.data){
-              this.layerBands[key].setOpacity(1);
-              $("#blank").prop("checked",false);
-            }else{
-              this.layerBands[key].setOpacity(0);
-            }
-          }
-        }
-      }).bind(this));
+/**
+ * Caches full map IDs that the server sent with an ETag.
+ * @param {string} key The key of the options of the map.
+ * @param {?string} etag The ETag of the map IDs.
+ * @param {?string|number} maxAge The Cache-Control header or the seconds the map IDs may be reused.
+ * @param {Array<Object>} bands The bands of the map IDs.
+ */
+ntst.App.prototype.cacheMapIds = function(key, etag, maxAge, bands) {
+  if (typeof maxAge == "string") {
+    var match = /max-age=(\d+)/.exec(maxAge);
+    maxAge = match ? parseInt(match[1]) : null;
+  }
+  if (etag && maxAge) {
+    this.mapIdCache[key] = {etag: etag, expires: (new Date()).getTime() + maxAge * 1000, bands: bands};
+  }
+};
 
-      var label = document.createElement("label");
-      $(label).attr("for",band.name);
-      $(label).html(band.name);
+/**
+ * Replaces the preview of a layer with the full resolution map IDs sent over Firebase.
+ * @param {Object} message The Firebase message with the data {layer_request, bands, etag, max_age}.
+ */
+ntst.App.prototype.handleLayerMessage = function(message) {
+  var name = message.data.layer_request.split(":")[0];
+  if (this.layerRequestIds[name] != message.data.layer_request) {
+    return;  // the options have changed since the preview was requested
+  }
+  this.showBands(name, message.data.bands);
+  this.cacheMapIds(this.layerCacheKeys[name], message.data.etag, message.data.max_age, message.data.bands);
+  this.setAlert(message.id, message.style, message.line1, message.line2);
+};
 
-      $("#bandSwitcher").append($(div).append(input).append(label));
-    };
+/**
+ * Adds a map overlay for each band to the map and creates the band switcher.
+ * Existing overlays of the layer are replaced and the selected band stays visible.
+ * @param {string} name The name of the layer.
+ * @param {Array<Object>} bands The bands like {name:<band name>,mapid:<mapid>,token:<token>}
+ *     and the url of the tile proxy if it is enabled.
+ */
+ntst.App.prototype.showBands = function(name, bands) {
+  // remember the selected band and remove the current overlays
+  var selectedBand = $("#bandSwitcher input[name='bands']:checked").attr("id");
+  var hideAll = $("#blank").prop("checked");
+  this.removeOverlays(name);
+  $("#bandSwitcher").html("");
+  var showLoadingFn = this.setAlert.bind(this, name, "warning", "Map is loading.");
+
+  //remeber first band, to make it visible later
+  var firstBand = "";
+  this.layerBands = {};
+  for (var i = 0; i < bands.length; i++) {
+    var band = bands[i];
+    if(i==0){
+      firstBand = band.name; //remeber first band, to make it visible later
+    }
 
+    // the tiles are loaded from EE or from the tile proxy of the app if the band has an url
+    this.layerBands[band.name] = new ee.MapLayerOverlay(band.url || ntst.App.EE_URL + "/map", band.mapid, band.token, {name: name});
 
-    //add blank option
+    //add overlay invisible to map
+    this.layerBands[band.name].setOpacity(0);
+    this.map.overlayMapTypes.push(this.layerBands[band.name]);
+
+    //add the band name to the MapLayerOverlay to access it in the callback
+    this.layerBands[band.name].band_name = band.name;
+    // Hide and show the 'layer loading' alert as needed.
+    this.layerBands[band.name].addTileCallback((function(event) {
+      showLoadingFn(event.target.band_name + ": " + event.count + " tiles remaining.");
+      if (event.count === 0) {
+        this.removeAlert(name);
+      }
+    }).bind(this));
+
+    // create the band switcher
     var div = document.createElement("div");
-    $(div).attr("class","checkbox checkbox-warning");
+    $(div).attr("class","checkbox checkbox");
 
     var input = document.createElement("input");
-    $(input).attr("type","checkbox");
-    $(input).attr("id","blank");
-    $(input).css("margin-left","0px");
-    $(input).change((function(event){
+    $(input).attr("type","radio");
+    $(input).attr("id",band.name);
+    $(input).attr("name","bands");
+
+    // if band is checked make it visible and hide all other
+    $(input).change(band.name,(function(event){
       if(event.target.checked){
         for(var key in this.layerBands){
-          this.layerBands[key].setOpacity(0);
-        }
-      }else{
-        for(var key in this.layerBands){
-          if($("#" + key).prop("checked")){
+          if(key == event.data){
             this.layerBands[key].setOpacity(1);
+            $("#blank").prop("checked",false);
           }else{
             this.layerBands[key].setOpacity(0);
           }
@@ -734,23 +1151,56 @@ ntst.App.prototype.setLayer = function(name, options, optionsString) {
     }).bind(this));
 
     var label = document.createElement("label");
-    $(label).attr("for","blank");
-    $(label).html("hide all");
+    $(label).attr("for",band.name);
+    $(label).html(band.name);
 
-    $("#bandSwitcher").prepend($(div).append(input).append(label));
+    $("#bandSwitcher").append($(div).append(input).append(label));
+  };
 
-    //display the band switcher
-    $("#bandSwitcher").css("display","inline");
 
-    //make the first band visible
-    this.layerBands[firstBand].setOpacity(1);
-    $("#" + firstBand).prop("checked",true);
+  //add blank option
+  var div = document.createElement("div");
+  $(div).attr("class","checkbox checkbox-warning");
 
-  }).bind(this);
+  var input = document.createElement("input");
+  $(input).attr("type","checkbox");
+  $(input).attr("id","blank");
+  $(input).css("margin-left","0px");
+  $(input).change((function(event){
+    if(event.target.checked){
+      for(var key in this.layerBands){
+        this.layerBands[key].setOpacity(0);
+      }
+    }else{
+      for(var key in this.layerBands){
+        if($("#" + key).prop("checked")){
+          this.layerBands[key].setOpacity(1);
+        }else{
+          this.layerBands[key].setOpacity(0);
+        }
+      }
+    }
+  }).bind(this));
 
-  showLoadingFn();
-  this.layerPaths[name] = optionsString;
-  this.layerRequests[name] = ntst.App.handleRequest($.post("/mapid",options), onDone, onError);
+  var label = document.createElement("label");
+  $(label).attr("for","blank");
+  $(label).html("hide all");
+
+  $("#bandSwitcher").prepend($(div).append(input).append(label));
+
+  //display the band switcher
+  $("#bandSwitcher").css("display","inline");
+
+  //make the previously selected band or the first band visible
+  if (!this.layerBands[selectedBand]) {
+    selectedBand = firstBand;
+  }
+  this.layerBands[selectedBand].setOpacity(1);
+  $("#" + selectedBand).prop("checked",true);
+
+  if (hideAll) {
+    $("#blank").prop("checked",true).change();
+  }
 };
 
 /**
@@ -764,14 +1214,24 @@ ntst.App.prototype.removeLayer = function(name) {
     this.layerRequests[name].abort();
     delete this.layerRequests[name];
   }
-  // Delete the current path.
+  // Delete the current path and request id.
   delete this.layerPaths[name];
+  delete this.layerRequestIds[name];
   this.removeAlert(name);
-  this.map.overlayMapTypes.forEach((function(mapType, index) {
+  this.removeOverlays(name);
+};
+
+/**
+ * Removes the map overlays of the layer with the given name.
+ * @param {string} name The name of the layer.
+ */
+ntst.App.prototype.removeOverlays = function(name) {
+  for (var i = this.map.overlayMapTypes.getLength() - 1; i >= 0; i--) {
+    var mapType = this.map.overlayMapTypes.getAt(i);
     if (mapType && mapType.name == name) {
-      this.map.overlayMapTypes.removeAt(index);
+      this.map.overlayMapTypes.removeAt(i);
     }
-  }).bind(this));
+  }
 };
 
 
@@ -792,13 +1252,79 @@ ntst.App.prototype.exportImage = function() {
 * Creates a download link for the currently configured image.
 * The download link creates a zip file with a tif image for each band,
 * computing happens on the fly so that the dowload is not very stable.
-* Also it is limited by a max file size of 1024 MB.
+* Downloads larger than 1024 MB are split into tiles, even larger ones are exported via Google Drive.
 */
 ntst.App.prototype.getDownloadUrl = function(){
   var params = this.getOptions();
   ntst.App.handleRequest($.post("/download", params), null, this.setAlert.bind(this, "download-" + params.filename, "danger", "Download creation failed."));
 }
 
+/**
+* Computes summary statistics of the bands of the currently configured image inside of the region.
+* The statistics are computed from a random sample of the pixels, so they are ready in seconds.
+*/
+ntst.App.prototype.getRegionStats = function(){
+  var params = this.getOptions();
+  var name = "stats-" + params.filename;
+  this.setAlert(name, "info", "Statistics of '" + params.filename + "' in progress.");
+  ntst.App.handleRequest($.post("/stats", params), (function(data){
+    this.setAlert(name, "success", "Statistics of '" + params.filename + "' (pixels of " + data.scale + " m):", this.describeRegionStats(data));
+  }).bind(this), this.setAlert.bind(this, name, "danger", "Statistics failed."));
+}
+
+/**
+ * Describes the statistics of the bands of a region as table with a small histogram per band.
+ * @param {Object} stats The statistics sent by the server (mode, scale, bands and adaptations).
+ * @return {Object} The jQuery DOM wrapper of the description.
+ */
+ntst.App.prototype.describeRegionStats = function(stats) {
+  var format = function(value) {
+    return value === null || value === undefined ? "-" : Number(value).toPrecision(3);
+  };
+  var table = $("<table/>", {class: "region-stats"});
+  var header = $("<tr/>").append($("<th/>").text("Band"), $("<th/>").text("Pixels"), $("<th/>").text("Mean"));
+  var percentiles = Object.keys(stats.bands[Object.keys(stats.bands)[0]].percentiles).sort(function(a, b) {
+    return parseInt(a.substring(1)) - parseInt(b.substring(1));
+  });
+  for (var i = 0; i < percentiles.length; i++) {
+    header.append($("<th/>").text(percentiles[i]));
+  }
+  table.append(header.append($("<th/>").text("Histogram")));
+
+  var bars = "\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588";
+  var names = Object.keys(stats.bands).sort();
+  for (var j = 0; j < names.length; j++) {
+    var band = stats.bands[names[j]];
+    var row = $("<tr/>").append($("<td/>").text(names[j]), $("<td/>").text(band.count), $("<td/>").text(format(band.mean)));
+    for (var k = 0; k < percentiles.length; k++) {
+      row.append($("<td/>").text(format(band.percentiles[percentiles[k]])));
+    }
+    // the buckets as bars relative to the largest one, the title shows the range of the values
+    var histogram = "";
+    var title = "";
+    if (band.histogram) {
+      var counts = band.histogram.histogram;
+      var largest = Math.max.apply(null, counts);
+      for (var l = 0; l < counts.length; l++) {
+        histogram += bars.charAt(largest ? Math.round(counts[l] / largest * (bars.length - 1)) : 0);
+      }
+      title = format(band.histogram.bucketMin) + " to " + format(band.histogram.bucketMin + counts.length * band.histogram.bucketWidth);
+    }
+    table.append(row.append($("<td/>", {title: title}).text(histogram)));
+  }
+
+  var description = $("<span/>").append(table);
+  if (stats.mode == "sampled") {
+    var samples = stats.bands[names[0]].samples;
+    description.append("Sampled statistics of " + (samples === null || samples === undefined ? 0 : samples) + " pixels at " + stats.scale +
+                       " m, the pixels are estimated at " + stats.countScale + " m.");
+  }
+  if (stats.adaptations) {
+    description.append("<br>Retried after EE memory or time limits with " + stats.adaptations.join(", ") + ".");
+  }
+  return description;
+};
+
 /**
 * Creates a chart of the data at the selected point.
 * Also provides a temporary full screen chart url where the chart can be saved as image or as table.
@@ -857,19 +1383,26 @@ ntst.App.createDrawingManager = function(map) {
 /**
  * Handles the success or failure of the data request.
  * @param {Object} request The jqXHR sent.
- * @param {function(Object)} onDone The function to call if the request
- *     succeeds, with the data object as an argument.
+ * @param {function(Object, Object)} onDone The function to call if the request
+ *     succeeds, with the data object and the jqXHR as arguments.
  * @param {function(string)} onError The function to call if the request
  *     fails, with an error message as an argument.
  * @return {Object} The original request, against which further callbacks
  *     can be registered.
+ * The simplification of the region that the server reports with a response is shown as alert.
  */
 ntst.App.handleRequest = function(request, onDone, onError) {
-  request.done(function(data) {
-    if (data && data.error) {
+  request.done(function(data, textStatus, jqXHR) {
+    if (data && data.cancelled) {
+      return;  // the request was superseded by a newer request of this client
+    } else if (data && data.error) {
       onError(data.error);
     } else {
-      if (onDone) onDone(data);
+      if (data && data.region && data.region.vertices[1] < data.region.vertices[0]) {
+        ntst.App.prototype.setAlert("region", "info", "The region was simplified from " + data.region.vertices[0] + " to " +
+                                    data.region.vertices[1] + " vertices (by less than a pixel).");
+      }
+      if (onDone) onDone(data, jqXHR);
     }
   }).fail(function(jqXHR, textStatus) {
     onError("HTTP Status: " + jqXHR.status);
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Tracking and quota driven eviction of the exported files in the Google Drive of the service account.
+
+The exports of all clients are stored in the Drive of the service account,
+which has a fixed quota. Without a limit on the stored size a burst of large
+exports fills the Drive and the following exports fail, even though most of
+the stored files were already downloaded or are never downloaded at all.
+
+Each exported file is recorded in the Datastore with its owner (the client id),
+its export name, size and the time of its last download (the download links
+point to /file, which records the download and redirects to Drive). Before an
+export starts, the used space of the Drive is checked against a high-water
+mark. If the export would cross it, whole exports are evicted until the used
+space is below the low-water mark: the exports that were not downloaded for
+the longest time (or never, then their creation time counts) first, and the
+newest export of each client only after the older exports of all clients.
+Files younger than the minimum retention are never evicted, so the time based
+cleanup of the cron job is only shortened for the exports that are in the way.
+"""
+
+import logging
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+
+class ExportFile(ndb.Model):
+
+    """An exported file in the Drive of the service account, the key id is the Drive file id."""
+
+    client_id = ndb.StringProperty()
+    filename = ndb.StringProperty()
+    size = ndb.IntegerProperty(indexed=False)
+    url = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    downloaded = ndb.DateTimeProperty(indexed=False)
+
+
+class DriveStorage(object):
+
+    """Records the exported files and evicts them if the Drive is too full."""
+
+    def __init__(self, drive_helper, high_water, low_water, retention):
+        """Creates the storage manager.
+
+        Args:
+            drive_helper: The drive.DriveHelper of the service account.
+            high_water: The share [0-1] of the quota that an export may fill before exports are evicted.
+            low_water: The share [0-1] of the quota that the eviction frees the Drive down to.
+            retention: The minimum seconds an exported file is kept.
+        """
+        self.drive = drive_helper
+        self.high_water = high_water
+        self.low_water = low_water
+        self.retention = retention
+
+
+    def Register(self, client_id, filename, files):
+        """Records the files of a completed export.
+
+        Args:
+            client_id: The id of the client that owns the export.
+            filename: The name of the export, the files of an export are evicted together.
+            files: A list of dicts {"id":<Drive file id>,"size":<bytes>,"url":<download url>}.
+        """
+        ndb.put_multi([ExportFile(id=f["id"], client_id=client_id, filename=filename, size=f["size"], url=f["url"]) for f in files])
+
+
+    def Owned(self, client_id, filename):
+        """Returns the records of the files of an export if it is owned by the client."""
+        return ExportFile.query(ExportFile.filename == filename, ExportFile.client_id == client_id).fetch()
+
+
+    def Downloaded(self, file_id):
+        """Records the download of a file.
+
+        Returns:
+            The record of the file or None if the file is unknown (like an evicted file).
+        """
+        record = ExportFile.get_by_id(file_id)
+        if record is not None:
+            record.downloaded = datetime.utcnow()
+            record.put()
+        return record
+
+
+    def Forget(self, file_ids):
+        """Removes the records of deleted files."""
+        ndb.delete_multi([ndb.Key(ExportFile, file_id) for file_id in file_ids])
+
+
+    def Usage(self):
+        """Returns the (<used bytes>, <quota bytes>) of the Drive."""
+        about = self.drive.service.about().get().execute()
+        return int(about["quotaBytesUsed"]), int(about["quotaBytesTotal"])
+
+
+    def MakeRoom(self, size):
+        """Evicts exports if an export of the size would fill the Drive above the high-water mark.
+
+        Args:
+            size: The estimated size of the export (bytes), 0 to check the used space only.
+
+        Returns:
+            The number of evicted bytes.
+        """
+        used, total = self.Usage()
+        if used + size <= self.high_water * total:
+            return 0
+
+        # the files of an export are evicted together, young exports are kept
+        now = datetime.utcnow()
+        exports = {}
+        for record in ExportFile.query().fetch():
+            exports.setdefault((record.client_id, record.filename), []).append(record)
+        candidates = []
+        newest = {}
+        for (client_id, filename), records in exports.items():
+            created = max(r.created for r in records)
+            newest[client_id] = max(newest.get(client_id, created), created)
+            if (now - created).total_seconds() >= self.retention:
+                last_use = max(r.downloaded or r.created for r in records)
+                candidates.append((last_use, created, client_id, records))
+
+        # the newest export of each client goes last, then the least recently downloaded or oldest first
+        candidates.sort(key=lambda c: (c[1] == newest[c[2]], c[0], c[1]))
+
+        evicted = 0
+        target = self.low_water * total
+        for _, _, client_id, records in candidates:
+            if used - evicted <= target:
+                break
+            for record in records:
+                try:
+                    self.drive.DeleteFile(record.key.id())
+                except Exception as e:
+                    # the file may have been deleted by the cron job or the client
+                    logging.warning("Deleting the evicted file %s failed: %s", record.key.id(), e)
+            self.Forget([record.key.id() for record in records])
+            evicted += sum(record.size or 0 for record in records)
+            logging.info("Evicted export %s of client %s (%s files, %s bytes).", records[0].filename, client_id, len(records),
+                         sum(record.size or 0 for record in records))
+
+        if used - evicted + size > self.high_water * total:
+            logging.warning("The Drive is still %.0f%% full after evicting %s bytes.", 100.0 * (used - evicted) / total, evicted)
+        return evicted
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Generations of the requests of a client, so that superseded computations are stopped early.
+
+The client requests a new map whenever the options change (like scrubbing
+through the year ranges) and abandons the map IDs of the older requests, but
+the server would compute each of them to the end (the collection sizes and a
+map ID per band). Each map and chart request of a client gets the next number
+of a counter per client and kind in the Memcache. The handlers and runners
+check between their EE calls if a newer request of the same kind exists and
+stop with Superseded instead of computing results that nobody waits for.
+
+A counter that was evicted from the Memcache starts again at 1, then the older
+requests are not recognized as superseded and are computed to the end.
+"""
+
+from google.appengine.api import memcache
+
+
+class Superseded(Exception):
+
+    """The request was superseded by a newer request of the same client and kind."""
+
+
+class Generations(object):
+
+    """The counters of the requests per client and kind in the Memcache."""
+
+    def __init__(self, prefix="generation"):
+        """Creates the counters.
+
+        Args:
+            prefix: The prefix of the Memcache keys.
+        """
+        self.prefix = prefix
+
+
+    def Next(self, client_id, kind):
+        """Starts a new generation of the requests of a client, which supersedes the running ones.
+
+        Returns:
+            The generation of the new request or None if the client has no id.
+        """
+        if not client_id:
+            return None
+        return memcache.incr(self._Key(client_id, kind), initial_value=0)
+
+
+    def Check(self, client_id, kind, generation):
+        """Checks that a request is still the newest of its client and kind.
+
+        Args:
+            client_id: The id of the client.
+            kind: The kind of the request (like "map" or "chart").
+            generation: The generation returned by Next() for the request, None is never superseded.
+
+        Raises:
+            Superseded: If the client started a newer request of the kind.
+        """
+        if generation is None:
+            return
+        current = memcache.get(self._Key(client_id, kind))
+        if current is not None and int(current) > generation:
+            raise Superseded("Superseded by a newer %s request." % kind)
+
+
+    def Checker(self, client_id, kind, generation):
+        """Returns a function without arguments that calls Check() for the request."""
+        return lambda: self.Check(client_id, kind, generation)
+
+
+    def _Key(self, client_id, kind):
+        return "%s:%s:%s" % (self.prefix, kind, client_id)
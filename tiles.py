@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""A caching proxy for the EE map tiles of the regression layers.
+
+The tiles are cached under a layer key (derived from the canonical options and
+the band) instead of the short-lived EE map id, so that the tiles of a layer are
+reused by later /mapid requests and by other clients with the same options.
+A layer key is mapped to the current EE map id and token by AddLayer().
+
+The cache has two levels: an LRU cache in the memory of the instance and a
+bounded directory on disk or, if no directory is given, the Memcache API (the
+App Engine file system is read-only). Concurrent requests of the same tile
+wait for one fetch from EE, within an instance by an event and across instances
+by a lock in the Memcache.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+
+class TileError(Exception):
+
+    """A tile could not be fetched from EE, status is the HTTP status for the client."""
+
+    def __init__(self, message, status=502):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class TileProxy(object):
+
+    """Fetches the map tiles of registered layers from EE and caches them."""
+
+    def __init__(self, url, memory_bytes, directory=None, disk_bytes=None, lifetime=24 * 60 * 60, map_lifetime=6 * 60 * 60, wait=20):
+        """Creates the proxy.
+
+        Args:
+            url: The EE map url, the tiles are fetched from <url>/<mapid>/<z>/<x>/<y>?token=<token>.
+            memory_bytes: The size of the memory cache of the instance.
+            directory: The directory of the disk cache or None to use the Memcache API.
+            disk_bytes: The size of the disk cache.
+            lifetime: Seconds after which a cached tile is fetched again (the EE collections change).
+            map_lifetime: Seconds a registered EE map id is used.
+            wait: Seconds a request waits for the fetch of the same tile by another request.
+        """
+        self.url = url
+        self.lifetime = lifetime
+        self.map_lifetime = map_lifetime
+        self.wait = wait
+        self.memory = _MemoryCache(memory_bytes)
+        self.disk = _DiskCache(directory, disk_bytes) if directory is not None else None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+
+    def AddLayer(self, layer, mapid, token):
+        """Registers the EE map id and token that are used to fetch the tiles of a layer."""
+        memcache.set("tile-layer:" + layer, {"mapid": mapid, "token": token}, time=self.map_lifetime)
+
+
+    def HasLayers(self, layers):
+        """Checks if the EE map ids of all layers are still registered (the Memcache may evict them early)."""
+        return len(memcache.get_multi(layers, key_prefix="tile-layer:")) == len(set(layers))
+
+
+    def GetTile(self, layer, z, x, y):
+        """Returns a tile from the cache or fetches it from EE.
+
+        Returns:
+            A tuple (<content type>, <data>).
+
+        Raises:
+            TileError: If the layer is unknown or EE returned an error.
+        """
+        key = "%s/%s/%s/%s" % (layer, z, x, y)
+        tile = self.memory.Get(key, self.lifetime)
+        if tile is not None:
+            return tile
+        tile = self._GetShared(key)
+        if tile is not None:
+            self.memory.Set(key, tile)
+            return tile
+
+        # only the first request of a tile fetches it, the others wait for its result
+        with self.lock:
+            pending = self.pending.get(key)
+            first = pending is None
+            if first:
+                pending = self.pending[key] = _PendingFetch()
+
+        if not first:
+            if not pending.event.wait(self.wait):
+                raise TileError("Timeout while waiting for tile %s." % key, 504)
+            if pending.error is not None:
+                raise pending.error
+            return pending.tile
+
+        try:
+            pending.tile = self._Fetch(layer, key, z, x, y)
+            self.memory.Set(key, pending.tile)
+            return pending.tile
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.event.set()
+
+
+    def _Fetch(self, layer, key, z, x, y):
+        """Fetches a tile from EE, other instances wait for it in _AwaitShared()."""
+        shared = self.disk is None
+        if shared and not memcache.add("tile-fetch:" + key, True, time=self.wait):
+            tile = self._AwaitShared(key)
+            if tile is not None:
+                return tile
+
+        try:
+            mapid = memcache.get("tile-layer:" + layer)
+            if mapid is None:
+                raise TileError("Unknown layer: %s" % layer, 404)
+
+            try:
+                result = urlfetch.fetch("%s/%s/%s/%s/%s?token=%s" % (self.url, mapid["mapid"], z, x, y, mapid["token"]), deadline=self.wait)
+            except Exception as e:
+                raise TileError("Fetch of tile %s failed: %s" % (key, e))
+            if result.status_code != 200:
+                raise TileError("EE returned status %s for tile %s." % (result.status_code, key))
+
+            tile = (result.headers.get("content-type", "image/png"), result.content)
+            self._SetShared(key, tile)
+            return tile
+        finally:
+            if shared:
+                memcache.delete("tile-fetch:" + key)
+
+
+    def _AwaitShared(self, key):
+        """Waits until another instance has fetched the tile. Returns None on a timeout."""
+        end = time.time() + self.wait
+        while time.time() < end:
+            time.sleep(0.1)
+            tile = self._GetShared(key)
+            if tile is not None:
+                return tile
+            if memcache.get("tile-fetch:" + key) is None:
+                return None  # the other fetch failed
+        return None
+
+
+    def _GetShared(self, key):
+        if self.disk is not None:
+            return self.disk.Get(key, self.lifetime)
+        return memcache.get("tile:" + key)
+
+
+    def _SetShared(self, key, tile):
+        if self.disk is not None:
+            self.disk.Set(key, tile)
+            return
+        try:
+            memcache.set("tile:" + key, tile, time=self.lifetime)
+        except ValueError:
+            logging.warning("Tile %s is too large for the Memcache.", key)
+
+
+class _PendingFetch(object):
+
+    """The result of a running fetch for the requests that wait for it."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.tile = None
+        self.error = None
+
+
+class _MemoryCache(object):
+
+    """A thread-safe LRU cache of tiles that is bounded by the size of the tile data.
+
+    The tiles are stored with the time they were added.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def Get(self, key, lifetime):
+        with self.lock:
+            entry = self.tiles.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time() - lifetime:
+                self.bytes -= len(entry[1][1])
+                return None
+            self.tiles[key] = entry
+            return entry[1]
+
+
+    def Set(self, key, tile):
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1][1])
+            self.tiles[key] = (time.time(), tile)
+            self.bytes += len(tile[1])
+            while self.bytes > self.max_bytes and self.tiles:
+                _, evicted = self.tiles.popitem(last=False)
+                self.bytes -= len(evicted[1][1])
+
+
+class _DiskCache(object):
+
+    """A directory of tiles that is bounded by the size of the files.
+
+    The least recently used files are deleted. The index of the files is kept per
+    process and read from the modification times of the files at the start, so the
+    bound is only approximate if several processes share the directory.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        files = []
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+        self.files = collections.OrderedDict((name, size) for _, name, size in sorted(files))
+        self.bytes = sum(self.files.values())
+
+
+    def Get(self, key, lifetime):
+        name = self._Name(key)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files[name] = self.files.pop(name)
+        try:
+            if os.path.getmtime(path) < time.time() - lifetime:
+                return None
+            with open(path, "rb") as f:
+                content_type, data = f.read().split(b"\n", 1)
+        except (IOError, OSError, ValueError):
+            return None
+        return content_type.decode("ascii"), data
+
+
+    def Set(self, key, tile):
+        name = self._Name(key)
+        path = os.path.join(self.directory, name)
+        data = tile[0].encode("ascii") + b"\n" + tile[1]
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+
+        with self.lock:
+            self.bytes += len(data) - self.files.pop(name, 0)
+            self.files[name] = len(data)
+            while self.bytes > self.max_bytes and self.files:
+                evicted, size = self.files.popitem(last=False)
+                self.bytes -= size
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except OSError:
+                    pass
+
+
+    def _Name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Benchmark of the map and chart computation with the local EE emulator.
+
+Runs _GetImage() with _GetLayers() (the work of /mapid and /mapidrunner) and
+_GetChart() (the work of /chartrunner) of the app for combinations of options
+and reports their wall times. EE is replaced by the numpy emulator (see
+eemulator), Drive, Firebase and the App Engine APIs by the fakes of
+fakebackend.py without latency, so the times are the times of the app code and
+of the computation.
+
+Usage:
+    python tools/benchmark.py --regression poly1 zhuWood --source all land8 --repeat 3
+    python tools/benchmark.py --composite none 16day month --composite-method maxndvi
+    python tools/benchmark.py --data /path/to/stacks --json benchmark.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import fakebackend
+import loadtest
+
+
+def Run(server, options, repeat, cold):
+    """Times the map and chart computation of the options.
+
+    Returns:
+        A dict with the collection size and the lists of seconds of each run of "map" and "chart".
+    """
+    result = {"size": None, "map": [], "chart": []}
+    for _ in range(repeat):
+        if cold:
+            server.ee.CACHE.Clear()
+
+        started = time.time()
+        info = {}
+        image = server._GetImage(options, info=info)
+        if image is not None:
+            server._GetLayers(image, None, server._ImageBands(options))
+        result["map"].append(time.time() - started)
+        result["size"] = info.get("size")
+
+        started = time.time()
+        server._GetChart(options)
+        result["chart"].append(time.time() - started)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--regression", nargs="+", default=["poly1"], choices=["poly1", "poly2", "poly3", "zhuWood"])
+    parser.add_argument("--source", nargs="+", default=["all"], choices=["all", "land5", "land7", "land8"])
+    parser.add_argument("--cloudmask", nargs="+", default=["score"], choices=["score", "qa"])
+    parser.add_argument("--composite", nargs="+", default=["none"], choices=["none", "16day", "month"])
+    parser.add_argument("--composite-method", default="median", choices=["median", "maxndvi"])
+    parser.add_argument("--cloudscore", type=int, default=20, help="the max cloud score of the pixels")
+    parser.add_argument("--start", type=int, default=2010, help="the first year of the collection")
+    parser.add_argument("--end", type=int, default=2015, help="the last year of the collection")
+    parser.add_argument("--point", type=float, nargs=2, default=loadtest.POINTS[1], metavar=("LON", "LAT"))
+    parser.add_argument("--region-size", type=float, default=0.2, help="the width and height of the region (degrees)")
+    parser.add_argument("--repeat", type=int, default=1, help="the runs per combination of options")
+    parser.add_argument("--warm", action="store_true", help="keep the pixel cache of the emulator between the runs")
+    parser.add_argument("--data", help="the directory with the raster stacks of the emulator (default synthetic scenes)")
+    parser.add_argument("--map-pixels", type=int, default=None, help="the maximum pixels per side of a map")
+    parser.add_argument("--json", metavar="FILE", help="write the results as json to the file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    backend = fakebackend.Backend(latencies=dict((service, 0) for service in fakebackend.DEFAULT_LATENCIES))
+    backend.Install()
+
+    # the app reads its templates relative to the working directory
+    os.chdir(loadtest.ROOT)
+    sys.path.insert(0, loadtest.ROOT)
+    import config
+    config.EE_EMULATOR = True
+    config.EE_EMULATOR_DATA = args.data and os.path.abspath(args.data)
+    import server
+    server.ee.Configure(map_pixels=args.map_pixels)
+
+    lon, lat = args.point
+    half = args.region_size / 2
+    region = [[lon - half, lat - half], [lon + half, lat - half], [lon + half, lat + half], [lon - half, lat + half], [lon - half, lat - half]]
+
+    print("%-8s %-6s %-6s %-6s %6s %9s %9s" % ("Regr.", "Source", "Mask", "Comp.", "Images", "Map (s)", "Chart (s)"))
+    results = []
+    for regression in args.regression:
+        for source in args.source:
+            for cloudmask in args.cloudmask:
+                for composite in args.composite:
+                    options = {"regression": regression, "source": source, "start": args.start, "end": args.end,
+                               "cloudscore": args.cloudscore, "cloudmask": cloudmask, "composite": composite,
+                               "compositemethod": args.composite_method, "point": [lon, lat], "region": region,
+                               "client_id": "benchmark", "filename": "benchmark"}
+                    result = Run(server, options, args.repeat, not args.warm)
+                    print("%-8s %-6s %-6s %-6s %6s %9.2f %9.2f" % (regression, source, cloudmask, composite, result["size"],
+                                                                   loadtest.Percentile(sorted(result["map"]), 50),
+                                                                   loadtest.Percentile(sorted(result["chart"]), 50)))
+                    result["options"] = options
+                    results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
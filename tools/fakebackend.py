@@ -0,0 +1,987 @@
+#!/usr/bin/env python
+"""A fake backend to run the app outside of App Engine.
+
+The App Engine APIs (Memcache, Task Queue, URL Fetch, Users, Datastore), Earth Engine,
+Google Drive and Firebase are replaced with in-process fakes. Every outbound
+call sleeps for a random time around a configurable mean latency and fails
+with a configurable rate, so that the app can be loaded with simulated clients
+without credentials or network access.
+
+Usage:
+    backend = fakebackend.Backend(latencies={"ee.getInfo": 2.0})
+    backend.Install()
+    import server
+"""
+
+import datetime
+import json
+import math
+import pickle
+import random
+import re
+import sys
+import threading
+import time
+import types
+
+
+# The mean latency of the outbound calls (seconds)
+DEFAULT_LATENCIES = {
+    "ee.getInfo": 1.5,
+    "ee.getMapId": 0.8,
+    "ee.getDownloadURL": 0.5,
+    "ee.startTask": 1.0,
+    "ee.getTaskStatus": 0.3,
+    "ee.cancelTask": 0.3,
+    "ee.getList": 0.5,
+    "ee.getTile": 0.4,
+    "drive": 0.3,
+    "firebase": 0.1,
+    "memcache": 0.002,
+    "datastore": 0.02,
+    "taskqueue": 0.01,
+    "urlfetch": 0.1,
+}
+
+# The size of the file of a completed EE export task (bytes)
+EXPORT_FILE_BYTES = 10 * 1024 * 1024
+
+# The spread of the lognormal latency distribution
+LATENCY_SIGMA = 0.5
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+
+class Backend(object):
+
+    """The state and the configuration of the fake services.
+
+    The recorded outbound calls are available as calls {<service>: [<count>, <seconds>, <failures>]},
+    the Firebase messages as messages {<client id>: [<message dict>, ...]}.
+    """
+
+    def __init__(self, latencies=None, failure_rates=None, seed=None, collection_size=(20, 200),
+                 export_duration=30.0, dispatch=None, drive_quota=15 * 1024 ** 3):
+        """Creates the backend.
+
+        Args:
+            latencies: A dict of mean latencies (seconds) that overwrite the DEFAULT_LATENCIES.
+            failure_rates: A dict with the probability [0-1] that a call of a service fails.
+                "ee.task" is the probability that an EE export task fails.
+                "ee.limit" is the probability that an EE computation (getInfo or an export task) exceeds the
+                memory limit of EE, it is divided by the tileScale of the region reductions or by the shrinking of
+                the shards of an export (256 / shardSize).
+            seed: The seed of the random generator.
+            collection_size: The (min, max) number of images of a fake image collection.
+            export_duration: The seconds an EE export task runs.
+            dispatch: A function (url, params) that runs the tasks added to the Task Queue.
+                If None the tasks are only recorded in tasks.
+            drive_quota: The quota of the Drive (bytes), an export task fails if its file does not fit.
+        """
+        self.latencies = dict(DEFAULT_LATENCIES)
+        self.latencies.update(latencies or {})
+        self.failure_rates = dict(failure_rates or {})
+        self.random = random.Random(seed)
+        self.collection_size = collection_size
+        self.export_duration = export_duration
+        self.dispatch = dispatch
+        self.drive_quota = drive_quota
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.calls = {}
+        self.messages = {}
+        self.tasks = []
+        self.cache = {}
+        self.ee_tasks = {}
+        self.files = {}
+        self.datastore = {}
+        self.objects = {}
+        self._ids = 0
+
+
+    def Call(self, service):
+        """Simulates an outbound call of the service.
+
+        Sleeps for the latency of the service and raises an exception with the configured failure rate.
+        """
+        mean = self.latencies.get(service, 0)
+        seconds = 0
+        if mean > 0:
+            seconds = self.random.lognormvariate(math.log(mean) - LATENCY_SIGMA ** 2 / 2, LATENCY_SIGMA)
+            time.sleep(seconds)
+
+        failed = self.random.random() < self.failure_rates.get(service, 0)
+        with self.lock:
+            record = self.calls.setdefault(service, [0, 0.0, 0])
+            record[0] += 1
+            record[1] += seconds
+            record[2] += int(failed)
+        if failed:
+            raise _FAILURES.get(service.split(".")[0], Exception)("Simulated %s failure." % service)
+
+
+    def Limited(self, relief=1):
+        """Returns True if a computation exceeds the simulated memory limit of EE, relief divides the "ee.limit" rate."""
+        limited = self.random.random() < self.failure_rates.get("ee.limit", 0) / float(relief)
+        if limited:
+            with self.lock:
+                self.calls.setdefault("ee.limit", [0, 0.0, 0])[2] += 1
+        return limited
+
+
+    def NewId(self, prefix):
+        with self.lock:
+            self._ids += 1
+            return "%s%06d" % (prefix, self._ids)
+
+
+    def AddMessage(self, client_id, message):
+        with self.lock:
+            message["received"] = time.time()
+            self.messages.setdefault(client_id, []).append(message)
+            self.changed.notify_all()
+
+
+    def WaitForMessage(self, client_id, predicate, timeout, start=0):
+        """Waits for a Firebase message of a client.
+
+        Args:
+            client_id: The id of the client.
+            predicate: A function that returns True for the message that is waited for.
+            timeout: The maximum seconds to wait.
+            start: The index of the first message of the client that is checked.
+
+        Returns:
+            A tuple (<message dict>, <index>) or (None, <number of messages>) on a timeout.
+        """
+        end = time.time() + timeout
+        with self.lock:
+            while True:
+                messages = self.messages.get(client_id, [])
+                for index in range(start, len(messages)):
+                    if predicate(messages[index]):
+                        return messages[index], index
+                start = len(messages)
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None, start
+                self.changed.wait(remaining)
+
+
+    def MessageCount(self, client_id):
+        with self.lock:
+            return len(self.messages.get(client_id, []))
+
+
+    def AddFile(self, title, size=None):
+        """Adds a file to the fake Drive, like the exports of the EE emulator."""
+        with self.lock:
+            return _NewFile(self, title, size)
+
+
+    def Install(self):
+        """Registers the fake modules in sys.modules. Has to be called before the server is imported."""
+        modules = {}
+
+        def module(name, **attributes):
+            m = types.ModuleType(name)
+            m.__dict__.update(attributes)
+            modules[name] = m
+            return m
+
+        google = module("google")
+        google.appengine = module("google.appengine")
+        google.appengine.api = module("google.appengine.api")
+        google.appengine.api.memcache = module("google.appengine.api.memcache", **_MemcacheApi(self))
+        google.appengine.api.taskqueue = module("google.appengine.api.taskqueue", **_TaskQueueApi(self))
+        google.appengine.api.urlfetch = module("google.appengine.api.urlfetch", **_UrlFetchApi(self))
+        google.appengine.api.users = module("google.appengine.api.users", **_UsersApi())
+        google.appengine.ext = module("google.appengine.ext")
+        google.appengine.ext.ndb = module("google.appengine.ext.ndb", **_NdbApi(self))
+
+        module("ee", **_EarthEngineApi(self))
+
+        firebase_admin = module("firebase_admin", initialize_app=lambda credentials, options=None: None)
+        firebase_admin.credentials = module("firebase_admin.credentials", Certificate=lambda path: path)
+        firebase_admin.auth = module("firebase_admin.auth", create_custom_token=lambda uid: "token-%s" % uid)
+
+        oauth2client = module("oauth2client")
+        oauth2client.service_account = module("oauth2client.service_account", ServiceAccountCredentials=_Credentials)
+
+        googleapiclient = module("googleapiclient")
+        googleapiclient.discovery = module("googleapiclient.discovery", build=lambda name, version, http=None: _DriveService(self))
+        googleapiclient.http = module("googleapiclient.http", MediaInMemoryUpload=_MediaUpload)
+
+        backend = self
+
+        class Http(object):
+            def request(self, url, method="GET", body=None, headers=None):
+                backend.Call("firebase")
+                m = re.search(r"/channels/([^/]+)\.json$", url)
+                if m is not None and body is not None:
+                    backend.AddMessage(m.group(1), json.loads(body))
+                return {"status": "200"}, ""
+
+        module("httplib2", Http=Http)
+
+        sys.modules.update(modules)
+
+
+# The exceptions raised by a simulated failure
+class EEException(Exception):
+    pass
+
+_FAILURES = {"ee": EEException}
+
+
+class _Credentials(object):
+
+    @classmethod
+    def from_json_keyfile_name(cls, filename, scopes=None):
+        return cls()
+
+    def authorize(self, http):
+        return http
+
+
+###############################################################################
+#                              App Engine APIs.                               #
+###############################################################################
+
+def _MemcacheApi(backend):
+    """Returns the members of the memcache module. Values are pickled like in the real Memcache."""
+    versions = {}
+    local = threading.local()
+
+    def expired(key):
+        entry = backend.cache.get(key)
+        if entry is not None and entry[1] and entry[1] < time.time():
+            del backend.cache[key]
+
+    def get(key):
+        backend.Call("memcache")
+        with backend.lock:
+            expired(key)
+            entry = backend.cache.get(key)
+            return None if entry is None else pickle.loads(entry[0])
+
+    def get_multi(keys, key_prefix=""):
+        backend.Call("memcache")
+        result = {}
+        with backend.lock:
+            for key in keys:
+                expired(key_prefix + key)
+                entry = backend.cache.get(key_prefix + key)
+                if entry is not None:
+                    result[key] = pickle.loads(entry[0])
+        return result
+
+    def store(key, value, expires):
+        if expires and expires < 30 * 24 * 60 * 60:
+            expires = time.time() + expires
+        backend.cache[key] = (pickle.dumps(value), expires)
+        versions[key] = versions.get(key, 0) + 1
+
+    def set(key, value, time=0):
+        backend.Call("memcache")
+        with backend.lock:
+            store(key, value, time)
+        return True
+
+    def add(key, value, time=0):
+        backend.Call("memcache")
+        with backend.lock:
+            expired(key)
+            if key in backend.cache:
+                return False
+            store(key, value, time)
+        return True
+
+    def delete(key):
+        backend.Call("memcache")
+        with backend.lock:
+            return 2 if backend.cache.pop(key, None) is not None else 1
+
+    def incr(key, delta=1, initial_value=None):
+        backend.Call("memcache")
+        with backend.lock:
+            expired(key)
+            entry = backend.cache.get(key)
+            if entry is None and initial_value is None:
+                return None
+            value = max((pickle.loads(entry[0]) if entry is not None else initial_value) + delta, 0)
+            backend.cache[key] = (pickle.dumps(value), entry[1] if entry is not None else 0)
+            versions[key] = versions.get(key, 0) + 1
+        return value
+
+    class Client(object):
+
+        """Keeps the compare and set ids per thread."""
+
+        def gets(self, key):
+            backend.Call("memcache")
+            with backend.lock:
+                expired(key)
+                entry = backend.cache.get(key)
+                if entry is None:
+                    return None
+                if not hasattr(local, "cas_ids"):
+                    local.cas_ids = {}
+                local.cas_ids[key] = versions.get(key)
+                return pickle.loads(entry[0])
+
+        def cas(self, key, value, time=0):
+            backend.Call("memcache")
+            with backend.lock:
+                cas_id = getattr(local, "cas_ids", {}).pop(key, None)
+                if key not in backend.cache or cas_id is None or versions.get(key) != cas_id:
+                    return False
+                store(key, value, time)
+            return True
+
+        def get(self, key):
+            return get(key)
+
+        def set(self, key, value, time=0):
+            return set(key, value, time)
+
+        def add(self, key, value, time=0):
+            return add(key, value, time)
+
+    return {"get": get, "get_multi": get_multi, "set": set, "add": add, "delete": delete, "incr": incr, "Client": Client}
+
+
+def _TaskQueueApi(backend):
+    """Returns the members of the taskqueue module. Added tasks are passed to the dispatch function."""
+
+    class TaskRetryOptions(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    def add(url, params=None, retry_options=None, **kwargs):
+        backend.Call("taskqueue")
+        params = dict((k, str(v)) for k, v in (params or {}).items())
+        with backend.lock:
+            backend.tasks.append((url, params))
+        if backend.dispatch is not None:
+            backend.dispatch(url, params)
+
+    return {"add": add, "TaskRetryOptions": TaskRetryOptions}
+
+
+def _UrlFetchApi(backend):
+    """Returns the members of the urlfetch module. EE map tiles are answered with fake tiles of 10 KB."""
+
+    class _Result(object):
+        def __init__(self, status_code, content, headers):
+            self.status_code = status_code
+            self.content = content
+            self.headers = headers
+
+    def fetch(url, *args, **kwargs):
+        if re.search(r"/map/[^/]+/\d+/\d+/\d+", url):
+            backend.Call("ee.getTile")
+            return _Result(200, b"\x89PNG" + b"\0" * 10 * 1024, {"content-type": "image/png"})
+        backend.Call("urlfetch")
+
+    return {"fetch": fetch, "set_default_fetch_deadline": lambda deadline: None}
+
+
+def _UsersApi():
+    return {
+        "get_current_user": lambda: None,
+        "is_current_user_admin": lambda: False,
+        "create_login_url": lambda dest_url=None: "/_ah/login",
+    }
+
+
+def _NdbApi(backend):
+    """Returns the members of the ndb module, the entities are kept as dicts in datastore {<key path>: <values>}.
+
+    Only the models with simple properties, the gets and puts by key, the queries with == or < filters or
+    an ancestor and the transactions (serialized with a lock) are faked. The values are copied like in the
+    real Datastore.
+    """
+    transactions = threading.RLock()
+
+    class Key(object):
+        def __init__(self, kind, key_id, parent=None):
+            self.kind = kind if isinstance(kind, _STRING_TYPES) else kind.__name__
+            self.key_id = key_id
+            self.parent = parent
+
+        def id(self):
+            return self.key_id
+
+        def pair(self):
+            return (self.parent.pair() if self.parent is not None else ()) + (self.kind, self.key_id)
+
+        def get(self):
+            backend.Call("datastore")
+            with backend.lock:
+                values = backend.datastore.get(self.pair())
+                return None if values is None else _ModelClass(self.kind)._FromValues(self, values)
+
+        def delete(self):
+            backend.Call("datastore")
+            with backend.lock:
+                backend.datastore.pop(self.pair(), None)
+
+    class Property(object):
+        def __init__(self, indexed=True, auto_now_add=False, compressed=False):
+            self.auto_now_add = auto_now_add
+            self.name = None
+
+        def __eq__(self, value):
+            return (self.name, lambda v: v == value)
+
+        def __lt__(self, value):
+            return (self.name, lambda v: v is not None and v < value)
+
+    class Model(object):
+        def __init__(self, id=None, parent=None, **values):
+            self.key = Key(type(self), id if id is not None else backend.NewId(type(self).__name__), parent)
+            for name in self._Properties():
+                setattr(self, name, values.get(name))
+
+        @classmethod
+        def _Properties(cls):
+            properties = {}
+            for klass in reversed(cls.__mro__):
+                for name, value in vars(klass).items():
+                    if isinstance(value, Property):
+                        value.name = name
+                        properties[name] = value
+            return properties
+
+        @classmethod
+        def _FromValues(cls, key, values):
+            entity = cls.__new__(cls)
+            entity.key = key
+            values = pickle.loads(values)
+            for name in cls._Properties():
+                setattr(entity, name, values.get(name))
+            return entity
+
+        def _Store(self):
+            for name, prop in self._Properties().items():
+                if prop.auto_now_add and getattr(self, name) is None:
+                    setattr(self, name, datetime.datetime.utcnow())
+            backend.datastore[self.key.pair()] = pickle.dumps(dict((name, getattr(self, name)) for name in self._Properties()))
+
+        def put(self):
+            backend.Call("datastore")
+            with backend.lock:
+                self._Store()
+            return self.key
+
+        @classmethod
+        def get_by_id(cls, key_id, parent=None):
+            return Key(cls, key_id, parent).get()
+
+        @classmethod
+        def query(cls, *filters, **kwargs):
+            cls._Properties()
+            ancestor = kwargs.get("ancestor")
+
+            class Query(object):
+                def fetch(self, limit=None, keys_only=False):
+                    backend.Call("datastore")
+                    entities = []
+                    with backend.lock:
+                        for path, values in backend.datastore.items():
+                            if path[-2] != cls.__name__ or (ancestor is not None and path[:len(ancestor.pair())] != ancestor.pair()):
+                                continue
+                            entity = cls._FromValues(_KeyFromPath(path), values)
+                            if all(test(getattr(entity, name)) for name, test in filters):
+                                entities.append(entity)
+                    entities = entities[:limit]
+                    return [entity.key for entity in entities] if keys_only else entities
+
+            return Query()
+
+    def _ModelClass(kind):
+        classes = Model.__subclasses__()
+        while classes:
+            cls = classes.pop()
+            if cls.__name__ == kind:
+                return cls
+            classes.extend(cls.__subclasses__())
+        raise KeyError(kind)
+
+    def _KeyFromPath(path):
+        key = None
+        for index in range(0, len(path), 2):
+            key = Key(path[index], path[index + 1], key)
+        return key
+
+    def put_multi(entities):
+        backend.Call("datastore")
+        with backend.lock:
+            for entity in entities:
+                entity._Store()
+        return [entity.key for entity in entities]
+
+    def delete_multi(keys):
+        backend.Call("datastore")
+        with backend.lock:
+            for key in keys:
+                backend.datastore.pop(key.pair(), None)
+
+    def transaction(callback, retries=3, xg=False):
+        with transactions:
+            return callback()
+
+    return {"Key": Key, "Model": Model, "StringProperty": Property, "IntegerProperty": Property, "FloatProperty": Property,
+            "DateTimeProperty": Property, "JsonProperty": Property, "put_multi": put_multi, "delete_multi": delete_multi,
+            "transaction": transaction}
+
+
+###############################################################################
+#                                Earth Engine.                                #
+###############################################################################
+
+class _Object(object):
+
+    """A lazy EE object that records the chain of method calls that created it.
+
+    Only getInfo(), getMapId() and getDownloadURL() call the (fake) EE servers.
+    """
+
+    def __init__(self, backend, name, parent=None, args=(), kwargs=None):
+        self._backend = backend
+        self._name = name
+        self._parent = parent
+        self._args = args
+        self._kwargs = kwargs or {}
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _Object(self._backend, name, self)
+
+    def __call__(self, *args, **kwargs):
+        if self._name == "map" and args and callable(args[0]):
+            # like the EE client library the function is called once with a placeholder to build the graph
+            args = (args[0](_Object(self._backend, "Image")),) + args[1:]
+        return _Object(self._backend, self._name, self._parent, args, kwargs)
+
+    # like in the EE client library the requests are sent by the functions of ee.data
+
+    def getInfo(self):
+        return sys.modules["ee"].data.computeValue(self)
+
+    def getMapId(self, vis_params=None):
+        return sys.modules["ee"].data.getMapId({"image": self, "vis_params": vis_params})
+
+    def getDownloadURL(self, params=None):
+        download = sys.modules["ee"].data.getDownloadId(dict(params or {}, image=self))
+        return "https://earthengine.googleapis.com/api/download?docid=%s&token=%s" % (download["docid"], download["token"])
+
+
+def _Evaluate(obj, tables=None):
+    """Returns a plausible result for the computed EE object.
+
+    The columns of a table (aggregate_array of a property) in one request share the rows in tables.
+    """
+    if not isinstance(obj, _Object):
+        return obj
+    backend = obj._backend
+    if tables is None:
+        tables = {}
+    if obj._name == "size":
+        return backend.random.randint(*backend.collection_size)
+    if obj._name == "Dictionary":
+        return dict((k, _Evaluate(v, tables)) for k, v in obj._args[0].items())
+    if obj._name == "reduceRegions":
+        features = []
+        for properties in _Features(obj._args[0]):
+            values = dict((band, backend.random.uniform(-0.1, 0.1)) for band in _Bands(obj._parent))
+            features.append({"type": "Feature", "geometry": None, "properties": dict(properties, **values)})
+        return {"type": "FeatureCollection", "features": features}
+    if obj._name == "aggregate_array" and obj._args and obj._args[0] != "values":
+        if id(obj._parent) not in tables:
+            tables[id(obj._parent)] = _Table(obj._parent)
+        return [row.get(obj._args[0]) for row in tables[id(obj._parent)]]
+    if obj._name == "bandNames":
+        return _Bands(obj._parent)
+    if obj._name == "reduceColumns":
+        # a reducer repeated by forEach for the columns of a sample of an image
+        reducer = obj._args[0] if obj._args else obj._kwargs.get("reducer")
+        columns = reducer._args[0] if reducer._name == "forEach" else obj._args[1]
+        return _ReducerResult(backend, columns, _ReducerOutputs(reducer._parent if reducer._name == "forEach" else reducer))
+    if obj._name == "reduceRegion":
+        outputs = _ReducerOutputs(obj._args[0] if obj._args else obj._kwargs.get("reducer"))
+        if outputs == ["count"]:
+            return dict((band, backend.random.randint(0, 10000)) for band in _Bands(obj._parent))
+        if len(outputs) <= 1:
+            return dict((band, backend.random.uniform(-0.1, 0.1)) for band in _Bands(obj._parent))
+        return _ReducerResult(backend, _Bands(obj._parent), outputs)
+    if obj._name == "aggregate_array":
+        start, end = _Years(obj)
+        first = (datetime.datetime(start, 1, 1) - datetime.datetime(1970, 1, 1)).total_seconds()
+        last = (datetime.datetime(end + 1, 1, 1) - datetime.datetime(1970, 1, 1)).total_seconds()
+        values = []
+        for _ in range(backend.random.randint(*backend.collection_size)):
+            seconds = int(backend.random.uniform(first, last))
+            doy = (seconds % (365 * 24 * 60 * 60)) / (24 * 60 * 60.0)
+            ndvi = 0.5 + 0.3 * math.sin(2 * math.pi * (doy - 100) / 365) + backend.random.gauss(0, 0.05)
+            values.append([seconds, ndvi])
+        return sorted(values)
+    return None
+
+
+def _Features(obj):
+    """Returns the properties of the features of an ee.FeatureCollection created from a list of ee.Feature."""
+    if not isinstance(obj, _Object) or not obj._args or not isinstance(obj._args[0], list):
+        return []
+    return [dict(f._args[1]) if len(f._args) > 1 else {} for f in obj._args[0] if isinstance(f, _Object)]
+
+
+def _Table(obj):
+    """Returns the rows of a plausible NDVI time series table of the points in the graph of the object."""
+    backend = obj._backend
+    start, end = _Years(obj)
+    points = []
+    stack = [obj]
+    seen = set()
+    while stack:
+        o = stack.pop()
+        if not isinstance(o, _Object) or id(o) in seen:
+            continue
+        seen.add(id(o))
+        if o._name == "FeatureCollection" and o._parent is None:
+            points.extend(_Features(o))
+        stack.append(o._parent)
+        stack.extend(o._args)
+    rows = []
+    for point in points:
+        for _ in range(backend.random.randint(*backend.collection_size) // 10):
+            date = datetime.date(start, 1, 1) + datetime.timedelta(days=backend.random.randint(0, 365 * (end - start + 1) - 1))
+            ndvi = 0.5 + 0.3 * math.sin(2 * math.pi * (date.timetuple().tm_yday - 100) / 365) + backend.random.gauss(0, 0.05)
+            rows.append(dict(point, date=date.isoformat(), sensor="LANDSAT_8", ndvi=ndvi))
+    return rows
+
+
+def _ReducerResult(backend, bands, outputs):
+    """Returns plausible results <band>_<output> of a combined reducer."""
+    result = {}
+    for band in bands:
+        for output in outputs:
+            if output == "count":
+                value = backend.random.randint(0, 100000)
+            elif output == "histogram":
+                counts = [backend.random.randint(0, 1000) for _ in range(20)]
+                value = {"bucketMin": -0.1, "bucketWidth": 0.01, "histogram": counts, "bucketMeans": [-0.095 + 0.01 * i for i in range(20)]}
+            else:
+                value = backend.random.uniform(-0.1, 0.1)
+            result["%s_%s" % (band, output)] = value
+    return result
+
+
+def _ReducerOutputs(obj):
+    """Returns the output names of a (combined) reducer created by a chain of ee.Reducer calls."""
+    if not isinstance(obj, _Object):
+        return []
+    if obj._name == "combine":
+        return _ReducerOutputs(obj._parent) + _ReducerOutputs(obj._args[0] if obj._args else obj._kwargs.get("reducer2"))
+    if obj._name == "percentile" and obj._args:
+        return ["p%s" % p for p in obj._args[0]]
+    return [obj._name]
+
+
+def _Bands(obj):
+    """Returns the band names of the image that results from the chain of method calls."""
+    if not isinstance(obj, _Object) or obj._parent is None:
+        return []
+    if obj._name == "arrayFlatten":
+        names = [""]
+        for labels in obj._args[0]:
+            names = [(n + "_" + l).lstrip("_") for n in names for l in labels]
+        return names
+    if obj._name == "addBands":
+        return _Bands(obj._parent) + _Bands(obj._args[0])
+    if obj._name == "select" and obj._args and isinstance(obj._args[0], _STRING_TYPES):
+        return [obj._args[0]]
+    if obj._name == "rename" and obj._args:
+        return list(obj._args[0]) if isinstance(obj._args[0], list) else list(obj._args)
+    return _Bands(obj._parent)
+
+
+def _TileScale(obj):
+    """Returns the largest tileScale of the region reductions and samples in the graph of the object (None if there is none)."""
+    scales = []
+    seen = set()
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if not isinstance(o, _Object) or id(o) in seen:
+            continue
+        seen.add(id(o))
+        if o._name in ("reduceRegion", "reduceRegions", "sample"):
+            scales.append(o._kwargs.get("tileScale", 1))
+        stack.append(o._parent)
+        stack.extend(o._args)
+        stack.extend(o._kwargs.values())
+    return max(scales) if scales else None
+
+
+def _Years(obj, default=(2000, 2017)):
+    """Returns the (start, end) years that pass all filterDate calls in the graph of the object."""
+    starts = []
+    ends = []
+    seen = set()
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if not isinstance(o, _Object) or id(o) in seen:
+            continue
+        seen.add(id(o))
+        if o._name == "filterDate" and all(isinstance(a, _STRING_TYPES) for a in o._args[:2]):
+            starts.append(int(str(o._args[0])[:4]))
+            ends.append(int(str(o._args[1])[:4]))
+        stack.append(o._parent)
+        stack.extend(o._args)
+        stack.extend(o._kwargs.values())
+    return (max(starts), min(ends)) if starts else default
+
+
+class _TaskState(object):
+    UNSUBMITTED = "UNSUBMITTED"
+    READY = "READY"
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+    FAILED = "FAILED"
+    CANCEL_REQUESTED = "CANCEL_REQUESTED"
+    CANCELLED = "CANCELLED"
+
+
+def _EarthEngineApi(backend):
+    """Returns the members of the ee module."""
+
+    class Task(object):
+
+        State = _TaskState
+
+        def __init__(self, description, extension=".tif", asset=None, config=None):
+            self.id = None
+            self.description = description
+            self.extension = extension
+            self.asset = asset
+            self.config = config or {}
+
+        def start(self):
+            self.id = sys.modules["ee"].data.startProcessing(backend.NewId("TASK"), {"description": self.description})["taskId"]
+            failed = None
+            if backend.random.random() < backend.failure_rates.get("ee.task", 0):
+                failed = "Simulated task failure."
+            elif backend.Limited(256.0 / self.config.get("shardSize", 256)):
+                failed = "User memory limit exceeded."
+            with backend.lock:
+                backend.ee_tasks[self.id] = {"description": self.description, "extension": self.extension, "asset": self.asset,
+                                             "started": time.time(), "cancelled": False, "failed": failed}
+
+    class ImageExport(object):
+
+        def __call__(self, image=None, description="myExportImageTask", config=None):
+            return Task(description, config=config)
+
+        def toAsset(self, image=None, description="myExportImageTask", assetId=None, **kwargs):
+            return Task(description, asset=assetId)
+
+    class Export(object):
+
+        image = ImageExport()
+
+        @staticmethod
+        def table(collection=None, description="myExportTableTask", config=None):
+            return Task(description, ".csv")
+
+    def computeValue(obj):
+        backend.Call("ee.getInfo")
+        if _TileScale(obj) is not None and backend.Limited(_TileScale(obj)):
+            raise EEException("User memory limit exceeded.")
+        return _Evaluate(obj)
+
+    def getMapId(params):
+        backend.Call("ee.getMapId")
+        return {"mapid": backend.NewId("mapid"), "token": backend.NewId("token")}
+
+    def getDownloadId(params):
+        backend.Call("ee.getDownloadURL")
+        return {"docid": backend.NewId("doc"), "token": backend.NewId("token")}
+
+    def startProcessing(task_id, params):
+        backend.Call("ee.startTask")
+        return {"taskId": task_id}
+
+    def getTaskStatus(task_id):
+        backend.Call("ee.getTaskStatus")
+        with backend.lock:
+            task = backend.ee_tasks[task_id]
+            elapsed = time.time() - task["started"]
+            if task["cancelled"]:
+                state = _TaskState.CANCELLED
+            elif elapsed < backend.export_duration * 0.1:
+                state = _TaskState.READY
+            elif elapsed < backend.export_duration:
+                state = _TaskState.RUNNING
+            elif task["failed"]:
+                state = _TaskState.FAILED
+            else:
+                state = _TaskState.COMPLETED
+                if "file" not in task:
+                    if _DriveUsed(backend) + EXPORT_FILE_BYTES > backend.drive_quota:
+                        state = _TaskState.FAILED
+                        task["failed"] = "Google Drive storage quota exceeded."
+                    else:
+                        task["file"] = _NewFile(backend, task["description"] + task["extension"], EXPORT_FILE_BYTES)
+        status = {"id": task_id, "state": state, "description": task["description"]}
+        if state == _TaskState.RUNNING:
+            status["progress"] = round((elapsed / backend.export_duration - 0.1) / 0.9, 1)
+        if state == _TaskState.FAILED:
+            status["error_message"] = task["failed"]
+        return [status]
+
+    def getList(params):
+        # the assets of the export tasks that completed
+        backend.Call("ee.getList")
+        now = time.time()
+        with backend.lock:
+            return [{"type": "Image", "id": task["asset"]} for task in backend.ee_tasks.values()
+                    if task["asset"] is not None and task["asset"].startswith(params["id"] + "/") and not task["cancelled"]
+                    and not task["failed"] and now - task["started"] >= backend.export_duration]
+
+    def cancelTask(task_id):
+        backend.Call("ee.cancelTask")
+        with backend.lock:
+            backend.ee_tasks[task_id]["cancelled"] = True
+
+    def toJSON(obj, opt_pretty=False):
+        # the graph is not encoded, the object is kept in the backend like a serialized graph in a memcache entry
+        reference = backend.NewId("graph")
+        with backend.lock:
+            backend.objects[reference] = obj
+        return json.dumps({"graph": reference})
+
+    def fromJSON(json_obj):
+        with backend.lock:
+            return backend.objects[json.loads(json_obj)["graph"]]
+
+    def namespace(name):
+        return _Object(backend, name)
+
+    members = dict((name, namespace(name)) for name in (
+        "Algorithms", "Array", "Date", "Dictionary", "Feature", "FeatureCollection", "Filter",
+        "Geometry", "Image", "ImageCollection", "List", "Number", "Reducer", "String"))
+    members.update({
+        "Initialize": lambda credentials=None, opt_url=None: None,
+        "EEException": EEException,
+        "batch": _Namespace(Export=Export, Task=Task),
+        "serializer": _Namespace(toJSON=toJSON),
+        "deserializer": _Namespace(fromJSON=fromJSON),
+        "data": _Namespace(computeValue=computeValue, getMapId=getMapId, getDownloadId=getDownloadId, startProcessing=startProcessing,
+                           getTaskStatus=getTaskStatus, cancelTask=cancelTask, getList=getList, setDeadline=lambda milliseconds: None),
+    })
+    return members
+
+
+class _Namespace(object):
+    def __init__(self, **members):
+        self.__dict__.update(members)
+
+
+###############################################################################
+#                                Google Drive.                                #
+###############################################################################
+
+def _NewFile(backend, title, size=None):
+    """Adds a file to the fake Drive. Has to be called with the backend lock."""
+    backend._ids += 1
+    file_id = "file%06d" % backend._ids
+    f = {"id": file_id, "title": title, "createdDate": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+         "webContentLink": "https://docs.google.com/uc?id=%s&export=download" % file_id, "parents": []}
+    if size is not None:
+        f["fileSize"] = str(size)
+    backend.files[file_id] = f
+    return f
+
+
+def _DriveUsed(backend):
+    """Returns the bytes used in the fake Drive. Has to be called with the backend lock."""
+    return sum(int(f.get("fileSize", 0)) for f in backend.files.values())
+
+
+class _MediaUpload(object):
+    def __init__(self, body, mimetype=None, **kwargs):
+        self.data = body
+        self.mimetype = mimetype
+
+
+class _Request(object):
+
+    def __init__(self, backend, function):
+        self.backend = backend
+        self.function = function
+
+    def execute(self):
+        self.backend.Call("drive")
+        with self.backend.lock:
+            return self.function()
+
+
+class _DriveService(object):
+
+    """A fake of the resources of the Drive v2 API that are used by the DriveHelper."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        backend = self.backend
+        files = backend.files
+
+        class Files(object):
+            def list(self, q=""):
+                m = re.match(r"title contains '(.*)'", q or "")
+                return _Request(backend, lambda: {"items": [dict(f) for f in files.values() if m is None or m.group(1) in f["title"]]})
+
+            def get(self, fileId, acknowledgeAbuse=False):
+                return _Request(backend, lambda: dict(files[fileId]))
+
+            def delete(self, fileId):
+                return _Request(backend, lambda: files.pop(fileId) and None)
+
+            def insert(self, body, media_body=None):
+                size = len(media_body.data) if media_body is not None else None
+                return _Request(backend, lambda: dict(_NewFile(backend, body["title"], size)))
+
+            def update(self, fileId, body):
+                def update():
+                    files[fileId].update(body)
+                    return dict(files[fileId])
+                return _Request(backend, update)
+
+        return Files()
+
+    def permissions(self):
+        backend = self.backend
+
+        class Permissions(object):
+            def insert(self, fileId, body):
+                return _Request(backend, lambda: dict(body, id="anyoneWithLink"))
+
+        return Permissions()
+
+    def about(self):
+        backend = self.backend
+
+        class About(object):
+            def get(self):
+                return _Request(backend, lambda: {"quotaBytesTotal": str(backend.drive_quota), "quotaBytesUsed": str(_DriveUsed(backend))})
+
+        return About()
@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+"""Load test for the NDVI Time Series Tool.
+
+Simulates browser clients that run realistic sessions against the WSGI app:
+load the main page, compute the map for varied options, request a chart and
+start (and sometimes cancel) an export. EE, Drive, Firebase and the App Engine
+APIs are replaced by the fakes of fakebackend.py, whose latencies and failure
+rates can be configured. With --emulator the EE requests are computed by the
+local emulator (see eemulator) instead, so their latencies are real. With
+--tile-proxy the clients load the tiles of their maps through the tile proxy
+of the app (see tiles.py) and some views repeat the options of earlier views.
+With --chart-prefetch the clients prefetch the series of their chart when they
+place the marker (see ChartPrefetchHandler). With --scrub-rate the clients
+request the maps of other year ranges in quick succession before some maps
+and abandon them (see supersession.py).
+
+The requests are served by a pool of simulated instances. Like App Engine with
+"threadsafe: false" each instance handles one request at a time, so requests
+wait in a queue when all instances are busy. The Task Queue tasks (chart, map
+and export runners) are served by the same pool.
+
+The report contains per route the throughput, the latency percentiles and the
+queueing delay, the outbound calls to the fake services and the
+instance-equivalent concurrency (busy instance seconds per second).
+
+Usage:
+    python tools/loadtest.py --clients 20 --duration 120 --instances 4
+    python tools/loadtest.py --latency ee.getInfo=3 --failure ee.getMapId=0.05 --json report.json
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import fakebackend
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# The points of interest the simulated clients choose from [<longitude>,<latitude>]
+POINTS = [[9.93, 51.53], [13.40, 52.52], [-74.00, 40.71], [-122.42, 37.77], [-112.07, 33.45],
+          [-47.93, -15.78], [36.82, -1.29], [77.21, 28.61], [116.40, 39.90], [151.21, -33.87]]
+
+# The regression types weighted by how often they are used
+REGRESSIONS = ["poly1", "poly1", "poly1", "poly2", "poly3", "zhuWood"]
+SOURCES = ["all", "all", "land5", "land7", "land8"]
+
+# The maximum seconds a client waits for an async result (chart, full map, export)
+ASYNC_TIMEOUT = 600
+
+# The tiles per side of the block around the point that a client loads of a map (with --tile-proxy)
+TILES_PER_SIDE = 3
+
+
+class Recorder(object):
+
+    """Collects the timings of the served requests and of the async results."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.busy = 0.0
+        self.inflight = 0
+        self.peak = 0
+
+    def Start(self):
+        with self.lock:
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+
+    def Add(self, route, latency, queued=0.0, service=None, error=False):
+        with self.lock:
+            self.samples.setdefault(route, []).append((latency, queued, error))
+            if service is not None:
+                self.busy += service
+                self.inflight -= 1
+
+    def Report(self, wall, backend, instances):
+        """Returns the results as json encodable dict."""
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            latencies = sorted(s[0] for s in samples)
+            queued = sorted(s[1] for s in samples)
+            routes[route] = {
+                "count": len(samples),
+                "errors": sum(1 for s in samples if s[2]),
+                "throughput": len(samples) / wall,
+                "p50": Percentile(latencies, 50),
+                "p95": Percentile(latencies, 95),
+                "p99": Percentile(latencies, 99),
+                "queue_p50": Percentile(queued, 50),
+                "queue_p95": Percentile(queued, 95),
+            }
+        calls = {}
+        for service, (count, seconds, failures) in sorted(backend.calls.items()):
+            calls[service] = {"count": count, "failures": failures, "mean": seconds / count if count else 0}
+        return {
+            "wall": wall,
+            "instances": instances or None,
+            "concurrency": self.busy / wall,
+            "peak": self.peak,
+            "routes": routes,
+            "calls": calls,
+        }
+
+
+class InstancePool(object):
+
+    """Serves WSGI requests with a fixed number of single threaded instances (0 for unlimited)."""
+
+    def __init__(self, app, instances, recorder):
+        self.app = app
+        self.instances = instances
+        self.recorder = recorder
+        self.queue = queue.Queue()
+        self.pending = 0
+        self.idle = threading.Condition()
+        for _ in range(instances):
+            worker = threading.Thread(target=self._Work)
+            worker.daemon = True
+            worker.start()
+
+    def Submit(self, method, path, params=None, background=False):
+        """Serves a request.
+
+        Args:
+            method: GET or POST
+            path: the url path (with query for GET requests)
+            params: a dict of POST parameters
+            background: if True the request is a Task Queue task and the call returns immediately
+
+        Returns:
+            A tuple (<status code>, <body>) or None for background requests.
+        """
+        item = {"method": method, "path": path, "params": params, "submitted": time.time(),
+                "done": threading.Event(), "background": background}
+        with self.idle:
+            self.pending += 1
+        if self.instances:
+            self.queue.put(item)
+        else:
+            worker = threading.Thread(target=self._Serve, args=(item,))
+            worker.daemon = True
+            worker.start()
+        if background:
+            return None
+        item["done"].wait()
+        return item["result"]
+
+    def Drain(self, timeout):
+        """Waits until all requests (including the Task Queue tasks) are served."""
+        end = time.time() + timeout
+        with self.idle:
+            while self.pending and time.time() < end:
+                self.idle.wait(end - time.time())
+            return self.pending
+
+    def _Work(self):
+        while True:
+            self._Serve(self.queue.get())
+
+    def _Serve(self, item):
+        import webapp2
+
+        started = time.time()
+        self.recorder.Start()
+        if item["method"] == "POST":
+            request = webapp2.Request.blank(item["path"], POST=item["params"])
+        else:
+            request = webapp2.Request.blank(item["path"])
+        try:
+            response = request.get_response(self.app)
+            result = (response.status_int, response.body)
+        except Exception as e:
+            result = (500, str(e))
+        finished = time.time()
+
+        error = result[0] >= 400 or result[1].startswith(b'{"error"')
+        route = "%s %s" % (item["method"], re.sub(r"^/tiles/.*", "/tiles", item["path"].split("?")[0]))
+        self.recorder.Add(route, finished - item["submitted"], started - item["submitted"], finished - started, error)
+
+        item["result"] = result
+        item["done"].set()
+        with self.idle:
+            self.pending -= 1
+            self.idle.notify_all()
+
+
+class Client(threading.Thread):
+
+    """A simulated browser client that runs sessions until the stop event is set."""
+
+    def __init__(self, number, pool, backend, recorder, stop, args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.backend = backend
+        self.recorder = recorder
+        self.stop = stop
+        self.args = args
+        self.random = random.Random(None if args.seed is None else args.seed + number)
+        self.client_id = None
+        self.requests = 0
+
+    # the map options of all clients, which are repeated by later views
+    views = []
+    views_lock = threading.Lock()
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                self.Session()
+            except Exception:
+                logging.exception("Session failed.")
+
+    def Session(self):
+        """Loads the page, computes 1-3 maps, requests a chart and maybe exports a file."""
+        status, body = self.pool.Submit("GET", "/")
+        m = re.search(r'ntst\.boot\("([^"]+)"', body.decode("utf-8") if isinstance(body, bytes) else body)
+        if m is None:
+            return
+        self.client_id = m.group(1)
+
+        for _ in range(self.random.randint(1, 3)):
+            if self.stop.is_set():
+                return
+            self.Think()
+            options = self.ViewOptions()
+            if self.random.random() < self.args.scrub_rate:
+                self.Scrub(options)
+            self.MapId(options)
+
+        # with --chart-prefetch the series of the chart is prefetched when the marker is placed, before the think time
+        options = self.Options()
+        if self.args.chart_prefetch:
+            self.pool.Submit("POST", "/chartprefetch", dict(options, region="null"))
+        self.Think()
+        self.Chart(options)
+
+        if self.random.random() < self.args.export_rate and not self.stop.is_set():
+            self.Think()
+            self.Export(self.Options())
+
+    def Options(self):
+        point = self.random.choice(POINTS)
+        point = [point[0] + self.random.uniform(-0.2, 0.2), point[1] + self.random.uniform(-0.2, 0.2)]
+        size = self.random.uniform(0.02, 0.3)
+        region = [[point[0] - size, point[1] - size], [point[0] + size, point[1] - size],
+                  [point[0] + size, point[1] + size], [point[0] - size, point[1] + size]]
+        start = self.random.randint(1985, 2016)
+        self.requests += 1
+        return {
+            "regression": self.random.choice(REGRESSIONS),
+            "source": self.random.choice(SOURCES),
+            "start": str(start),
+            "end": str(min(start + self.random.randint(0, 5), 2018)),
+            "cloudscore": str(self.random.randint(10, 60)),
+            "cloudmask": "qa" if self.random.random() < 0.2 else "score",
+            "point": json.dumps(point),
+            "region": json.dumps(region),
+            "filename": "loadtest_%s_%s" % (self.client_id, self.requests),
+            "client_id": self.client_id,
+        }
+
+    def ViewOptions(self):
+        """Returns the options of a map, which repeat the options of an earlier view of any client with the repeat rate."""
+        with Client.views_lock:
+            if Client.views and self.random.random() < self.args.repeat_rate:
+                return dict(self.random.choice(Client.views), client_id=self.client_id)
+            options = self.Options()
+            Client.views.append(options)
+            return options
+
+    def Think(self):
+        if self.args.think > 0:
+            self.stop.wait(self.random.expovariate(1.0 / self.args.think))
+
+    def MapId(self, options):
+        layer_request = "%s:%s" % (self.client_id, self.requests)
+        zoom = self.random.randint(6, 14)
+        params = dict(options, preview="true" if self.args.preview else "false",
+                      zoom=str(zoom), layer_request=layer_request)
+        start = self.backend.MessageCount(self.client_id)
+        submitted = time.time()
+        status, body = self.pool.Submit("POST", "/mapid", params)
+        if status != 200:
+            return
+        result = json.loads(body)
+        self.Tiles(result.get("bands"), json.loads(options["point"]), zoom)
+        if result.get("preview"):
+            message = self.Await("layer (full map)", submitted, start,
+                                 lambda m: m["id"] == "layer" and (m.get("data") or {}).get("layer_request") == layer_request or
+                                 m["id"] == "layer" and m["style"] == "danger")
+            if message is not None and message.get("data"):
+                self.Tiles(message["data"]["bands"], json.loads(options["point"]), zoom)
+
+    def Scrub(self, options):
+        """Requests the maps of 1-3 other year ranges in quick succession and abandons them, like a client scrubbing through the years."""
+        for _ in range(self.random.randint(1, 3)):
+            start = self.random.randint(1985, 2016)
+            self.requests += 1
+            params = dict(options, start=str(start), end=str(min(start + self.random.randint(0, 5), 2018)),
+                          preview="true" if self.args.preview else "false", zoom="10", layer_request="%s:%s" % (self.client_id, self.requests))
+            self.pool.Submit("POST", "/mapid", params, background=True)
+            self.stop.wait(0.3)
+
+    def Tiles(self, bands, point, zoom):
+        """Loads the tiles of the first band around the point like the map of the browser, if they are served by the tile proxy."""
+        if not bands or "url" not in bands[0]:
+            return
+        n = 2 ** zoom
+        lat = math.radians(point[1])
+        x = int((point[0] + 180.0) / 360.0 * n)
+        y = int((1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n)
+        for dx in range(-(TILES_PER_SIDE // 2), TILES_PER_SIDE // 2 + 1):
+            for dy in range(-(TILES_PER_SIDE // 2), TILES_PER_SIDE // 2 + 1):
+                self.pool.Submit("GET", "%s/%s/%s/%s/%s" % (bands[0]["url"], bands[0]["mapid"], zoom, (x + dx) % n, min(max(y + dy, 0), n - 1)))
+
+    def Chart(self, options):
+        start = self.backend.MessageCount(self.client_id)
+        submitted = time.time()
+        status, body = self.pool.Submit("POST", "/chart", options)
+        if status == 200:
+            self.Await("chart (result)", submitted, start,
+                       lambda m: m["id"] == "chart-" + options["filename"] and _State(m) in ("completed", "failed"))
+
+    def Export(self, options):
+        start = self.backend.MessageCount(self.client_id)
+        submitted = time.time()
+        status, body = self.pool.Submit("POST", "/export", options)
+        if status != 200 or body:
+            return
+
+        def done(m):
+            return m["id"] == "export-" + options["filename"] and _State(m) in ("completed", "failed", "cancelled")
+
+        def cancellable(m):
+            return m["id"] == "export-" + options["filename"] and _State(m) in ("queued", "running") and "id" in m["job"]
+
+        if self.random.random() < self.args.cancel_rate:
+            # wait for a message of the queued or running export and cancel it like the cancel link of the client
+            message, start = self.backend.WaitForMessage(
+                self.client_id, lambda m: done(m) or cancellable(m), ASYNC_TIMEOUT, start)
+            if message is not None and not done(message):
+                self.Think()
+                param = "job" if _State(message) == "queued" else "task"
+                self.pool.Submit("GET", "/clean?%s=%s&client_id=%s" % (param, message["job"]["id"], self.client_id))
+        message = self.Await("export (result)", submitted, start, done)
+
+        # the download links point to /file, which records the download (see storage.py)
+        if message is not None and _State(message) == "completed" and self.random.random() < self.args.download_rate:
+            self.Think()
+            for url in message["job"].get("urls") or []:
+                self.pool.Submit("GET", url)
+
+    def Await(self, route, submitted, start, predicate):
+        """Records the time until the async result of a request is sent over Firebase."""
+        message, _ = self.backend.WaitForMessage(self.client_id, predicate, ASYNC_TIMEOUT, start)
+        if message is None:
+            self.recorder.Add(route, time.time() - submitted, error=True)
+        else:
+            self.recorder.Add(route, message["received"] - submitted, error=message["style"] == "danger" if message.get("job") is None else _State(message) == "failed")
+        return message
+
+
+def _State(message):
+    """Returns the state of a job status message (see _SendStatus() of the app) or None."""
+    return (message.get("job") or {}).get("state")
+
+
+def Percentile(values, percent):
+    """Nearest rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def _ParseRates(pairs, name):
+    """Parses service=value arguments into a dict."""
+    rates = {}
+    for pair in pairs or []:
+        service, _, value = pair.partition("=")
+        try:
+            rates[service] = float(value)
+        except ValueError:
+            raise SystemExit("Invalid %s '%s', expected <service>=<number>." % (name, pair))
+    return rates
+
+
+def PrintReport(report):
+    print("Wall time: %.1f s, instances: %s" % (report["wall"], report["instances"] or "unlimited"))
+    print("Instance-equivalent concurrency: %.2f (peak %s concurrent requests)" % (report["concurrency"], report["peak"]))
+    print("")
+    print("%-24s %7s %7s %8s %8s %8s %8s %10s %10s" % ("Route", "count", "errors", "req/s", "p50", "p95", "p99", "queue p50", "queue p95"))
+    for route, r in sorted(report["routes"].items()):
+        print("%-24s %7d %7d %8.2f %8.2f %8.2f %8.2f %10.2f %10.2f" % (
+            route, r["count"], r["errors"], r["throughput"], r["p50"], r["p95"], r["p99"], r["queue_p50"], r["queue_p95"]))
+    print("")
+    print("%-24s %7s %9s %9s" % ("Outbound call", "count", "failures", "mean (s)"))
+    for service, c in sorted(report["calls"].items()):
+        print("%-24s %7d %9d %9.3f" % (service, c["count"], c["failures"], c["mean"]))
+
+
+def AddBackendArguments(parser):
+    """Adds the arguments of the fake backend and the instance pool to the parser."""
+    parser.add_argument("--instances", type=int, default=0, help="number of single threaded instances (0 unlimited)")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=SECONDS", help="mean latency of a fake service")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="factor for all latencies")
+    parser.add_argument("--failure", action="append", metavar="SERVICE=RATE", help="failure rate of a fake service")
+    parser.add_argument("--export-duration", type=float, default=30, help="seconds an EE export task runs")
+    parser.add_argument("--poll-frequency", type=float, default=1, help="seconds between the polls of an export task")
+    parser.add_argument("--drain", type=float, default=120, help="seconds to wait for running requests after the duration")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random generators")
+    parser.add_argument("--capture", metavar="FILE", help="capture all requests of the app to the file (see capture.py)")
+    parser.add_argument("--emulator", action="store_true", help="compute the EE requests with the local emulator instead of the fake (see eemulator)")
+    parser.add_argument("--tile-proxy", action="store_true", help="serve the map tiles through the tile proxy of the app (see tiles.py)")
+    parser.add_argument("--chart-prefetch", action="store_true", help="prefetch the series of a chart when the marker is placed (see ChartPrefetchHandler)")
+    parser.add_argument("--drive-quota", type=float, default=15 * 1024, help="quota of the fake Drive (MB), an export fails if its file does not fit")
+    parser.add_argument("--drive-retention", type=float, default=None, help="minimum seconds an exported file is kept if the Drive is full (see storage.py)")
+    parser.add_argument("--json", metavar="FILE", help="write the report as json to the file")
+    parser.add_argument("--verbose", action="store_true", help="show the log messages of the app")
+
+
+def StartApp(args, recorder):
+    """Installs the fake backend, imports the app and creates the instance pool.
+
+    Returns:
+        A tuple (<fakebackend.Backend>, <InstancePool>).
+    """
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    for name in ("json", "capture"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    latencies = dict(fakebackend.DEFAULT_LATENCIES)
+    latencies.update(_ParseRates(args.latency, "latency"))
+    latencies = dict((service, seconds * args.latency_scale) for service, seconds in latencies.items())
+
+    backend = fakebackend.Backend(latencies=latencies, failure_rates=_ParseRates(args.failure, "failure rate"),
+                                  seed=args.seed, export_duration=args.export_duration, drive_quota=int(args.drive_quota * 1024 * 1024))
+    backend.Install()
+
+    # the app reads its templates relative to the working directory
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    if args.capture:
+        import config
+        config.CAPTURE_RATE = 1
+        config.CAPTURE_FILE = args.capture
+    if args.emulator:
+        import config
+        config.EE_EMULATOR = True
+    if args.tile_proxy:
+        import config
+        config.TILE_PROXY = True
+    if args.chart_prefetch:
+        import config
+        config.CHART_PREFETCH = True
+    import server
+    server.TASK_POLL_FREQUENCY = args.poll_frequency
+    if args.drive_retention is not None:
+        server.STORAGE.retention = args.drive_retention
+    if args.emulator:
+        # the exports of the emulator are found by the app in the fake Drive
+        server.ee.Configure(exported=lambda path: backend.AddFile(os.path.basename(path), os.path.getsize(path)))
+
+    pool = InstancePool(server.app, args.instances, recorder)
+    backend.dispatch = lambda url, params: pool.Submit("POST", url, params, background=True)
+    return backend, pool
+
+
+def Finish(args, started, backend, pool, recorder):
+    """Waits for the running requests and prints the report."""
+    pending = pool.Drain(args.drain)
+    if pending:
+        print("%s requests were still running after the drain time." % pending)
+
+    report = recorder.Report(time.time() - started, backend, args.instances)
+    PrintReport(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, default=10, help="number of simulated browser clients")
+    parser.add_argument("--duration", type=float, default=60, help="seconds the clients start new requests")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which the clients are started")
+    parser.add_argument("--think", type=float, default=2.0, help="mean think time between the requests of a client (seconds)")
+    parser.add_argument("--export-rate", type=float, default=0.3, help="probability that a session exports a file")
+    parser.add_argument("--cancel-rate", type=float, default=0.3, help="probability that an export is cancelled")
+    parser.add_argument("--no-preview", dest="preview", action="store_false", help="request the full map without preview")
+    parser.add_argument("--repeat-rate", type=float, default=0.5, help="probability that a map repeats the options of an earlier map")
+    parser.add_argument("--scrub-rate", type=float, default=0.0, help="probability that the maps of other year ranges are requested and abandoned before a map")
+    parser.add_argument("--download-rate", type=float, default=0.5, help="probability that a completed export is downloaded")
+    AddBackendArguments(parser)
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    backend, pool = StartApp(args, recorder)
+
+    stop = threading.Event()
+    clients = [Client(i, pool, backend, recorder, stop, args) for i in range(args.clients)]
+    started = time.time()
+    for i, client in enumerate(clients):
+        client.start()
+        if args.clients > 1:
+            time.sleep(args.ramp / (args.clients - 1))
+    stop.wait(max(0, args.duration - (time.time() - started)))
+    stop.set()
+
+    for client in clients:
+        client.join(args.drain)
+    Finish(args, started, backend, pool, recorder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Replays captured requests against the app with the fake backend.
+
+The records are written by the request capture of the app (see capture.py and
+CAPTURE_RATE in config.py), either to a rotating JSONL file or to the
+application log. Lines of a log export are accepted as well, everything before
+the first "{" of a line is ignored.
+
+The requests of the browser clients are sent again with their original
+inter-arrival times (optionally sped up). The Task Queue tasks and the cron job
+are not replayed, the app adds the tasks again. Before the replay the captured
+timings and outbound calls, the sizes of the EE graphs per route, the vertices
+of the drawn and simplified regions and the share of requests with repeated
+options (the hit rate of an unbounded cache of the results) are reported.
+
+Usage:
+    python tools/replay.py capture.jsonl capture.jsonl.1 --speed 4 --instances 4
+"""
+
+import argparse
+import json
+import threading
+import time
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+import loadtest
+
+
+# The routes that are called by App Engine and not by the browser clients
+BACKGROUND_ROUTES = ("/chartrunner", "/chartprefetchrunner", "/exportrunner", "/mapidrunner", "/cron/clean", "/cron/dispatch")
+
+
+def ReadRecords(paths):
+    """Reads the capture records of the files sorted by time."""
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                start = line.find("{")
+                if start < 0:
+                    continue
+                try:
+                    record = json.loads(line[start:])
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "route" in record and "time" in record:
+                    records.append(record)
+    records.sort(key=lambda r: r["time"])
+    return records
+
+
+def PrintCaptured(records):
+    """Prints the captured timings, outbound calls, EE graph sizes, region vertices and repeated options per route."""
+    routes = {}
+    for record in records:
+        routes.setdefault("%s %s" % (record["method"], record["route"]), []).append(record)
+
+    span = records[-1]["time"] + records[-1]["duration"] - records[0]["time"]
+    sessions = len(set(r["client_id"] for r in records if r.get("client_id")))
+    print("Captured: %s requests of %s sessions in %.1f s" % (len(records), sessions, span))
+    print("")
+    print("%-24s %7s %7s %8s %8s %8s %9s %9s" % ("Route", "count", "errors", "p50", "p95", "p99", "distinct", "repeated"))
+    for route, rs in sorted(routes.items()):
+        durations = sorted(r["duration"] for r in rs)
+        keys = [r["key"] for r in rs if r.get("key")]
+        repeated = "%8.1f%%" % (100.0 * (len(keys) - len(set(keys))) / len(keys)) if keys else "%9s" % "-"
+        print("%-24s %7d %7d %8.2f %8.2f %8.2f %9s %s" % (
+            route, len(rs), sum(1 for r in rs if r.get("error") or r["status"] != 200),
+            loadtest.Percentile(durations, 50), loadtest.Percentile(durations, 95), loadtest.Percentile(durations, 99),
+            len(set(keys)) if keys else "-", repeated))
+
+    calls = {}
+    for record in records:
+        for service, (count, seconds) in record.get("calls", {}).items():
+            call = calls.setdefault(service, [0, 0.0])
+            call[0] += count
+            call[1] += seconds
+    print("")
+    print("%-24s %7s %9s %9s" % ("Captured call", "count", "per req.", "mean (s)"))
+    for service, (count, seconds) in sorted(calls.items()):
+        print("%-24s %7d %9.2f %9.3f" % (service, count, float(count) / len(records), seconds / count if count else 0))
+    print("")
+
+    # the serialized EE graphs sent per request (records of older captures have none)
+    print("%-24s %7s %9s %9s %9s" % ("EE graphs", "count", "per req.", "KB/req.", "nodes/req"))
+    for route, rs in sorted(routes.items()):
+        graphs = [graph for r in rs for graph in r.get("graphs", {}).values()]
+        if graphs:
+            print("%-24s %7d %9.2f %9.1f %9.1f" % (route, sum(g[0] for g in graphs), float(sum(g[0] for g in graphs)) / len(rs),
+                                                   sum(g[1] for g in graphs) / 1024.0 / len(rs), float(sum(g[2] for g in graphs)) / len(rs)))
+    print("")
+
+    # the vertices of the drawn and the simplified regions (see polygons.py)
+    vertices = [r["region_vertices"] for r in records if r.get("region_vertices")]
+    if vertices:
+        drawn, simplified = sorted(v[0] for v in vertices), sorted(v[1] for v in vertices)
+        print("%-24s %7s %9s %9s %9s" % ("Region vertices", "count", "p50", "p95", "max"))
+        print("%-24s %7d %9d %9d %9d" % ("drawn", len(drawn), loadtest.Percentile(drawn, 50), loadtest.Percentile(drawn, 95), drawn[-1]))
+        print("%-24s %7d %9d %9d %9d" % ("simplified", len(simplified), loadtest.Percentile(simplified, 50),
+                                          loadtest.Percentile(simplified, 95), simplified[-1]))
+        print("")
+
+
+def _Request(record):
+    """Returns the method, path and POST parameters of a captured request."""
+    params = dict((k, v.encode("utf-8") if not isinstance(v, str) else v) for k, v in record.get("params", {}).items())
+    if record["method"] == "POST":
+        return "POST", record["route"], params
+    return record["method"], record["route"] + ("?" + urlencode(params) if params else ""), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("captures", nargs="+", help="capture files (JSONL or log exports)")
+    parser.add_argument("--speed", type=float, default=1.0, help="factor for the replay speed (2 halves the inter-arrival times)")
+    parser.add_argument("--sessions", type=int, default=None, help="only replay the first sessions (by client id)")
+    parser.add_argument("--dry-run", action="store_true", help="only report the captured requests")
+    loadtest.AddBackendArguments(parser)
+    args = parser.parse_args()
+
+    records = [r for r in ReadRecords(args.captures) if r["route"] not in BACKGROUND_ROUTES]
+    if args.sessions is not None:
+        clients = []
+        for record in records:
+            if record.get("client_id") and record["client_id"] not in clients:
+                clients.append(record["client_id"])
+        clients = set(clients[:args.sessions])
+        records = [r for r in records if r.get("client_id") in clients]
+    if not records:
+        raise SystemExit("No captured requests found.")
+
+    PrintCaptured(records)
+    if args.dry_run:
+        return
+
+    recorder = loadtest.Recorder()
+    backend, pool = loadtest.StartApp(args, recorder)
+
+    first = records[0]["time"]
+    started = time.time()
+    threads = []
+    for record in records:
+        delay = started + (record["time"] - first) / args.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=pool.Submit, args=_Request(record))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join(args.drain)
+    print("Replay:")
+    loadtest.Finish(args, started, backend, pool, recorder)
+
+
+if __name__ == "__main__":
+    main()
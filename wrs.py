@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""A local spatial index of the Landsat Worldwide Reference System (WRS-2).
+
+The footprints of the WRS-2 path/row scenes are derived from the nominal orbit
+of Landsat 5, 7 and 8 (233 paths, 248 rows, 98.2 degrees inclination, path 1
+crossing the equator at 64.60 degrees west on the descending node).
+They are computed once per instance and stored in latitude bands, so that a
+point or polygon can be turned into its path/row pairs without asking EE for a
+geometric intersection against all scene footprints.
+"""
+
+import math
+
+
+# The number of WRS-2 paths and rows
+PATHS = 233
+ROWS = 248
+
+# The row whose scene center lies on the equator (descending node)
+EQUATOR_ROW = 60
+
+# The last row with daytime scenes. Rows 1 to 122 are acquired north to south,
+# Antarctic scenes continue behind the pole up to row 133. The other rows lie on
+# the ascending (night) part of the orbit and are not indexed.
+LAST_DAYTIME_ROW = 133
+
+# The longitude of the descending node of path 1 (degrees)
+PATH1_LONGITUDE = -64.60
+
+# The inclination of the orbit (degrees)
+INCLINATION = 98.2
+
+# The westward shift of the ground track during one orbit (degrees), 233 orbits in 16 days
+ORBIT_SHIFT = 360.0 * 16 / PATHS
+
+# Earth radius (km) and squared eccentricity of the WGS84 ellipsoid
+EARTH_RADIUS = 6371.0
+ECCENTRICITY2 = 0.00669438
+
+# The nominal size of a scene (km) plus a safety margin for the orbit model and scene center shifts
+SCENE_HALF_WIDTH = 185.0 / 2 + 15
+SCENE_HALF_LENGTH = 180.0 / 2 + 15
+
+
+class WrsIndex(object):
+
+    """A grid index that maps geometries to the WRS-2 path/row pairs that overlap them.
+
+    All paths share the same footprints shifted by 360/233 degrees of longitude,
+    so only the footprints of path 1 are stored in latitude bands. The paths of a
+    row that may overlap a geometry are then derived from its longitude range.
+    """
+
+    def __init__(self, cell_size=1.0):
+        """Creates the index.
+
+        Args:
+            cell_size: The height of a latitude band in degrees.
+        """
+        self.cell_size = cell_size
+
+        # footprints of path 1 keyed by row and the rows that overlap each latitude band
+        self._templates = {}
+        self._bands = {}
+        for row in range(1, LAST_DAYTIME_ROW + 1):
+            footprint = _Footprint(1, row)
+            lons = [c[0] for c in footprint]
+            lats = [c[1] for c in footprint]
+            self._templates[row] = (footprint, min(lons), max(lons))
+            for band in range(self._Band(min(lats)), self._Band(max(lats)) + 1):
+                self._bands.setdefault(band, []).append(row)
+
+
+    def PathRowsForPoint(self, point):
+        """Returns the path/row pairs whose footprint contains the point.
+
+        Args:
+            point: [<longitude>,<latitude>]
+
+        Returns:
+            A sorted list of (path, row) tuples.
+        """
+        lon, lat = point
+        result = []
+        for row in self._bands.get(self._Band(lat), ()):
+            for path, footprint in self._Candidates(row, lon, lon):
+                if _PointInRing(_Unwrap(lon, footprint), lat, footprint):
+                    result.append((path, row))
+        return sorted(result)
+
+
+    def PathRowsForPolygon(self, polygon):
+        """Returns the path/row pairs whose footprint intersects the polygon.
+
+        Args:
+            polygon: [[<longitude>,<latitude>],[<longitude>,<latitude>],...]
+
+        Returns:
+            A sorted list of (path, row) tuples.
+        """
+        # make the longitudes continuous if the polygon crosses the antimeridian
+        ring = [list(polygon[0])]
+        for c in polygon[1:]:
+            ring.append([_Unwrap(c[0], [ring[-1]]), c[1]])
+        lons = [c[0] for c in ring]
+        lats = [c[1] for c in ring]
+
+        rows = set()
+        for band in range(self._Band(min(lats)), self._Band(max(lats)) + 1):
+            rows.update(self._bands.get(band, ()))
+
+        result = []
+        for row in rows:
+            for path, footprint in self._Candidates(row, min(lons), max(lons)):
+                # shift the polygon next to the footprint
+                shift = _Unwrap(ring[0][0], footprint) - ring[0][0]
+                if _RingsIntersect([[c[0] + shift, c[1]] for c in ring], footprint):
+                    result.append((path, row))
+        return sorted(result)
+
+
+    def PathRows(self, point=None, region=None):
+        """Returns the union of the path/row pairs of a point and a polygon.
+
+        Args:
+            point: [<longitude>,<latitude>] or None
+            region: [[<longitude>,<latitude>],...] or None
+
+        Returns:
+            A sorted list of (path, row) tuples.
+        """
+        result = set()
+        if point is not None:
+            result.update(self.PathRowsForPoint(point))
+        if region is not None:
+            result.update(self.PathRowsForPolygon(region))
+        return sorted(result)
+
+
+    def Footprint(self, path, row):
+        """Returns the footprint of a scene as a closed ring [[<longitude>,<latitude>],...].
+
+        The longitudes of a footprint that crosses the antimeridian are continuous (may exceed 180).
+        """
+        return _Shift(self._templates[row][0], path)
+
+
+    def _Band(self, lat):
+        return int(math.floor(lat / self.cell_size))
+
+
+    def _Candidates(self, row, min_lon, max_lon):
+        """Yields the (path, footprint) pairs of a row whose longitude range overlaps [min_lon, max_lon]."""
+        footprint, template_min, template_max = self._templates[row]
+        spacing = 360.0 / PATHS
+        # path p covers [template_min, template_max] - (p - 1) * spacing (modulo 360)
+        first = int(math.ceil((template_min - max_lon) / spacing))
+        last = int(math.floor((template_max - min_lon) / spacing))
+        for k in range(first, last + 1):
+            path = k % PATHS + 1
+            yield path, _Shift(footprint, path)
+
+
+def _GroundPoint(path, u, cross):
+    """Returns the ground point [<longitude>,<latitude>] of the satellite.
+
+    Args:
+        path: The WRS-2 path.
+        u: The angle along the orbit since the descending node (radians).
+        cross: The angle perpendicular to the orbit (radians), positive to the east of the ground track.
+    """
+    inclination = math.radians(INCLINATION)
+
+    # position on the unit sphere in a frame where the descending node lies on the x axis
+    x = math.cos(u)
+    y = math.cos(inclination) * math.sin(u)
+    z = -math.sin(inclination) * math.sin(u)
+
+    # move perpendicular to the orbit plane (the normal points to the east of the descending track)
+    nx, ny, nz = 0.0, math.sin(inclination), math.cos(inclination)
+    x = math.cos(cross) * x + math.sin(cross) * nx
+    y = math.cos(cross) * y + math.sin(cross) * ny
+    z = math.cos(cross) * z + math.sin(cross) * nz
+
+    latitude = math.atan2(z, math.sqrt(x * x + y * y))
+    # geocentric to geodetic latitude
+    latitude = math.degrees(math.atan(math.tan(latitude) / (1 - ECCENTRICITY2)))
+
+    node = PATH1_LONGITUDE - (path - 1) * 360.0 / PATHS
+    longitude = node + math.degrees(math.atan2(y, x)) - ORBIT_SHIFT * math.degrees(u) / 360.0
+    return [longitude, latitude]
+
+
+def _Footprint(path, row):
+    """Returns the footprint of a scene as a closed ring with continuous longitudes."""
+    u = math.radians((row - EQUATOR_ROW) * 360.0 / ROWS)
+    du = SCENE_HALF_LENGTH / EARTH_RADIUS
+    dc = SCENE_HALF_WIDTH / EARTH_RADIUS
+
+    ring = [_GroundPoint(path, u - du, -dc), _GroundPoint(path, u - du, dc),
+            _GroundPoint(path, u + du, dc), _GroundPoint(path, u + du, -dc)]
+
+    # normalize the longitudes to the one of the scene center
+    center = (_GroundPoint(path, u, 0)[0] + 180) % 360 - 180
+    for c in ring:
+        c[0] = center + (c[0] - center + 180) % 360 - 180
+    ring.append(list(ring[0]))
+    return ring
+
+
+def _Shift(footprint, path):
+    """Moves a footprint of path 1 to the given path."""
+    shift = -(path - 1) * 360.0 / PATHS
+    center = footprint[0][0] + shift
+    shift = shift + ((center + 180) % 360 - 180) - center
+    return [[c[0] + shift, c[1]] for c in footprint]
+
+
+def _Unwrap(lon, ring):
+    """Returns lon shifted by a multiple of 360 degrees to be next to the ring."""
+    reference = ring[0][0]
+    return reference + (lon - reference + 180) % 360 - 180
+
+
+def _PointInRing(x, y, ring):
+    """Ray casting point in polygon test."""
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _SegmentsIntersect(a, b, c, d):
+    """Checks if the segments a-b and c-d intersect."""
+    def orientation(p, q, r):
+        return (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+    d1 = orientation(c, d, a)
+    d2 = orientation(c, d, b)
+    d3 = orientation(a, b, c)
+    d4 = orientation(a, b, d)
+    return ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0))
+
+
+def _RingsIntersect(ring1, ring2):
+    """Checks if two polygons overlap (a vertex lies in the other polygon or two edges cross)."""
+    if _PointInRing(ring1[0][0], ring1[0][1], ring2) or _PointInRing(ring2[0][0], ring2[0][1], ring1):
+        return True
+    for i in range(len(ring1)):
+        a, b = ring1[i - 1], ring1[i]
+        for j in range(len(ring2)):
+            if _SegmentsIntersect(a, b, ring2[j - 1], ring2[j]):
+                return True
+    return False